@@ -0,0 +1,281 @@
+"""
+异步API模块 - 只做数据库读取的接口和检测进度的长连接接口的asyncio版本（Quart + motor）
+
+hello.py中大部分GET接口（病历、用户资料、图像列表、检测状态/报告）只是读取MongoDB，
+同步部署时每个请求在等待数据库期间占着一个请求线程；SSE和长轮询连接更是在整个等待期间占着线程，
+gunicorn每个工作进程的线程数（SERVING_REQUEST_THREADS）就是它能同时保持的进度连接数。
+这里用motor异步读取数据库，进度连接等待时只占一个Future（ProgressBroker.wait_async），
+一个进程可以同时保持数千个空闲的进度连接。
+
+其余接口（写入、文件上传、提交检测任务等）仍由hello.py的Flask应用处理，在线程池中执行；
+风险评分和图像推理本来就由检测任务工作线程执行，不在事件循环中运行。
+
+用法:
+    hypercorn -c python:hypercorn_conf async_app:application
+
+生产环境中反向代理只把检测进度接口转发到这里（见hypercorn_conf.py），其余接口由gunicorn多进程部署处理；
+这个部署默认不执行检测任务（ASYNC_EMBEDDED_WORKERS）。
+
+ASYNC_DB_BACKEND为memory时使用async_store.py中的内存替身（不需要MongoDB，用于测试）。
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
+from quart import Quart, Response, jsonify, request
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+
+import config
+import hello
+from async_store import create_async_db
+from detection_status import DetectionStatusStore, LEGACY_REPORT_PROJECTION, STATUS_PROJECTION, status_from_report
+from embedding_store import REPORT_DEFAULT_PROJECTION
+from progress_broker import ProgressBroker, is_terminal
+
+app = Quart(__name__, static_folder=None)
+
+# 在before_serving中创建（motor的客户端要在事件循环中创建）
+db = None
+_job_workers = []
+
+
+@app.before_serving
+async def startup():
+    global db
+    loop = asyncio.get_running_loop()
+    # 转发给Flask应用的请求在默认线程池中执行
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=config.ASYNC_EXECUTOR_THREADS,
+                                                 thread_name_prefix="flask"))
+    db = create_async_db(config.ASYNC_DB_BACKEND, config.MONGO_URI, config.DATABASE_NAME)
+    if config.JOB_EMBEDDED_WORKERS and config.ASYNC_EMBEDDED_WORKERS:
+        # 创建工作线程时会同步创建任务队列索引，放到线程池中执行
+        _job_workers.extend(await loop.run_in_executor(None, hello.create_job_workers))
+        for worker in _job_workers:
+            worker.start()
+
+
+@app.after_serving
+async def shutdown():
+    loop = asyncio.get_running_loop()
+    for worker in _job_workers:
+        await loop.run_in_executor(None, worker.stop, config.SERVING_GRACEFUL_TIMEOUT)
+    _job_workers.clear()
+
+
+@app.after_request
+async def add_cors_headers(response):
+    # 与hello.py中的CORS(app)一致
+    response.headers.setdefault("Access-Control-Allow-Origin", "*")
+    return response
+
+
+# 辅助函数: 用户最近一次检测的状态（hello.latest_detection的异步版本）
+async def latest_detection(user_id):
+    key = DetectionStatusStore.user_key(user_id)
+    status = await db.detection_status.find_one({"_id": key}, STATUS_PROJECTION)
+    if status is not None:
+        return status
+
+    report = await db.reports.find_one({"userId": user_id}, LEGACY_REPORT_PROJECTION, sort=[("createdAt", DESCENDING)])
+    if not report:
+        return None
+    fields = status_from_report(user_id, report)
+    try:
+        await db.detection_status.update_one({"_id": key}, {"$setOnInsert": fields}, upsert=True)
+    except DuplicateKeyError:
+        # 并发的请求已经补写
+        pass
+    return fields
+
+
+async def latest_report(user_id, projection):
+    status = await latest_detection(user_id)
+    if not status or status.get("reportId") is None:
+        return None
+    return await db.reports.find_one({"_id": status["reportId"]}, projection)
+
+
+async def current_detection_state(user_id):
+    event = hello.progress_broker.latest(ProgressBroker.user_key(user_id))
+    if hello.is_fresh_event(event):
+        return event
+    return hello.merge_detection_state(user_id, event, await latest_detection(user_id))
+
+
+async def wait_detection_state(user_id, after, timeout):
+    """hello.wait_detection_state的异步版本"""
+    key = ProgressBroker.user_key(user_id)
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        event = await hello.progress_broker.wait_async(key, after_seq=after,
+                                                       timeout=min(remaining, config.PROGRESS_RECHECK_SECONDS))
+        if event is not None:
+            return event
+        state = hello.merge_detection_state(user_id, hello.progress_broker.latest(key), await latest_detection(user_id))
+        if state is not None and state["seq"] > after:
+            return state
+
+
+@app.route('/api/user/medical-record', methods=['GET'])
+async def get_medical_record():
+    user_id = request.args.get('userId')
+
+    user = await db.users.find_one({"userId": user_id}, {"_id": 0})
+    if not user:
+        return jsonify({"success": False, "message": "用户不存在"}), 404
+
+    report = await latest_report(user_id, REPORT_DEFAULT_PROJECTION)
+    if report:
+        user["report"] = report
+
+    return jsonify({"success": True, "data": user})
+
+
+@app.route('/api/user/profile', methods=['GET'])
+async def get_user_profile():
+    user_id = request.args.get('userId')
+    if not user_id:
+        return jsonify({"success": False, "message": "用户ID不能为空"}), 400
+
+    user = await db.users.find_one({"userId": user_id}, hello.USER_PROFILE_PROJECTION)
+    if not user:
+        return jsonify({"success": False, "message": "用户不存在"}), 404
+
+    hello.enrich_profile_symptoms(user)
+    return jsonify({"success": True, "profile": user})
+
+
+@app.route('/api/user/medical-records', methods=['GET'])
+async def get_medical_records():
+    user_id = request.args.get('userId')
+
+    records = await db.medical_records.find({"userId": user_id}, hello.MEDICAL_RECORDS_PROJECTION).to_list(None)
+    return jsonify({"success": True, "records": hello.format_medical_records(records)})
+
+
+@app.route('/api/medical-image/list', methods=['GET'])
+async def get_medical_images():
+    user_id = request.args.get('userId')
+    if not user_id:
+        return jsonify({"success": False, "message": "用户ID不能为空"}), 400
+
+    query = hello.medical_images_query(user_id, request.args.get('imageType'))
+    images = await db.medical_records.find(query, hello.MEDICAL_IMAGES_PROJECTION).to_list(None)
+    return jsonify({"success": True, "images": hello.format_medical_images(images)})
+
+
+@app.route('/api/detect/status', methods=['GET'])
+async def check_detection_status():
+    user_id = request.args.get('userId')
+
+    state = await current_detection_state(user_id)
+    if not state:
+        return jsonify({"success": False, "message": "未找到检测记录"}), 404
+
+    return jsonify({"success": True, "status": state["status"], "progress": state["progress"]})
+
+
+@app.route('/api/detect/events', methods=['GET'])
+async def stream_detection_events():
+    user_id = request.args.get('userId')
+    if not user_id:
+        return jsonify({"success": False, "message": "用户ID不能为空"}), 400
+
+    state = await current_detection_state(user_id)
+    if not state:
+        return jsonify({"success": False, "message": "未找到检测记录"}), 404
+
+    async def generate(state):
+        deadline = time.monotonic() + config.PROGRESS_STREAM_SECONDS
+        sent = None
+        while True:
+            fields = hello.state_fields(state)
+            if fields != sent:
+                yield hello.sse_progress_message(state, fields).encode()
+                sent = fields
+            else:
+                yield b": keepalive\n\n"
+            if is_terminal(state) or time.monotonic() >= deadline:
+                return
+            timeout = min(config.PROGRESS_KEEPALIVE_SECONDS, deadline - time.monotonic())
+            state = await wait_detection_state(user_id, state["seq"], timeout) or state
+
+    response = Response(generate(state), mimetype="text/event-stream", headers=hello.SSE_HEADERS)
+    # 连接的时长由PROGRESS_STREAM_SECONDS控制，不使用Quart的响应超时
+    response.timeout = None
+    return response
+
+
+@app.route('/api/detect/wait', methods=['GET'])
+async def wait_detection_status():
+    user_id = request.args.get('userId')
+    after = request.args.get('after', -1, type=int)
+    timeout = min(request.args.get('timeout', config.PROGRESS_LONG_POLL_SECONDS, type=float),
+                  config.PROGRESS_LONG_POLL_SECONDS)
+
+    state = await current_detection_state(user_id)
+    if not state:
+        return jsonify({"success": False, "message": "未找到检测记录"}), 404
+
+    if state["seq"] <= after and not is_terminal(state):
+        state = await wait_detection_state(user_id, after, timeout) or state
+
+    return jsonify({"success": True, **hello.state_fields(state)})
+
+
+@app.route('/api/detect/report', methods=['GET'])
+async def get_detection_report():
+    user_id = request.args.get('userId')
+
+    report = await latest_report(user_id, REPORT_DEFAULT_PROJECTION)
+    if not report:
+        return jsonify({"success": False, "message": "报告不存在"}), 404
+
+    return jsonify({"success": True, "report": report})
+
+
+@app.route('/api/image/analysis-result', methods=['GET'])
+async def get_image_analysis_result():
+    file_id = request.args.get('fileId')
+    if not file_id:
+        return jsonify({"success": False, "message": "文件ID不能为空"}), 400
+
+    report = await db.reports.find_one(
+        {"fileId": file_id, "status": "finished", "analysisCompleted": True},
+        REPORT_DEFAULT_PROJECTION
+    )
+    if not report:
+        return jsonify({"success": False, "message": "未找到分析完成的报告"}), 404
+
+    return jsonify({"success": True, "result": report})
+
+
+class RouteDispatcher:
+    """ASGI入口：本模块定义的接口由Quart处理，其余请求转发给hello.py的Flask应用（在线程池中执行）"""
+
+    def __init__(self, async_app, wsgi_app):
+        self.async_app = async_app
+        self.wsgi_app = AsyncioWSGIMiddleware(wsgi_app, max_body_size=config.MAX_CONTENT_LENGTH)
+        self._adapter = async_app.url_map.bind("localhost")
+
+    def handles(self, method, path):
+        try:
+            self._adapter.match(path, method=method)
+        except (NotFound, MethodNotAllowed):
+            return False
+        return True
+
+    async def __call__(self, scope, receive, send):
+        # lifespan事件（before_serving/after_serving）也由Quart处理
+        if scope["type"] == "http" and not self.handles(scope["method"], scope["path"]):
+            return await self.wsgi_app(scope, receive, send)
+        return await self.async_app(scope, receive, send)
+
+
+application = RouteDispatcher(app, hello.app)
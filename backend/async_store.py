@@ -0,0 +1,243 @@
+"""
+异步数据库模块 - async_app.py使用的异步MongoDB连接（motor）以及本地的内存替身
+
+内存替身只实现async_app.py用到的一小部分motor接口（find_one/find/insert_one/update_one/
+replace_one/delete_one，常用的查询运算符和投影），数据只保存在当前进程中，用于测试和基准测试，
+不需要MongoDB服务。
+"""
+import copy
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import DeleteResult, InsertOneResult, UpdateResult
+
+
+def create_async_db(backend="motor", uri=None, database=None):
+    """
+    按配置创建异步数据库
+
+    Args:
+        backend (str): 'motor'（MongoDB）或 'memory'（内存替身）
+        uri (str): MongoDB连接地址，backend为motor时使用
+        database (str): 数据库名，backend为motor时使用
+    """
+    if backend == "motor":
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient(uri)[database]
+    if backend == "memory":
+        return InMemoryAsyncDatabase()
+    raise ValueError(f"不支持的异步数据库: {backend}")
+
+
+def _get(document, path):
+    """按点号路径取值，不存在时返回 (False, None)"""
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return False, None
+        value = value[part]
+    return True, value
+
+
+def _set(document, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def _unset(document, path):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+
+def _match_condition(found, value, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        for operator, operand in condition.items():
+            if operator == "$exists":
+                ok = found == bool(operand)
+            elif operator == "$in":
+                ok = found and value in operand
+            elif operator == "$nin":
+                ok = not found or value not in operand
+            elif operator == "$ne":
+                ok = (value if found else None) != operand
+            elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                if not found or value is None:
+                    ok = False
+                else:
+                    ok = {"$gt": value > operand, "$gte": value >= operand,
+                          "$lt": value < operand, "$lte": value <= operand}[operator]
+            else:
+                raise ValueError(f"内存替身不支持的查询运算符: {operator}")
+            if not ok:
+                return False
+        return True
+    if not found:
+        return condition is None
+    return value == condition
+
+
+def matches(document, query):
+    """文档是否满足查询条件"""
+    for path, condition in (query or {}).items():
+        found, value = _get(document, path)
+        if not _match_condition(found, value, condition):
+            return False
+    return True
+
+
+def project(document, projection):
+    """按投影返回文档的副本（支持包含或排除两种模式和点号路径）"""
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+    include_id = projection.get("_id", 1)
+    fields = {path: flag for path, flag in projection.items() if path != "_id"}
+    if fields and any(fields.values()):
+        result = {}
+        for path in fields:
+            found, value = _get(document, path)
+            if found:
+                _set(result, path, value)
+    else:
+        result = document
+        for path in fields:
+            _unset(result, path)
+    if include_id and "_id" in document:
+        result["_id"] = document["_id"]
+    else:
+        result.pop("_id", None)
+    return result
+
+
+def _sort_key(path, document):
+    found, value = _get(document, path)
+    # 缺少字段的文档排在最前（与MongoDB升序时null最小一致）
+    return (found and value is not None, value if found and value is not None else 0)
+
+
+def _sorted(documents, sort):
+    for path, direction in reversed(sort or []):
+        documents = sorted(documents, key=lambda document: _sort_key(path, document), reverse=direction < 0)
+    return documents
+
+
+class InMemoryAsyncCursor:
+    def __init__(self, documents, projection):
+        self._documents = documents
+        self._projection = projection
+        self._sort = None
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = key_or_list if isinstance(key_or_list, list) else [(key_or_list, direction or 1)]
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def _results(self):
+        documents = _sorted(self._documents, self._sort)
+        if self._limit:
+            documents = documents[:self._limit]
+        return [project(document, self._projection) for document in documents]
+
+    async def to_list(self, length=None):
+        results = self._results()
+        return results if length is None else results[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._results():
+            yield document
+
+
+class InMemoryAsyncCollection:
+    """motor集合的内存替身"""
+
+    def __init__(self, name):
+        self.name = name
+        self._documents = []
+
+    def _find(self, query):
+        return [document for document in self._documents if matches(document, query)]
+
+    async def find_one(self, filter=None, projection=None, sort=None):
+        documents = _sorted(self._find(filter), sort)
+        return project(documents[0], projection) if documents else None
+
+    def find(self, filter=None, projection=None, sort=None):
+        cursor = InMemoryAsyncCursor(self._find(filter), projection)
+        return cursor.sort(sort) if sort else cursor
+
+    async def insert_one(self, document):
+        document.setdefault("_id", ObjectId())
+        if any(existing["_id"] == document["_id"] for existing in self._documents):
+            raise DuplicateKeyError(f"重复的_id: {document['_id']}")
+        self._documents.append(copy.deepcopy(document))
+        return InsertOneResult(document["_id"], True)
+
+    async def update_one(self, filter, update, upsert=False):
+        matched = self._find(filter)
+        if matched:
+            document = matched[0]
+            for path, value in update.get("$set", {}).items():
+                _set(document, path, copy.deepcopy(value))
+            for path, value in update.get("$inc", {}).items():
+                found, current = _get(document, path)
+                _set(document, path, (current if found else 0) + value)
+            for path in update.get("$unset", {}):
+                _unset(document, path)
+            return UpdateResult({"n": 1, "nModified": 1}, True)
+        if not upsert:
+            return UpdateResult({"n": 0, "nModified": 0}, True)
+        document = {path: value for path, value in (filter or {}).items() if not isinstance(value, dict)}
+        for path, value in {**update.get("$setOnInsert", {}), **update.get("$set", {})}.items():
+            _set(document, path, copy.deepcopy(value))
+        await self.insert_one(document)
+        return UpdateResult({"n": 0, "nModified": 0, "upserted": document["_id"]}, True)
+
+    async def replace_one(self, filter, replacement, upsert=False):
+        matched = self._find(filter)
+        if matched:
+            replacement = {**copy.deepcopy(replacement), "_id": matched[0]["_id"]}
+            self._documents[self._documents.index(matched[0])] = replacement
+            return UpdateResult({"n": 1, "nModified": 1}, True)
+        if not upsert:
+            return UpdateResult({"n": 0, "nModified": 0}, True)
+        document = {**copy.deepcopy(replacement)}
+        if "_id" in (filter or {}):
+            document.setdefault("_id", filter["_id"])
+        await self.insert_one(document)
+        return UpdateResult({"n": 0, "nModified": 0, "upserted": document["_id"]}, True)
+
+    async def delete_one(self, filter):
+        matched = self._find(filter)
+        if matched:
+            self._documents.remove(matched[0])
+        return DeleteResult({"n": len(matched[:1])}, True)
+
+
+class InMemoryAsyncDatabase:
+    """motor数据库的内存替身，按名称访问集合"""
+
+    def __init__(self):
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = InMemoryAsyncCollection(name)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+异步部署（hypercorn async_app:application）与gunicorn同步部署的进度连接负载测试
+
+模拟大量客户端在检测进行中等待进度：先保持 --idle 个空闲的长轮询连接（/api/detect/wait，
+每个最多等待 --poll-timeout 秒，返回后立即重新发起），在这些连接保持期间用 --clients 个并发客户端
+请求/api/detect/status，比较:
+    - 状态查询的每秒请求数和延迟p50/p99（同步部署的请求线程被长轮询占满时，状态查询要排队）
+    - 测试期间完成的长轮询数和失败数
+    - 服务进程的RSS/PSS内存合计
+两种模式:
+    gunicorn: gunicorn -c gunicorn.conf.py hello:app
+    async:    hypercorn async_app:application（单进程）
+
+需要MongoDB（config.MONGO_URI）：测试前写入 --users 个处于processing状态的测试用户
+（userId以bench-async-开头，没有排队的任务，长轮询会一直等到超时），测试后删除。
+
+用法:
+    python benchmarks/bench_async_app.py
+    python benchmarks/bench_async_app.py --idle 5000 --clients 32 --duration 30
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from bench_serving import memory_mb, wait_ready  # noqa: E402
+
+USER_PREFIX = "bench-async-"
+
+
+def seed(db, users):
+    """写入测试用户和处于processing状态的检测状态文档"""
+    cleanup(db)
+    now = datetime.now()
+    db.users.insert_many([{"userId": f"{USER_PREFIX}{i}", "createdAt": now} for i in range(users)])
+    db.detection_status.insert_many([{
+        "_id": f"user:{USER_PREFIX}{i}",
+        "userId": f"{USER_PREFIX}{i}",
+        "jobId": f"{USER_PREFIX}job-{i}",
+        "reportId": None,
+        "kind": "risk",
+        "status": "processing",
+        "progress": 30,
+        "message": "",
+        "provisional": False,
+        "createdAt": now,
+        "updatedAt": now
+    } for i in range(users)])
+
+
+def cleanup(db):
+    db.users.delete_many({"userId": {"$regex": f"^{USER_PREFIX}"}})
+    db.detection_status.delete_many({"userId": {"$regex": f"^{USER_PREFIX}"}})
+
+
+def server_command(mode, port, workers):
+    if mode == "async":
+        return [sys.executable, "-m", "hypercorn", "async_app:application", "--bind", f"127.0.0.1:{port}"]
+    command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}"]
+    if workers:
+        command += ["--workers", str(workers)]
+    return command + ["hello:app"]
+
+
+async def http_get(port, path, timeout):
+    """发送一个GET请求（Connection: close），返回状态码"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        data = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    return int(data.split(b" ", 2)[1]) if data else 0
+
+
+async def idle_poller(port, user, poll_timeout, counters):
+    """一个一直在等待进度的客户端：长轮询返回后立即重新发起"""
+    path = f"/api/detect/wait?userId={user}&after=0&timeout={poll_timeout}"
+    while True:
+        counters["inFlight"] += 1
+        try:
+            ok = await http_get(port, path, poll_timeout + 30) == 200
+        except (OSError, asyncio.TimeoutError):
+            ok = False
+        finally:
+            counters["inFlight"] -= 1
+        if ok:
+            counters["completed"] += 1
+        else:
+            counters["errors"] += 1
+            await asyncio.sleep(1)
+
+
+async def status_client(port, users, deadline, latencies, errors):
+    i = 0
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            ok = await http_get(port, f"/api/detect/status?userId={USER_PREFIX}{i % users}", 60) == 200
+        except (OSError, asyncio.TimeoutError):
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors[0] += 1
+        i += 1
+
+
+async def drive(port, args):
+    counters = {"inFlight": 0, "completed": 0, "errors": 0}
+    pollers = [asyncio.create_task(idle_poller(port, f"{USER_PREFIX}{i % args.users}", args.poll_timeout, counters))
+               for i in range(args.idle)]
+    await asyncio.sleep(args.ramp)
+
+    latencies, errors = [], [0]
+    start = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(status_client(port, args.users, deadline, latencies, errors) for _ in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    held = counters["inFlight"]
+
+    for poller in pollers:
+        poller.cancel()
+    await asyncio.gather(*pollers, return_exceptions=True)
+    return latencies, errors[0], elapsed, held, counters
+
+
+def run(mode, args, port):
+    log_path = os.path.join(tempfile.gettempdir(), f"bench_async_app_{mode}.log")
+    log = open(log_path, "w")
+    process = subprocess.Popen(server_command(mode, port, args.workers), cwd=BACKEND_DIR,
+                               stdout=log, stderr=subprocess.STDOUT)
+    try:
+        try:
+            wait_ready(port, f"/api/detect/status?userId={USER_PREFIX}0", process, args.startup_timeout)
+        except (RuntimeError, TimeoutError) as e:
+            raise RuntimeError(f"{mode}服务启动失败（日志: {log_path}）: {e}")
+        latencies, errors, elapsed, held, counters = asyncio.run(drive(port, args))
+        memory = memory_mb(process.pid)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50": float(np.percentile(latencies, 50)) if len(latencies) else float("nan"),
+        "p99": float(np.percentile(latencies, 99)) if len(latencies) else float("nan"),
+        "errors": errors,
+        "held": held,
+        "polls": counters["completed"],
+        "pollErrors": counters["errors"],
+        "memory": memory
+    }
+
+
+def raise_file_limit(needed):
+    """每个连接占一个文件描述符，服务进程继承这里提高后的限制"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="异步部署与gunicorn的进度连接负载测试")
+    parser.add_argument("--idle", type=int, default=2000, help="保持的空闲长轮询连接数")
+    parser.add_argument("--poll-timeout", type=float, default=25, help="长轮询的等待时间（秒）")
+    parser.add_argument("--clients", type=int, default=16, help="并发请求/api/detect/status的客户端数")
+    parser.add_argument("--duration", type=float, default=20, help="状态查询的测试时长（秒）")
+    parser.add_argument("--ramp", type=float, default=5, help="建立空闲连接后等待的时间（秒）")
+    parser.add_argument("--users", type=int, default=500, help="测试用户数")
+    parser.add_argument("--workers", type=int, help="gunicorn工作进程数，默认按gunicorn.conf.py")
+    parser.add_argument("--port", type=int, default=18180)
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--modes", nargs="+", default=["gunicorn", "async"], choices=["gunicorn", "async"])
+    args = parser.parse_args()
+
+    import pymongo
+    import config
+
+    raise_file_limit(2 * args.idle + 1024)
+    client = pymongo.MongoClient(config.MONGO_URI)
+    db = client[config.DATABASE_NAME]
+    seed(db, args.users)
+    results = {}
+    try:
+        for offset, mode in enumerate(args.modes):
+            print(f"{mode} ...")
+            results[mode] = run(mode, args, args.port + offset)
+    finally:
+        cleanup(db)
+
+    print(f"\n保持 {args.idle} 个长轮询连接，{args.clients} 个客户端并发查询状态 {args.duration:.0f} 秒")
+    print(f"{'模式':>10} {'请求/秒':>9} {'p50':>9} {'p99':>9} {'错误':>6} {'等待中':>7} {'长轮询完成':>10} "
+          f"{'长轮询失败':>10} {'RSS合计':>9} {'PSS合计':>9}")
+    for mode, result in results.items():
+        rss, pss = result["memory"] or (float("nan"), float("nan"))
+        print(f"{mode:>10} {result['rps']:>9.1f} {result['p50']:>7.1f}ms {result['p99']:>7.1f}ms "
+              f"{result['errors']:>6} {result['held']:>7} {result['polls']:>10} {result['pollErrors']:>10} "
+              f"{rss:>7.0f}MB {pss:>7.0f}MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
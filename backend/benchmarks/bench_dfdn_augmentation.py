@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+DFDN训练数据增强阶段的吞吐量基准测试
+
+用内存中的合成图像构建与create_optimized_dataset相同的管道，比较:
+    none:       不增强
+    per_sample: batch之前逐张图像增强（每张图像单独调用一次增强函数）
+    batched:    batch之后按批次向量化增强（models/dfdn_augment.py的做法）
+加上--compare-training时同时测量DFDN训练步骤的吞吐量，判断增强后的管道是否会成为瓶颈。
+
+用法:
+    python benchmarks/bench_dfdn_augmentation.py
+    python benchmarks/bench_dfdn_augmentation.py --samples 2048 --batch-size 32 --modality MRI --compare-training
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.dfdn_augment import AUTOTUNE, augment_dataset, augment_images, get_augmentation_params  # noqa: E402
+
+
+def build_pipeline(images, labels, batch_size, mode, params):
+    """构建训练管道，mode为none、per_sample或batched"""
+    dataset = tf.data.Dataset.from_tensor_slices((images, labels))
+    dataset = dataset.shuffle(len(images), seed=0).repeat()
+    if mode == 'per_sample':
+        seeds = tf.data.Dataset.random(seed=0).batch(2)
+        dataset = tf.data.Dataset.zip((dataset, seeds)).map(
+            lambda sample, seed: (augment_images(sample[0][tf.newaxis], seed, params)[0], sample[1]),
+            num_parallel_calls=AUTOTUNE
+        )
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    if mode == 'batched':
+        dataset = augment_dataset(dataset, params, seed=0)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def measure_pipeline(dataset, batches, warmup):
+    """遍历数据集，返回每秒产出的图像数"""
+    iterator = iter(dataset)
+    for _ in range(warmup):
+        next(iterator)
+    start = time.perf_counter()
+    images = 0
+    for _ in range(batches):
+        images += int(next(iterator)[0].shape[0])
+    return images / (time.perf_counter() - start)
+
+
+def measure_training(input_shape, batch_size, steps, warmup):
+    """DFDN训练步骤每秒处理的图像数"""
+    from models.dfdn import DynamicFeatureDecouplingNetwork
+
+    model = DynamicFeatureDecouplingNetwork(input_shape=input_shape)
+    model.compile_model()
+    batch = (tf.random.uniform((batch_size,) + input_shape), tf.one_hot(tf.range(batch_size) % 3, 3))
+    for _ in range(warmup):
+        losses = model.train_step(batch)
+    float(losses['total_loss'])
+    start = time.perf_counter()
+    for _ in range(steps):
+        losses = model.train_step(batch)
+    float(losses['total_loss'])
+    return batch_size * steps / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DFDN数据增强吞吐量基准测试")
+    parser.add_argument("--samples", type=int, default=1024, help="内存中合成图像的数量")
+    parser.add_argument("--input-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--modality", choices=["CT", "MRI"], default="CT")
+    parser.add_argument("--batches", type=int, default=50, help="计时的批次数")
+    parser.add_argument("--warmup", type=int, default=5, help="预热批次数")
+    parser.add_argument("--compare-training", action="store_true", help="同时测量DFDN训练步骤的吞吐量")
+    args = parser.parse_args()
+
+    input_shape = (args.input_size, args.input_size, 1)
+    rng = np.random.default_rng(0)
+    images = rng.random((args.samples,) + input_shape, dtype=np.float32)
+    labels = np.eye(3, dtype=np.float32)[rng.integers(0, 3, args.samples)]
+    params = get_augmentation_params(args.modality)
+
+    results = {}
+    for mode in ('none', 'per_sample', 'batched'):
+        dataset = build_pipeline(images, labels, args.batch_size, mode, params)
+        results[mode] = measure_pipeline(dataset, args.batches, args.warmup)
+        print(f"{mode}: {results[mode]:.1f} 图像/秒")
+
+    print(f"\n{args.modality}增强，输入 {args.input_size}x{args.input_size}，批次 {args.batch_size}，"
+          f"CPU核数 {os.cpu_count()}")
+    print(f"{'管道':>12} {'图像/秒':>10} {'相对不增强':>10}")
+    for mode, throughput in results.items():
+        print(f"{mode:>12} {throughput:>10.1f} {throughput / results['none']:>10.0%}")
+
+    if args.compare_training:
+        training = measure_training(input_shape, args.batch_size, steps=5, warmup=2)
+        print(f"\nDFDN训练步骤: {training:.1f} 图像/秒，"
+              f"批次增强管道是训练速度的 {results['batched'] / training:.1f} 倍")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
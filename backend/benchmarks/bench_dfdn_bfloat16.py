@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+DFDN bfloat16混合精度的速度与精度一致性基准测试
+
+用同一份权重分别构建float32和mixed_bfloat16模型，比较:
+    - 推理吞吐量和训练吞吐量（图像/秒）
+    - 同一批图像上的一致性：预测类别一致率、类别概率的最大/平均绝对误差、
+      病灶特征与float32特征的余弦相似度
+
+bfloat16只有在支持AVX512_BF16或AMX的CPU上才会明显加速，否则可能比float32更慢。
+一致性应该用训练好的权重（--weights）和真实图像（--image-dir）评估，随机权重只用于测速。
+
+用法:
+    python benchmarks/bench_dfdn_bfloat16.py
+    python benchmarks/bench_dfdn_bfloat16.py --weights ctMRImodel/dfdn_ct_model.h5 --image-dir data/ct_val --report bf16_report.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.dfdn import DynamicFeatureDecouplingNetwork  # noqa: E402
+
+
+def load_images(image_dir, input_size, limit):
+    """读取目录（包括子目录）中的图像，按推理时的方式预处理"""
+    from PIL import Image
+
+    from image_cascade import normalize_image
+
+    images = []
+    for root, _, files in os.walk(image_dir):
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() not in ('.png', '.jpg', '.jpeg'):
+                continue
+            image = np.array(Image.open(os.path.join(root, name)).convert('L'))
+            images.append(normalize_image(image, (input_size, input_size))[0])
+            if len(images) >= limit:
+                return np.asarray(images, dtype=np.float32)
+    if not images:
+        raise ValueError(f"目录中没有图像: {image_dir}")
+    return np.asarray(images, dtype=np.float32)
+
+
+def measure_throughput(fn, batch, steps, warmup):
+    """重复执行fn(batch)，返回每秒处理的图像数"""
+    for _ in range(warmup):
+        output = fn(batch)
+    tf.nest.map_structure(lambda tensor: tensor.numpy(), output)
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        output = fn(batch)
+    tf.nest.map_structure(lambda tensor: tensor.numpy(), output)
+    return len(batch[0]) * steps / (time.perf_counter() - start)
+
+
+def compare_outputs(reference, candidate, images, batch_size):
+    """逐批次推理，比较candidate与reference的输出"""
+    predict_reference = tf.function(lambda x: reference.dfdn_model(x, training=False))
+    predict_candidate = tf.function(lambda x: candidate.dfdn_model(x, training=False))
+
+    agree, prob_errors, cosines = [], [], []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        ref_probs, ref_features, _ = predict_reference(batch)
+        probs, features, _ = predict_candidate(batch)
+
+        agree.append(np.argmax(ref_probs, axis=1) == np.argmax(probs, axis=1))
+        prob_errors.append(np.abs(ref_probs.numpy() - probs.numpy()))
+        cosines.append(tf.reduce_sum(
+            tf.math.l2_normalize(ref_features, axis=1) * tf.math.l2_normalize(features, axis=1), axis=1
+        ).numpy())
+
+    agree, prob_errors, cosines = np.concatenate(agree), np.concatenate(prob_errors), np.concatenate(cosines)
+    return {
+        "samples": len(images),
+        "classAgreement": round(float(agree.mean()), 4),
+        "probMaxAbsError": round(float(prob_errors.max()), 5),
+        "probMeanAbsError": round(float(prob_errors.mean()), 5),
+        "featureCosineMin": round(float(cosines.min()), 5),
+        "featureCosineMean": round(float(cosines.mean()), 5)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DFDN bfloat16混合精度基准测试")
+    parser.add_argument("--input-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--samples", type=int, default=64, help="一致性比较的图像数")
+    parser.add_argument("--weights", help="训练好的DFDN权重（.h5），不指定时使用随机初始化的权重")
+    parser.add_argument("--image-dir", help="用于一致性比较的图像目录，不指定时使用合成图像")
+    parser.add_argument("--steps", type=int, default=5, help="计时的步数")
+    parser.add_argument("--warmup", type=int, default=2, help="预热步数")
+    parser.add_argument("--skip-training", action="store_true", help="只测推理")
+    parser.add_argument("--report", help="把结果写入JSON文件")
+    args = parser.parse_args()
+
+    input_shape = (args.input_size, args.input_size, 1)
+    models = {
+        precision: DynamicFeatureDecouplingNetwork(input_shape=input_shape, precision=precision)
+        for precision in ('float32', 'mixed_bfloat16')
+    }
+    if args.weights:
+        models['float32'].load_model(args.weights)
+    # 变量都是float32，bfloat16模型直接使用float32模型的权重
+    models['mixed_bfloat16'].dfdn_model.set_weights(models['float32'].dfdn_model.get_weights())
+
+    if args.image_dir:
+        images = load_images(args.image_dir, args.input_size, args.samples)
+    else:
+        images = np.random.default_rng(0).random((args.samples,) + input_shape, dtype=np.float32)
+    batch = tf.constant(images[:args.batch_size])
+    labels = tf.one_hot(tf.range(len(batch)) % 3, 3)
+
+    results = {}
+    for precision, model in models.items():
+        print(f"\n{precision} ...")
+        predict = tf.function(lambda x, model=model: model.dfdn_model(x, training=False))
+        results[precision] = {
+            "inferenceImagesPerSecond": measure_throughput(lambda b: predict(b[0]), (batch,), args.steps, args.warmup)
+        }
+        if not args.skip_training:
+            model.compile_model()
+            results[precision]["trainingImagesPerSecond"] = measure_throughput(
+                lambda b, model=model: model.train_step(b)['total_loss'], (batch, labels), args.steps, args.warmup
+            )
+
+    # 训练会改变权重，一致性比较前重新同步
+    models['mixed_bfloat16'].dfdn_model.set_weights(models['float32'].dfdn_model.get_weights())
+    parity = compare_outputs(models['float32'], models['mixed_bfloat16'], images, args.batch_size)
+
+    print(f"\n输入 {args.input_size}x{args.input_size}，批次 {args.batch_size}")
+    print(f"{'精度':>16} {'推理 图像/秒':>12} {'训练 图像/秒':>12}")
+    for precision, r in results.items():
+        training = r.get("trainingImagesPerSecond")
+        training_text = f"{training:.1f}" if training else "-"
+        print(f"{precision:>16} {r['inferenceImagesPerSecond']:>12.1f} {training_text:>12}")
+    base = results['float32']['inferenceImagesPerSecond']
+    print(f"bfloat16推理加速: {results['mixed_bfloat16']['inferenceImagesPerSecond'] / base:.2f}x")
+    print(f"\n一致性（{parity['samples']} 张{'真实' if args.image_dir else '合成'}图像）:")
+    for name, value in parity.items():
+        if name != "samples":
+            print(f"  {name}: {value}")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({
+                "inputSize": args.input_size,
+                "batchSize": args.batch_size,
+                "weights": args.weights,
+                "imageDir": args.image_dir,
+                "throughput": results,
+                "parity": parity
+            }, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.report}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+DFDN梯度累加（微批次）的内存和吞吐量基准测试
+
+固定逻辑批次大小，把每个批次拆成K个微批次训练，比较不同K下的进程内存峰值和吞吐量。
+每个K在单独的子进程中运行，内存峰值（ru_maxrss）互不影响。
+
+用法:
+    python benchmarks/bench_dfdn_grad_accumulation.py
+    python benchmarks/bench_dfdn_grad_accumulation.py --batch-size 128 --micro-batches 1 4 16
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_single(args):
+    """在当前进程中用一个K训练若干步，把结果写入结果文件"""
+    import numpy as np
+    import tensorflow as tf
+
+    from models.dfdn import DynamicFeatureDecouplingNetwork
+    from models.dfdn_profiler import memory_high_water
+
+    input_shape = (args.input_size, args.input_size, 1)
+    model = DynamicFeatureDecouplingNetwork(input_shape=input_shape)
+    model.compile_model()
+
+    rng = np.random.default_rng(0)
+    images = tf.constant(rng.random((args.batch_size,) + input_shape, dtype=np.float32))
+    labels = tf.one_hot(tf.range(args.batch_size) % 3, 3)
+
+    # 批次维度不固定，先用很小的批次完成追踪和编译，使追踪本身占用的内存不计入训练步骤
+    train_step = tf.function(
+        lambda x, y: model._train_step(model.dfdn_model, (x, y), args.k),
+        input_signature=[tf.TensorSpec((None,) + input_shape), tf.TensorSpec((None, 3))]
+    )
+    float(train_step(images[:args.k], labels[:args.k])['total_loss'])
+    traced_memory = memory_high_water()["maxRssMb"]
+
+    # 预热
+    for _ in range(args.warmup):
+        losses = train_step(images, labels)
+    float(losses['total_loss'])
+
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        losses = train_step(images, labels)
+    float(losses['total_loss'])
+    elapsed = time.perf_counter() - start
+
+    with open(args.result_file, 'w', encoding='utf-8') as f:
+        json.dump({
+            "microBatches": args.k,
+            "microBatchSize": args.batch_size // args.k,
+            "secondsPerStep": elapsed / args.steps,
+            "imagesPerSecond": args.batch_size * args.steps / elapsed,
+            "tracedMemoryMb": traced_memory,
+            "peakMemoryMb": memory_high_water()["maxRssMb"],
+            "contrastiveLoss": float(losses['contrastive_loss'])
+        }, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DFDN梯度累加基准测试")
+    parser.add_argument("--batch-size", type=int, default=64, help="逻辑批次大小")
+    parser.add_argument("--micro-batches", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--input-size", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=5, help="计时的训练步数")
+    parser.add_argument("--warmup", type=int, default=2, help="预热步数")
+    parser.add_argument("--k", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.k:
+        run_single(args)
+        return 0
+
+    results = []
+    for k in args.micro_batches:
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            result_file = f.name
+        command = [
+            sys.executable, os.path.abspath(__file__), '--k', str(k), '--result-file', result_file,
+            '--batch-size', str(args.batch_size), '--input-size', str(args.input_size),
+            '--steps', str(args.steps), '--warmup', str(args.warmup)
+        ]
+        print(f"\nK={k} ...")
+        try:
+            if subprocess.call(command) != 0:
+                print(f"  K={k} 运行失败")
+                continue
+            with open(result_file, 'r', encoding='utf-8') as f:
+                results.append(json.load(f))
+        finally:
+            os.remove(result_file)
+
+    if not results:
+        return 1
+
+    print(f"\n逻辑批次 {args.batch_size}，输入 {args.input_size}x{args.input_size}")
+    print(f"{'K':>4} {'微批次':>6} {'秒/步':>8} {'图像/秒':>8} {'训练步内存MB':>12} {'进程峰值MB':>10} {'对比损失':>10}")
+    for r in results:
+        # 减去完成追踪后的内存，只比较训练步骤本身（激活和梯度）占用的部分
+        training_memory = r["peakMemoryMb"] - r["tracedMemoryMb"]
+        print(f"{r['microBatches']:>4} {r['microBatchSize']:>6} {r['secondsPerStep']:>8.3f} "
+              f"{r['imagesPerSecond']:>8.1f} {training_memory:>12.1f} {r['peakMemoryMb']:>10.1f} "
+              f"{r['contrastiveLoss']:>10.4f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
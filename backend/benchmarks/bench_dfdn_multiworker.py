@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+DFDN多进程数据并行训练的扩展性基准测试
+
+在本机分别启动1、2、4、8个worker进程（每个worker固定批次大小，弱扩展），
+用合成图像训练若干步，由chief统计全局吞吐量（图像/秒）。
+
+用法:
+    python benchmarks/bench_dfdn_multiworker.py
+    python benchmarks/bench_dfdn_multiworker.py --workers 1 2 4 --per-worker-batch 8 --input-size 128
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.dfdn_distributed import launch_local_workers  # noqa: E402
+
+
+def run_worker(args):
+    """作为集群中的一个worker运行合成数据训练，chief把吞吐量写入结果文件"""
+    import tensorflow as tf
+
+    from models.dfdn import DynamicFeatureDecouplingNetwork
+    from models.dfdn_distributed import create_strategy
+
+    strategy = create_strategy()
+    num_workers = strategy.num_replicas_in_sync
+    global_batch_size = args.per_worker_batch * num_workers
+    input_shape = (args.input_size, args.input_size, 1)
+
+    model = DynamicFeatureDecouplingNetwork(input_shape=input_shape, strategy=strategy)
+    model.compile_model()
+
+    def dataset_fn(input_context):
+        batch_size = input_context.get_per_replica_batch_size(global_batch_size)
+        images = tf.random.uniform((batch_size,) + input_shape, seed=input_context.input_pipeline_id)
+        labels = tf.one_hot(tf.range(batch_size) % 3, 3)
+        return tf.data.Dataset.from_tensors((images, labels)).repeat()
+
+    iterator = iter(strategy.distribute_datasets_from_function(dataset_fn))
+
+    # 预热：包含tf.function追踪和集合通信的建立
+    for _ in range(args.warmup):
+        losses = model.distributed_train_step(next(iterator))
+    float(losses['total_loss'])
+
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        losses = model.distributed_train_step(next(iterator))
+    float(losses['total_loss'])
+    elapsed = time.perf_counter() - start
+
+    if model.is_chief():
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "workers": num_workers,
+                "globalBatchSize": global_batch_size,
+                "secondsPerStep": elapsed / args.steps,
+                "imagesPerSecond": global_batch_size * args.steps / elapsed
+            }, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DFDN多worker扩展性基准测试")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--per-worker-batch", type=int, default=8)
+    parser.add_argument("--input-size", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=10, help="计时的训练步数")
+    parser.add_argument("--warmup", type=int, default=2, help="预热步数")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return 0
+
+    results = []
+    for num_workers in args.workers:
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            result_file = f.name
+        command = [
+            os.path.abspath(__file__), '--worker', '--result-file', result_file,
+            '--per-worker-batch', str(args.per_worker_batch), '--input-size', str(args.input_size),
+            '--steps', str(args.steps), '--warmup', str(args.warmup)
+        ]
+        print(f"\n启动 {num_workers} 个worker...")
+        exit_codes = launch_local_workers(num_workers, command)
+        try:
+            if any(exit_codes):
+                print(f"  worker异常退出: {exit_codes}")
+                continue
+            with open(result_file, 'r', encoding='utf-8') as f:
+                results.append(json.load(f))
+        finally:
+            os.remove(result_file)
+
+    if not results:
+        return 1
+
+    base = results[0]["imagesPerSecond"] / results[0]["workers"]
+    print(f"\n{'worker数':>8} {'全局批次':>8} {'秒/步':>8} {'图像/秒':>10} {'扩展效率':>8}")
+    for r in results:
+        efficiency = r["imagesPerSecond"] / (base * r["workers"])
+        print(f"{r['workers']:>8} {r['globalBatchSize']:>8} {r['secondsPerStep']:>8.3f} "
+              f"{r['imagesPerSecond']:>10.1f} {efficiency:>8.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
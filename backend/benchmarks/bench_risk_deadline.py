@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+风险评分截止时间的首次出报告时间基准测试
+
+用DeadlineRiskScorer模拟risk通道：请求按泊松过程以 --rate 个/秒到达，排队后由 --concurrency 个
+通道工作线程评分；模型耗时服从对数正态分布，并有一定比例的请求卡住（模拟负载高时TabNet变慢）。
+比较不设截止时间和设置截止时间时:
+    - 首次出报告时间（time-to-first-report，从请求提交算起，包括排队时间）的p50/p99
+    - 最终报告时间，以及超时回退和模型更新的比例
+卡住的模型占满通道工作线程时，排在后面的请求即使模型很快也要等，这部分等待计入首次出报告时间。
+
+用法:
+    python benchmarks/bench_risk_deadline.py
+    python benchmarks/bench_risk_deadline.py --requests 400 --rate 20 --concurrency 2 --deadline 0.5 --stall-rate 0.1
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from risk_scoring import DeadlineRiskScorer  # noqa: E402
+
+
+def make_model(median, sigma, stall_rate, stall_seconds, seed):
+    """模拟集成模型：对数正态分布的耗时，stall_rate比例的请求额外卡住stall_seconds秒"""
+    rng = np.random.default_rng(seed)
+    lock = threading.Lock()
+
+    def predict(user):
+        with lock:
+            latency = rng.lognormal(np.log(median), sigma)
+            if rng.random() < stall_rate:
+                latency += stall_seconds
+        time.sleep(latency)
+        return {"riskPercent": 42.0}
+
+    return predict
+
+
+def fallback(user):
+    return {"riskPercent": 40.0}
+
+
+def run(deadline, args):
+    """按给定截止时间跑完所有请求，返回评分统计"""
+    predict = make_model(args.median, args.sigma, args.stall_rate, args.stall_seconds, seed=0)
+    scorer = DeadlineRiskScorer(predict, fallback, deadline=deadline, max_workers=args.concurrency)
+    arrivals = np.random.default_rng(1).exponential(1 / args.rate, args.requests)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as lane:
+        for i, gap in enumerate(arrivals):
+            time.sleep(gap)
+            lane.submit(scorer.score, {"userId": i}, lambda result, provisional, source: None, time.time())
+    # 等待超时后在后台继续的模型预测完成，最终报告时间才完整
+    scorer.close()
+    return scorer.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="风险评分截止时间基准测试")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=10, help="请求到达速率（个/秒）")
+    parser.add_argument("--concurrency", type=int, default=2, help="risk通道的工作线程数（也是模型预测的线程数）")
+    parser.add_argument("--deadline", type=float, default=0.5, help="截止时间（秒）")
+    parser.add_argument("--median", type=float, default=0.1, help="模型耗时的中位数（秒）")
+    parser.add_argument("--sigma", type=float, default=0.5, help="模型耗时对数正态分布的sigma")
+    parser.add_argument("--stall-rate", type=float, default=0.05, help="卡住的请求比例")
+    parser.add_argument("--stall-seconds", type=float, default=3.0, help="卡住的请求额外耗时（秒）")
+    args = parser.parse_args()
+
+    results = {}
+    for name, deadline in (("no_deadline", None), (f"deadline_{args.deadline}s", args.deadline)):
+        print(f"{name} ...")
+        results[name] = run(deadline, args)
+
+    print(f"\n{args.requests} 个请求，每秒 {args.rate} 个，{args.concurrency} 个工作线程，模型耗时中位数 {args.median}s，"
+          f"{args.stall_rate:.0%} 的请求卡住 {args.stall_seconds}s")
+    print(f"{'模式':>16} {'首次p50':>9} {'首次p99':>9} {'最终p99':>9} {'超时回退':>8} {'满载回退':>8} {'模型更新':>8}")
+    for name, stats in results.items():
+        first, final = stats["timeToFirstReportMs"], stats["timeToFinalReportMs"]
+        print(f"{name:>16} {first['p50']:>7.0f}ms {first['p99']:>7.0f}ms {final['p99']:>7.0f}ms "
+              f"{stats['timeoutRate']:>8.1%} {stats['busyRate']:>8.1%} {stats['counts']['upgraded']:>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
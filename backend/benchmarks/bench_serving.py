@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+开发服务器与gunicorn多进程部署的负载测试
+
+分别启动两种服务，用多个客户端进程并发请求同一个接口，比较:
+    - 每秒请求数（requests/s）和延迟p50/p99
+    - 服务进程（含gunicorn工作进程）的PSS内存合计，PSS按共享页面的进程数分摊，
+      主进程预加载的模型被工作进程共享时，合计值明显小于各进程RSS之和
+两种模式:
+    dev:      hello.app.run，与python hello.py相同（config.DEBUG，不启用重新加载）
+    gunicorn: gunicorn -c gunicorn.conf.py hello:app
+
+默认请求不访问数据库的/api/symptoms/list，只比较服务器本身；需要数据库时可以换成其他接口。
+
+用法:
+    python benchmarks/bench_serving.py
+    python benchmarks/bench_serving.py --endpoint "/api/detect/status?userId=u1" --clients 64 --duration 30
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def server_command(mode, port, workers):
+    if mode == "dev":
+        code = ("import config, hello; "
+                f"hello.app.run(host='127.0.0.1', port={port}, debug=config.DEBUG, use_reloader=False)")
+        return [sys.executable, "-c", code]
+    command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}"]
+    if workers:
+        command += ["--workers", str(workers)]
+    return command + ["hello:app"]
+
+
+def request_once(port, endpoint, timeout=30):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        connection.request("GET", endpoint)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def wait_ready(port, endpoint, process, timeout):
+    """等待服务可以响应请求（hello.py启动时会连接数据库创建索引，数据库不可用时较慢）"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"服务进程已退出，返回码 {process.returncode}")
+        try:
+            if request_once(port, endpoint, timeout=5) == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"服务在 {timeout} 秒内没有就绪")
+
+
+def client_process(port, endpoint, threads, duration, queue):
+    """一个客户端进程：threads个线程各自循环请求，直到duration秒后"""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def loop():
+        local, failed = [], 0
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                ok = request_once(port, endpoint) == 200
+            except OSError:
+                ok = False
+            if ok:
+                local.append(time.perf_counter() - start)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    workers = [threading.Thread(target=loop) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    queue.put((latencies, errors[0]))
+
+
+def process_tree(pid):
+    """pid及其所有子进程"""
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def memory_mb(pid):
+    """进程树的 (RSS合计, PSS合计)，单位MB；不支持/proc时返回None"""
+    rss = pss = 0
+    try:
+        for current in process_tree(pid):
+            with open(f"/proc/{current}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Rss:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("Pss:"):
+                        pss += int(line.split()[1])
+    except OSError:
+        return None
+    return rss / 1024, pss / 1024
+
+
+def run(mode, args, port):
+    # 服务的输出写到临时目录，便于排查启动失败
+    log_path = os.path.join(tempfile.gettempdir(), f"bench_serving_{mode}.log")
+    log = open(log_path, "w")
+    process = subprocess.Popen(server_command(mode, port, args.workers), cwd=BACKEND_DIR,
+                               stdout=log, stderr=subprocess.STDOUT)
+    try:
+        try:
+            wait_ready(port, args.endpoint, process, args.startup_timeout)
+        except (RuntimeError, TimeoutError) as e:
+            raise RuntimeError(f"{mode}服务启动失败（日志: {log_path}）: {e}")
+        # 预热
+        for _ in range(20):
+            request_once(port, args.endpoint)
+
+        queue = multiprocessing.Queue()
+        threads_per_process = max(1, args.clients // args.client_processes)
+        clients = [
+            multiprocessing.Process(target=client_process,
+                                    args=(port, args.endpoint, threads_per_process, args.duration, queue))
+            for _ in range(args.client_processes)
+        ]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        results = [queue.get() for _ in clients]
+        elapsed = time.perf_counter() - start
+        for client in clients:
+            client.join()
+        memory = memory_mb(process.pid)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+
+    latencies = np.array([latency for result in results for latency in result[0]]) * 1000
+    return {
+        "requests": len(latencies),
+        "errors": sum(result[1] for result in results),
+        "rps": len(latencies) / elapsed,
+        "p50": float(np.percentile(latencies, 50)) if len(latencies) else float("nan"),
+        "p99": float(np.percentile(latencies, 99)) if len(latencies) else float("nan"),
+        "memory": memory
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="开发服务器与gunicorn的负载测试")
+    parser.add_argument("--endpoint", default="/api/symptoms/list")
+    parser.add_argument("--clients", type=int, default=32, help="并发客户端数")
+    parser.add_argument("--client-processes", type=int, default=4, help="发起请求的客户端进程数")
+    parser.add_argument("--duration", type=float, default=15, help="每种模式的测试时长（秒）")
+    parser.add_argument("--workers", type=int, help="gunicorn工作进程数，默认按gunicorn.conf.py")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--modes", nargs="+", default=["dev", "gunicorn"], choices=["dev", "gunicorn"])
+    args = parser.parse_args()
+
+    results = {}
+    for offset, mode in enumerate(args.modes):
+        print(f"{mode} ...")
+        results[mode] = run(mode, args, args.port + offset)
+
+    print(f"\n{args.endpoint}，{args.clients} 个并发客户端，每种模式 {args.duration:.0f} 秒")
+    print(f"{'模式':>10} {'请求/秒':>9} {'p50':>9} {'p99':>9} {'错误':>6} {'RSS合计':>9} {'PSS合计':>9}")
+    for mode, result in results.items():
+        rss, pss = result["memory"] or (float("nan"), float("nan"))
+        print(f"{mode:>10} {result['rps']:>9.1f} {result['p50']:>7.1f}ms {result['p99']:>7.1f}ms "
+              f"{result['errors']:>6} {rss:>7.0f}MB {pss:>7.0f}MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
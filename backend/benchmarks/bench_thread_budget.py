@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+CPU线程预算在混合负载下的吞吐量基准测试
+
+模拟后端同时处理风险计算和图像分析:若干线程反复执行DFDN推理（TensorFlow），若干线程反复执行
+树模型predict_proba（有XGBoost时用XGBClassifier，否则用scikit-learn的RandomForestClassifier），
+比较两种模式下各类任务每秒完成的数量:
+    unmanaged: 各个库使用默认线程数（每个库、每个任务都按全部CPU核开线程池）
+    managed:   使用thread_budget.py统一分配线程
+
+TensorFlow的线程池在进程内只能设置一次，每种模式在单独的子进程中运行。
+CPU核数越多、并发任务越多，两种模式的差别越明显。
+
+用法:
+    python benchmarks/bench_thread_budget.py
+    python benchmarks/bench_thread_budget.py --image-workers 2 --risk-workers 4 --duration 60
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thread_budget import ThreadBudget  # noqa: E402
+
+
+def build_tree_model(rows, trees):
+    """在合成的表格数据上训练风险模型的替身"""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    features = rng.random((rows, 20), dtype=np.float32)
+    labels = (features[:, 0] + features[:, 1] * features[:, 2] + rng.normal(0, 0.1, rows) > 0.8).astype(int)
+    try:
+        from xgboost import XGBClassifier
+        model = XGBClassifier(n_estimators=trees, max_depth=6, n_jobs=-1)
+    except ImportError:
+        from sklearn.ensemble import RandomForestClassifier
+        model = RandomForestClassifier(n_estimators=trees, max_depth=10, n_jobs=-1, random_state=0)
+    model.fit(features, labels)
+    return model, features
+
+
+def run_mode(args):
+    """在当前进程中运行一种模式，返回各类任务的吞吐量"""
+    budget = None
+    if args.mode == 'managed':
+        budget = ThreadBudget(total_threads=args.total_threads, tf_inter_op_threads=2,
+                              tf_share=args.image_workers / (args.image_workers + args.risk_workers))
+        budget.configure_process()
+
+    import numpy as np
+    import tensorflow as tf
+
+    from models.dfdn import DynamicFeatureDecouplingNetwork
+
+    input_shape = (args.input_size, args.input_size, 1)
+    dfdn = DynamicFeatureDecouplingNetwork(input_shape=input_shape)
+    predict = tf.function(lambda x: dfdn.dfdn_model(x, training=False)[0])
+    image = tf.constant(np.random.default_rng(0).random((1,) + input_shape, dtype=np.float32))
+    predict(image).numpy()
+
+    tree_model, tree_features = build_tree_model(args.rows, args.trees)
+    tree_model.predict_proba(tree_features)
+
+    def image_task():
+        predict(image).numpy()
+
+    def risk_task():
+        if budget is None:
+            tree_model.predict_proba(tree_features)
+            return
+        with budget.model_threads(tree_model):
+            tree_model.predict_proba(tree_features)
+
+    completed = {'image': 0, 'risk': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker(kind, task):
+        while time.perf_counter() < deadline:
+            if budget is not None:
+                with budget.job(kind):
+                    task()
+            else:
+                task()
+            with lock:
+                completed[kind] += 1
+
+    threads = [threading.Thread(target=worker, args=('image', image_task)) for _ in range(args.image_workers)]
+    threads += [threading.Thread(target=worker, args=('risk', risk_task)) for _ in range(args.risk_workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "treeModel": type(tree_model).__name__,
+        "imageTasksPerSecond": completed['image'] / elapsed,
+        "riskTasksPerSecond": completed['risk'] / elapsed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU线程预算混合负载基准测试")
+    parser.add_argument("--image-workers", type=int, default=2, help="执行DFDN推理的线程数")
+    parser.add_argument("--risk-workers", type=int, default=2, help="执行树模型推理的线程数")
+    parser.add_argument("--duration", type=float, default=30.0, help="每种模式的计时秒数")
+    parser.add_argument("--input-size", type=int, default=256)
+    parser.add_argument("--rows", type=int, default=20000, help="每个风险任务预测的行数")
+    parser.add_argument("--trees", type=int, default=200)
+    parser.add_argument("--total-threads", type=int, help="线程预算总数，默认使用CPU核数")
+    parser.add_argument("--mode", choices=["unmanaged", "managed"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args)))
+        return 0
+
+    results = {}
+    for mode in ('unmanaged', 'managed'):
+        print(f"{mode} ...")
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--mode', mode] + sys.argv[1:],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"\nDFDN推理线程 {args.image_workers}，{results['managed']['treeModel']}推理线程 {args.risk_workers}，"
+          f"CPU核数 {os.cpu_count()}")
+    print(f"{'模式':>10} {'图像任务/秒':>12} {'风险任务/秒':>12}")
+    for mode, r in results.items():
+        print(f"{mode:>10} {r['imageTasksPerSecond']:>12.2f} {r['riskTasksPerSecond']:>12.2f}")
+    for kind, key in (('图像', 'imageTasksPerSecond'), ('风险', 'riskTasksPerSecond')):
+        print(f"{kind}任务吞吐量变化: {results['managed'][key] / max(results['unmanaged'][key], 1e-9):.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
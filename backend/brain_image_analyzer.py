@@ -12,6 +12,8 @@ from matplotlib.colors import LinearSegmentedColormap
 import matplotlib.gridspec as gridspec
 from datetime import datetime
 import sys
+import threading
+import time
 
 # 添加models目录到Python路径
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -20,6 +22,9 @@ if current_dir not in sys.path:
 
 # 导入自定义的DFDN模型
 from models.dfdn import DynamicFeatureDecouplingNetwork
+import config
+from image_cascade import CascadeClassifier, load_thresholds, normalize_image
+from image_quality import DECODE_ERROR_REASON, ImageQualityError, check_image_quality
 
 # 设置中文字体支持
 plt.rcParams['font.sans-serif'] = ['SimHei', 'Arial Unicode MS', 'DejaVu Sans', 'FangSong', 'Arial']
@@ -51,30 +56,31 @@ def preprocess_image(image_path, target_size=(256, 256)):
         pil_image = Image.open(image_path).convert('L')  # 转换为灰度图
         image = np.array(pil_image)
         
-        # 调整大小
-        resized = cv2.resize(image, target_size, interpolation=cv2.INTER_LINEAR)
-        
-        # 归一化
-        if resized.max() > resized.min():
-            normalized = (resized - resized.min()) / (resized.max() - resized.min())
-        else:
-            normalized = np.zeros_like(resized, dtype=np.float32)
-        
-        # 添加批次和通道维度
-        normalized = normalized[np.newaxis, ..., np.newaxis]
+        # 调整大小、归一化并添加批次和通道维度
+        normalized = normalize_image(image, target_size)
         
         return normalized, image
+    except FileNotFoundError:
+        # FileNotFoundError也是OSError，文件在检查之后被删除时按缺失文件报告，不当作解码失败
+        raise
+    except OSError as e:
+        # PIL对截断或损坏的文件抛出OSError，作为质量问题直接拒绝
+        print(f"解码图像时出错: {e}")
+        raise ImageQualityError(DECODE_ERROR_REASON)
     except Exception as e:
         print(f"读取图像时出错: {e}")
         raise ValueError(f"无法读取图像: {image_path}")
 
-def load_model(modality='CT'):
+def load_model(modality='CT', input_size=(256, 256)):
     """加载预训练模型"""
-    print(f"正在加载{modality}模型...")
+    print(f"正在加载{modality}模型 (输入尺寸 {input_size[0]}x{input_size[1]})...")
     
+    # DFDN的编码器对输入尺寸没有依赖（卷积 + 按实际序列长度计算的位置编码 + 全局池化），
+    # 同一份权重可以加载到不同输入尺寸的模型上
     model = DynamicFeatureDecouplingNetwork(
-        input_shape=(256, 256, 1),
-        modality=modality
+        input_shape=(input_size[0], input_size[1], 1),
+        modality=modality,
+        precision=config.DFDN_PRECISION
     )
     
     model_path = os.path.join(MODELS_DIR, f'dfdn_{modality.lower()}_model.h5')
@@ -87,6 +93,56 @@ def load_model(modality='CT'):
     
     return model
 
+# 模型缓存，避免每次分析都重新构建网络和加载权重
+_model_cache = {}
+_model_cache_lock = threading.Lock()
+
+def get_model(modality='CT', input_size=(256, 256)):
+    """获取缓存的模型实例"""
+    key = (modality, tuple(input_size))
+    with _model_cache_lock:
+        if key not in _model_cache:
+            _model_cache[key] = load_model(modality, input_size)
+        return _model_cache[key]
+
+def get_cascade_classifier(modality='CT', thresholds=None):
+    """构建级联分类器（模型实例来自缓存），没有阈值的模态阈值为1.0（校准时使用）"""
+    thresholds = thresholds or load_thresholds()
+    return CascadeClassifier(
+        modality,
+        low_res_model=get_model(modality, config.CASCADE_LOW_RES_SIZE),
+        full_model=get_model(modality),
+        threshold=thresholds.get(modality, 1.0),
+        low_res_size=config.CASCADE_LOW_RES_SIZE
+    )
+
+def classify_image(original_image, preprocessed, modality='CT'):
+    """
+    对图像分类并提取特征
+
+    启用级联且该模态有校准阈值时先走低分辨率通道，置信度不足再升级到完整DFDN；
+    否则直接使用完整DFDN。两种情况都只做一次前向传播就同时得到概率和特征。
+    """
+    if config.CASCADE_ENABLED:
+        thresholds = load_thresholds()
+        if modality in thresholds:
+            return get_cascade_classifier(modality, thresholds).classify(original_image, full_input=preprocessed)
+    
+    model = get_model(modality)
+    start = time.perf_counter()
+    probabilities, pathology_features, physiology_features = model.dfdn_model(preprocessed, training=False)
+    latency_ms = (time.perf_counter() - start) * 1000
+    return {
+        "probabilities": probabilities.numpy(),
+        "pathology_features": pathology_features.numpy(),
+        "physiology_features": physiology_features.numpy(),
+        "cascade": {
+            "stage": "full",
+            "escalated": False,
+            "latencyMs": {"lowRes": None, "full": round(latency_ms, 2), "total": round(latency_ms, 2)}
+        }
+    }
+
 def create_feature_heatmap(pathology_features, image_shape=(256, 256)):
     """从病灶特征创建热力图"""
     # 重塑特征为2D网格 - 按照文档中的方法实现
@@ -263,6 +319,23 @@ def save_analysis_report(image_path, modality, result, feature_analysis, save_pa
             f.write(f"  {class_name}: {prob:.4f}\n")
         f.write("\n")
         
+        cascade = result.get('cascade')
+        if cascade:
+            f.write("-" * 40 + "\n")
+            f.write("级联推理\n")
+            f.write("-" * 40 + "\n")
+            f.write(f"决策阶段: {'完整分辨率' if cascade['stage'] == 'full' else '低分辨率'}\n")
+            if 'lowResConfidence' in cascade:
+                f.write(f"低分辨率置信度: {cascade['lowResConfidence']:.4f} (阈值 {cascade['threshold']:.4f})\n")
+            latency = cascade['latencyMs']
+            if latency.get('lowRes') is not None:
+                f.write(f"低分辨率耗时: {latency['lowRes']:.1f} ms\n")
+            if latency.get('full') is not None:
+                f.write(f"完整分辨率耗时: {latency['full']:.1f} ms\n")
+            if 'escalationRate' in cascade:
+                f.write(f"累计升级率: {cascade['escalationRate']:.2%}\n")
+            f.write("\n")
+        
         f.write("-" * 40 + "\n")
         f.write("特征分析\n")
         f.write("-" * 40 + "\n")
@@ -301,39 +374,83 @@ def save_analysis_report(image_path, modality, result, feature_analysis, save_pa
         f.write("注: 本报告由AI辅助诊断系统自动生成，仅供医学参考，不能替代专业医生的诊断。\n")
         f.write("=" * 80 + "\n")
 
-def predict_and_visualize(image_path, modality='CT', output_dir=None):
-    """预测图像并可视化结果"""
+def render_visualization(image_path, modality, prediction, pathology_features, physiology_features,
+                         output_dir=None):
+    """
+    根据分类结果和特征向量生成可视化分析图
+
+    与推理分开，可以在图像分析完成之后由渲染任务单独执行。
+
+    Args:
+        image_path (str): 原始图像路径
+        modality (str): 'CT' 或 'MRI'
+        prediction (dict): predict_and_visualize返回结果中的prediction
+        pathology_features, physiology_features: 病灶特征和生理特征向量（一维）
+
+    Returns:
+        str: 可视化图像路径
+    """
+    if output_dir is None:
+        output_dir = RESULTS_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    
+    _, original_image = preprocess_image(image_path)
+    pathology_features = np.asarray(pathology_features, dtype=np.float32).reshape(1, -1)
+    physiology_features = np.asarray(physiology_features, dtype=np.float32).reshape(1, -1)
+    class_names = list(prediction['probabilities'])
+    
+    base_name = os.path.basename(image_path).split('.')[0]
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    visualization_path = os.path.join(output_dir, f"{base_name}_{modality}_{timestamp}_analysis.png")
+    create_advanced_visualization(
+        original_image,
+        create_feature_heatmap(pathology_features, original_image.shape),
+        [prediction['probabilities'][name] for name in class_names],
+        class_names,
+        prediction['class'],
+        prediction['confidence'],
+        analyze_features(pathology_features, physiology_features),
+        visualization_path
+    )
+    return visualization_path
+
+def predict_and_visualize(image_path, modality='CT', output_dir=None, render=True):
+    """
+    预测图像并可视化结果
+
+    render为False时不生成可视化分析图（visualization_path为None），之后可以用render_visualization补上
+    """
     if output_dir is None:
         output_dir = RESULTS_DIR
     
     # 预处理图像
     preprocessed, original_image = preprocess_image(image_path)
     
-    # 加载模型
-    model = load_model(modality)
-    
-    # 预测
-    predictions = model.predict(preprocessed)
+    # 推理前的质量检查，不合格的图像不进入模型加载和推理（提交任务时已经检查过一次，这里兜底已经排队的任务）
+    if config.QUALITY_GATE_ENABLED:
+        is_valid, reason, quality_metrics = check_image_quality(original_image)
+        print(f"图像质量检查: {'通过' if is_valid else reason} ({quality_metrics['elapsedMs']:.2f} ms)")
+        if not is_valid:
+            raise ImageQualityError(reason, quality_metrics)
+    
+    # 预测并提取特征
+    outputs = classify_image(original_image, preprocessed, modality)
+    predictions = outputs["probabilities"]
+    pathology_features = outputs["pathology_features"]
+    physiology_features = outputs["physiology_features"]
     class_names = ['正常', '缺血性卒中', '出血性卒中']
     pred_class_idx = np.argmax(predictions[0])
     confidence = predictions[0][pred_class_idx]
     predicted_class = class_names[pred_class_idx]
     
-    # 提取特征
-    pathology_features, physiology_features = model.extract_features(preprocessed)
-    
     # 创建结果字典
     result = {
         'class': predicted_class,
         'confidence': float(confidence),
         'probabilities': {class_names[i]: float(predictions[0][i]) for i in range(len(class_names))},
-        'pathology_features': pathology_features.tolist(),  # 转换为列表以便JSON序列化
-        'physiology_features': physiology_features.tolist()
+        'cascade': outputs["cascade"]
     }
     
-    # 生成热力图
-    feature_map = create_feature_heatmap(pathology_features, original_image.shape)
-    
     # 分析特征
     feature_analysis = analyze_features(pathology_features, physiology_features)
     
@@ -346,17 +463,19 @@ def predict_and_visualize(image_path, modality='CT', output_dir=None):
     save_path_base = os.path.join(output_dir, f"{base_name}_{modality}_{timestamp}")
     
     # 创建高级可视化
-    visualization_path = f"{save_path_base}_analysis.png"
-    create_advanced_visualization(
-        original_image, 
-        feature_map, 
-        predictions[0], 
-        class_names, 
-        predicted_class, 
-        confidence, 
-        feature_analysis,
-        visualization_path
-    )
+    visualization_path = None
+    if render:
+        visualization_path = f"{save_path_base}_analysis.png"
+        create_advanced_visualization(
+            original_image, 
+            create_feature_heatmap(pathology_features, original_image.shape), 
+            predictions[0], 
+            class_names, 
+            predicted_class, 
+            confidence, 
+            feature_analysis,
+            visualization_path
+        )
     
     # 保存分析报告
     report_path = f"{save_path_base}_report.txt"
@@ -375,22 +494,35 @@ def predict_and_visualize(image_path, modality='CT', output_dir=None):
     print("\n类别概率:")
     for class_name, prob in result['probabilities'].items():
         print(f"  {class_name}: {prob:.4f}")
+    print(f"决策阶段: {result['cascade']['stage']}, 耗时: {result['cascade']['latencyMs']['total']:.1f} ms")
     
-    print(f"\n详细分析结果已保存到: {visualization_path}")
+    if visualization_path:
+        print(f"\n详细分析结果已保存到: {visualization_path}")
     print(f"分析报告已保存到: {report_path}")
     
     # 返回结果和文件路径
+    # 特征向量以NumPy数组单独返回，由调用方以二进制格式存储，不再内嵌进预测结果
     return {
         "prediction": result,
+        "embeddings": {
+            "pathology": pathology_features[0],
+            "physiology": physiology_features[0]
+        },
         "visualization_path": visualization_path,
         "report_path": report_path,
         "feature_analysis": feature_analysis
     }
 
-def analyze_brain_image(image_path, modality='CT'):
-    """分析脑部图像并返回结果"""
+def analyze_brain_image(image_path, modality='CT', render=True):
+    """分析脑部图像并返回结果，render为False时不生成可视化分析图"""
     try:
-        return predict_and_visualize(image_path, modality)
+        return predict_and_visualize(image_path, modality, render=render)
+    except ImageQualityError as e:
+        return {
+            "error": f"图像质量检查未通过: {e.reason}",
+            "success": False,
+            "qualityCheck": e.metrics
+        }
     except Exception as e:
         print(f"分析图像时发生错误: {str(e)}")
         import traceback
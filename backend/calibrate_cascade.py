@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+级联推理阈值校准脚本
+
+在带标签的图像集上分别运行低分辨率通道和完整DFDN，为每个模态挑选最低的提前退出阈值，
+使级联后的准确率不低于完整DFDN的准确率减去允许的下降幅度。
+
+数据目录按类别分子目录存放图像，子目录名可以是中文类别名或英文别名：
+    data_dir/正常/*.png  (或 normal/)
+    data_dir/缺血性卒中/*.png  (或 ischemic/)
+    data_dir/出血性卒中/*.png  (或 hemorrhagic/)
+
+用法:
+    python calibrate_cascade.py --data-dir /path/to/ct_labeled --modality CT
+    python calibrate_cascade.py --data-dir /path/to/mri_labeled --modality MRI --max-accuracy-drop 0.005
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+import config
+from brain_image_analyzer import get_cascade_classifier
+from models.dfdn_data import iter_labeled_images
+
+
+def choose_threshold(low_res_probs, full_probs, labels, max_accuracy_drop=0.0):
+    """
+    选择满足准确率约束的最低阈值
+
+    Args:
+        low_res_probs (np.ndarray): 低分辨率通道的概率 [N, C]
+        full_probs (np.ndarray): 完整DFDN的概率 [N, C]
+        labels (np.ndarray): 真实类别 [N]
+        max_accuracy_drop (float): 允许的最大准确率下降
+
+    Returns:
+        dict: 阈值、级联准确率、完整DFDN准确率和升级率
+    """
+    low_res_pred = np.argmax(low_res_probs, axis=1)
+    full_pred = np.argmax(full_probs, axis=1)
+    low_res_conf = np.max(low_res_probs, axis=1)
+
+    full_accuracy = float(np.mean(full_pred == labels))
+    target_accuracy = full_accuracy - max_accuracy_drop
+
+    # 候选阈值为所有出现过的置信度，再加一个保证全部升级的上界
+    candidates = np.unique(np.concatenate([low_res_conf, [1.0 + 1e-6]]))
+
+    # 按置信度降序排序后，阈值t对应"置信度>=t的样本提前退出"，用前缀和一次性算出所有候选
+    order = np.argsort(-low_res_conf)
+    sorted_conf = low_res_conf[order]
+    low_correct = (low_res_pred == labels)[order].astype(np.int64)
+    full_correct = (full_pred == labels)[order].astype(np.int64)
+    low_prefix = np.concatenate([[0], np.cumsum(low_correct)])
+    full_suffix = np.concatenate([np.cumsum(full_correct[::-1])[::-1], [0]])
+
+    best = None
+    for threshold in candidates:
+        # 提前退出的样本数
+        n_exit = int(np.searchsorted(-sorted_conf, -threshold, side='right'))
+        accuracy = (low_prefix[n_exit] + full_suffix[n_exit]) / len(labels)
+        if accuracy >= target_accuracy - 1e-12:
+            best = {
+                "threshold": float(threshold),
+                "cascadeAccuracy": float(accuracy),
+                "fullAccuracy": full_accuracy,
+                "escalationRate": float(1 - n_exit / len(labels))
+            }
+            break
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="校准级联推理的提前退出阈值")
+    parser.add_argument("--data-dir", required=True, help="带标签的图像目录（按类别分子目录）")
+    parser.add_argument("--modality", choices=["CT", "MRI"], required=True, help="图像模态")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.0, help="允许的最大准确率下降，默认0")
+    parser.add_argument(
+        "--output",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), config.CASCADE_THRESHOLDS_FILE),
+        help="阈值输出文件"
+    )
+    args = parser.parse_args()
+
+    samples = list(iter_labeled_images(args.data_dir))
+    if not samples:
+        print(f"在 {args.data_dir} 中没有找到带标签的图像")
+        return 1
+    print(f"共找到 {len(samples)} 张带标签的图像")
+
+    classifier = get_cascade_classifier(args.modality)
+
+    low_res_probs, full_probs, labels = [], [], []
+    for i, (image_path, label) in enumerate(samples):
+        image = np.array(Image.open(image_path).convert('L'))
+        low_res, full = classifier.run_stages(image)
+        low_res_probs.append(low_res)
+        full_probs.append(full)
+        labels.append(label)
+        if (i + 1) % 50 == 0:
+            print(f"  已处理 {i + 1}/{len(samples)}")
+
+    result = choose_threshold(
+        np.array(low_res_probs), np.array(full_probs), np.array(labels), args.max_accuracy_drop
+    )
+    result["samples"] = len(samples)
+    result["maxAccuracyDrop"] = args.max_accuracy_drop
+
+    print(f"\n{args.modality} 校准结果:")
+    print(f"  阈值: {result['threshold']:.4f}")
+    print(f"  完整DFDN准确率: {result['fullAccuracy']:.4f}")
+    print(f"  级联准确率: {result['cascadeAccuracy']:.4f}")
+    print(f"  升级率: {result['escalationRate']:.2%}")
+
+    # 合并写入，保留其他模态已有的校准结果
+    thresholds = {}
+    if os.path.exists(args.output):
+        with open(args.output, 'r', encoding='utf-8') as f:
+            thresholds = json.load(f)
+    thresholds[args.modality] = result
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(thresholds, f, ensure_ascii=False, indent=2)
+    print(f"阈值已写入 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+数据库索引模块 - 声明各集合的索引，启动时幂等创建，并用explain检查API的查询是否走索引
+
+hello.py中的热点查询都按userId过滤、按createdAt排序或按fileId/status过滤，
+此前除了任务队列外没有任何集合声明索引，数据量一大每次查询都是全集合扫描。
+INDEXES是各集合需要的索引，ensure_indexes在启动时创建（已存在的同名同定义索引不会重复创建）；
+jobs集合的索引仍由job_queue.MongoJobQueue.ensure_indexes负责。
+QUERY_SHAPES列出API用到的查询形状，explain子命令逐个执行explain并标出全集合扫描（COLLSCAN）。
+
+用法:
+    python db_schema.py ensure
+    python db_schema.py explain
+"""
+import argparse
+import json
+import sys
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+# 集合名 -> [(索引名, 键, 其他选项)]
+INDEXES = {
+    "users": [
+        ("userId_unique", [("userId", ASCENDING)], {"unique": True}),
+    ],
+    "reports": [
+        # 用户最新报告（状态查询、报告查询、病历查询）
+        ("userId_createdAt", [("userId", ASCENDING), ("createdAt", DESCENDING)], {}),
+        # 用户进行中的检测：只索引processing状态的报告，索引很小
+        ("userId_createdAt_processing", [("userId", ASCENDING), ("createdAt", DESCENDING)],
+         {"partialFilterExpression": {"status": "processing"}}),
+        # 按文件查询图像分析结果、更新图像检测状态
+        ("fileId_status", [("fileId", ASCENDING), ("status", ASCENDING)], {}),
+    ],
+    "medical_records": [
+        # 用户的病历/医学图像列表，按userId或userId+imageType查询
+        ("userId_imageType", [("userId", ASCENDING), ("imageType", ASCENDING)], {}),
+    ],
+    "embeddings": [
+        # 相似病例索引按createdAt增量同步
+        ("createdAt", [("createdAt", ASCENDING)], {}),
+    ],
+    "upload_sessions": [
+        # 分块上传会话按_id读写；过期（expiresAt之后）的会话由MongoDB自动删除
+        ("expiresAt_ttl", [("expiresAt", ASCENDING)], {"expireAfterSeconds": 0}),
+    ],
+}
+
+# 用于explain的示例值，查询计划与具体取值无关
+_USER_ID = "explain-user"
+_FILE_ID = "000000000000000000000000"
+
+# (名称, 集合名, 过滤条件, 投影, 排序)，与hello.py和job_queue.py中的查询一一对应；
+# update_one/count_documents按相同的过滤条件检查
+QUERY_SHAPES = [
+    ("用户信息", "users", {"userId": _USER_ID}, None, None),
+    ("用户检测状态", "detection_status", {"_id": f"user:{_USER_ID}"}, {"_id": 0, "status": 1, "reportId": 1}, None),
+    ("任务检测状态", "detection_status", {"_id": "job:explain-job"}, {"_id": 0, "status": 1, "reportId": 1}, None),
+    ("按ID读取报告", "reports", {"_id": ObjectId(_FILE_ID)}, None, None),
+    ("最新报告（无状态文档的旧数据）", "reports", {"userId": _USER_ID}, {"_id": 0, "status": 1, "progress": 1},
+     [("createdAt", DESCENDING)]),
+    ("进行中的检测", "reports", {"userId": _USER_ID, "status": "processing"}, {"_id": 1},
+     [("createdAt", DESCENDING)]),
+    ("更新图像检测状态", "reports", {"userId": _USER_ID, "fileId": _FILE_ID}, None, None),
+    ("图像分析结果", "reports", {"fileId": _FILE_ID, "status": "finished", "analysisCompleted": True}, None, None),
+    ("批量相似病例", "reports",
+     {"fileId": {"$in": [_FILE_ID]}, "status": "finished", "embeddingId": {"$ne": None}},
+     {"_id": 0, "fileId": 1, "embeddingId": 1}, None),
+    ("病历列表", "medical_records", {"userId": _USER_ID}, {"_id": 0, "userId": 0}, None),
+    ("医学图像列表", "medical_records", {"userId": _USER_ID, "imageType": "CT"}, {"_id": 1, "fileUrl": 1}, None),
+    ("病历文件", "medical_records", {"_id": ObjectId(_FILE_ID)}, None, None),
+    ("上传会话", "upload_sessions", {"_id": "explain-upload", "status": "uploading", "offset": 0}, None, None),
+    ("文件引用计数", "blobs", {"_id": "ab/cd/explain", "state": "live"}, None, None),
+    ("特征向量", "embeddings", {"_id": ObjectId(_FILE_ID)}, None, None),
+    ("相似病例增量同步", "embeddings",
+     {"vectors.pathology": {"$exists": True}, "createdAt": {"$gte": datetime.now()}}, None, [("createdAt", ASCENDING)]),
+    ("领取任务", "jobs", {"status": "queued", "availableAt": {"$lte": datetime.now()}, "kind": {"$in": ["risk"]}},
+     None, [("availableAt", ASCENDING)]),
+    ("通道排队数", "jobs", {"status": "queued", "kind": "risk"}, {"_id": 1}, None),
+    ("回收过期租约", "jobs", {"status": "running", "leaseExpiresAt": {"$lt": datetime.now()}}, None, None),
+]
+
+
+def ensure_indexes(db):
+    """
+    创建INDEXES中声明的索引
+
+    同名索引的定义与声明不一致（或已有重复数据导致唯一索引创建失败）时只打印警告，不影响启动。
+
+    Returns:
+        list: 创建失败的 (集合名, 索引名, 错误信息)
+    """
+    failures = []
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        for name, keys, options in indexes:
+            try:
+                collection.create_index(keys, name=name, **options)
+            except OperationFailure as e:
+                print(f"警告: 创建索引 {collection_name}.{name} 失败: {str(e)}")
+                failures.append((collection_name, name, str(e)))
+    return failures
+
+
+def _plan_summary(node, stages, index_names):
+    """递归收集执行计划中的阶段名和索引名（兼容classic和SBE两种explain格式）"""
+    if isinstance(node, dict):
+        if "stage" in node:
+            stages.append(node["stage"])
+        if "indexName" in node:
+            index_names.append(node["indexName"])
+        for key, value in node.items():
+            # 只看选中的计划，被淘汰的候选计划会包含COLLSCAN
+            if key not in ("rejectedPlans", "allPlansExecution"):
+                _plan_summary(value, stages, index_names)
+    elif isinstance(node, list):
+        for item in node:
+            _plan_summary(item, stages, index_names)
+
+
+def summarize_explain(explain):
+    """
+    从explain结果中提取选中计划的阶段、所用索引和扫描数
+
+    Returns:
+        dict: stages、indexes、collscan（是否全集合扫描）以及executionStats中的扫描/返回文档数
+    """
+    stages, index_names = [], []
+    _plan_summary(explain.get("queryPlanner", {}).get("winningPlan", {}), stages, index_names)
+    execution = explain.get("executionStats", {})
+    return {
+        "stages": stages,
+        "indexes": sorted(set(index_names)),
+        "collscan": "COLLSCAN" in stages,
+        "docsExamined": execution.get("totalDocsExamined"),
+        "keysExamined": execution.get("totalKeysExamined"),
+        "returned": execution.get("nReturned")
+    }
+
+
+def explain_queries(db, shapes=QUERY_SHAPES):
+    """对每个查询形状执行explain，返回 [(名称, 集合名, 摘要)]"""
+    results = []
+    for name, collection_name, query, projection, sort in shapes:
+        cursor = db[collection_name].find(query, projection).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        results.append((name, collection_name, summarize_explain(cursor.explain())))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="数据库索引创建与查询计划检查")
+    parser.add_argument("command", choices=["ensure", "explain"], help="ensure: 创建索引；explain: 检查查询计划")
+    parser.add_argument("--json", action="store_true", help="explain结果以JSON输出")
+    args = parser.parse_args()
+
+    import pymongo
+    import config
+
+    client = pymongo.MongoClient(config.MONGO_URI)
+    db = client[config.DATABASE_NAME]
+
+    if args.command == "ensure":
+        from job_queue import MongoJobQueue
+        MongoJobQueue(db["jobs"]).ensure_indexes()
+        failures = ensure_indexes(db)
+        print(f"索引检查完成，{len(failures)} 个失败")
+        return 1 if failures else 0
+
+    results = explain_queries(db)
+    if args.json:
+        print(json.dumps([{"name": name, "collection": collection, **summary}
+                          for name, collection, summary in results], ensure_ascii=False, indent=2))
+    else:
+        for name, collection, summary in results:
+            flag = "COLLSCAN" if summary["collscan"] else "ok"
+            print(f"[{flag:>8}] {collection}.{name}: {' -> '.join(summary['stages'])} "
+                  f"索引={','.join(summary['indexes']) or '-'} "
+                  f"扫描文档={summary['docsExamined']} 返回={summary['returned']}")
+    collscans = [name for name, _, summary in results if summary["collscan"]]
+    if collscans:
+        print(f"\n{len(collscans)} 个查询为全集合扫描: {', '.join(collscans)}")
+        return 1
+    print("\n所有查询都使用了索引")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
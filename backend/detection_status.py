@@ -0,0 +1,151 @@
+"""
+检测状态模块 - 按用户和按任务维护精简的状态文档，状态和最新报告查询只需按_id读取一个小文档
+
+原来/api/detect/status、/api/detect/report和/api/user/medical-record每次都要对用户的全部报告
+按createdAt排序找出最新一份，状态轮询还要读取整份报告只为了取两个字段。这里在detection_status集合中维护:
+    - user:<userId>  用户最近一次检测：jobId、reportId、status、progress、message、provisional和时间
+    - job:<jobId>    单个检测任务的同样字段
+报告的创建和状态变化（提交、完成、失败）时同步更新；部署支持事务（副本集/分片集群）时
+报告写入和状态写入放在同一个事务中，单机MongoDB上依次写入（先写报告）。
+
+没有状态文档的旧数据由调用方回退到原来的排序查询，并用backfill补写。
+"""
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+STATUS_PROJECTION = {
+    "_id": 0, "userId": 1, "jobId": 1, "reportId": 1, "kind": 1, "status": 1, "progress": 1,
+    "message": 1, "provisional": 1, "createdAt": 1, "updatedAt": 1
+}
+
+# 补写旧数据时从报告中读取的字段
+LEGACY_REPORT_PROJECTION = {
+    "_id": 1, "status": 1, "progress": 1, "progressMessage": 1, "jobId": 1, "provisional": 1,
+    "fileId": 1, "createdAt": 1
+}
+
+
+def status_from_report(user_id, report):
+    """由报告（至少包含LEGACY_REPORT_PROJECTION中的字段）构造用户状态文档"""
+    return {
+        "userId": user_id,
+        "jobId": report.get("jobId"),
+        "reportId": report["_id"],
+        "kind": "image" if report.get("fileId") else "risk",
+        "status": report.get("status", "processing"),
+        "progress": report.get("progress", 0),
+        "message": report.get("progressMessage", ""),
+        "provisional": bool(report.get("provisional")),
+        "createdAt": report.get("createdAt", datetime.now()),
+        "updatedAt": datetime.now()
+    }
+
+
+class DetectionStatusStore:
+    """用户和任务的检测状态文档"""
+
+    def __init__(self, collection, client=None):
+        """
+        Args:
+            collection: MongoDB集合（detection_status）
+            client: MongoClient，用于判断是否支持事务；为None时不使用事务
+        """
+        self.collection = collection
+        self.client = client
+
+    @staticmethod
+    def user_key(user_id):
+        return f"user:{user_id}"
+
+    @staticmethod
+    def job_key(job_id):
+        return f"job:{job_id}"
+
+    def supports_transactions(self):
+        """副本集和分片集群支持多文档事务，单机MongoDB不支持"""
+        if self.client is None:
+            return False
+        return self.client.topology_description.topology_type_name in ("ReplicaSetWithPrimary", "Sharded")
+
+    def write(self, callback):
+        """
+        执行callback(session)，支持事务时在同一个事务中执行
+
+        callback中的报告写入和状态写入都要传入session（不支持事务时为None）。
+
+        Returns:
+            callback的返回值
+        """
+        if not self.supports_transactions():
+            return callback(None)
+        with self.client.start_session() as session:
+            return session.with_transaction(callback)
+
+    def start(self, user_id, job_id, report_id, kind, message="", session=None):
+        """新的检测任务已提交：写入任务状态，并把用户的最新检测指向该任务"""
+        now = datetime.now()
+        fields = {
+            "userId": user_id,
+            "jobId": job_id,
+            "reportId": report_id,
+            "kind": kind,
+            "status": "processing",
+            "progress": 0,
+            "message": message,
+            "provisional": False,
+            "createdAt": now,
+            "updatedAt": now
+        }
+        self.collection.replace_one({"_id": self.job_key(job_id)}, fields, upsert=True, session=session)
+        self.collection.replace_one({"_id": self.user_key(user_id)}, fields, upsert=True, session=session)
+
+    def update(self, user_id, job_id, status, progress, message="", provisional=False, report_id=None, session=None):
+        """
+        更新任务状态；用户的最新检测仍是该任务时同时更新用户状态
+
+        Returns:
+            dict: 更新后的任务状态，任务状态不存在时返回None
+        """
+        fields = {
+            "status": status,
+            "progress": progress,
+            "message": message,
+            "provisional": provisional,
+            "updatedAt": datetime.now()
+        }
+        if report_id is not None:
+            fields["reportId"] = report_id
+        job = self.collection.find_one_and_update(
+            {"_id": self.job_key(job_id)},
+            {"$set": fields},
+            projection=STATUS_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        # 条件中带上jobId，旧任务结束时不会覆盖用户新提交的检测
+        self.collection.update_one(
+            {"_id": self.user_key(user_id), "jobId": job_id},
+            {"$set": fields},
+            session=session
+        )
+        return job
+
+    def backfill(self, user_id, report):
+        """用排序查询得到的最新报告补写用户状态（旧数据没有状态文档），已有状态文档时不覆盖"""
+        fields = status_from_report(user_id, report)
+        try:
+            self.collection.update_one({"_id": self.user_key(user_id)}, {"$setOnInsert": fields}, upsert=True)
+        except DuplicateKeyError:
+            # 并发的请求已经补写
+            pass
+        return fields
+
+    def get_user(self, user_id):
+        """用户最近一次检测的状态，没有时返回None"""
+        return self.collection.find_one({"_id": self.user_key(user_id)}, STATUS_PROJECTION)
+
+    def get_job(self, job_id):
+        """任务的状态，没有时返回None"""
+        return self.collection.find_one({"_id": self.job_key(job_id)}, STATUS_PROJECTION)
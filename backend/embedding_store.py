@@ -0,0 +1,109 @@
+"""
+特征向量存储模块 - 以紧凑的二进制格式保存DFDN特征
+
+DFDN输出的病灶特征和生理特征各128维，以JSON列表/BSON double存进报告时每份报告
+要多带256个浮点数，读取报告的接口每次也都要把它们传回去。这里把特征打包成
+float16/float32二进制，单独存放在embeddings集合中，报告里只保留embeddingId。
+"""
+from datetime import datetime
+
+import numpy as np
+from bson.binary import Binary
+from bson.objectid import ObjectId
+
+# 读取报告时默认排除的字段（兼容特征仍以列表形式内嵌在报告中的旧数据）
+REPORT_DEFAULT_PROJECTION = {
+    "_id": 0,
+    "prediction.pathology_features": 0,
+    "prediction.physiology_features": 0
+}
+
+SUPPORTED_DTYPES = {"float16", "float32"}
+
+
+def pack_vector(vector, dtype="float16"):
+    """
+    将特征向量打包为二进制
+
+    Args:
+        vector (np.ndarray): 特征向量
+        dtype (str): 存储精度，'float16' 或 'float32'
+
+    Returns:
+        dict: 包含dtype、shape和二进制数据的子文档
+    """
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"不支持的存储精度: {dtype}")
+
+    array = np.ascontiguousarray(vector, dtype=dtype)
+    return {
+        "dtype": dtype,
+        "shape": list(array.shape),
+        # 统一使用小端字节序，保证跨平台读取一致
+        "data": Binary(array.astype(array.dtype.newbyteorder('<'), copy=False).tobytes())
+    }
+
+
+def unpack_vector(packed):
+    """将pack_vector生成的子文档还原为float32数组"""
+    dtype = np.dtype(packed["dtype"]).newbyteorder('<')
+    array = np.frombuffer(bytes(packed["data"]), dtype=dtype)
+    return array.reshape(packed["shape"]).astype(np.float32)
+
+
+class EmbeddingStore:
+    """基于MongoDB集合的特征向量存储"""
+
+    def __init__(self, collection, dtype="float16"):
+        """
+        初始化特征向量存储
+
+        Args:
+            collection: MongoDB集合（embeddings）
+            dtype (str): 存储精度，'float16' 或 'float32'
+        """
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"不支持的存储精度: {dtype}")
+        self.collection = collection
+        self.dtype = dtype
+
+    def save(self, vectors, metadata=None):
+        """
+        保存一组特征向量
+
+        Args:
+            vectors (dict): 名称 -> 特征向量，例如 {"pathology": ..., "physiology": ...}
+            metadata (dict): 附加信息（userId、fileId、modality、predictedClass等）
+
+        Returns:
+            str: embeddingId
+        """
+        document = dict(metadata or {})
+        document["vectors"] = {name: pack_vector(vector, self.dtype) for name, vector in vectors.items()}
+        document["createdAt"] = datetime.now()
+        return str(self.collection.insert_one(document).inserted_id)
+
+    def load(self, embedding_id, names=None):
+        """
+        读取特征向量
+
+        Args:
+            embedding_id (str): embeddingId
+            names (list): 只读取指定名称的向量，默认全部读取
+
+        Returns:
+            dict: 名称 -> float32数组，找不到时返回None
+        """
+        projection = {"vectors": 1}
+        if names:
+            projection = {f"vectors.{name}": 1 for name in names}
+
+        document = self.collection.find_one({"_id": ObjectId(embedding_id)}, projection)
+        if not document:
+            return None
+
+        return {name: unpack_vector(packed) for name, packed in document.get("vectors", {}).items()}
+
+    def delete(self, embedding_id):
+        """删除特征向量"""
+        return self.collection.delete_one({"_id": ObjectId(embedding_id)}).deleted_count > 0
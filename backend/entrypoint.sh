@@ -3,5 +3,10 @@
 pip install -r requirements.txt
 
 
-# 启动应用
-python3 hello.py
\ No newline at end of file
+if [ "$1" = "progress" ]; then
+    # 检测进度长连接的异步部署（单独启动），反向代理把/api/detect/events和/api/detect/wait转发到这里
+    exec hypercorn -c python:hypercorn_conf async_app:application
+fi
+
+# 启动应用（多进程，主进程预加载模型，见gunicorn.conf.py）
+exec gunicorn -c gunicorn.conf.py hello:app
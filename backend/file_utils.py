@@ -1,60 +1,248 @@
 """
 文件处理工具模块
+
+文件按内容的SHA-256存为blob（storage_backends.blob_key：按哈希前缀分层的路径），
+内容相同的文件只存一份。blobs集合记录每个blob被多少条记录引用（病历记录、报告中的分析结果），
+delete_file释放一个引用，最后一个引用释放时才删除文件。
+写入时先在本地临时目录按块写入并计算SHA-256，得到键之后再交给存储后端（本地存储为原子重命名）。
 """
+import hashlib
 import os
+import shutil
+import time
 import uuid
 from datetime import datetime
 
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from storage_backends import LocalStorage, blob_key, is_blob_key
+
+# 流式写入时每次读取的字节数，内存占用与文件大小无关
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# 分块上传的分块文件目录和写入中的临时文件目录（在存储目录下，不通过/uploads提供访问）
+PARTIAL_DIR = ".partial"
+TEMP_DIR = ".tmp"
+
+# blob正在被删除（引用计数降到0）时，新的引用等待删除完成后重新创建的次数和间隔
+BLOB_ACQUIRE_RETRIES = 50
+BLOB_ACQUIRE_RETRY_SECONDS = 0.05
+
+
+class FileSignatureError(ValueError):
+    """文件开头的字节与扩展名不符"""
+
+
+class UploadSizeError(ValueError):
+    """上传的数据超过了允许的大小"""
+
+
+class _ConcatenatedChunks:
+    """按偏移量顺序依次读取各分块文件的流"""
+
+    def __init__(self, directory, chunks):
+        self.directory = directory
+        self.pending = sorted(chunks, key=lambda chunk: chunk["offset"])
+        self.expected_offset = 0
+        self.current = None
+
+    def read(self, size):
+        while True:
+            if self.current is None:
+                if not self.pending:
+                    return b""
+                chunk = self.pending.pop(0)
+                if chunk["offset"] != self.expected_offset:
+                    raise ValueError(f"分块不连续: 期望偏移量 {self.expected_offset}，实际 {chunk['offset']}")
+                self.expected_offset += chunk["size"]
+                self.current = open(os.path.join(self.directory, chunk["name"]), "rb")
+            block = self.current.read(size)
+            if block:
+                return block
+            self.current.close()
+            self.current = None
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+
+
 class FileHandler:
     """文件处理类"""
     
-    def __init__(self, storage_dir="uploads"):
+    def __init__(self, storage_dir="uploads", backend=None, blobs=None):
         """
         初始化文件处理器
         
         Args:
-            storage_dir (str): 文件存储目录
+            storage_dir (str): 本地目录，存放分块上传的分块和写入中的临时文件；
+                backend为None时也是文件的存储目录
+            backend: 存储后端（storage_backends.py），默认是storage_dir下的本地存储
+            blobs: MongoDB集合（blobs），记录各blob的引用计数；为None时不计数，blob不会被删除
         """
         self.storage_dir = storage_dir
+        self.backend = backend or LocalStorage(storage_dir)
+        self.blobs = blobs
         
         # 确保存储目录存在
-        if not os.path.exists(storage_dir):
-            os.makedirs(storage_dir)
+        os.makedirs(os.path.join(storage_dir, TEMP_DIR), exist_ok=True)
     
-    def save_file(self, file, user_id):
+    @staticmethod
+    def peek(file, size):
         """
-        保存上传的文件
+        读取上传文件开头的size个字节（用于检查文件格式），读取后回到文件开头
         
         Args:
             file: 上传的文件对象
-            user_id (str): 用户ID
-            
+            size (int): 字节数
+        """
+        head = file.stream.read(size)
+        file.stream.seek(0)
+        return head
+    
+    @staticmethod
+    def url(key):
+        """文件的访问URL（见hello.py中的/uploads接口）"""
+        # 注意：在实际生产环境中，应该使用配置的域名和CDN
+        return f"/uploads/{key}"
+    
+    def _file_info(self, original_filename, key, size, sha256, image_type=None):
+        info = {
+            "originalName": original_filename,
+            "fileName": key,
+            "fileUrl": self.url(key),
+            "fileSize": size,
+            "sha256": sha256,
+            "uploadTime": datetime.now()
+        }
+        if image_type:
+            info["imageType"] = image_type
+        return info
+    
+    def _write_stream(self, stream, file_path, max_bytes=None, head_check=None, head_size=0):
+        """
+        把流按块写入文件，同时计算大小和SHA-256
+        
+        先写入同目录下的临时文件，写完后重命名为file_path，中途失败时不会留下不完整的文件。
+        
+        Args:
+            stream: 有read(size)方法的输入流
+            file_path (str): 目标文件路径
+            max_bytes (int): 最多写入的字节数，超过时抛出UploadSizeError
+            head_check (callable): 读到开头的head_size个字节（或整个流）后调用，
+                返回 (是否有效, 错误信息)，无效时抛出FileSignatureError
+            head_size (int): head_check检查的字节数
+        
         Returns:
-            dict: 包含文件信息的字典
+            tuple: (字节数, SHA-256十六进制字符串)
         """
-        # 生成唯一文件名
-        original_filename = file.filename
-        file_ext = os.path.splitext(original_filename)[1]
-        unique_filename = f"{user_id}_{uuid.uuid4().hex}{file_ext}"
+        digest = hashlib.sha256()
+        size = 0
+        head = b""
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                while True:
+                    block = stream.read(COPY_BUFFER_SIZE)
+                    if not block:
+                        break
+                    size += len(block)
+                    if max_bytes is not None and size > max_bytes:
+                        raise UploadSizeError(f"数据超过 {max_bytes} 字节")
+                    if head_check is not None and len(head) < head_size:
+                        head += block[:head_size - len(head)]
+                        if len(head) >= head_size:
+                            self._check_head(head_check, head)
+                    digest.update(block)
+                    f.write(block)
+            if head_check is not None and len(head) < head_size:
+                self._check_head(head_check, head)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return size, digest.hexdigest()
+    
+    @staticmethod
+    def _check_head(head_check, head):
+        is_valid, error_message = head_check(head)
+        if not is_valid:
+            raise FileSignatureError(error_message)
+    
+    def _store_stream(self, stream, ext):
+        """
+        把流存为blob，并增加一个引用
         
-        # 构建文件路径
-        file_path = os.path.join(self.storage_dir, unique_filename)
+        Returns:
+            tuple: (键, 字节数, SHA-256)
+        """
+        temp_path = os.path.join(self.storage_dir, TEMP_DIR, uuid.uuid4().hex)
+        try:
+            size, sha256 = self._write_stream(stream, temp_path)
+            key = blob_key(sha256, ext)
+            self._acquire(key, sha256, size)
+            try:
+                # 内容相同的blob已经存在时不再写入
+                if not self.backend.exists(key):
+                    self.backend.put_file(key, temp_path)
+            except BaseException:
+                self.delete_file(key)
+                raise
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return key, size, sha256
+    
+    def _acquire(self, key, sha256, size):
+        """增加blob的引用计数，没有记录时创建"""
+        if self.blobs is None:
+            return
+        for _ in range(BLOB_ACQUIRE_RETRIES):
+            try:
+                self.blobs.update_one(
+                    {"_id": key, "state": "live"},
+                    {"$inc": {"refCount": 1}, "$setOnInsert": {"sha256": sha256, "size": size, "createdAt": datetime.now()}},
+                    upsert=True
+                )
+                return
+            except DuplicateKeyError:
+                # 最后一个引用刚被释放，blob正在删除（state为deleting），删除完成后重新创建
+                time.sleep(BLOB_ACQUIRE_RETRY_SECONDS)
+        raise RuntimeError(f"blob {key} 一直处于删除中")
+    
+    def store_file(self, path, remove_source=True):
+        """
+        把本地文件（图像分析生成的可视化分析图和报告、迁移前的旧文件）存为blob
         
-        # 保存文件
-        file.save(file_path)
+        Args:
+            path (str): 本地文件路径
+            remove_source (bool): 存储后是否删除原文件
         
-        # 构建文件URL
-        # 注意：在实际生产环境中，应该使用配置的域名和CDN
-        file_url = f"/uploads/{unique_filename}"
+        Returns:
+            dict: key、size、sha256
+        """
+        with open(path, "rb") as f:
+            key, size, sha256 = self._store_stream(f, os.path.splitext(path)[1])
+        if remove_source:
+            os.remove(path)
+        return {"key": key, "size": size, "sha256": sha256}
+    
+    def save_file(self, file, user_id):
+        """
+        保存上传的文件（按块写入，同时计算大小和SHA-256）
         
-        return {
-            "originalName": original_filename,
-            "fileName": unique_filename,
-            "filePath": file_path,
-            "fileUrl": file_url,
-            "fileSize": os.path.getsize(file_path),
-            "uploadTime": datetime.now()
-        }
+        Args:
+            file: 上传的文件对象
+            user_id (str): 用户ID
+        
+        Returns:
+            dict: 包含文件信息的字典
+        """
+        original_filename = file.filename
+        key, size, sha256 = self._store_stream(file.stream, os.path.splitext(original_filename)[1])
+        return self._file_info(original_filename, key, size, sha256)
     
     def save_medical_image(self, file, user_id, image_type):
         """
@@ -64,48 +252,134 @@ class FileHandler:
             file: 上传的文件对象
             user_id (str): 用户ID
             image_type (str): 图像类型 ('MRI' 或 'CT')
-            
+        
         Returns:
             dict: 包含文件信息的字典
         """
-        # 生成唯一文件名，包含图像类型前缀
         original_filename = file.filename
-        file_ext = os.path.splitext(original_filename)[1]
-        unique_filename = f"{image_type}_{user_id}_{uuid.uuid4().hex}{file_ext}"
+        key, size, sha256 = self._store_stream(file.stream, os.path.splitext(original_filename)[1])
+        return self._file_info(original_filename, key, size, sha256, image_type)
+    
+    def _upload_dir(self, upload_id):
+        return os.path.join(self.storage_dir, PARTIAL_DIR, upload_id)
+    
+    def write_chunk(self, upload_id, offset, stream, max_bytes, head_check=None, head_size=0):
+        """
+        把分块上传的一个分块写入该上传的分块目录
+        
+        每个分块是单独的文件（文件名包含偏移量和随机后缀），同一偏移量的并发请求互不覆盖，
+        由调用方决定采用哪一个；连接中断时不完整的分块被删除。
         
-        # 构建文件路径
-        file_path = os.path.join(self.storage_dir, unique_filename)
+        Args:
+            upload_id (str): 上传ID
+            offset (int): 分块在文件中的偏移量
+            stream: 分块数据的输入流
+            max_bytes (int): 分块最多的字节数
+            head_check (callable): 第一个分块的格式检查，见_write_stream
+            head_size (int): head_check检查的字节数
+        
+        Returns:
+            dict: name（分块文件名）、size、sha256
+        """
+        directory = self._upload_dir(upload_id)
+        os.makedirs(directory, exist_ok=True)
+        name = f"{offset}.{uuid.uuid4().hex}.chunk"
+        size, sha256 = self._write_stream(stream, os.path.join(directory, name), max_bytes, head_check, head_size)
+        return {"name": name, "size": size, "sha256": sha256}
+    
+    def discard_chunk(self, upload_id, name):
+        path = os.path.join(self._upload_dir(upload_id), name)
+        if os.path.exists(path):
+            os.remove(path)
+    
+    def assemble_upload(self, upload_id, chunks, original_filename, user_id, image_type=None):
+        """
+        按偏移量顺序拼接分块，得到最终文件，拼接时计算整个文件的大小和SHA-256
         
-        # 保存文件
-        file.save(file_path)
+        Args:
+            upload_id (str): 上传ID
+            chunks (list): 已提交的分块 [{"offset", "name", "size"}]，偏移量必须连续
+            original_filename (str): 原始文件名
+            user_id (str): 用户ID
+            image_type (str): 图像类型，病历文件为None
         
-        # 构建文件URL
-        file_url = f"/uploads/{unique_filename}"
+        Returns:
+            dict: 与save_file相同的文件信息
+        """
+        stream = _ConcatenatedChunks(self._upload_dir(upload_id), chunks)
+        try:
+            key, size, sha256 = self._store_stream(stream, os.path.splitext(original_filename)[1])
+        finally:
+            stream.close()
+        return self._file_info(original_filename, key, size, sha256, image_type)
+    
+    def discard_upload(self, upload_id):
+        """删除分块上传的所有分块文件"""
+        shutil.rmtree(self._upload_dir(upload_id), ignore_errors=True)
+    
+    def purge_stale_uploads(self, max_age_seconds):
+        """
+        删除超过max_age_seconds没有写入新分块的分块目录（会话已过期或被放弃的上传）
         
-        return {
-            "originalName": original_filename,
-            "fileName": unique_filename,
-            "filePath": file_path,
-            "fileUrl": file_url,
-            "fileSize": os.path.getsize(file_path),
-            "imageType": image_type,
-            "uploadTime": datetime.now()
-        }
+        Returns:
+            int: 删除的目录数
+        """
+        root = os.path.join(self.storage_dir, PARTIAL_DIR)
+        if not os.path.isdir(root):
+            return 0
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        for entry in os.scandir(root):
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+    
+    def exists(self, key):
+        return self.backend.exists(key)
+    
+    def open(self, key):
+        return self.backend.open(key)
+    
+    def local_path(self, key):
+        """按路径读取文件的上下文管理器，见StorageBackend.local_path"""
+        return self.backend.local_path(key)
     
     def delete_file(self, filename):
         """
-        删除文件
+        释放文件的一个引用，最后一个引用释放时删除文件；迁移前的旧文件（扁平文件名）直接删除
         
         Args:
-            filename (str): 文件名
-            
+            filename (str): 文件的键（记录中的storedFileName）
+        
         Returns:
-            bool: 是否删除成功
+            bool: 是否释放/删除成功
         """
-        file_path = os.path.join(self.storage_dir, filename)
+        if not is_blob_key(filename):
+            if self.backend.exists(filename):
+                self.backend.delete(filename)
+                return True
+            return False
+        
+        if self.blobs is None:
+            # 不计数时无法知道是否还有其他引用，不删除
+            return False
+        
+        blob = self.blobs.find_one_and_update(
+            {"_id": filename, "state": "live", "refCount": {"$gt": 0}},
+            {"$inc": {"refCount": -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if blob is None:
+            return False
         
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            return True
+        # 先把记录标记为删除中，并发的新引用会等待删除完成后重新创建，不会引用到被删除的文件
+        if blob["refCount"] == 0 and self.blobs.update_one(
+                {"_id": filename, "state": "live", "refCount": 0}, {"$set": {"state": "deleting"}}).modified_count:
+            self.backend.delete(filename)
+            self.blobs.delete_one({"_id": filename, "state": "deleting"})
         
-        return False 
\ No newline at end of file
+        return True
@@ -0,0 +1,41 @@
+"""
+gunicorn配置 - 生产环境多进程部署
+
+用法:
+    gunicorn -c gunicorn.conf.py hello:app
+
+集成模型在主进程中预加载，工作进程fork后共享；MongoDB连接、检测任务工作线程和DFDN模型
+在每个工作进程中创建（见serving.py）。
+
+gthread工作进程中每个检测进度连接（/api/detect/events、/api/detect/wait）占一个请求线程，
+反向代理应该把这两个接口转发到单独的异步部署（entrypoint.sh progress，见hypercorn_conf.py）。
+"""
+# gunicorn把本文件中的模块级变量都当作配置项，"config"本身是gunicorn的配置项，所以换个名字导入
+import config as app_config
+import serving
+
+bind = f"{app_config.HOST}:{app_config.PORT}"
+workers = serving.worker_count()
+worker_class = "gthread"
+threads = app_config.SERVING_REQUEST_THREADS
+max_requests = app_config.SERVING_MAX_REQUESTS
+max_requests_jitter = app_config.SERVING_MAX_REQUESTS_JITTER
+timeout = app_config.SERVING_TIMEOUT
+graceful_timeout = app_config.SERVING_GRACEFUL_TIMEOUT
+
+# 应用在工作进程中加载（MongoClient不能跨fork共享），模型在下面的主进程代码中预加载
+preload_app = False
+
+serving.preload_models(workers)
+
+
+def post_fork(server, worker):
+    serving.configure_worker(server.cfg.workers)
+
+
+def post_worker_init(worker):
+    serving.start_embedded_workers()
+
+
+def worker_exit(server, worker):
+    serving.stop_embedded_workers()
@@ -1,13 +1,35 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 import pymongo
 from bson.objectid import ObjectId
 import os
+import json
+import mimetypes
+import time
+from contextlib import closing
 from datetime import datetime
 import config
-from validators import validate_basic_info, validate_lifestyle, validate_symptoms, validate_file_upload, validate_image_file
+from thread_budget import get_thread_budget
+
+# 在导入TensorFlow、PyTorch和树模型库之前固定各自的线程数
+thread_budget = get_thread_budget()
+thread_budget.configure_process()
+
+from validators import (validate_basic_info, validate_lifestyle, validate_symptoms, validate_file_upload, validate_image_file,
+                        validate_file_signature, validate_upload_init, SIGNATURE_BYTES)
 from risk_calculator import RiskCalculator
-from file_utils import FileHandler
+from file_utils import FileHandler, FileSignatureError, UploadSizeError
+from embedding_store import EmbeddingStore, REPORT_DEFAULT_PROJECTION
+from similarity_index import SimilarCaseIndex
+from job_queue import create_job_queue, new_job_id
+from lane_scheduler import LaneScheduler, LaneSaturatedError
+from risk_scoring import SOURCE_CALCULATOR, SOURCE_MODEL, DeadlineRiskScorer
+from progress_broker import ProgressBroker, is_terminal, seq_at
+from db_schema import ensure_indexes
+from detection_status import DetectionStatusStore, LEGACY_REPORT_PROJECTION
+from upload_sessions import UploadSessionStore
+from storage_backends import LocalStorage, create_storage_backend
+from image_quality import check_image_bytes
 
 app = Flask(__name__)
 CORS(app)
@@ -21,9 +43,57 @@ db = client[config.DATABASE_NAME]
 users_collection = db["users"]
 medical_records_collection = db["medical_records"]
 reports_collection = db["reports"]
+embeddings_collection = db["embeddings"]
+detection_status_collection = db["detection_status"]
+upload_sessions_collection = db["upload_sessions"]
+
+# 检测任务队列（任务持久化在jobs集合中，由Web进程内的工作线程或worker.py进程执行）
+job_queue = create_job_queue(
+    db,
+    backend=config.JOB_QUEUE_BACKEND,
+    lease_seconds=config.JOB_LEASE_SECONDS,
+    max_attempts=config.JOB_MAX_ATTEMPTS,
+    retry_delay=config.JOB_RETRY_DELAY_SECONDS
+)
+
+# 启动时创建各集合的索引（已存在时不重复创建），数据库暂时不可用时不影响启动
+if config.DB_ENSURE_INDEXES:
+    try:
+        ensure_indexes(db)
+        job_queue.ensure_indexes()
+    except pymongo.errors.PyMongoError as e:
+        print(f"警告: 创建数据库索引失败: {str(e)}")
+
+# 按通道调度：风险评分、图像推理和可视化渲染分别排队、分别执行
+scheduler = LaneScheduler(job_queue, config.JOB_LANES)
+
+# 检测进度的进程内发布/订阅，MongoDB只在状态变化时更新
+progress_broker = ProgressBroker()
+
+# 用户和任务的精简状态文档（最新报告指针），与报告一起写入
+status_store = DetectionStatusStore(detection_status_collection, client)
+
+# 初始化文件处理器（文件按内容哈希存储在配置的存储后端，blobs集合记录引用计数）
+storage_backend = create_storage_backend(
+    config.STORAGE_BACKEND, root=config.UPLOAD_FOLDER, bucket=config.STORAGE_S3_BUCKET, prefix=config.STORAGE_S3_PREFIX,
+    endpoint_url=config.STORAGE_S3_ENDPOINT_URL, region=config.STORAGE_S3_REGION
+)
+file_handler = FileHandler(storage_dir=config.UPLOAD_FOLDER, backend=storage_backend, blobs=db["blobs"])
+
+# 分块上传会话（大文件、断点续传）
+upload_sessions = UploadSessionStore(upload_sessions_collection, config.UPLOAD_SESSION_TTL_SECONDS)
 
-# 初始化文件处理器
-file_handler = FileHandler(storage_dir=config.UPLOAD_FOLDER)
+# 初始化特征向量存储
+embedding_store = EmbeddingStore(embeddings_collection, dtype=config.EMBEDDING_DTYPE)
+
+# 初始化相似病例索引（首次查询时从embeddings集合加载）
+similar_case_index = SimilarCaseIndex(
+    embeddings_collection,
+    refresh_interval=config.SIMILARITY_REFRESH_SECONDS,
+    refresh_overlap=config.SIMILARITY_REFRESH_OVERLAP_SECONDS,
+    ivf_threshold=config.SIMILARITY_IVF_THRESHOLD,
+    n_probe=config.SIMILARITY_N_PROBE
+)
 
 # User Information and Medical Record Management
 
@@ -177,11 +247,7 @@ def get_medical_record():
         return jsonify({"success": False, "message": "用户不存在"}), 404
     
     # Get latest report
-    report = reports_collection.find_one(
-        {"userId": user_id},
-        {"_id": 0},
-        sort=[("createdAt", pymongo.DESCENDING)]
-    )
+    report = latest_report(user_id, REPORT_DEFAULT_PROJECTION)
     
     # Combine data
     result = user
@@ -211,45 +277,225 @@ def start_detection():
     )
     
     if existing_report:
-        print(f"用户 {user_id} 已有进行中的检测任务")
-        return jsonify({"success": True, "message": "检测已在进行中"}), 200
+        if existing_report.get("jobId") and job_queue.is_active(existing_report["jobId"]):
+            print(f"用户 {user_id} 已有进行中的检测任务")
+            return jsonify({"success": True, "message": "检测已在进行中"}), 200
+        
+        # 对应的任务已结束或已丢失（例如旧版本的后台线程随进程重启丢失），报告不会再被更新
+        print(f"用户 {user_id} 的检测任务已中断，标记为失败后重新检测")
+        
+        def mark_interrupted(session):
+            reports_collection.update_one(
+                {"_id": existing_report["_id"], "status": "processing"},
+                {"$set": {"status": "failed", "errorMessage": "检测任务已中断", "completedAt": datetime.now()}},
+                session=session
+            )
+            if existing_report.get("jobId"):
+                status_store.update(user_id, existing_report["jobId"], "failed", 0, "检测任务已中断", session=session)
+        
+        status_store.write(mark_interrupted)
+    
+    # 风险评分通道排满时拒绝，提示客户端稍后重试
+    try:
+        scheduler.admit("risk")
+    except LaneSaturatedError as e:
+        return lane_saturated_response(e)
     
     # Create detection task
-    reports_collection.insert_one({
-        "userId": user_id,
-        "status": "processing",
-        "progress": 0,
-        "createdAt": datetime.now()
-    })
+    job_id = new_job_id()
+    
+    def create_report(session):
+        report_id = reports_collection.insert_one({
+            "userId": user_id,
+            "status": "processing",
+            "progress": 0,
+            "jobId": job_id,
+            "createdAt": datetime.now()
+        }, session=session).inserted_id
+        status_store.start(user_id, job_id, report_id, "risk", "排队中", session=session)
+    
+    status_store.write(create_report)
     
-    # 在后台线程中执行风险计算
-    import threading
-    thread = threading.Thread(target=calculate_risk, args=(user_id,))
-    thread.daemon = True
-    thread.start()
+    # 提交到任务队列，由工作线程/工作进程执行风险计算
+    scheduler.submit("risk", {"userId": user_id, "jobId": job_id, "submittedAt": time.time()}, job_id=job_id)
+    progress_broker.publish(user_id, job_id, "processing", 0, "排队中")
     
-    print(f"用户 {user_id} 的风险检测已启动，计算在后台线程中进行")
-    return jsonify({"success": True, "message": "检测已启动"})
+    print(f"用户 {user_id} 的风险检测已提交，任务ID: {job_id}")
+    return jsonify({"success": True, "message": "检测已启动", "jobId": job_id})
 
-@app.route('/api/detect/status', methods=['GET'])
-def check_detection_status():
-    user_id = request.args.get('userId')
+# 辅助函数: 通道排满时的响应
+def lane_saturated_response(error):
+    print(f"{error}，拒绝新任务")
+    response = jsonify({
+        "success": False,
+        "message": "当前检测任务较多，请稍后重试",
+        "retryAfter": error.retry_after
+    })
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 429
+
+# 辅助函数: 用户最近一次检测的状态
+def latest_detection(user_id):
+    """
+    按_id读取用户的状态文档；没有状态文档的旧数据回退到排序查询并补写
+
+    Returns:
+        dict: 状态（jobId、reportId、status、progress等），用户没有检测记录时返回None
+    """
+    status = status_store.get_user(user_id)
+    if status is not None:
+        return status
     
-    # Get latest report status
     report = reports_collection.find_one(
         {"userId": user_id},
+        LEGACY_REPORT_PROJECTION,
         sort=[("createdAt", pymongo.DESCENDING)]
     )
-    
     if not report:
+        return None
+    return status_store.backfill(user_id, report)
+
+# 辅助函数: 用户最新的报告
+def latest_report(user_id, projection):
+    """通过状态文档中的reportId读取最新报告，没有时返回None"""
+    status = latest_detection(user_id)
+    if not status or status.get("reportId") is None:
+        return None
+    return reports_collection.find_one({"_id": status["reportId"]}, projection)
+
+# 辅助函数: 查询用户最近一次检测的进度
+def current_detection_state(user_id):
+    """
+    优先使用进程内的进度事件，事件过旧时回查数据库
+
+    任务可能在其他进程中执行（收不到事件），或者已经有了新的检测，所以事件超过
+    PROGRESS_EVENT_FRESH_SECONDS后要和数据库核对：数据库中仍是同一个任务且在进行中时沿用事件的进度。
+    找不到检测记录时返回None。
+    """
+    event = progress_broker.latest(ProgressBroker.user_key(user_id))
+    if is_fresh_event(event):
+        return event
+    return merge_detection_state(user_id, event, latest_detection(user_id))
+
+def is_fresh_event(event):
+    """进度事件是否还没有过期（过期后要和数据库核对）"""
+    return event is not None and time.time() - event["time"] < config.PROGRESS_EVENT_FRESH_SECONDS
+
+def merge_detection_state(user_id, event, status):
+    """
+    合并进程内的进度事件和数据库中的状态文档：同一个任务仍在进行中时沿用事件的进度
+
+    状态文档的seq取updatedAt，任务在其他进程中状态变化后seq随之增大
+    """
+    if not status:
+        return event
+    if event is not None and status.get("jobId") == event["jobId"] and status.get("status") == "processing":
+        return event
+    updated_at = status.get("updatedAt") or status.get("createdAt")
+    return {
+        "seq": max(seq_at(updated_at.timestamp()) if updated_at else 0, event["seq"] if event else 0),
+        "jobId": status.get("jobId"),
+        "userId": user_id,
+        "status": status.get("status", "processing"),
+        "progress": status.get("progress", 0),
+        "message": status.get("message", ""),
+        "provisional": status.get("provisional", False),
+        "time": time.time()
+    }
+
+# 辅助函数: 等待用户的下一个进度
+def wait_detection_state(user_id, after, timeout):
+    """
+    等待seq大于after的进度，超时返回None
+
+    进程内的事件到达时立即返回；任务在其他进程中执行时收不到事件，
+    每隔PROGRESS_RECHECK_SECONDS按_id回查一次状态文档
+    """
+    key = ProgressBroker.user_key(user_id)
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        event = progress_broker.wait(key, after_seq=after, timeout=min(remaining, config.PROGRESS_RECHECK_SECONDS))
+        if event is not None:
+            return event
+        state = merge_detection_state(user_id, progress_broker.latest(key), latest_detection(user_id))
+        if state is not None and state["seq"] > after:
+            return state
+
+@app.route('/api/detect/status', methods=['GET'])
+def check_detection_status():
+    user_id = request.args.get('userId')
+    
+    state = current_detection_state(user_id)
+    if not state:
         return jsonify({"success": False, "message": "未找到检测记录"}), 404
     
     return jsonify({
         "success": True,
-        "status": report.get("status", "processing"),
-        "progress": report.get("progress", 0)
+        "status": state["status"],
+        "progress": state["progress"]
     })
 
+def state_fields(state):
+    """进度接口返回的字段"""
+    fields = {key: state.get(key) for key in ("seq", "jobId", "status", "progress", "message")}
+    fields["provisional"] = bool(state.get("provisional"))
+    return fields
+
+def sse_progress_message(state, fields):
+    return f"id: {state['seq']}\nevent: progress\ndata: {json.dumps(fields, ensure_ascii=False)}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# 新增接口: 检测进度事件流（SSE）
+@app.route('/api/detect/events', methods=['GET'])
+def stream_detection_events():
+    """以Server-Sent Events推送用户最近一次检测的进度，任务结束或连接超过时长后关闭"""
+    user_id = request.args.get('userId')
+    if not user_id:
+        return jsonify({"success": False, "message": "用户ID不能为空"}), 400
+    
+    state = current_detection_state(user_id)
+    if not state:
+        return jsonify({"success": False, "message": "未找到检测记录"}), 404
+    
+    def generate(state):
+        deadline = time.monotonic() + config.PROGRESS_STREAM_SECONDS
+        sent = None
+        while True:
+            fields = state_fields(state)
+            if fields != sent:
+                yield sse_progress_message(state, fields)
+                sent = fields
+            else:
+                # 注释行作为心跳，避免代理因连接空闲而断开
+                yield ": keepalive\n\n"
+            if is_terminal(state) or time.monotonic() >= deadline:
+                return
+            timeout = min(config.PROGRESS_KEEPALIVE_SECONDS, deadline - time.monotonic())
+            state = wait_detection_state(user_id, state["seq"], timeout) or state
+    
+    return Response(generate(state), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+# 新增接口: 检测进度长轮询（不支持EventSource的客户端使用）
+@app.route('/api/detect/wait', methods=['GET'])
+def wait_detection_status():
+    """等待seq大于after的进度事件，超时返回当前进度；after省略时立即返回"""
+    user_id = request.args.get('userId')
+    after = request.args.get('after', -1, type=int)
+    timeout = min(request.args.get('timeout', config.PROGRESS_LONG_POLL_SECONDS, type=float), config.PROGRESS_LONG_POLL_SECONDS)
+    
+    state = current_detection_state(user_id)
+    if not state:
+        return jsonify({"success": False, "message": "未找到检测记录"}), 404
+    
+    if state["seq"] <= after and not is_terminal(state):
+        state = wait_detection_state(user_id, after, timeout) or state
+    
+    return jsonify({"success": True, **state_fields(state)})
+
 @app.route('/api/detect/report', methods=['GET'])
 def get_detection_report():
     user_id = request.args.get('userId')
@@ -257,12 +503,8 @@ def get_detection_report():
     # 添加调试日志
     print(f"获取用户 {user_id} 的检测报告")
     
-    # Get latest report
-    report = reports_collection.find_one(
-        {"userId": user_id},
-        {"_id": 0},  # 移除了status和progress的过滤，以便我们可以看到完整数据
-        sort=[("createdAt", pymongo.DESCENDING)]
-    )
+    # Get latest report（特征向量默认不返回）
+    report = latest_report(user_id, REPORT_DEFAULT_PROJECTION)
     
     # 添加调试日志
     print(f"查询到的报告数据: {report}")
@@ -289,8 +531,10 @@ def upload_medical_record():
     if not user_id:
         return jsonify({"success": False, "message": "用户ID不能为空"}), 400
     
-    # 验证文件
+    # 验证文件（扩展名和文件开头的格式标记）
     is_valid, error_message = validate_file_upload(file)
+    if is_valid:
+        is_valid, error_message = validate_file_signature(file_handler.peek(file, SIGNATURE_BYTES), file.filename)
     if not is_valid:
         return jsonify({"success": False, "message": error_message}), 400
     
@@ -298,16 +542,28 @@ def upload_medical_record():
     file_info = file_handler.save_file(file, user_id)
     
     # 保存记录到数据库
-    medical_records_collection.insert_one({
+    save_upload_record(user_id, file_info)
+    
+    return jsonify({"success": True, "fileUrl": file_info["fileUrl"]})
+
+# 辅助函数: 保存上传文件的病历记录（普通上传和分块上传共用）
+def save_upload_record(user_id, file_info):
+    """
+    Returns:
+        ObjectId: 记录ID（医学图像的fileId）
+    """
+    record = {
         "userId": user_id,
         "fileUrl": file_info["fileUrl"],
         "fileName": file_info["originalName"],
         "storedFileName": file_info["fileName"],
         "fileSize": file_info["fileSize"],
+        "sha256": file_info["sha256"],
         "uploadedAt": datetime.now()
-    })
-    
-    return jsonify({"success": True, "fileUrl": file_info["fileUrl"]})
+    }
+    if file_info.get("imageType"):
+        record["imageType"] = file_info["imageType"]
+    return medical_records_collection.insert_one(record).inserted_id
 
 @app.route('/api/user/medical-records', methods=['GET'])
 def get_medical_records():
@@ -316,10 +572,15 @@ def get_medical_records():
     # Get all user medical records
     records = list(medical_records_collection.find(
         {"userId": user_id},
-        {"_id": 0, "userId": 0}
+        MEDICAL_RECORDS_PROJECTION
     ))
     
-    # Format records
+    return jsonify({"success": True, "records": format_medical_records(records)})
+
+MEDICAL_RECORDS_PROJECTION = {"_id": 0, "userId": 0}
+
+# 辅助函数: 病历列表的返回格式（async_app.py共用）
+def format_medical_records(records):
     formatted_records = []
     for record in records:
         formatted_records.append({
@@ -328,8 +589,7 @@ def get_medical_records():
             "summary": "病历文件",
             "fileUrl": record.get("fileUrl")
         })
-    
-    return jsonify({"success": True, "records": formatted_records})
+    return formatted_records
 
 # 新增接口: 获取可选症状列表
 @app.route('/api/symptoms/list', methods=['GET'])
@@ -393,14 +653,19 @@ def get_user_profile():
         return jsonify({"success": False, "message": "用户ID不能为空"}), 400
     
     # 查询用户
-    user = users_collection.find_one(
-        {"userId": user_id},
-        {"_id": 0, "basicInfo": 1, "lifestyle": 1, "symptoms": 1, "hasSymptoms": 1, "createdAt": 1}
-    )
+    user = users_collection.find_one({"userId": user_id}, USER_PROFILE_PROJECTION)
     
     if not user:
         return jsonify({"success": False, "message": "用户不存在"}), 404
     
+    enrich_profile_symptoms(user)
+    
+    return jsonify({"success": True, "profile": user})
+
+USER_PROFILE_PROJECTION = {"_id": 0, "basicInfo": 1, "lifestyle": 1, "symptoms": 1, "hasSymptoms": 1, "createdAt": 1}
+
+# 辅助函数: 为用户资料中的症状添加emoji和label（async_app.py共用）
+def enrich_profile_symptoms(user):
     # 如果用户有症状数据，丰富症状信息（添加emoji和label）
     if user.get("symptoms") and isinstance(user["symptoms"], list):
         # 获取症状列表的完整信息
@@ -419,10 +684,10 @@ def get_user_profile():
             {"key": "snoring", "label": "睡觉打鼾", "emoji": "😴"},
             {"key": "anxiety", "label": "感到焦虑", "emoji": "😰"}
         ]
-        
+    
         # 创建一个查找表，以便通过key快速查找症状信息
         symptoms_map = {symptom["key"]: symptom for symptom in symptoms_list}
-        
+    
         # 丰富用户的症状数据
         enriched_symptoms = []
         for symptom in user["symptoms"]:
@@ -435,17 +700,25 @@ def get_user_profile():
                     "label": symptoms_map[symptom_key]["label"]
                 }
                 enriched_symptoms.append(enriched_symptom)
-        
+    
         # 用丰富后的症状数据替换原始数据
         user["symptoms"] = enriched_symptoms
-    
-    return jsonify({"success": True, "profile": user})
 
 # 新增接口: 提供上传的文件访问
-@app.route('/uploads/<filename>', methods=['GET'])
+@app.route('/uploads/<path:filename>', methods=['GET'])
 def serve_file(filename):
-    """提供上传文件的访问"""
-    return send_from_directory(config.UPLOAD_FOLDER, filename)
+    """提供上传文件的访问（filename是存储键，如ab/cd/<sha256>.png）"""
+    # 分块上传的分块和写入中的临时文件不对外提供
+    if any(part.startswith(".") for part in filename.split("/")):
+        return jsonify({"code": 404, "message": "文件不存在"}), 404
+    if isinstance(storage_backend, LocalStorage):
+        return send_from_directory(config.UPLOAD_FOLDER, filename)
+    try:
+        body = storage_backend.open(filename)
+    except (FileNotFoundError, ValueError):
+        return jsonify({"code": 404, "message": "文件不存在"}), 404
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return Response(iter(lambda: body.read(1024 * 1024), b""), mimetype=mimetype)
 
 # Health check endpoint
 @app.route('/health', methods=['GET'])
@@ -464,150 +737,170 @@ def hello_world():
 from stroke_model import convert_user_data_to_model_format, predict_stroke_risk, determine_risk_level
 
 # Helper function to calculate risk
-def calculate_risk(user_id):
-    print(f"开始为用户 {user_id} 计算风险...")
+def predict_risk_with_model(user):
+    """使用机器学习模型预测风险，模型返回空结果时返回None"""
+    # 1. 将用户数据转换为模型所需的格式
+    print(f"将用户数据转换为模型格式...")
+    model_input_df = convert_user_data_to_model_format(user)
+    print(f"模型输入数据形状: {model_input_df.shape}, 列名: {model_input_df.columns.tolist()}")
+    
+    # 2. 使用模型进行预测
+    print(f"使用模型进行预测...")
+    with thread_budget.job('risk'):
+        risk_probabilities = predict_stroke_risk(model_input_df)
     
-    # Get user data
-    user = users_collection.find_one({"userId": user_id})
-    if not user:
-        print(f"用户 {user_id} 不存在，无法计算风险")
-        return
+    if risk_probabilities is None or len(risk_probabilities) == 0:
+        print(f"模型预测返回空结果")
+        return None
     
-    try:
-        # 使用新的机器学习模型进行预测
-        # 1. 将用户数据转换为模型所需的格式
-        print(f"将用户数据转换为模型格式...")
-        model_input_df = convert_user_data_to_model_format(user)
-        print(f"模型输入数据形状: {model_input_df.shape}, 列名: {model_input_df.columns.tolist()}")
+    # 3. 根据预测概率确定风险级别
+    risk_probability = risk_probabilities[0]  # 获取第一个用户的预测结果
+    print(f"模型预测风险概率: {risk_probability}")
+    return determine_risk_level(risk_probability)
+
+def calculate_fallback_risk(user):
+    """使用简单计算器计算风险，并考虑症状的影响（模型失败或超时时使用）"""
+    calculator = RiskCalculator(user)
+    risk_result = calculator.calculate()
+    
+    # 检查是否有症状，并调整风险值
+    if user.get("hasSymptoms") == "有" and user.get("symptoms"):
+        symptom_count = len(user.get("symptoms", []))
         
-        # 2. 使用模型进行预测
-        print(f"使用模型进行预测...")
-        risk_probabilities = predict_stroke_risk(model_input_df)
+        # 计算高风险症状数量
+        high_risk_symptoms = ["chestPain", "dizziness", "dyspnea", "arrhythmia", "neckPain"]
+        high_risk_symptom_count = sum(1 for symptom in user.get("symptoms", []) 
+                                     if symptom.get("key") in high_risk_symptoms)
         
-        if risk_probabilities is None or len(risk_probabilities) == 0:
-            # 如果模型预测失败，回退到简单计算器
-            print(f"模型预测返回空结果，回退到简单计算器...")
-            calculator = RiskCalculator(user)
-            risk_result = calculator.calculate()
-            
-            # 检查是否有症状，并调整风险值
-            if user.get("hasSymptoms") == "有" and user.get("symptoms"):
-                symptom_count = len(user.get("symptoms", []))
-                
-                # 计算高风险症状数量
-                high_risk_symptoms = ["chestPain", "dizziness", "dyspnea", "arrhythmia", "neckPain"]
-                high_risk_symptom_count = sum(1 for symptom in user.get("symptoms", []) 
-                                             if symptom.get("key") in high_risk_symptoms)
-                
-                print(f"使用简单计算器时考虑症状影响: 总症状数 {symptom_count}, 高风险症状数 {high_risk_symptom_count}")
-                
-                # 调整风险百分比
-                symptom_factor = 2 * symptom_count  # 每个症状增加2%
-                high_risk_factor = 3 * high_risk_symptom_count  # 每个高风险症状额外增加3%
-                
-                adjusted_risk = min(risk_result["riskPercent"] + symptom_factor + high_risk_factor, 100)
-                risk_result["riskPercent"] = adjusted_risk
-                risk_result["details"]["symptomAdjustment"] = symptom_factor + high_risk_factor
-                
-                # 根据调整后的风险重新确定风险级别
-                if adjusted_risk >= 60:
-                    risk_result["riskLevel"] = "高风险"
-                    risk_result["riskDescription"] = "您的脑卒中风险较高"
-                    risk_result["riskAdvice"] = "建议立即就医，进行专业检查和评估。"
-                elif adjusted_risk >= 30:
-                    risk_result["riskLevel"] = "中风险"
-                    risk_result["riskDescription"] = "您的脑卒中风险中等"
-                    risk_result["riskAdvice"] = "建议近期咨询医生，检查相关指标，改善生活习惯，增加体育锻炼，控制体重。"
-                
-                print(f"调整后的风险百分比: {adjusted_risk}%")
-        else:
-            # 3. 根据预测概率确定风险级别
-            risk_probability = risk_probabilities[0]  # 获取第一个用户的预测结果
-            print(f"模型预测风险概率: {risk_probability}")
-            risk_result = determine_risk_level(risk_probability)
+        print(f"使用简单计算器时考虑症状影响: 总症状数 {symptom_count}, 高风险症状数 {high_risk_symptom_count}")
         
-        # Update report with calculated risk
-        print(f"更新报告状态为已完成...")
-        update_result = reports_collection.update_one(
-            {"userId": user_id, "status": "processing"},
-            {"$set": {
-                "status": "finished",
-                "progress": 100,
-                "riskPercent": risk_result["riskPercent"],
-                "riskLevel": risk_result["riskLevel"],
-                "riskDescription": risk_result["riskDescription"],
-                "riskAdvice": risk_result["riskAdvice"],
-                "details": risk_result["details"],
-                "completedAt": datetime.now()
-            }}
-        )
+        # 调整风险百分比
+        symptom_factor = 2 * symptom_count  # 每个症状增加2%
+        high_risk_factor = 3 * high_risk_symptom_count  # 每个高风险症状额外增加3%
+        
+        adjusted_risk = min(risk_result["riskPercent"] + symptom_factor + high_risk_factor, 100)
+        risk_result["riskPercent"] = adjusted_risk
+        risk_result["details"]["symptomAdjustment"] = symptom_factor + high_risk_factor
         
-        print(f"报告更新结果: matched={update_result.matched_count}, modified={update_result.modified_count}")
+        # 根据调整后的风险重新确定风险级别
+        if adjusted_risk >= 60:
+            risk_result["riskLevel"] = "高风险"
+            risk_result["riskDescription"] = "您的脑卒中风险较高"
+            risk_result["riskAdvice"] = "建议立即就医，进行专业检查和评估。"
+        elif adjusted_risk >= 30:
+            risk_result["riskLevel"] = "中风险"
+            risk_result["riskDescription"] = "您的脑卒中风险中等"
+            risk_result["riskAdvice"] = "建议近期咨询医生，检查相关指标，改善生活习惯，增加体育锻炼，控制体重。"
         
-        # 检查更新是否成功
-        if update_result.matched_count == 0:
+        print(f"调整后的风险百分比: {adjusted_risk}%")
+    
+    return risk_result
+
+# 超过截止时间先写入简单计算器的临时结果，模型完成后再更新报告
+risk_scorer = DeadlineRiskScorer(
+    predict_risk_with_model,
+    calculate_fallback_risk,
+    deadline=config.RISK_DEADLINE_SECONDS,
+    max_workers=config.JOB_LANES["risk"]["workers"]
+)
+
+def write_risk_report(user_id, report_id, risk_result, provisional, source, job_id=None):
+    """写入风险报告并更新检测状态，找不到对应的报告时新建一份，返回报告的_id"""
+    fields = {
+        "status": "finished",
+        "progress": 100,
+        "riskPercent": risk_result["riskPercent"],
+        "riskLevel": risk_result["riskLevel"],
+        "riskDescription": risk_result["riskDescription"],
+        "riskAdvice": risk_result["riskAdvice"],
+        "details": risk_result["details"],
+        "provisional": provisional,  # True表示模型超时时的临时结果，模型完成后会被更新
+        "riskSource": source,        # model 或 calculator
+        "completedAt": datetime.now()
+    }
+    
+    def write(session):
+        target_id = report_id
+        if target_id is not None:
+            update_result = reports_collection.update_one({"_id": target_id}, {"$set": fields}, session=session)
+            print(f"报告更新结果: matched={update_result.matched_count}, modified={update_result.modified_count}")
+            if not update_result.matched_count:
+                target_id = None
+        
+        if target_id is None:
             print(f"警告: 未找到用户 {user_id} 的进行中报告记录")
             # 创建一个新的报告
-            reports_collection.insert_one({
-                "userId": user_id,
-                "status": "finished",
-                "progress": 100,
-                "riskPercent": risk_result["riskPercent"],
-                "riskLevel": risk_result["riskLevel"],
-                "riskDescription": risk_result["riskDescription"],
-                "riskAdvice": risk_result["riskAdvice"],
-                "details": risk_result["details"],
-                "createdAt": datetime.now(),
-                "completedAt": datetime.now()
-            })
+            target_id = reports_collection.insert_one(
+                {**fields, "userId": user_id, "createdAt": datetime.now()}, session=session
+            ).inserted_id
             print(f"已创建新的报告记录")
-    except Exception as e:
-        print(f"模型预测失败: {str(e)}")
-        import traceback
-        traceback.print_exc()  # 打印完整的错误堆栈
         
-        # 如果模型预测失败，回退到简单计算器
-        calculator = RiskCalculator(user)
-        risk_result = calculator.calculate()
-        
-        # Update report with calculated risk from simple calculator
-        try:
-            update_result = reports_collection.update_one(
-                {"userId": user_id, "status": "processing"},
-                {"$set": {
-                    "status": "finished",
-                    "progress": 100,
-                    "riskPercent": risk_result["riskPercent"],
-                    "riskLevel": risk_result["riskLevel"],
-                    "riskDescription": risk_result["riskDescription"],
-                    "riskAdvice": risk_result["riskAdvice"],
-                    "details": risk_result["details"],
-                    "completedAt": datetime.now()
-                }}
-            )
-            
-            print(f"异常情况下报告更新结果: matched={update_result.matched_count}, modified={update_result.modified_count}")
-            
-            # 检查更新是否成功
-            if update_result.matched_count == 0:
-                print(f"警告: 异常情况下未找到用户 {user_id} 的进行中报告记录")
-                # 创建一个新的报告
-                reports_collection.insert_one({
-                    "userId": user_id,
-                    "status": "finished",
-                    "progress": 100,
-                    "riskPercent": risk_result["riskPercent"],
-                    "riskLevel": risk_result["riskLevel"],
-                    "riskDescription": risk_result["riskDescription"],
-                    "riskAdvice": risk_result["riskAdvice"],
-                    "details": risk_result["details"],
-                    "createdAt": datetime.now(),
-                    "completedAt": datetime.now()
-                })
-                print(f"异常情况下已创建新的报告记录")
-        except Exception as inner_e:
-            print(f"更新报告时发生错误: {str(inner_e)}")
-            traceback.print_exc()  # 打印完整的错误堆栈
+        if job_id is not None:
+            status_store.update(user_id, job_id, "finished", 100, provisional=provisional, report_id=target_id, session=session)
+        return target_id
+    
+    return status_store.write(write)
+
+def calculate_risk(user_id, job_id=None, submitted_at=None):
+    print(f"开始为用户 {user_id} 计算风险...")
+    
+    # Get user data
+    user = users_collection.find_one({"userId": user_id})
+    if not user:
+        print(f"用户 {user_id} 不存在，无法计算风险")
+        return
+    
+    # 任务的状态文档中记录了对应的报告，旧任务回退到查询进行中的报告
+    job_status = status_store.get_job(job_id) if job_id else None
+    if job_status is not None:
+        report_id = job_status.get("reportId")
+    else:
+        report = reports_collection.find_one(
+            {"userId": user_id, "status": "processing"},
+            {"_id": 1},
+            sort=[("createdAt", pymongo.DESCENDING)]
+        )
+        report_id = report["_id"] if report else None
+    progress_broker.publish(user_id, job_id, "processing", 30, "正在计算风险...")
+    
+    def publish(risk_result, provisional, source):
+        nonlocal report_id
+        print(f"更新报告状态为已完成{'（临时结果）' if provisional else ''}...")
+        report_id = write_risk_report(user_id, report_id, risk_result, provisional, source, job_id)
+        progress_broker.publish(user_id, job_id, "finished", 100, "", provisional=provisional)
+        if provisional:
+            # 进程内的更新在进程重启后丢失，由持久化的后续任务兜底
+            scheduler.submit("risk", {"userId": user_id, "jobId": job_id, "reportId": report_id, "upgrade": True},
+                             delay=config.RISK_UPGRADE_DELAY_SECONDS)
+    
+    risk_scorer.score(user, publish, submitted_at)
+
+def finalize_provisional_risk(user_id, report_id, job_id=None, use_model=True):
+    """
+    报告仍是临时结果时重新评分并写入正式结果（RISK_UPGRADE_DELAY_SECONDS后的后续任务）
+
+    use_model为False时直接写入简单计算器的结果（后续任务的重试次数用完时）。
+    模型预测占满评分线程池时抛出ModelBusyError，任务稍后重试。
+    """
+    report = reports_collection.find_one({"_id": report_id}, {"provisional": 1})
+    if report is None or not report.get("provisional"):
+        print(f"报告 {report_id} 已经是正式结果，无需更新")
+        return
+    
+    user = users_collection.find_one({"userId": user_id})
+    if not user:
+        print(f"用户 {user_id} 不存在，无法更新临时报告")
+        return
+    
+    def publish(risk_result, provisional, source):
+        print(f"用{'模型' if source == SOURCE_MODEL else '简单计算器'}结果更新临时报告 {report_id}")
+        write_risk_report(user_id, report_id, risk_result, provisional, source, job_id)
+        progress_broker.publish(user_id, job_id, "finished", 100, "", provisional=provisional)
+    
+    if use_model:
+        risk_scorer.finalize(user, publish)
+    else:
+        publish(calculate_fallback_risk(user), False, SOURCE_CALCULATOR)
 
 # 新增接口: 启动图像检测
 @app.route('/api/detect/image', methods=['POST'])
@@ -637,29 +930,52 @@ def start_image_detection():
     if not file_record:
         return jsonify({"success": False, "message": "找不到对应的文件记录"}), 404
     
+    stored_file_name = file_record.get("storedFileName", "")
+    if not stored_file_name or not file_handler.exists(stored_file_name):
+        return jsonify({"success": False, "message": "文件不存在"}), 404
+    
+    # 提交前检查图像质量，空白、截断等无法使用的图像直接返回具体原因，不占用image通道
+    if config.QUALITY_GATE_ENABLED:
+        with closing(file_handler.open(stored_file_name)) as f:
+            is_valid, reason, quality_metrics = check_image_bytes(f.read())
+        print(f"图像质量检查: {'通过' if is_valid else reason}")
+        if not is_valid:
+            return jsonify({"success": False, "message": reason, "qualityCheck": quality_metrics}), 400
+    
+    # 图像推理通道排满时拒绝，提示客户端稍后重试
+    try:
+        scheduler.admit("image")
+    except LaneSaturatedError as e:
+        return lane_saturated_response(e)
+    
     # 创建检测任务
-    reports_collection.insert_one({
-        "userId": user_id,
-        "status": "processing",
-        "progress": 0,
-        "imageType": image_type,
-        "fileId": file_id,
-        "fileName": file_record.get("fileName", ""),
-        "fileUrl": file_record.get("fileUrl", ""),
-        "createdAt": datetime.now()
-    })
+    job_id = new_job_id()
+    
+    def create_report(session):
+        report_id = reports_collection.insert_one({
+            "userId": user_id,
+            "status": "processing",
+            "progress": 0,
+            "imageType": image_type,
+            "fileId": file_id,
+            "fileName": file_record.get("fileName", ""),
+            "fileUrl": file_record.get("fileUrl", ""),
+            "jobId": job_id,
+            "createdAt": datetime.now()
+        }, session=session).inserted_id
+        status_store.start(user_id, job_id, report_id, "image", "排队中", session=session)
+    
+    status_store.write(create_report)
     
-    # 在后台线程中执行图像风险计算
-    import threading
-    thread = threading.Thread(target=process_image_detection, args=(user_id, image_type, file_id))
-    thread.daemon = True
-    thread.start()
+    # 提交到任务队列，由工作线程/工作进程执行图像分析
+    scheduler.submit("image", {"userId": user_id, "imageType": image_type, "fileId": file_id, "jobId": job_id}, job_id=job_id)
+    progress_broker.publish(user_id, job_id, "processing", 0, "排队中")
     
-    print(f"用户 {user_id} 的{image_type}图像检测已启动，处理在后台线程中进行")
-    return jsonify({"success": True, "message": f"{image_type}检测已启动"})
+    print(f"用户 {user_id} 的{image_type}图像检测已提交，任务ID: {job_id}")
+    return jsonify({"success": True, "message": f"{image_type}检测已启动", "jobId": job_id})
 
 # 辅助函数: 处理图像检测
-def process_image_detection(user_id, image_type, file_id):
+def process_image_detection(user_id, image_type, file_id, job_id=None):
     """处理图像检测并生成报告"""
     print(f"开始为用户 {user_id} 处理{image_type}图像检测...")
     
@@ -668,43 +984,67 @@ def process_image_detection(user_id, image_type, file_id):
         file_record = medical_records_collection.find_one({"_id": ObjectId(file_id)})
         if not file_record:
             print(f"错误: 找不到文件ID为 {file_id} 的记录")
-            update_image_detection_status(user_id, file_id, "failed", "找不到文件记录")
+            update_image_detection_status(user_id, file_id, "failed", "找不到文件记录", job_id)
             return
         
-        # 获取文件路径
-        file_path = os.path.join(config.UPLOAD_FOLDER, file_record.get("storedFileName", ""))
-        if not os.path.exists(file_path):
-            print(f"错误: 文件 {file_path} 不存在")
-            update_image_detection_status(user_id, file_id, "failed", "文件不存在")
+        # 获取文件
+        stored_file_name = file_record.get("storedFileName", "")
+        if not stored_file_name or not file_handler.exists(stored_file_name):
+            print(f"错误: 文件 {stored_file_name} 不存在")
+            update_image_detection_status(user_id, file_id, "failed", "文件不存在", job_id)
             return
         
         # 更新进度
-        update_image_detection_progress(user_id, file_id, 20, "正在分析图像...")
+        update_image_detection_progress(user_id, file_id, 20, "正在分析图像...", job_id)
         
         # 导入模型分析模块
         try:
             from brain_image_analyzer import analyze_brain_image
             
             # 更新进度
-            update_image_detection_progress(user_id, file_id, 50, "正在进行AI分析...")
+            update_image_detection_progress(user_id, file_id, 50, "正在进行AI分析...", job_id)
             
-            # 执行图像分析
-            analysis_result = analyze_brain_image(file_path, modality=image_type)
+            # 执行图像分析（可视化分析图由render通道单独生成）
+            with thread_budget.job('image'), file_handler.local_path(stored_file_name) as file_path:
+                analysis_result = analyze_brain_image(file_path, modality=image_type, render=False)
             
             # 检查分析是否成功
             if "error" in analysis_result:
                 print(f"图像分析失败: {analysis_result['error']}")
-                update_image_detection_status(user_id, file_id, "failed", f"图像分析失败: {analysis_result['error']}")
+                if "qualityCheck" in analysis_result:
+                    # 质量检查未通过时直接返回具体原因
+                    update_image_detection_status(user_id, file_id, "failed", analysis_result['error'], job_id)
+                else:
+                    update_image_detection_status(user_id, file_id, "failed", f"图像分析失败: {analysis_result['error']}", job_id)
                 return
             
             # 更新进度
-            update_image_detection_progress(user_id, file_id, 80, "生成分析报告...")
+            update_image_detection_progress(user_id, file_id, 80, "生成分析报告...", job_id)
             
             # 获取预测结果
             prediction = analysis_result["prediction"]
             predicted_class = prediction["class"]
             confidence = prediction["confidence"]
             
+            # 特征向量以二进制格式单独存储，报告中只保留引用
+            embedding_id = None
+            embeddings = analysis_result.pop("embeddings", None)
+            if embeddings:
+                embedding_id = embedding_store.save(embeddings, {
+                    "userId": user_id,
+                    "fileId": file_id,
+                    "modality": image_type,
+                    "predictedClass": predicted_class,
+                    "confidence": confidence
+                })
+                # 增量加入相似病例索引
+                similar_case_index.add_case(image_type, embeddings["pathology"], {
+                    "caseId": embedding_id,
+                    "predictedClass": predicted_class,
+                    "confidence": confidence,
+                    "date": datetime.now().strftime("%Y-%m-%d")
+                })
+            
             # 构建风险评估结果
             risk_result = {
                 "riskPercent": round(confidence * 100, 2),
@@ -717,44 +1057,100 @@ def process_image_detection(user_id, image_type, file_id):
                     "imageType": image_type,
                     "probabilities": prediction["probabilities"]
                 },
+                "embeddingId": embedding_id,
                 "analysis": analysis_result
             }
             
             # 更新报告状态为完成
-            update_image_detection_status(user_id, file_id, "finished", risk_result)
+            update_image_detection_status(user_id, file_id, "finished", risk_result, job_id)
             print(f"用户 {user_id} 的{image_type}图像分析已完成")
+            
+            # 提交可视化分析图的渲染
+            schedule_visualization(user_id, image_type, file_id, prediction, embedding_id, job_id)
         except ImportError as e:
             print(f"导入模型分析模块失败: {str(e)}")
-            update_image_detection_status(user_id, file_id, "failed", f"导入模型分析模块失败: {str(e)}")
+            update_image_detection_status(user_id, file_id, "failed", f"导入模型分析模块失败: {str(e)}", job_id)
             return
         
     except Exception as e:
         print(f"处理{image_type}图像时发生错误: {str(e)}")
         import traceback
         traceback.print_exc()
-        update_image_detection_status(user_id, file_id, "failed", f"处理失败: {str(e)}")
+        update_image_detection_status(user_id, file_id, "failed", f"处理失败: {str(e)}", job_id)
 
-# 辅助函数: 更新图像检测进度
-def update_image_detection_progress(user_id, file_id, progress, message=""):
-    """更新图像检测进度"""
+# 辅助函数: 提交可视化渲染任务
+def schedule_visualization(user_id, image_type, file_id, prediction, embedding_id, image_job_id=None):
+    """
+    把可视化分析图提交到render通道；通道排满或没有特征向量时降级为不生成可视化分析图
+
+    图像检测任务的状态文档记录了对应的报告，渲染结果按报告_id写入（同一文件检测多次时不会写到其他报告）
+    """
+    job_status = status_store.get_job(image_job_id) if image_job_id else None
+    report_id = job_status.get("reportId") if job_status else None
+    job_id = None
+    if embedding_id:
+        job_id = scheduler.submit_or_degrade("render", {
+            "userId": user_id,
+            "imageType": image_type,
+            "fileId": file_id,
+            "reportId": report_id,
+            "embeddingId": embedding_id,
+            "prediction": prediction
+        })
+    if job_id is None:
+        print(f"render通道已满或缺少特征向量，文件 {file_id} 的报告不生成可视化分析图")
+        set_visualization_status(user_id, file_id, "skipped", report_id=report_id)
+
+# 辅助函数: 存储分析结果文件
+def result_file_url(path):
+    """把图像分析生成的文件（可视化分析图、分析报告）存入文件存储，返回访问URL；没有文件时返回空字符串"""
+    if not path or not os.path.exists(path):
+        return ""
+    return file_handler.url(file_handler.store_file(path)["key"])
+
+# 辅助函数: 更新可视化分析图状态
+def set_visualization_status(user_id, file_id, status, visualization_path=None, report_id=None):
+    """
+    status: pending（等待渲染）、finished、skipped（过载降级）、failed
+
+    report_id为None时（没有记录报告的旧任务）按文件查找报告
+    """
+    update_data = {"visualizationStatus": status}
+    if visualization_path:
+        update_data["visualization_url"] = result_file_url(visualization_path)
+    report_filter = {"_id": report_id} if report_id is not None else {"userId": user_id, "fileId": file_id}
     try:
-        reports_collection.update_one(
-            {
-                "userId": user_id,
-                "fileId": file_id,
-                "status": "processing"
-            },
-            {"$set": {
-                "progress": progress,
-                "progressMessage": message
-            }}
-        )
+        reports_collection.update_one(report_filter, {"$set": update_data})
     except Exception as e:
-        print(f"更新进度时发生错误: {str(e)}")
+        print(f"更新可视化状态时发生错误: {str(e)}")
+
+# 辅助函数: 渲染可视化分析图
+def render_image_visualization(user_id, image_type, file_id, embedding_id, prediction, report_id=None):
+    """从报告对应的原始图像和已存储的特征向量生成可视化分析图"""
+    from brain_image_analyzer import render_visualization
+    
+    file_record = medical_records_collection.find_one({"_id": ObjectId(file_id)})
+    vectors = embedding_store.load(embedding_id)
+    if not file_record or vectors is None:
+        print(f"文件 {file_id} 的记录或特征向量不存在，跳过可视化")
+        set_visualization_status(user_id, file_id, "skipped", report_id=report_id)
+        return
+    
+    with file_handler.local_path(file_record.get("storedFileName", "")) as file_path:
+        visualization_path = render_visualization(
+            file_path, image_type, prediction, vectors["pathology"], vectors["physiology"]
+        )
+    set_visualization_status(user_id, file_id, "finished", visualization_path, report_id)
+    print(f"文件 {file_id} 的可视化分析图已生成: {visualization_path}")
+
+# 辅助函数: 更新图像检测进度
+def update_image_detection_progress(user_id, file_id, progress, message="", job_id=None):
+    """发布图像检测进度（中间进度只通过进度事件推送，不写数据库）"""
+    progress_broker.publish(user_id, job_id, "processing", progress, message, fileId=file_id)
 
 # 辅助函数: 更新图像检测状态
-def update_image_detection_status(user_id, file_id, status, result):
-    """更新图像检测状态"""
+def update_image_detection_status(user_id, file_id, status, result, job_id=None):
+    """更新图像检测状态，并发布对应的进度事件"""
     try:
         update_data = {
             "status": status,
@@ -774,25 +1170,41 @@ def update_image_detection_status(user_id, file_id, status, result):
             
             # 如果是分析结果，添加额外的分析数据
             if "analysis" in result:
+                visualization_path = result["analysis"].get("visualization_path")
                 update_data.update({
                     "analysisCompleted": True,
+                    "embeddingId": result.get("embeddingId"),
                     "prediction": result["analysis"].get("prediction", {}),
-                    "visualization_url": result["analysis"].get("visualization_path", "").replace(config.UPLOAD_FOLDER, "/uploads"),
-                    "report_url": result["analysis"].get("report_path", "").replace(config.UPLOAD_FOLDER, "/uploads")
+                    "visualizationStatus": "finished" if visualization_path else "pending",
+                    "visualization_url": result_file_url(visualization_path),
+                    "report_url": result_file_url(result["analysis"].get("report_path"))
                 })
         elif status == "failed" and isinstance(result, str):
             # 如果结果是错误消息
             update_data["errorMessage"] = result
         
-        reports_collection.update_one(
-            {
-                "userId": user_id,
-                "fileId": file_id
-            },
-            {"$set": update_data}
-        )
+        message = result if status == "failed" and isinstance(result, str) else ""
+        # 任务的状态文档中记录了对应的报告（同一文件检测多次时不会更新到其他报告），旧任务按文件查找
+        job_status = status_store.get_job(job_id) if job_id else None
+        if job_status is not None and job_status.get("reportId") is not None:
+            report_filter = {"_id": job_status["reportId"]}
+        else:
+            report_filter = {"userId": user_id, "fileId": file_id}
+        
+        def write(session):
+            reports_collection.update_one(report_filter, {"$set": update_data}, session=session)
+            if job_status is not None:
+                status_store.update(user_id, job_id, status, update_data["progress"], message, session=session)
+        
+        status_store.write(write)
     except Exception as e:
         print(f"更新状态时发生错误: {str(e)}")
+    
+    progress_broker.publish(
+        user_id, job_id, status, update_data["progress"],
+        result if status == "failed" and isinstance(result, str) else "",
+        fileId=file_id
+    )
 
 # 新增接口: 上传MRI或CT图像
 @app.route('/api/medical-image/upload', methods=['POST'])
@@ -812,8 +1224,10 @@ def upload_medical_image():
     if not image_type or image_type not in ['MRI', 'CT']:
         return jsonify({"success": False, "message": "图像类型必须是'MRI'或'CT'"}), 400
     
-    # 验证文件
+    # 验证文件（扩展名和文件开头的格式标记）
     is_valid, error_message = validate_image_file(file, image_type)
+    if is_valid:
+        is_valid, error_message = validate_file_signature(file_handler.peek(file, SIGNATURE_BYTES), file.filename)
     if not is_valid:
         return jsonify({"success": False, "message": error_message}), 400
     
@@ -821,15 +1235,7 @@ def upload_medical_image():
     file_info = file_handler.save_medical_image(file, user_id, image_type)
     
     # 保存记录到数据库
-    file_id = medical_records_collection.insert_one({
-        "userId": user_id,
-        "fileUrl": file_info["fileUrl"],
-        "fileName": file_info["originalName"],
-        "storedFileName": file_info["fileName"],
-        "fileSize": file_info["fileSize"],
-        "imageType": image_type,
-        "uploadedAt": datetime.now()
-    }).inserted_id
+    file_id = save_upload_record(user_id, file_info)
     
     return jsonify({
         "success": True, 
@@ -838,6 +1244,169 @@ def upload_medical_image():
         "imageType": image_type
     })
 
+# 新增接口: 分块上传（大文件、断点续传），见upload_sessions.py
+@app.route('/api/upload/init', methods=['POST'])
+def init_chunked_upload():
+    """创建分块上传会话"""
+    data = request.json or {}
+    
+    is_valid, error_message = validate_upload_init(data)
+    if not is_valid:
+        return jsonify({"success": False, "message": error_message}), 400
+    
+    # 顺便清理过期会话留下的分块文件
+    file_handler.purge_stale_uploads(config.UPLOAD_SESSION_TTL_SECONDS)
+    
+    kind = data.get('kind', 'record')
+    session = upload_sessions.create(
+        data['userId'], kind, data['fileName'], data['fileSize'],
+        image_type=data.get('imageType') if kind == 'image' else None,
+        sha256=data.get('sha256')
+    )
+    
+    return jsonify({"success": True, **upload_session_fields(session), "chunkSize": config.UPLOAD_CHUNK_SIZE})
+
+def upload_session_fields(session):
+    """分块上传接口返回的会话字段"""
+    return {
+        "uploadId": session["_id"],
+        "status": session["status"],
+        "offset": session["offset"],
+        "fileSize": session["fileSize"],
+        "expiresAt": session["expiresAt"]
+    }
+
+@app.route('/api/upload/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    """查询分块上传的进度，断点续传时从返回的offset继续上传"""
+    session = upload_sessions.get(upload_id)
+    if not session:
+        return jsonify({"success": False, "message": "上传会话不存在或已过期"}), 404
+    
+    fields = upload_session_fields(session)
+    if session["status"] == "completed":
+        fields["result"] = session["result"]
+    elif session["status"] == "failed":
+        fields["message"] = session.get("message", "")
+    
+    return jsonify({"success": True, **fields})
+
+@app.route('/api/upload/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    """
+    上传一个分块：请求体是分块的原始字节，offset参数必须等于已提交的偏移量
+
+    分块按块写入磁盘，不在内存中缓存；第一个分块检查文件开头的格式标记。
+    """
+    offset = request.args.get('offset', type=int)
+    
+    session = upload_sessions.get(upload_id)
+    if not session:
+        return jsonify({"success": False, "message": "上传会话不存在或已过期"}), 404
+    
+    if session["status"] != "uploading":
+        return jsonify({"success": False, "message": "上传已结束", "status": session["status"]}), 409
+    
+    if offset != session["offset"]:
+        return jsonify({"success": False, "message": "偏移量与已上传的位置不一致", "offset": session["offset"]}), 409
+    
+    head_check = None
+    if offset == 0:
+        head_check = lambda head: validate_file_signature(head, session["fileName"])
+    
+    max_bytes = min(config.UPLOAD_CHUNK_SIZE, session["fileSize"] - offset)
+    try:
+        chunk = file_handler.write_chunk(upload_id, offset, request.stream, max_bytes, head_check, SIGNATURE_BYTES)
+    except FileSignatureError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    except UploadSizeError:
+        return jsonify({"success": False, "message": f"分块不能超过 {max_bytes} 字节"}), 413
+    
+    if chunk["size"] == 0:
+        file_handler.discard_chunk(upload_id, chunk["name"])
+        return jsonify({"success": False, "message": "分块不能为空"}), 400
+    
+    updated = upload_sessions.commit_chunk(upload_id, offset, chunk)
+    if updated is None:
+        # 同一偏移量的其他请求已经提交
+        file_handler.discard_chunk(upload_id, chunk["name"])
+        current = upload_sessions.get(upload_id)
+        return jsonify({
+            "success": False,
+            "message": "偏移量与已上传的位置不一致",
+            "offset": current["offset"] if current else None
+        }), 409
+    
+    return jsonify({
+        "success": True,
+        "offset": updated["offset"],
+        "fileSize": updated["fileSize"],
+        "chunkSha256": chunk["sha256"]
+    })
+
+@app.route('/api/upload/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """所有分块上传后拼接文件，核对大小和SHA-256，写入病历记录；重复请求返回同样的结果"""
+    session = upload_sessions.get(upload_id)
+    if not session:
+        return jsonify({"success": False, "message": "上传会话不存在或已过期"}), 404
+    
+    if session["status"] == "completed":
+        return jsonify({"success": True, **session["result"]})
+    
+    if session["status"] == "failed":
+        return jsonify({"success": False, "message": session.get("message", "上传失败")}), 409
+    
+    if session["offset"] != session["fileSize"]:
+        return jsonify({"success": False, "message": "文件尚未上传完整", "offset": session["offset"]}), 409
+    
+    session = upload_sessions.begin_complete(upload_id, session["fileSize"])
+    if session is None:
+        return jsonify({"success": False, "message": "上传正在完成，请稍后查询"}), 409
+    
+    file_info = file_handler.assemble_upload(
+        upload_id, session["chunks"], session["fileName"], session["userId"],
+        image_type=session["imageType"] if session["kind"] == "image" else None
+    )
+    
+    expected_sha256 = session.get("sha256")
+    if file_info["fileSize"] != session["fileSize"] or (expected_sha256 and file_info["sha256"] != expected_sha256):
+        message = "文件校验失败（大小或SHA-256与声明的不一致），请重新上传"
+        print(f"分块上传 {upload_id} 校验失败: 大小 {file_info['fileSize']}/{session['fileSize']}，"
+              f"SHA-256 {file_info['sha256']}/{expected_sha256}")
+        file_handler.delete_file(file_info["fileName"])
+        file_handler.discard_upload(upload_id)
+        upload_sessions.fail(upload_id, message)
+        return jsonify({"success": False, "message": message}), 400
+    
+    file_id = save_upload_record(session["userId"], file_info)
+    result = {
+        "fileUrl": file_info["fileUrl"],
+        "fileId": str(file_id),
+        "fileSize": file_info["fileSize"],
+        "sha256": file_info["sha256"]
+    }
+    if file_info.get("imageType"):
+        result["imageType"] = file_info["imageType"]
+    
+    upload_sessions.finish(upload_id, result)
+    file_handler.discard_upload(upload_id)
+    
+    return jsonify({"success": True, **result})
+
+@app.route('/api/upload/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    """放弃分块上传，删除已上传的分块"""
+    session = upload_sessions.get(upload_id)
+    if not session:
+        return jsonify({"success": False, "message": "上传会话不存在或已过期"}), 404
+    
+    if session["status"] in ("uploading", "failed"):
+        file_handler.discard_upload(upload_id)
+    upload_sessions.delete(upload_id)
+    
+    return jsonify({"success": True})
+
 # 新增接口: 兼容前端的图像上传路径
 @app.route('/api/image/upload', methods=['POST'])
 def upload_image_compat():
@@ -862,7 +1431,7 @@ def get_image_analysis_result():
     # 查找对应的报告记录
     report = reports_collection.find_one(
         {"fileId": file_id, "status": "finished", "analysisCompleted": True},
-        {"_id": 0}
+        REPORT_DEFAULT_PROJECTION
     )
     
     if not report:
@@ -870,6 +1439,108 @@ def get_image_analysis_result():
     
     return jsonify({"success": True, "result": report})
 
+# 新增接口: 按需获取图像的特征向量
+@app.route('/api/image/embeddings', methods=['GET'])
+def get_image_embeddings():
+    """获取图像分析得到的病灶特征和生理特征向量（报告接口默认不返回）"""
+    file_id = request.args.get('fileId')
+    
+    if not file_id:
+        return jsonify({"success": False, "message": "文件ID不能为空"}), 400
+    
+    report = reports_collection.find_one(
+        {"fileId": file_id, "status": "finished", "analysisCompleted": True},
+        {"_id": 0, "embeddingId": 1, "imageType": 1,
+         "prediction.pathology_features": 1, "prediction.physiology_features": 1}
+    )
+    
+    if not report:
+        return jsonify({"success": False, "message": "未找到分析完成的报告"}), 404
+    
+    if report.get("embeddingId"):
+        vectors = embedding_store.load(report["embeddingId"])
+        if vectors is None:
+            return jsonify({"success": False, "message": "特征向量不存在"}), 404
+        embeddings = {name: vector.tolist() for name, vector in vectors.items()}
+    else:
+        # 兼容特征以列表形式内嵌在报告中的旧数据
+        prediction = report.get("prediction", {})
+        embeddings = {
+            "pathology": prediction.get("pathology_features", [[]])[0],
+            "physiology": prediction.get("physiology_features", [[]])[0]
+        }
+    
+    return jsonify({
+        "success": True,
+        "embeddingId": report.get("embeddingId"),
+        "imageType": report.get("imageType"),
+        "embeddings": embeddings
+    })
+
+# 辅助函数: 批量查询相似病例
+def find_similar_cases(file_ids, k):
+    """按文件ID批量查询相似病例，返回 fileId -> 相似病例列表（找不到特征的文件不在结果中）"""
+    reports = reports_collection.find(
+        {"fileId": {"$in": file_ids}, "status": "finished", "embeddingId": {"$ne": None}},
+        {"_id": 0, "fileId": 1, "imageType": 1, "embeddingId": 1}
+    )
+    
+    # 按模态分组，每个模态一次批量检索
+    groups = {}
+    for report in reports:
+        vectors = embedding_store.load(report["embeddingId"], names=["pathology"])
+        if not vectors:
+            continue
+        groups.setdefault(report["imageType"], []).append((report["fileId"], report["embeddingId"], vectors["pathology"]))
+    
+    results = {}
+    for modality, items in groups.items():
+        matches = similar_case_index.search(
+            modality,
+            [vector for _, _, vector in items],
+            k=k,
+            exclude_case_ids=[embedding_id for _, embedding_id, _ in items]
+        )
+        for (file_id, _, _), cases in zip(items, matches):
+            results[file_id] = {"imageType": modality, "cases": cases}
+    
+    return results
+
+# 新增接口: 相似病例检索
+@app.route('/api/image/similar-cases', methods=['GET', 'POST'])
+def get_similar_cases():
+    """根据病灶特征检索同模态下最相似的历史病例；POST支持批量查询"""
+    if request.method == 'POST':
+        data = request.json or {}
+        file_ids = data.get('fileIds') or []
+        k = data.get('k', 5)
+    else:
+        file_ids = [request.args.get('fileId')] if request.args.get('fileId') else []
+        k = request.args.get('k', 5)
+    
+    if not file_ids:
+        return jsonify({"success": False, "message": "文件ID不能为空"}), 400
+    
+    try:
+        k = int(k)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "k必须是整数"}), 400
+    if k < 1 or k > config.SIMILARITY_MAX_K:
+        return jsonify({"success": False, "message": f"k必须在1-{config.SIMILARITY_MAX_K}之间"}), 400
+    
+    results = find_similar_cases(file_ids, k)
+    
+    if request.method == 'GET':
+        if file_ids[0] not in results:
+            return jsonify({"success": False, "message": "未找到该图像的特征向量"}), 404
+        return jsonify({"success": True, **results[file_ids[0]]})
+    
+    return jsonify({
+        "success": True,
+        "results": results,
+        "missing": [file_id for file_id in file_ids if file_id not in results]
+    })
+
 # 新增接口: 获取用户医学图像列表
 @app.route('/api/medical-image/list', methods=['GET'])
 def get_medical_images():
@@ -881,17 +1552,27 @@ def get_medical_images():
         return jsonify({"success": False, "message": "用户ID不能为空"}), 400
     
     # 构建查询条件
-    query = {"userId": user_id}
-    if image_type and image_type in ['MRI', 'CT']:
-        query["imageType"] = image_type
+    query = medical_images_query(user_id, image_type)
     
     # 查询数据库
-    images = list(medical_records_collection.find(
-        query,
-        {"_id": 1, "fileUrl": 1, "fileName": 1, "imageType": 1, "uploadedAt": 1}
-    ))
+    images = list(medical_records_collection.find(query, MEDICAL_IMAGES_PROJECTION))
     
-    # 格式化结果
+    return jsonify({
+        "success": True,
+        "images": format_medical_images(images)
+    })
+
+MEDICAL_IMAGES_PROJECTION = {"_id": 1, "fileUrl": 1, "fileName": 1, "imageType": 1, "uploadedAt": 1}
+
+# 辅助函数: 医学图像列表的查询条件（async_app.py共用）
+def medical_images_query(user_id, image_type):
+    query = {"userId": user_id}
+    if image_type and image_type in ['MRI', 'CT']:
+        query["imageType"] = image_type
+    return query
+
+# 辅助函数: 医学图像列表的返回格式（async_app.py共用）
+def format_medical_images(images):
     result = []
     for image in images:
         if "imageType" in image:  # 确保是医学图像记录
@@ -902,11 +1583,81 @@ def get_medical_images():
                 "imageType": image.get("imageType", "未知"),
                 "uploadDate": image.get("uploadedAt", datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
             })
+    return result
+
+# 任务队列的处理函数
+def run_risk_job(payload):
+    if payload.get("upgrade"):
+        finalize_provisional_risk(payload["userId"], payload["reportId"], payload.get("jobId"))
+        return
+    calculate_risk(payload["userId"], payload.get("jobId"), payload.get("submittedAt"))
+
+def run_image_job(payload):
+    process_image_detection(payload["userId"], payload["imageType"], payload["fileId"], payload.get("jobId"))
+
+def run_render_job(payload):
+    render_image_visualization(
+        payload["userId"], payload["imageType"], payload["fileId"], payload["embeddingId"], payload["prediction"],
+        payload.get("reportId")
+    )
+
+def on_risk_job_failed(payload, error):
+    """风险计算任务最终失败（重试次数用完）时更新报告状态"""
+    user_id, job_id = payload["userId"], payload.get("jobId")
+    if payload.get("upgrade"):
+        # 临时报告的更新一直没能完成：临时结果转为正式结果
+        finalize_provisional_risk(user_id, payload["reportId"], job_id, use_model=False)
+        return
+    job_status = status_store.get_job(job_id) if job_id else None
+    if job_status is not None and job_status.get("reportId") is not None:
+        report_filter = {"_id": job_status["reportId"], "status": "processing"}
+    else:
+        report_filter = {"userId": user_id, "status": "processing"}
     
+    def write(session):
+        reports_collection.update_one(
+            report_filter,
+            {"$set": {"status": "failed", "errorMessage": f"检测任务失败: {error}", "completedAt": datetime.now()}},
+            session=session
+        )
+        if job_status is not None:
+            status_store.update(user_id, job_id, "failed", 0, f"检测任务失败: {error}", session=session)
+    
+    status_store.write(write)
+    progress_broker.publish(payload["userId"], payload.get("jobId"), "failed", 0, f"检测任务失败: {error}")
+
+def on_image_job_failed(payload, error):
+    """图像检测任务最终失败（重试次数用完）时更新报告状态"""
+    update_image_detection_status(payload["userId"], payload["fileId"], "failed", f"检测任务失败: {error}", payload.get("jobId"))
+
+def on_render_job_failed(payload, error):
+    set_visualization_status(payload["userId"], payload["fileId"], "failed", report_id=payload.get("reportId"))
+
+def create_job_workers(lanes=None, threads=None):
+    """按通道创建执行检测任务的工作线程（Web进程内嵌或worker.py使用）"""
+    job_queue.ensure_indexes()
+    return scheduler.create_workers(
+        handlers={"risk": run_risk_job, "image": run_image_job, "render": run_render_job},
+        failure_handlers={"risk": on_risk_job_failed, "image": on_image_job_failed, "render": on_render_job_failed},
+        lanes=lanes,
+        threads=threads,
+        poll_interval=config.JOB_POLL_INTERVAL
+    )
+
+# 新增接口: 任务通道统计
+@app.route('/api/jobs/stats', methods=['GET'])
+def get_job_stats():
+    """各任务通道的排队数、执行数、等待时间和拒绝/降级次数，以及风险评分的出报告时间和回退比例"""
     return jsonify({
         "success": True,
-        "images": result
+        "lanes": scheduler.stats(),
+        "riskScoring": risk_scorer.stats(),
+        "progressEvents": progress_broker.stats()
     })
 
 if __name__ == "__main__":
+    # debug模式下重载器的监控进程不处理请求，只在实际服务的子进程中启动工作线程
+    if config.JOB_EMBEDDED_WORKERS and (not config.DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        for worker in create_job_workers():
+            worker.start()
     app.run(host=config.HOST, port=config.PORT, debug=config.DEBUG)
\ No newline at end of file
@@ -0,0 +1,19 @@
+"""
+hypercorn配置 - 检测进度接口的异步部署（entrypoint.sh progress）
+
+用法:
+    hypercorn -c python:hypercorn_conf async_app:application
+
+生产环境的主部署是gunicorn多进程部署（gunicorn.conf.py）。gthread工作进程中每个检测进度连接
+（/api/detect/events最长PROGRESS_STREAM_SECONDS、/api/detect/wait最长PROGRESS_LONG_POLL_SECONDS）
+占一个请求线程，十几个打开着检测页面的客户端就能占满所有请求线程（见benchmarks/bench_async_app.py），
+所以反向代理只把这两个接口转发到这里的异步部署，进度连接在事件循环中等待，不占线程。
+
+这个部署不执行检测任务（ASYNC_EMBEDDED_WORKERS），任务在其他进程中执行时按PROGRESS_RECHECK_SECONDS
+回查状态文档得到进度，一个进程就能保持数千个进度连接。
+"""
+import config as app_config
+
+bind = [f"{app_config.HOST}:{app_config.PROGRESS_SERVER_PORT}"]
+workers = 1
+graceful_timeout = app_config.SERVING_GRACEFUL_TIMEOUT
@@ -0,0 +1,185 @@
+"""
+图像级联推理模块 - 低分辨率快速通道 + 完整DFDN
+
+大部分上传的影像要么明显正常，要么是大面积高密度的出血，不需要在256x256分辨率上
+对每个patch做完整的注意力计算。级联推理先用低分辨率输入跑一遍DFDN（同一套权重，
+ResNet计算量约为1/4，Transformer序列长度从64降到16），置信度达到阈值时直接返回，
+否则再升级到完整分辨率的DFDN。
+"""
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import config
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def normalize_image(image, target_size=(256, 256)):
+    """将灰度图缩放到目标尺寸并做min-max归一化，返回带批次和通道维度的数组"""
+    resized = cv2.resize(image, target_size, interpolation=cv2.INTER_LINEAR)
+
+    if resized.max() > resized.min():
+        normalized = (resized - resized.min()) / (resized.max() - resized.min())
+    else:
+        normalized = np.zeros_like(resized, dtype=np.float32)
+
+    return normalized[np.newaxis, ..., np.newaxis]
+
+
+def load_thresholds():
+    """
+    读取级联置信度阈值
+
+    手工指定的值来自config.CASCADE_THRESHOLDS，如果存在calibrate_cascade.py生成的阈值文件，
+    则用文件中的值覆盖对应模态。
+
+    Returns:
+        dict: 模态 -> 阈值，不包含既没有校准也没有指定阈值的模态
+    """
+    thresholds = dict(config.CASCADE_THRESHOLDS)
+
+    thresholds_path = os.path.join(BASE_DIR, config.CASCADE_THRESHOLDS_FILE)
+    if os.path.exists(thresholds_path):
+        try:
+            with open(thresholds_path, 'r', encoding='utf-8') as f:
+                calibrated = json.load(f)
+            for modality, info in calibrated.items():
+                thresholds[modality] = float(info["threshold"])
+            print(f"已加载校准后的级联阈值: {thresholds}")
+        except Exception as e:
+            print(f"读取级联阈值文件失败，使用默认阈值: {e}")
+
+    return thresholds
+
+
+class CascadeStats:
+    """按模态统计级联推理的升级率，供报告和监控使用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def record(self, modality, escalated):
+        """
+        记录一次推理
+
+        Returns:
+            float: 记录后该模态的累计升级率
+        """
+        with self._lock:
+            counts = self._counts.setdefault(modality, {"total": 0, "escalated": 0})
+            counts["total"] += 1
+            if escalated:
+                counts["escalated"] += 1
+            return counts["escalated"] / counts["total"]
+
+    def snapshot(self):
+        """返回各模态的累计统计"""
+        with self._lock:
+            return {
+                modality: {
+                    "total": counts["total"],
+                    "escalated": counts["escalated"],
+                    "escalationRate": counts["escalated"] / counts["total"] if counts["total"] else 0.0
+                }
+                for modality, counts in self._counts.items()
+            }
+
+
+cascade_stats = CascadeStats()
+
+
+class CascadeClassifier:
+    """两级图像分类器：低分辨率DFDN提前退出，低置信度时升级到完整DFDN"""
+
+    def __init__(self, modality, low_res_model, full_model, threshold,
+                 low_res_size=(128, 128), full_size=(256, 256), stats=None):
+        """
+        初始化级联分类器
+
+        Args:
+            modality (str): 图像模态 ('CT' 或 'MRI')
+            low_res_model: 以low_res_size为输入构建的DynamicFeatureDecouplingNetwork
+            full_model: 以full_size为输入构建的DynamicFeatureDecouplingNetwork
+            threshold (float): 低分辨率通道的最低置信度，低于该值时升级
+            low_res_size (tuple): 低分辨率输入尺寸
+            full_size (tuple): 完整输入尺寸
+            stats (CascadeStats): 升级率统计，默认使用模块级统计
+        """
+        self.modality = modality
+        self.low_res_model = low_res_model
+        self.full_model = full_model
+        self.threshold = threshold
+        self.low_res_size = tuple(low_res_size)
+        self.full_size = tuple(full_size)
+        self.stats = stats if stats is not None else cascade_stats
+
+    @staticmethod
+    def _run(model, batch):
+        """单次前向传播同时得到分类概率和两组特征"""
+        probabilities, pathology_features, physiology_features = model.dfdn_model(batch, training=False)
+        return probabilities.numpy(), pathology_features.numpy(), physiology_features.numpy()
+
+    def run_stages(self, image):
+        """
+        分别运行两个阶段，不做提前退出（供阈值校准使用）
+
+        Returns:
+            tuple: (低分辨率概率, 完整分辨率概率)
+        """
+        low_res_probs, _, _ = self._run(self.low_res_model, normalize_image(image, self.low_res_size))
+        full_probs, _, _ = self._run(self.full_model, normalize_image(image, self.full_size))
+        return low_res_probs[0], full_probs[0]
+
+    def classify(self, image, full_input=None):
+        """
+        对一张灰度图做级联分类
+
+        Args:
+            image (np.ndarray): 原始灰度图
+            full_input (np.ndarray): 已经预处理好的完整分辨率输入，可选
+
+        Returns:
+            dict: probabilities、pathology_features、physiology_features和cascade信息
+        """
+        start = time.perf_counter()
+        probabilities, pathology_features, physiology_features = self._run(
+            self.low_res_model, normalize_image(image, self.low_res_size)
+        )
+        low_res_ms = (time.perf_counter() - start) * 1000
+        low_res_confidence = float(np.max(probabilities[0]))
+
+        escalated = low_res_confidence < self.threshold
+        full_ms = None
+        if escalated:
+            start = time.perf_counter()
+            if full_input is None:
+                full_input = normalize_image(image, self.full_size)
+            probabilities, pathology_features, physiology_features = self._run(self.full_model, full_input)
+            full_ms = (time.perf_counter() - start) * 1000
+
+        escalation_rate = self.stats.record(self.modality, escalated)
+
+        return {
+            "probabilities": probabilities,
+            "pathology_features": pathology_features,
+            "physiology_features": physiology_features,
+            "cascade": {
+                "stage": "full" if escalated else "low_res",
+                "escalated": escalated,
+                "threshold": self.threshold,
+                "lowResConfidence": low_res_confidence,
+                "lowResSize": list(self.low_res_size),
+                "latencyMs": {
+                    "lowRes": round(low_res_ms, 2),
+                    "full": round(full_ms, 2) if full_ms is not None else None,
+                    "total": round(low_res_ms + (full_ms or 0.0), 2)
+                },
+                "escalationRate": round(escalation_rate, 4)
+            }
+        }
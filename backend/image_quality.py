@@ -0,0 +1,162 @@
+"""
+图像质量检查模块 - 在推理前拒绝无法使用的上传图像
+
+空白、近乎单一灰度、非脑部或被截断的图像不应该进入模型加载、推理和300dpi渲染流程。
+所有检查都在解码后的灰度数组上以向量化方式完成，先把图像缩小到不超过256像素的边长，
+整个检查耗时在几毫秒以内。
+
+提交图像检测任务时用check_image_bytes在Web进程中先检查一次（不需要TensorFlow），
+不合格的上传不占用image通道的排队名额；任务执行时analyze_brain_image再检查一次，兜底已经排队的任务。
+"""
+import io
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import config
+
+DECODE_ERROR_REASON = "图像文件无法解码，文件可能不完整或已损坏"
+
+
+class ImageQualityError(ValueError):
+    """图像质量检查未通过"""
+
+    def __init__(self, reason, metrics=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.metrics = metrics or {}
+
+
+def _histogram_stats(image):
+    """基于256级直方图计算灰度分布的百分位跨度和熵"""
+    hist = np.bincount(image.ravel(), minlength=256).astype(np.float64)
+    prob = hist / hist.sum()
+    cdf = np.cumsum(prob)
+
+    p01 = int(np.searchsorted(cdf, 0.01))
+    p99 = int(np.searchsorted(cdf, 0.99))
+
+    nonzero = prob[prob > 0]
+    entropy = max(0.0, float(-np.sum(nonzero * np.log2(nonzero))))
+
+    return p99 - p01, entropy
+
+
+def _uniform_band_ratio(image, from_bottom):
+    """计算从图像底部（或顶部）开始连续的单一灰度行所占的比例"""
+    rows = image[::-1] if from_bottom else image
+    uniform = rows.min(axis=1) == rows.max(axis=1)
+    if uniform.all():
+        return 1.0
+    # 第一个非单一灰度行的位置即为连续单一灰度行的数量
+    return int(np.argmin(uniform)) / len(rows)
+
+
+def _mask_stats(image):
+    """用Otsu阈值估计脑组织掩膜，返回掩膜覆盖率和边框像素中前景的比例"""
+    _, mask = cv2.threshold(image, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    coverage = float(mask.mean())
+
+    border = np.concatenate([mask[0, :], mask[-1, :], mask[1:-1, 0], mask[1:-1, -1]])
+    border_foreground = float(border.mean())
+
+    return coverage, border_foreground
+
+
+def check_image_quality(image, thresholds=None):
+    """
+    检查解码后的灰度图像是否适合送入模型
+
+    Args:
+        image (np.ndarray): 灰度图像（uint8，形状为[H, W]）
+        thresholds (dict): 检查阈值，默认使用config.QUALITY_THRESHOLDS
+
+    Returns:
+        tuple: (是否通过, 未通过原因, 检查指标)
+    """
+    start = time.perf_counter()
+    thresholds = thresholds or config.QUALITY_THRESHOLDS
+    metrics = {}
+
+    def result(is_valid, reason=""):
+        metrics["elapsedMs"] = round((time.perf_counter() - start) * 1000, 3)
+        return is_valid, reason, metrics
+
+    if image.ndim != 2:
+        return result(False, "图像必须是单通道灰度图")
+
+    height, width = image.shape
+    metrics["height"] = int(height)
+    metrics["width"] = int(width)
+
+    # 1. 尺寸和宽高比
+    if min(height, width) < thresholds["min_size"]:
+        return result(False, f"图像尺寸过小（{width}x{height}），最小边长需要{thresholds['min_size']}像素")
+
+    aspect_ratio = max(height, width) / min(height, width)
+    metrics["aspectRatio"] = round(aspect_ratio, 3)
+    if aspect_ratio > thresholds["max_aspect_ratio"]:
+        return result(False, f"图像宽高比异常（{aspect_ratio:.2f}），可能不是脑部断层图像")
+
+    # 后续检查在缩小后的图像上进行，保证耗时与上传分辨率无关
+    if image.dtype != np.uint8:
+        image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    scale = 256 / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+
+    # 2. 灰度分布：动态范围和熵
+    intensity_range, entropy = _histogram_stats(image)
+    metrics["intensityRange"] = intensity_range
+    metrics["entropy"] = round(entropy, 3)
+    if intensity_range < thresholds["min_intensity_range"]:
+        return result(False, "图像几乎是单一灰度（空白或全黑/全白图像）")
+    if entropy < thresholds["min_entropy"]:
+        return result(False, f"图像信息量过低（熵 {entropy:.2f} bits）")
+
+    # 3. 截断：底部出现大片单一灰度行而顶部没有，通常是上传中断后解码器填充的结果
+    bottom_band = _uniform_band_ratio(image, from_bottom=True)
+    top_band = _uniform_band_ratio(image, from_bottom=False)
+    metrics["truncatedBand"] = round(bottom_band - top_band, 3)
+    if bottom_band - top_band > thresholds["max_truncated_band"]:
+        return result(False, "图像底部存在大片空白区域，文件可能在上传过程中被截断")
+
+    # 4. 模糊：拉普拉斯响应的方差
+    blur_score = float(cv2.Laplacian(image, cv2.CV_64F).var())
+    metrics["blurScore"] = round(blur_score, 3)
+    if blur_score < thresholds["min_blur_score"]:
+        return result(False, f"图像过于模糊（清晰度评分 {blur_score:.1f}）")
+
+    # 5. 脑组织掩膜：前景覆盖率应在合理范围内，且断层图像的边框应以背景为主
+    coverage, border_foreground = _mask_stats(image)
+    metrics["maskCoverage"] = round(coverage, 3)
+    metrics["borderForeground"] = round(border_foreground, 3)
+    if not thresholds["min_mask_coverage"] <= coverage <= thresholds["max_mask_coverage"]:
+        return result(False, f"未检测到有效的脑组织区域（前景覆盖率 {coverage:.1%}）")
+    if border_foreground > thresholds["max_border_foreground"]:
+        return result(False, "图像边缘被前景占满，可能不是脑部CT/MRI图像")
+
+    return result(True)
+
+
+def check_image_bytes(data, thresholds=None):
+    """
+    解码图像文件内容并检查质量
+
+    Args:
+        data (bytes): 图像文件内容
+        thresholds (dict): 检查阈值，默认使用config.QUALITY_THRESHOLDS
+
+    Returns:
+        tuple: (是否通过, 未通过原因, 检查指标)，与check_image_quality相同
+    """
+    try:
+        # 与brain_image_analyzer.preprocess_image相同的解码方式，截断或损坏的文件在convert时抛出OSError
+        image = np.array(Image.open(io.BytesIO(data)).convert('L'))
+    except OSError as e:
+        print(f"解码图像时出错: {e}")
+        return False, DECODE_ERROR_REASON, {}
+    return check_image_quality(image, thresholds)
@@ -0,0 +1,505 @@
+"""
+任务队列模块 - 持久化的检测任务队列（租约、心跳、重试和过期租约回收）
+
+原来每个检测请求启动一个守护线程，进程重启后任务直接丢失，报告永远停在processing。
+这里把任务写入jobs集合，任意数量的进程/节点中的JobWorker通过find_one_and_update原子地领取任务:
+    - 领取时任务进入running，并获得lease_seconds秒的租约，执行期间由心跳线程不断续期
+    - 工作进程崩溃后租约不再续期，过期后任务回到queued由其他工作进程重新执行
+    - 执行失败或租约过期的次数达到max_attempts后任务标记为failed，并通知对应的失败处理函数
+
+任务文档:
+    {_id: jobId, kind, payload, status: queued/running/done/failed, attempts, maxAttempts,
+     leaseOwner, leaseExpiresAt, availableAt, lastError, createdAt, updatedAt, finishedAt}
+
+InMemoryJobQueue与MongoJobQueue接口相同，用于测试和单进程运行。
+"""
+import copy
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, ReturnDocument
+
+JOB_STATUSES = ("queued", "running", "done", "failed")
+ACTIVE_STATUSES = ("queued", "running")
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def new_job_id():
+    """生成任务ID"""
+    return uuid.uuid4().hex
+
+
+class JobQueue:
+    """任务队列的公共部分，子类实现具体存储"""
+
+    def __init__(self, lease_seconds=60, max_attempts=3, retry_delay=10):
+        """
+        Args:
+            lease_seconds (float): 租约时长（秒），工作进程需要在此时间内发送心跳
+            max_attempts (int): 默认的最大执行次数（包括租约过期导致的重新执行）
+            retry_delay (float): 失败后重新排队的等待时间（秒），按已执行次数线性增长
+        """
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def _new_job(self, kind, payload, job_id, max_attempts, delay=0):
+        now = _now()
+        return {
+            "_id": job_id or new_job_id(),
+            "kind": kind,
+            "payload": payload or {},
+            "status": "queued",
+            "attempts": 0,
+            "maxAttempts": max_attempts or self.max_attempts,
+            "leaseOwner": None,
+            "leaseExpiresAt": None,
+            "availableAt": now + timedelta(seconds=delay),
+            "lastError": None,
+            "createdAt": now,
+            "updatedAt": now
+        }
+
+    def _failure_update(self, job, error, retry):
+        """失败后的状态：还有重试次数时延迟重新排队，否则标记为failed"""
+        now = _now()
+        update = {"leaseOwner": None, "leaseExpiresAt": None, "lastError": error, "updatedAt": now}
+        if retry and job["attempts"] < job["maxAttempts"]:
+            update.update({
+                "status": "queued",
+                "availableAt": now + timedelta(seconds=self.retry_delay * job["attempts"])
+            })
+        else:
+            update.update({"status": "failed", "finishedAt": now})
+        return update
+
+    def is_active(self, job_id):
+        """任务是否仍在排队或执行中（不存在的任务返回False）"""
+        job = self.get(job_id)
+        return job is not None and job["status"] in ACTIVE_STATUSES
+
+
+class MongoJobQueue(JobQueue):
+    """基于MongoDB集合的任务队列，可以在多个进程和节点之间共享"""
+
+    def __init__(self, collection, **kwargs):
+        """
+        Args:
+            collection: MongoDB集合（jobs）
+        """
+        super().__init__(**kwargs)
+        self.collection = collection
+
+    def ensure_indexes(self):
+        """领取任务和回收过期租约所用的索引"""
+        self.collection.create_index([("status", ASCENDING), ("kind", ASCENDING), ("availableAt", ASCENDING)])
+        self.collection.create_index([("status", ASCENDING), ("leaseExpiresAt", ASCENDING)])
+
+    def enqueue(self, kind, payload=None, job_id=None, max_attempts=None, delay=0):
+        """
+        提交任务
+
+        Args:
+            kind (str): 任务类型，对应JobWorker的处理函数
+            payload (dict): 任务参数
+            job_id (str): 任务ID，不指定时自动生成
+            max_attempts (int): 最大执行次数，不指定时使用队列的默认值
+            delay (float): 延迟多少秒后才能被领取
+
+        Returns:
+            str: 任务ID
+        """
+        job = self._new_job(kind, payload, job_id, max_attempts, delay)
+        self.collection.insert_one(job)
+        return job["_id"]
+
+    def get(self, job_id):
+        return self.collection.find_one({"_id": job_id})
+
+    def claim(self, worker_id, kinds=None):
+        """
+        原子地领取一个可执行的任务（最早可执行的优先）
+
+        Returns:
+            dict: 任务文档，没有可执行的任务时返回None
+        """
+        now = _now()
+        query = {"status": "queued", "availableAt": {"$lte": now}}
+        if kinds:
+            query["kind"] = {"$in": list(kinds)}
+        return self.collection.find_one_and_update(
+            query,
+            {
+                "$set": {
+                    "status": "running",
+                    "leaseOwner": worker_id,
+                    "leaseExpiresAt": now + timedelta(seconds=self.lease_seconds),
+                    "updatedAt": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("availableAt", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def heartbeat(self, job_id, worker_id):
+        """续期租约，租约已被回收（任务不再属于该工作进程）时返回False"""
+        now = _now()
+        result = self.collection.update_one(
+            {"_id": job_id, "status": "running", "leaseOwner": worker_id},
+            {"$set": {"leaseExpiresAt": now + timedelta(seconds=self.lease_seconds), "updatedAt": now}}
+        )
+        return result.matched_count == 1
+
+    def complete(self, job_id, worker_id):
+        """标记任务完成，租约已被回收时返回False"""
+        now = _now()
+        result = self.collection.update_one(
+            {"_id": job_id, "status": "running", "leaseOwner": worker_id},
+            {"$set": {"status": "done", "leaseOwner": None, "leaseExpiresAt": None,
+                      "updatedAt": now, "finishedAt": now}}
+        )
+        return result.matched_count == 1
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        """
+        记录一次执行失败
+
+        Returns:
+            dict: 更新后的任务文档（status为queued表示会重试），租约已被回收时返回None
+        """
+        job = self.collection.find_one({"_id": job_id, "status": "running", "leaseOwner": worker_id})
+        if job is None:
+            return None
+        return self.collection.find_one_and_update(
+            {"_id": job_id, "status": "running", "leaseOwner": worker_id},
+            {"$set": self._failure_update(job, error, retry)},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def recover_stale(self, limit=100):
+        """
+        回收租约已过期的任务：还有重试次数的重新排队，否则标记为failed
+
+        Returns:
+            tuple: (重新排队的任务列表, 标记为failed的任务列表)
+        """
+        now = _now()
+        expired = {"status": "running", "leaseExpiresAt": {"$lt": now}}
+        requeued, failed = [], []
+        for job in self.collection.find(expired).limit(limit):
+            update = self._failure_update(job, "租约过期（工作进程可能已退出）", retry=True)
+            # 条件中带上leaseExpiresAt，避免覆盖刚刚续期或被其他进程回收的任务
+            updated = self.collection.find_one_and_update(
+                {"_id": job["_id"], **expired},
+                {"$set": update},
+                return_document=ReturnDocument.AFTER
+            )
+            if updated is not None:
+                (requeued if updated["status"] == "queued" else failed).append(updated)
+        return requeued, failed
+
+    def count(self, kind, status):
+        """某类型、某状态的任务数"""
+        return self.collection.count_documents({"status": status, "kind": kind})
+
+    def stats(self):
+        """各类型、各状态的任务数，例如 {'risk': {'queued': 2, 'running': 1}}"""
+        counts = {}
+        for row in self.collection.aggregate([
+            {"$group": {"_id": {"kind": "$kind", "status": "$status"}, "count": {"$sum": 1}}}
+        ]):
+            counts.setdefault(row["_id"]["kind"], {})[row["_id"]["status"]] = row["count"]
+        return counts
+
+
+class InMemoryJobQueue(JobQueue):
+    """进程内的任务队列，语义与MongoJobQueue相同，用于测试和单进程运行"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        pass
+
+    def enqueue(self, kind, payload=None, job_id=None, max_attempts=None, delay=0):
+        job = self._new_job(kind, payload, job_id, max_attempts, delay)
+        with self._lock:
+            if job["_id"] in self._jobs:
+                raise ValueError(f"任务ID重复: {job['_id']}")
+            self._jobs[job["_id"]] = job
+        return job["_id"]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job else None
+
+    def _owned(self, job_id, worker_id):
+        job = self._jobs.get(job_id)
+        if job is None or job["status"] != "running" or job["leaseOwner"] != worker_id:
+            return None
+        return job
+
+    def claim(self, worker_id, kinds=None):
+        now = _now()
+        with self._lock:
+            candidates = [
+                job for job in self._jobs.values()
+                if job["status"] == "queued" and job["availableAt"] <= now and (not kinds or job["kind"] in kinds)
+            ]
+            if not candidates:
+                return None
+            job = min(candidates, key=lambda j: j["availableAt"])
+            job.update({
+                "status": "running",
+                "leaseOwner": worker_id,
+                "leaseExpiresAt": now + timedelta(seconds=self.lease_seconds),
+                "attempts": job["attempts"] + 1,
+                "updatedAt": now
+            })
+            return copy.deepcopy(job)
+
+    def heartbeat(self, job_id, worker_id):
+        now = _now()
+        with self._lock:
+            job = self._owned(job_id, worker_id)
+            if job is None:
+                return False
+            job.update({"leaseExpiresAt": now + timedelta(seconds=self.lease_seconds), "updatedAt": now})
+            return True
+
+    def complete(self, job_id, worker_id):
+        now = _now()
+        with self._lock:
+            job = self._owned(job_id, worker_id)
+            if job is None:
+                return False
+            job.update({"status": "done", "leaseOwner": None, "leaseExpiresAt": None,
+                        "updatedAt": now, "finishedAt": now})
+            return True
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        with self._lock:
+            job = self._owned(job_id, worker_id)
+            if job is None:
+                return None
+            job.update(self._failure_update(job, error, retry))
+            return copy.deepcopy(job)
+
+    def recover_stale(self, limit=100):
+        now = _now()
+        requeued, failed = [], []
+        with self._lock:
+            expired = [
+                job for job in self._jobs.values()
+                if job["status"] == "running" and job["leaseExpiresAt"] < now
+            ][:limit]
+            for job in expired:
+                job.update(self._failure_update(job, "租约过期（工作进程可能已退出）", retry=True))
+                (requeued if job["status"] == "queued" else failed).append(copy.deepcopy(job))
+        return requeued, failed
+
+    def count(self, kind, status):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job["kind"] == kind and job["status"] == status)
+
+    def stats(self):
+        with self._lock:
+            counter = Counter((job["kind"], job["status"]) for job in self._jobs.values())
+        counts = {}
+        for (kind, status), count in counter.items():
+            counts.setdefault(kind, {})[status] = count
+        return counts
+
+
+class JobWorker:
+    """
+    从队列领取任务并执行
+
+    每个执行线程一次执行一个任务；一个心跳线程为本工作进程持有的所有任务续期租约，
+    并定期回收其他工作进程遗留的过期租约。
+    """
+
+    def __init__(self, queue, handlers, failure_handlers=None, worker_id=None, threads=1,
+                 kinds=None, poll_interval=1.0, listener=None):
+        """
+        Args:
+            queue: MongoJobQueue或InMemoryJobQueue
+            handlers (dict): 任务类型 -> 处理函数handler(payload)，抛出异常表示失败
+            failure_handlers (dict): 任务类型 -> 最终失败时的回调on_failed(payload, error)
+            worker_id (str): 工作进程标识，默认使用 主机名:进程号:随机后缀
+            threads (int): 执行线程数
+            kinds: 只领取这些类型的任务，默认领取handlers中的全部类型
+            poll_interval (float): 队列为空时的轮询间隔（秒）
+            listener: 可选的统计对象，领取任务后调用listener.job_started(job)，
+                      执行结束后调用listener.job_finished(job, 执行秒数, 是否成功)
+        """
+        self.queue = queue
+        self.handlers = handlers
+        self.failure_handlers = failure_handlers or {}
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.threads = threads
+        self.kinds = list(kinds or handlers)
+        self.poll_interval = poll_interval
+        self.listener = listener
+
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _notify_failed(self, job):
+        handler = self.failure_handlers.get(job["kind"])
+        if handler is None:
+            return
+        try:
+            handler(job["payload"], job.get("lastError"))
+        except Exception as e:
+            print(f"任务 {job['_id']} 的失败处理函数出错: {str(e)}")
+            traceback.print_exc()
+
+    def _notify_listener(self, method, *args):
+        if self.listener is None:
+            return
+        try:
+            getattr(self.listener, method)(*args)
+        except Exception as e:
+            print(f"任务统计出错: {str(e)}")
+
+    def recover_stale(self):
+        """回收过期租约，并通知因此最终失败的任务"""
+        requeued, failed = self.queue.recover_stale()
+        for job in requeued:
+            print(f"任务 {job['_id']}（{job['kind']}）租约过期，重新排队（已执行 {job['attempts']} 次）")
+        for job in failed:
+            print(f"任务 {job['_id']}（{job['kind']}）租约过期且重试次数已用完，标记为失败")
+            self._notify_failed(job)
+        return len(requeued) + len(failed)
+
+    def run_once(self):
+        """
+        领取并执行一个任务
+
+        Returns:
+            bool: 是否执行了任务
+        """
+        job = self.queue.claim(self.worker_id, self.kinds)
+        if job is None:
+            return False
+
+        job_id, kind = job["_id"], job["kind"]
+        print(f"工作进程 {self.worker_id} 领取任务 {job_id}（{kind}，第 {job['attempts']} 次执行）")
+        with self._held_lock:
+            self._held.add(job_id)
+        self._notify_listener("job_started", job)
+        start = time.perf_counter()
+        succeeded = False
+        try:
+            self.handlers[kind](job["payload"])
+            succeeded = True
+        except Exception as e:
+            print(f"任务 {job_id}（{kind}）执行失败: {str(e)}")
+            traceback.print_exc()
+            updated = self.queue.fail(job_id, self.worker_id, str(e))
+            if updated is not None and updated["status"] == "failed":
+                self._notify_failed(updated)
+        else:
+            if not self.queue.complete(job_id, self.worker_id):
+                print(f"警告: 任务 {job_id} 的租约在执行期间被回收，结果可能被重复写入")
+        finally:
+            with self._held_lock:
+                self._held.discard(job_id)
+            self._notify_listener("job_finished", job, time.perf_counter() - start, succeeded)
+        return True
+
+    def _run_loop(self):
+        while not self._stop.is_set():
+            try:
+                if not self.run_once():
+                    self._stop.wait(self.poll_interval)
+            except Exception as e:
+                # 队列本身出错（例如数据库暂时不可用）时稍后重试
+                print(f"领取任务失败: {str(e)}")
+                self._stop.wait(self.poll_interval)
+
+    def _heartbeat_loop(self):
+        interval = self.queue.lease_seconds / 3
+        while not self._stop.wait(interval):
+            with self._held_lock:
+                held = list(self._held)
+            for job_id in held:
+                try:
+                    if not self.queue.heartbeat(job_id, self.worker_id):
+                        print(f"警告: 任务 {job_id} 的租约已被回收")
+                except Exception as e:
+                    print(f"任务 {job_id} 心跳失败: {str(e)}")
+            try:
+                self.recover_stale()
+            except Exception as e:
+                print(f"回收过期租约失败: {str(e)}")
+
+    def start(self):
+        """在后台线程中开始执行任务"""
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)]
+        self._threads += [
+            threading.Thread(target=self._run_loop, name=f"job-worker-{i}", daemon=True)
+            for i in range(self.threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+        print(f"工作进程 {self.worker_id} 已启动，{self.threads} 个执行线程，任务类型: {', '.join(self.kinds)}")
+
+    def stop(self, timeout=None):
+        """停止领取新任务，等待正在执行的任务结束"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+
+def run_workers(workers):
+    """启动一组JobWorker并阻塞当前线程，Ctrl+C或SIGTERM时等当前任务结束后退出"""
+    import signal
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    for worker in workers:
+        worker.start()
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    print("工作进程正在退出...")
+    for worker in workers:
+        worker.stop()
+
+
+def create_job_queue(db, backend="mongo", **kwargs):
+    """
+    按配置创建任务队列
+
+    Args:
+        db: MongoDB数据库，backend为mongo时使用其中的jobs集合
+        backend (str): 'mongo' 或 'memory'
+    """
+    if backend == "mongo":
+        queue = MongoJobQueue(db["jobs"], **kwargs)
+    elif backend == "memory":
+        queue = InMemoryJobQueue(**kwargs)
+    else:
+        raise ValueError(f"不支持的任务队列: {backend}")
+    return queue
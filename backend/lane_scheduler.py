@@ -0,0 +1,191 @@
+"""
+任务通道模块 - 按任务类型分通道调度，排队上限与过载保护
+
+表格数据的风险评分很快，CT/MRI推理和可视化渲染很慢。所有任务共用同一组工作线程时，
+一批图像上传就会让所有用户的风险报告跟着排队。这里每个通道（任务类型）:
+    - 有各自的工作线程数，互不占用
+    - 有排队上限，排满时拒绝新任务并给出建议的重试等待时间（Retry-After），
+      或由调用方降级处理（例如图像分析不生成可视化分析图）
+    - 统计排队数、执行数、排队等待时间、执行时间以及拒绝和降级次数
+
+排队数和执行数来自任务队列（多进程共享），等待时间和拒绝/降级次数是当前进程内的统计。
+"""
+import math
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+import numpy as np
+
+from job_queue import JobWorker
+
+
+class LaneSaturatedError(Exception):
+    """通道排队已满"""
+
+    def __init__(self, lane, queued, retry_after):
+        super().__init__(f"{lane}通道排队已满（{queued} 个任务）")
+        self.lane = lane
+        self.queued = queued
+        self.retry_after = retry_after
+
+
+class _LaneMetrics:
+    def __init__(self, window):
+        self.submitted = 0
+        self.rejected = 0
+        self.degraded = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = deque(maxlen=window)
+        self.run_seconds = deque(maxlen=window)
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "max": None}
+    array = np.asarray(values)
+    return {
+        "p50": round(float(np.percentile(array, 50)), 3),
+        "p95": round(float(np.percentile(array, 95)), 3),
+        "max": round(float(array.max()), 3)
+    }
+
+
+class LaneScheduler:
+    """按通道提交任务、创建工作线程并汇总统计"""
+
+    def __init__(self, queue, lanes, window=1000):
+        """
+        Args:
+            queue: MongoJobQueue或InMemoryJobQueue，通道名即任务类型
+            lanes (dict): 通道名 -> {"workers": 每个进程的工作线程数, "max_queued": 排队上限,
+                                      "retry_after": 没有执行时间统计时建议的重试等待秒数}
+            window (int): 等待时间和执行时间统计的样本数
+        """
+        self.queue = queue
+        self.lanes = lanes
+        self._lock = threading.Lock()
+        self._metrics = {lane: _LaneMetrics(window) for lane in lanes}
+
+    def _lane(self, lane):
+        if lane not in self.lanes:
+            raise ValueError(f"未知的任务通道: {lane}")
+        return self.lanes[lane]
+
+    def retry_after(self, lane, queued):
+        """按排队数和平均执行时间估计排到新任务所需的秒数"""
+        config = self._lane(lane)
+        with self._lock:
+            run_seconds = list(self._metrics[lane].run_seconds)
+        if not run_seconds:
+            return config["retry_after"]
+        estimate = queued * float(np.mean(run_seconds)) / max(1, config["workers"])
+        return int(min(max(math.ceil(estimate), 1), 600))
+
+    def _saturated(self, lane):
+        """返回 (是否排满, 当前排队数)"""
+        queued = self.queue.count(lane, "queued")
+        return queued >= self._lane(lane)["max_queued"], queued
+
+    def admit(self, lane):
+        """
+        检查通道是否还能接收新任务，排满时抛出LaneSaturatedError
+
+        在写入报告等准备工作之前调用，通过后再用submit提交。
+        """
+        saturated, queued = self._saturated(lane)
+        if saturated:
+            with self._lock:
+                self._metrics[lane].rejected += 1
+            raise LaneSaturatedError(lane, queued, self.retry_after(lane, queued))
+
+    def submit(self, lane, payload, job_id=None, delay=0):
+        """提交任务（不检查排队上限），delay秒后才能被领取，返回任务ID"""
+        self._lane(lane)
+        job_id = self.queue.enqueue(lane, payload, job_id=job_id, delay=delay)
+        with self._lock:
+            self._metrics[lane].submitted += 1
+        return job_id
+
+    def submit_or_degrade(self, lane, payload, job_id=None):
+        """通道未排满时提交任务并返回任务ID；排满时不提交，返回None，由调用方降级处理"""
+        saturated, _ = self._saturated(lane)
+        if saturated:
+            with self._lock:
+                self._metrics[lane].degraded += 1
+            return None
+        return self.submit(lane, payload, job_id)
+
+    def job_started(self, job):
+        available_at = job["availableAt"]
+        if available_at.tzinfo is None:
+            # MongoDB返回的时间不带时区（UTC）
+            available_at = available_at.replace(tzinfo=timezone.utc)
+        wait = max(0.0, (datetime.now(timezone.utc) - available_at).total_seconds())
+        with self._lock:
+            self._metrics[job["kind"]].wait_seconds.append(wait)
+
+    def job_finished(self, job, seconds, succeeded):
+        with self._lock:
+            metrics = self._metrics[job["kind"]]
+            metrics.run_seconds.append(seconds)
+            if succeeded:
+                metrics.completed += 1
+            else:
+                metrics.failed += 1
+
+    def create_workers(self, handlers, failure_handlers=None, lanes=None, threads=None, poll_interval=1.0):
+        """
+        为每个通道创建独立的JobWorker
+
+        Args:
+            handlers (dict): 通道名 -> 处理函数
+            failure_handlers (dict): 通道名 -> 最终失败时的回调
+            lanes: 只创建这些通道的工作线程，默认全部通道
+            threads (int): 覆盖每个通道的工作线程数
+
+        Returns:
+            list: JobWorker列表（尚未启动）
+        """
+        workers = []
+        for lane in lanes or self.lanes:
+            count = self._lane(lane)["workers"] if threads is None else threads
+            if count <= 0:
+                continue
+            workers.append(JobWorker(
+                self.queue,
+                handlers={lane: handlers[lane]},
+                failure_handlers={lane: failure_handlers[lane]} if failure_handlers and lane in failure_handlers else None,
+                threads=count,
+                poll_interval=poll_interval,
+                listener=self
+            ))
+        return workers
+
+    def stats(self):
+        """各通道的配置、排队数、执行数、等待/执行时间分布以及提交、拒绝和降级次数"""
+        result = {}
+        for lane, config in self.lanes.items():
+            with self._lock:
+                metrics = self._metrics[lane]
+                counters = {
+                    "submitted": metrics.submitted,
+                    "rejected": metrics.rejected,
+                    "degraded": metrics.degraded,
+                    "completed": metrics.completed,
+                    "failed": metrics.failed
+                }
+                wait_seconds, run_seconds = list(metrics.wait_seconds), list(metrics.run_seconds)
+            queued = self.queue.count(lane, "queued")
+            result[lane] = {
+                "workers": config["workers"],
+                "maxQueued": config["max_queued"],
+                "queued": queued,
+                "running": self.queue.count(lane, "running"),
+                "saturated": queued >= config["max_queued"],
+                "waitSeconds": _percentiles(wait_seconds),
+                "runSeconds": _percentiles(run_seconds),
+                **counters
+            }
+        return result
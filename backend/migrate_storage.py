@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+文件存储迁移脚本 - 把旧的扁平文件迁移到按内容哈希存储的布局（见file_utils.py、storage_backends.py）
+
+旧版本把上传文件直接存为UPLOAD_FOLDER/<userId>_<uuid>.<ext>，分析结果存为UPLOAD_FOLDER/results/下的文件，
+所有文件在同一个目录下，内容相同的文件各存一份。迁移:
+    1. medical_records中storedFileName是扁平文件名的记录：文件存为blob，更新storedFileName、fileUrl和sha256，
+       引用该文件的报告（fileUrl）一起更新
+    2. reports中visualization_url、report_url指向results/下旧文件的报告：文件存为blob，更新URL
+    3. 没有被任何记录引用的旧文件列为孤立文件，--delete-orphans时删除（results/也是图像分析的输出目录，
+       生成后才存入文件存储，删除孤立文件时不要有正在进行的图像检测）
+文件写入config.STORAGE_BACKEND配置的存储后端，配置为s3时同时完成到对象存储的迁移。
+每个文件先存为blob、更新记录后才删除旧文件，中途退出后可以重新执行。
+
+用法:
+    python migrate_storage.py --dry-run
+    python migrate_storage.py
+    python migrate_storage.py --delete-orphans
+"""
+import argparse
+import os
+import sys
+
+from storage_backends import is_blob_key
+
+RESULTS_SUBDIR = "results"
+
+
+def legacy_files(upload_folder):
+    """存储目录顶层和results/下的旧文件（blob在哈希前缀目录下，分块和临时文件在.开头的目录下）"""
+    files = set()
+    for subdir in ("", RESULTS_SUBDIR):
+        directory = os.path.join(upload_folder, subdir)
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.startswith(".") and os.path.isfile(path):
+                files.add(os.path.normpath(path))
+    return files
+
+
+def migrate_records(db, file_handler, upload_folder, dry_run, stats):
+    """迁移medical_records中的扁平文件，返回已迁移（可删除）的旧文件路径"""
+    migrated = set()
+    for record in db.medical_records.find({"storedFileName": {"$exists": True}},
+                                          {"storedFileName": 1, "fileUrl": 1}):
+        stored_file_name = record["storedFileName"]
+        if is_blob_key(stored_file_name):
+            continue
+        source = os.path.normpath(os.path.join(upload_folder, stored_file_name))
+        if not os.path.isfile(source):
+            print(f"缺失: 病历记录 {record['_id']} 的文件 {stored_file_name} 不存在")
+            stats["missing"] += 1
+            continue
+        stats["records"] += 1
+        if dry_run:
+            migrated.add(source)
+            continue
+
+        blob = file_handler.store_file(source, remove_source=False)
+        url = file_handler.url(blob["key"])
+        # 按旧文件名条件更新，并发执行的迁移只有一个生效，另一个释放自己的引用
+        result = db.medical_records.update_one(
+            {"_id": record["_id"], "storedFileName": stored_file_name},
+            {"$set": {"storedFileName": blob["key"], "fileUrl": url, "fileSize": blob["size"], "sha256": blob["sha256"]}}
+        )
+        if not result.modified_count:
+            file_handler.delete_file(blob["key"])
+            continue
+        if record.get("fileUrl"):
+            db.reports.update_many({"fileUrl": record["fileUrl"]}, {"$set": {"fileUrl": url}})
+        migrated.add(source)
+    return migrated
+
+
+def migrate_results(db, file_handler, upload_folder, dry_run, stats):
+    """迁移reports中指向results/下旧文件的可视化分析图和分析报告，返回已迁移的旧文件路径"""
+    migrated = set()
+    fields = ("visualization_url", "report_url")
+    query = {"$or": [{field: {"$regex": "^.+$"}} for field in fields]}
+    for report in db.reports.find(query, {field: 1 for field in fields}):
+        update = {}
+        for field in fields:
+            url = report.get(field)
+            if not url or is_blob_key(url.split("/uploads/", 1)[-1]):
+                continue
+            # 旧URL由绝对路径替换而来，格式不统一，按文件名在results/下查找
+            source = os.path.normpath(os.path.join(upload_folder, RESULTS_SUBDIR, os.path.basename(url)))
+            if not os.path.isfile(source):
+                print(f"缺失: 报告 {report['_id']} 的{field}文件 {url} 不存在")
+                stats["missing"] += 1
+                continue
+            stats["results"] += 1
+            if not dry_run:
+                update[field] = file_handler.url(file_handler.store_file(source, remove_source=False)["key"])
+            migrated.add(source)
+        if update:
+            result = db.reports.update_one({"_id": report["_id"], **{field: report[field] for field in update}},
+                                           {"$set": update})
+            if not result.modified_count:
+                for url in update.values():
+                    file_handler.delete_file(url.split("/uploads/", 1)[-1])
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把旧的扁平文件迁移到按内容哈希存储的布局")
+    parser.add_argument("--dry-run", action="store_true", help="只统计需要迁移的文件，不做修改")
+    parser.add_argument("--delete-orphans", action="store_true", help="删除没有被任何记录引用的旧文件")
+    args = parser.parse_args()
+
+    import pymongo
+    import config
+    from file_utils import FileHandler
+    from storage_backends import create_storage_backend
+
+    client = pymongo.MongoClient(config.MONGO_URI)
+    db = client[config.DATABASE_NAME]
+    backend = create_storage_backend(
+        config.STORAGE_BACKEND, root=config.UPLOAD_FOLDER, bucket=config.STORAGE_S3_BUCKET,
+        prefix=config.STORAGE_S3_PREFIX, endpoint_url=config.STORAGE_S3_ENDPOINT_URL, region=config.STORAGE_S3_REGION
+    )
+    file_handler = FileHandler(storage_dir=config.UPLOAD_FOLDER, backend=backend, blobs=db["blobs"])
+
+    stats = {"records": 0, "results": 0, "missing": 0}
+    before = legacy_files(config.UPLOAD_FOLDER)
+    migrated = migrate_records(db, file_handler, config.UPLOAD_FOLDER, args.dry_run, stats)
+    migrated |= migrate_results(db, file_handler, config.UPLOAD_FOLDER, args.dry_run, stats)
+
+    if not args.dry_run:
+        for path in migrated:
+            os.remove(path)
+    orphans = sorted(before - migrated)
+    if args.delete_orphans and not args.dry_run:
+        for path in orphans:
+            os.remove(path)
+
+    prefix = "[dry-run] " if args.dry_run else ""
+    print(f"{prefix}病历文件 {stats['records']} 个，分析结果文件 {stats['results']} 个，"
+          f"涉及旧文件 {len(migrated)} 个；缺失 {stats['missing']} 个")
+    action = "已删除" if args.delete_orphans and not args.dry_run else "未删除（--delete-orphans）"
+    print(f"{prefix}孤立的旧文件 {len(orphans)} 个，{action}")
+    for path in orphans[:20]:
+        print(f"  {path}")
+    if len(orphans) > 20:
+        print(f"  ... 另外 {len(orphans) - 20} 个")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
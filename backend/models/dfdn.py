@@ -1,18 +1,55 @@
 import os
+import itertools
+import math
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers, Model, optimizers
-import matplotlib.pyplot as plt
 from tensorflow.keras.applications import ResNet50V2
 from tensorflow.keras.layers import Input, Dense, Flatten, Dropout, GlobalAveragePooling2D, LayerNormalization, MultiHeadAttention, Activation, Add, GlobalAveragePooling1D
 from tqdm import tqdm
 
+# 支持的计算精度：float32、CPU上的bfloat16混合精度、GPU上的float16混合精度
+PRECISIONS = ('float32', 'mixed_bfloat16', 'mixed_float16')
+
+
+class Float32SoftmaxAttention(MultiHeadAttention):
+    """
+    注意力权重的softmax在float32中计算的多头注意力
+    
+    混合精度下Q/K/V投影和两次einsum使用低精度，注意力分数转换到float32后再做softmax，
+    避免bfloat16只有8位尾数造成的注意力权重偏差。权重与MultiHeadAttention完全相同。
+    """
+    
+    def _compute_attention(self, query, key, value, attention_mask=None, training=None, *args, **kwargs):
+        query = query * tf.cast(1.0 / math.sqrt(float(self._key_dim)), query.dtype)
+        attention_scores = tf.cast(tf.einsum(self._dot_product_equation, key, query), tf.float32)
+        if attention_mask is not None:
+            # 掩码从num_heads维度开始扩展到注意力分数的形状
+            for _ in range(len(attention_scores.shape) - len(attention_mask.shape)):
+                attention_mask = tf.expand_dims(attention_mask, axis=-len(self._attention_axes) * 2 - 1)
+            attention_scores += (1.0 - tf.cast(attention_mask, tf.float32)) * -1e9
+        attention_scores = tf.cast(tf.nn.softmax(attention_scores, axis=-1), query.dtype)
+        
+        attention_output = tf.einsum(
+            self._combine_equation, self._dropout_layer(attention_scores, training=training), value
+        )
+        return attention_output, attention_scores
+
+
 class DynamicFeatureDecouplingNetwork:
     """
     动态特征解耦网络(DFDN)
     用于分离医学影像中的病灶特征与生理噪声，基于Transformer和对比学习
     """
     
+    # ResNet50V2前100层被冻结；冻结边界内最后一个单张量输出的层是conv4_block1_out，
+    # 在这里切分主干，之后被冻结的conv4_block2_preact_bn/relu在尾部重新计算
+    FROZEN_BACKBONE_LAYERS = 100
+    BACKBONE_SPLIT_LAYER = 'conv4_block1_out'
+    
+    NUM_CLASSES = 3
+    CLASS_NAMES = ['正常', '缺血性卒中', '出血性卒中']
+    
     def __init__(
         self, 
         input_shape=(256, 256, 1),
@@ -24,7 +61,9 @@ class DynamicFeatureDecouplingNetwork:
         temperature=0.07,  # 降低温度参数
         contrastive_weight=0.01,  # 降低对比损失权重
         ortho_weight=0.01,  # 降低正交损失权重
-        modality='CT'
+        modality='CT',
+        strategy=None,  # tf.distribute策略，None时单进程训练
+        precision=None  # 计算精度（见PRECISIONS），None时使用当前的Keras全局策略
     ):
         self.input_shape = input_shape
         self.embedding_dim = embedding_dim
@@ -37,19 +76,43 @@ class DynamicFeatureDecouplingNetwork:
         self.ortho_weight = ortho_weight
         self.modality = modality
         
-        # 初始化模型
-        self.encoder = self._build_encoder()
-        self.pathology_decoder = self._build_decoder("pathology")
-        self.physiology_decoder = self._build_decoder("physiology")
-        self.classifier = self._build_classifier()
+        # 分布式训练时模型变量、指标和优化器都需要在策略作用域内创建
+        self.distributed = strategy is not None
+        self.strategy = strategy or tf.distribute.get_strategy()
         
-        # 创建训练模型
-        self.dfdn_model = self._build_dfdn_model()
-        self.contrastive_model = self._build_contrastive_model()
+        # 混合精度只作用于本实例的层：构建期间临时设置Keras全局策略，构建完成后恢复；
+        # 变量始终是float32，softmax、LayerNormalization、输出特征和分类概率保持float32
+        previous_policy = tf.keras.mixed_precision.global_policy()
+        self.precision = precision or previous_policy.name
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"不支持的计算精度: {self.precision}，可选 {', '.join(PRECISIONS)}")
+        self.mixed_precision = self.precision != 'float32'
+        tf.keras.mixed_precision.set_global_policy(self.precision)
         
-        # 初始化指标
-        self.ct_accuracy = tf.keras.metrics.CategoricalAccuracy(name='ct_accuracy')
-        self.mri_accuracy = tf.keras.metrics.CategoricalAccuracy(name='mri_accuracy')
+        try:
+            with self.strategy.scope():
+                # 初始化模型
+                self.encoder = self._build_encoder()
+                self.pathology_decoder = self._build_decoder("pathology")
+                self.physiology_decoder = self._build_decoder("physiology")
+                self.classifier = self._build_classifier()
+                
+                # 创建训练模型
+                self.dfdn_model = self._build_dfdn_model()
+                self.contrastive_model = self._build_contrastive_model()
+                
+                # 初始化指标
+                self.ct_accuracy = tf.keras.metrics.CategoricalAccuracy(name='ct_accuracy')
+                self.mri_accuracy = tf.keras.metrics.CategoricalAccuracy(name='mri_accuracy')
+        finally:
+            tf.keras.mixed_precision.set_global_policy(previous_policy)
+        
+        # 验证集混淆矩阵在设备上累积，只在本进程内使用，不需要在策略作用域内创建
+        self.val_confusion_matrix = tf.Variable(
+            tf.zeros((self.NUM_CLASSES, self.NUM_CLASSES), dtype=tf.int64),
+            trainable=False,
+            name='val_confusion_matrix'
+        )
         
         # 初始化损失函数
         self.ct_classification_loss = tf.keras.losses.CategoricalCrossentropy(
@@ -82,11 +145,15 @@ class DynamicFeatureDecouplingNetwork:
             input_shape=(self.input_shape[0], self.input_shape[1], 3)
         )
         # 冻结底层
-        for layer in base_model.layers[:100]:
+        for layer in base_model.layers[:self.FROZEN_BACKBONE_LAYERS]:
             layer.trainable = False
             
         x = base_model(x)
         
+        # 保留主干网络及其输出，供缓存激活的微调模式切分模型
+        self.backbone = base_model
+        self._backbone_output = x
+        
         # 将特征图转换为序列
         # 使用Keras层而不是直接调用tf函数
         reshape_layer = layers.Reshape((-1, tf.keras.backend.int_shape(x)[-1]))(x)
@@ -170,15 +237,16 @@ class DynamicFeatureDecouplingNetwork:
 
     def _transformer_block(self, x, embed_dim, num_heads, mlp_units, dropout_rate):
         """Transformer块实现"""
-        # 多头自注意力
-        attention_output = MultiHeadAttention(
+        # 多头自注意力（混合精度下softmax在float32中计算）
+        attention_layer = Float32SoftmaxAttention if self.mixed_precision else MultiHeadAttention
+        attention_output = attention_layer(
             num_heads=num_heads, key_dim=embed_dim // num_heads
         )(x, x)
         attention_output = Dropout(dropout_rate)(attention_output)
         
         # 第一个残差连接和标准化
         x1 = Add()([x, attention_output])
-        x1 = LayerNormalization(epsilon=1e-6)(x1)
+        x1 = LayerNormalization(epsilon=1e-6, dtype='float32')(x1)
         
         # 前馈神经网络
         ffn_output = Dense(mlp_units, activation='relu')(x1)
@@ -187,7 +255,7 @@ class DynamicFeatureDecouplingNetwork:
         
         # 第二个残差连接和标准化
         x2 = Add()([x1, ffn_output])
-        output = LayerNormalization(epsilon=1e-6)(x2)
+        output = LayerNormalization(epsilon=1e-6, dtype='float32')(x2)
         
         return output
     
@@ -217,13 +285,13 @@ class DynamicFeatureDecouplingNetwork:
         x = Dropout(self.dropout_rate)(x)
         x = Dense(256, activation='relu')(x)
         
-        # 不同类型的解码器有不同的目标
+        # 不同类型的解码器有不同的目标；输出特征保持float32，对比损失、正交损失和特征存储都在float32中进行
         if decoder_type == "pathology":
             # 病灶特征解码器
-            feature_output = Dense(128, name="pathology_features")(x)
+            feature_output = Dense(128, name="pathology_features", dtype='float32')(x)
         else:
             # 生理特征解码器
-            feature_output = Dense(128, name="physiology_features")(x)
+            feature_output = Dense(128, name="physiology_features", dtype='float32')(x)
         
         decoder_model = Model(inputs=inputs, outputs=feature_output, name=f"{decoder_type}_decoder")
         return decoder_model
@@ -238,7 +306,7 @@ class DynamicFeatureDecouplingNetwork:
         x = Dropout(self.dropout_rate)(x)
         
         # 多分类输出（正常、缺血性、出血性）
-        outputs = Dense(3, activation='softmax', name="stroke_classification")(x)
+        outputs = Dense(3, activation='softmax', name="stroke_classification", dtype='float32')(x)
         
         classifier_model = Model(inputs=inputs, outputs=outputs, name="classifier")
         return classifier_model
@@ -301,60 +369,81 @@ class DynamicFeatureDecouplingNetwork:
         features_1_norm = tf.math.l2_normalize(features_1, axis=1)
         features_2_norm = tf.math.l2_normalize(features_2, axis=1)
         
-        # 计算相似度矩阵
-        similarity_matrix = tf.matmul(features_1_norm, features_2_norm, transpose_b=True) / self.temperature
-        
         # 创建标签 - 对角线上的元素为正样本对
         batch_size = tf.shape(features_1)[0]
         labels = tf.eye(batch_size)  # 创建单位矩阵作为正样本对的标签
         
-        # 计算对比损失
-        loss = tf.reduce_mean(
-            tf.keras.losses.binary_crossentropy(
-                labels,
-                tf.nn.sigmoid(similarity_matrix),
-                from_logits=False
-            )
-        )
+        # 计算对比损失（所有样本对的均值）
+        loss = tf.reduce_mean(self._contrastive_terms(features_1_norm, features_2_norm, labels))
         
         return loss
+    
+    def _contrastive_terms(self, features_1_norm, features_2_norm, labels):
+        """逐样本对的对比损失项：相似度经sigmoid后与正样本对标签的二元交叉熵"""
+        features_1_norm = tf.cast(features_1_norm, tf.float32)
+        features_2_norm = tf.cast(features_2_norm, tf.float32)
+        similarity_matrix = tf.matmul(features_1_norm, features_2_norm, transpose_b=True) / self.temperature
+        return tf.keras.backend.binary_crossentropy(
+            tf.cast(labels, similarity_matrix.dtype),
+            tf.nn.sigmoid(similarity_matrix)
+        )
+    
+    def _micro_batch_contrastive_loss(self, pathology_norm, physiology_norm, pathology_queue, physiology_queue, start, end):
+        """
+        用特征队列计算一个微批次在整个逻辑批次上的对比损失
+        
+        完整的对比损失是B x B个样本对损失项的均值。微批次[start, end)负责两部分：
+        自己的行（本批次病理特征 x 全部生理特征）和其他行中自己的列（其他样本的病理特征 x 本批次生理特征）。
+        队列中的特征不参与求导，所以每个样本对的梯度恰好在它的行所在和列所在的微批次中各算一次，
+        K个微批次的梯度之和与一次性处理整个批次相同。
+        
+        参数:
+        pathology_norm, physiology_norm: 本微批次L2归一化后的特征
+        pathology_queue, physiology_queue: 整个逻辑批次的L2归一化特征（不求导）
+        start, end: 本微批次在逻辑批次中的位置
+        
+        返回:
+        loss: 本微批次的行之和除以B*B，K个微批次相加等于整个批次的对比损失，用于记录
+        gradient_loss: 用于求梯度的损失，额外包含其他行中本批次的列
+        """
+        batch_size = tf.shape(pathology_queue)[0]
+        num_pairs = tf.cast(batch_size * batch_size, tf.float32)
+        
+        # 本批次的行：把队列中本批次的位置替换为可求导的特征，正样本对在第start+i列
+        physiology_columns = tf.concat([
+            physiology_queue[:start], physiology_norm, physiology_queue[end:]
+        ], axis=0)
+        row_terms = self._contrastive_terms(
+            pathology_norm, physiology_columns, tf.one_hot(tf.range(start, end), batch_size)
+        )
+        
+        # 其他行中本批次的列：全部是负样本对
+        other_rows = tf.concat([pathology_queue[:start], pathology_queue[end:]], axis=0)
+        column_terms = self._contrastive_terms(
+            other_rows, physiology_norm, tf.zeros([batch_size - (end - start), end - start])
+        )
+        
+        loss = tf.reduce_sum(row_terms) / num_pairs
+        gradient_loss = loss + tf.reduce_sum(column_terms) / num_pairs
+        return loss, gradient_loss
         
     def orthogonality_loss(self, pathology_features, physiology_features):
         """正交损失 - 修改为计算每个样本内部特征的正交性"""
-        # 获取输入的数据类型
-        compute_dtype = tf.float32
-        
-        # 如果是混合精度环境，并且输入是float16
-        if pathology_features.dtype == tf.float16:
-            # 临时转换到float32进行精确计算
-            p_feat = tf.cast(pathology_features, compute_dtype)
-            ph_feat = tf.cast(physiology_features, compute_dtype)
-            
-            # L2归一化
-            p_feat_norm = tf.math.l2_normalize(p_feat, axis=1)
-            ph_feat_norm = tf.math.l2_normalize(ph_feat, axis=1)
-            
-            # 计算每个样本的点积
-            dot_products = tf.reduce_sum(p_feat_norm * ph_feat_norm, axis=1)
-            
-            # 计算正交损失（点积的平方的均值）
-            ortho_loss = tf.reduce_mean(tf.square(dot_products))
-            
-            # 转换回输入类型
-            return tf.cast(ortho_loss, pathology_features.dtype)
-        else:
-            # 正常处理流程
-            # L2归一化
-            p_feat_norm = tf.math.l2_normalize(pathology_features, axis=1)
-            ph_feat_norm = tf.math.l2_normalize(physiology_features, axis=1)
-            
-            # 计算每个样本的点积
-            dot_products = tf.reduce_sum(p_feat_norm * ph_feat_norm, axis=1)
-            
-            # 计算正交损失（点积的平方的均值）
-            ortho_loss = tf.reduce_mean(tf.square(dot_products))
-            
-            return ortho_loss
+        # 混合精度（float16/bfloat16）下转换到float32进行精确计算，损失保持float32
+        p_feat = tf.cast(pathology_features, tf.float32)
+        ph_feat = tf.cast(physiology_features, tf.float32)
+        
+        # L2归一化
+        p_feat_norm = tf.math.l2_normalize(p_feat, axis=1)
+        ph_feat_norm = tf.math.l2_normalize(ph_feat, axis=1)
+        
+        # 计算每个样本的点积
+        dot_products = tf.reduce_sum(p_feat_norm * ph_feat_norm, axis=1)
+        
+        # 计算正交损失（点积的平方的均值）
+        ortho_loss = tf.reduce_mean(tf.square(dot_products))
+        
+        return ortho_loss
     
     def get_balanced_sample_weights(self, labels):
         """计算平衡的样本权重用于不平衡数据集"""
@@ -371,26 +460,166 @@ class DynamicFeatureDecouplingNetwork:
         
         return sample_weights
     
+    def build_frozen_stage_model(self):
+        """
+        构建冻结阶段模型：输入图像，输出主干网络在BACKBONE_SPLIT_LAYER处的激活
+        
+        切分点之前的层全部被冻结（BatchNorm使用推理模式），输出与训练轮次无关，可以预先缓存。
+        """
+        if getattr(self, '_frozen_stage_model', None) is None:
+            split_output = self.backbone.get_layer(self.BACKBONE_SPLIT_LAYER).output
+            frozen_stage = Model(self.backbone.input, split_output, name="frozen_backbone_stage")
+            
+            inputs = Input(shape=self.input_shape)
+            if self.input_shape[-1] == 1:
+                x = layers.Lambda(
+                    lambda x: tf.repeat(x, 3, axis=-1),
+                    output_shape=(self.input_shape[0], self.input_shape[1], 3)
+                )(inputs)
+            else:
+                x = inputs
+            self._frozen_stage_model = Model(inputs, frozen_stage(x), name="frozen_stage")
+        return self._frozen_stage_model
+    
+    def build_split_models(self):
+        """
+        从现有的层切分出两个子模型（共享权重）
+        
+        返回:
+        backbone_tail: 主干网络从BACKBONE_SPLIT_LAYER到输出的部分
+        encoder_tail: 编码器中主干网络之后的部分（投影、位置编码和Transformer）
+        """
+        if getattr(self, '_split_models', None) is None:
+            split_output = self.backbone.get_layer(self.BACKBONE_SPLIT_LAYER).output
+            self._split_models = (
+                Model(split_output, self.backbone.output, name="backbone_tail"),
+                Model(self._backbone_output, self.encoder.output, name="encoder_tail")
+            )
+        return self._split_models
+    
+    def build_cached_model(self):
+        """
+        构建从缓存激活开始的训练模型
+        
+        由主干网络切分点之后的部分、Transformer编码器、两个解码器和分类器组成，
+        与dfdn_model共享同一套层和权重，训练后直接保存dfdn_model即可。
+        """
+        if getattr(self, '_cached_model', None) is None:
+            backbone_tail, encoder_tail = self.build_split_models()
+            
+            inputs = Input(shape=tuple(backbone_tail.input.shape[1:]))
+            encoded_features = encoder_tail(backbone_tail(inputs))
+            pathology_features = self.pathology_decoder(encoded_features)
+            physiology_features = self.physiology_decoder(encoded_features)
+            classification_outputs = self.classifier(pathology_features)
+            
+            self._cached_model = Model(
+                inputs=inputs,
+                outputs=[classification_outputs, pathology_features, physiology_features],
+                name="DFDN_Cached_Model"
+            )
+        return self._cached_model
+    
     @tf.function
-    def train_step(self, batch_data):
-        """优化的训练步骤"""
+    def train_step(self, batch_data, micro_batches=1):
+        """
+        优化的训练步骤
+        
+        micro_batches大于1时把批次拆成若干微批次依次计算并累加梯度（见_accumulate_gradients），
+        峰值内存随微批次大小下降，更新结果与整批训练等价
+        """
+        losses = self._train_step(self.dfdn_model, batch_data, micro_batches)
+        losses['accuracy'] = self.ct_accuracy.result()
+        return losses
+    
+    @tf.function
+    def cached_train_step(self, batch_data, micro_batches=1):
+        """缓存激活模式的训练步骤，只计算可训练部分的前向和反向传播"""
+        losses = self._train_step(self._cached_model, batch_data, micro_batches)
+        losses['accuracy'] = self.ct_accuracy.result()
+        return losses
+    
+    @tf.function
+    def distributed_train_step(self, batch_data, from_cache=False, micro_batches=1):
+        """
+        多副本训练步骤：每个副本处理自己的分片，梯度在优化器中跨副本求和
+        
+        各副本返回的损失已按副本数缩放，求和后即为全局批次上的平均损失
+        """
+        model = self._cached_model if from_cache else self.dfdn_model
+        per_replica_losses = self.strategy.run(
+            lambda batch: self._train_step(model, batch, micro_batches), args=(batch_data,)
+        )
+        losses = {
+            name: self.strategy.reduce(tf.distribute.ReduceOp.SUM, value, axis=None)
+            for name, value in per_replica_losses.items()
+        }
+        losses['accuracy'] = self.ct_accuracy.result()
+        return losses
+    
+    def _train_step(self, model, batch_data, micro_batches=1):
+        """训练步骤的实现，model为dfdn_model或build_cached_model()"""
+        if micro_batches > 1:
+            gradients, losses = self._accumulate_gradients(model, batch_data, micro_batches)
+        else:
+            gradients, losses = self._compute_gradients(model, batch_data)
+        
+        # 应用梯度
+        self.dfdn_model.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        
+        return losses
+    
+    def build_profiling_steps(self, from_cache=False, micro_batches=1):
+        """
+        返回分别编译的前向+反向传播函数和优化器更新函数，供性能分析模式分开计时
+        
+        返回:
+        forward_backward: batch_data -> (gradients, losses)
+        apply_gradients: gradients -> 优化器迭代次数
+        """
+        model = self.build_cached_model() if from_cache else self.dfdn_model
+        
+        @tf.function
+        def forward_backward(batch_data):
+            if micro_batches > 1:
+                return self._accumulate_gradients(model, batch_data, micro_batches)
+            return self._compute_gradients(model, batch_data)
+        
+        @tf.function
+        def apply_gradients(gradients):
+            self.dfdn_model.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            # 返回迭代计数，调用方读取它即可等待更新完成
+            return tf.identity(self.dfdn_model.optimizer.iterations)
+        
+        return forward_backward, apply_gradients
+    
+    def _compute_gradients(self, model, batch_data):
+        """
+        前向传播、计算损失和裁剪后的梯度，并更新训练准确率
+        
+        损失按全局批次缩放：分类损失用compute_average_loss除以全局批次大小，
+        对比损失和正交损失是副本内的批次均值，再除以副本数。单进程时副本数为1，与普通均值相同。
+        """
         # 解包批次数据
         images, labels = batch_data
+        num_replicas = tf.distribute.get_replica_context().num_replicas_in_sync
         
         # 使用单个梯度带进行所有计算
         with tf.GradientTape() as tape:
             # 前向传播
-            outputs = self.dfdn_model(images, training=True)
+            outputs = model(images, training=True)
             classification_output, pathology_features, physiology_features = outputs
             
-            # 计算分类损失
-            classification_loss = self.ct_classification_loss(labels, classification_output)
+            # 计算分类损失（逐样本损失，按全局批次求平均）
+            classification_loss = tf.nn.compute_average_loss(
+                self._cached_ce_loss(labels, classification_output)
+            )
             
             # 计算对比损失
-            contrastive_loss = self.contrastive_loss(pathology_features, physiology_features)
+            contrastive_loss = self.contrastive_loss(pathology_features, physiology_features) / num_replicas
             
             # 计算正交损失
-            ortho_loss = self.orthogonality_loss(pathology_features, physiology_features)
+            ortho_loss = self.orthogonality_loss(pathology_features, physiology_features) / num_replicas
             
             # 计算总损失，确保所有损失使用相同的数据类型
             total_loss = classification_loss
@@ -407,65 +636,195 @@ class DynamicFeatureDecouplingNetwork:
                 )
         
         # 计算梯度
-        gradients = tape.gradient(total_loss, self.dfdn_model.trainable_variables)
-        
-        # 应用梯度裁剪
-        gradients = [tf.clip_by_norm(g, 1.0) for g in gradients if g is not None]
+        gradients = tape.gradient(total_loss, model.trainable_variables)
         
-        # 应用梯度
-        self.dfdn_model.optimizer.apply_gradients(zip(gradients, self.dfdn_model.trainable_variables))
+        # 应用梯度裁剪（各副本的梯度求和后范数仍不超过1.0）
+        gradients = [tf.clip_by_norm(g, 1.0 / num_replicas) for g in gradients if g is not None]
         
         # 更新指标
         self.ct_accuracy.update_state(labels, classification_output)
         
-        # 返回损失和准确率
-        return {
+        # 返回梯度和损失，准确率由调用方在汇总后读取
+        return gradients, {
+            'total_loss': total_loss,
+            'classification_loss': classification_loss,
+            'contrastive_loss': contrastive_loss,
+            'ortho_loss': ortho_loss
+        }
+    
+    def _accumulate_gradients(self, model, batch_data, micro_batches):
+        """
+        梯度累加：把一个逻辑批次拆成micro_batches个微批次，依次前向、反向传播并累加梯度
+        
+        每次只保留一个微批次的激活，峰值内存约为整批训练的1/K。对比损失需要整个批次的
+        B x B相似度矩阵，先用一次不求导的推理模式前向传播（同样按微批次）把整个批次的
+        L2归一化特征写入队列，每个微批次再用队列计算自己在整个相似度矩阵中的部分
+        （见_micro_batch_contrastive_loss）。分类损失和正交损失是逐样本的，直接按逻辑批次大小缩放。
+        
+        与整批训练的差别：队列中的特征不含dropout；可训练的BatchNorm层按微批次统计均值和方差。
+        批次大小不能被K整除时，各微批次大小相差1。
+        
+        返回值与_compute_gradients相同，损失是整个逻辑批次上的值
+        """
+        images, labels = batch_data
+        num_replicas = tf.distribute.get_replica_context().num_replicas_in_sync
+        batch_size = tf.shape(images)[0]
+        bounds = tf.range(micro_batches + 1) * batch_size // micro_batches
+        batch_size_float = tf.cast(batch_size, tf.float32)
+        feature_dim = model.outputs[1].shape[-1]
+        
+        # 第一遍：推理模式计算整个批次的特征，填充对比损失的特征队列
+        def fill_queue(i, pathology_array, physiology_array):
+            start, end = bounds[i], bounds[i + 1]
+            _, pathology, physiology = model(images[start:end], training=False)
+            pathology_array = pathology_array.write(
+                i, tf.math.l2_normalize(tf.cast(pathology, tf.float32), axis=1)
+            )
+            physiology_array = physiology_array.write(
+                i, tf.math.l2_normalize(tf.cast(physiology, tf.float32), axis=1)
+            )
+            return i + 1, pathology_array, physiology_array
+        
+        def feature_array():
+            return tf.TensorArray(
+                tf.float32, size=micro_batches, infer_shape=False, element_shape=tf.TensorShape([None, feature_dim])
+            )
+        
+        _, pathology_array, physiology_array = tf.while_loop(
+            lambda i, *_: i < micro_batches,
+            fill_queue,
+            (tf.constant(0), feature_array(), feature_array()),
+            parallel_iterations=1
+        )
+        pathology_queue = tf.stop_gradient(pathology_array.concat())
+        physiology_queue = tf.stop_gradient(physiology_array.concat())
+        
+        # 第二遍：逐个微批次训练模式前向传播并累加梯度
+        def accumulate(i, gradient_sums, loss_sums):
+            start, end = bounds[i], bounds[i + 1]
+            micro_labels = labels[start:end]
+            micro_fraction = tf.cast(end - start, tf.float32) / batch_size_float
+            
+            with tf.GradientTape() as tape:
+                classification_output, pathology_features, physiology_features = model(
+                    images[start:end], training=True
+                )
+                
+                # 分类损失按逻辑批次（所有副本合计）求平均
+                classification_loss = tf.nn.compute_average_loss(
+                    self._cached_ce_loss(micro_labels, classification_output),
+                    global_batch_size=batch_size * num_replicas
+                )
+                
+                contrastive_loss, contrastive_gradient_loss = self._micro_batch_contrastive_loss(
+                    tf.math.l2_normalize(tf.cast(pathology_features, tf.float32), axis=1),
+                    tf.math.l2_normalize(tf.cast(physiology_features, tf.float32), axis=1),
+                    pathology_queue, physiology_queue, start, end
+                )
+                contrastive_loss = contrastive_loss / num_replicas
+                contrastive_gradient_loss = contrastive_gradient_loss / num_replicas
+                
+                # 正交损失是微批次内的均值，按微批次占逻辑批次的比例缩放
+                ortho_loss = tf.cast(
+                    self.orthogonality_loss(pathology_features, physiology_features), tf.float32
+                ) * micro_fraction / num_replicas
+                
+                total_loss = tf.cast(classification_loss, tf.float32)
+                if not tf.math.is_nan(contrastive_gradient_loss):
+                    total_loss = total_loss + self.contrastive_weight * tf.clip_by_value(
+                        contrastive_gradient_loss, -1e6, 1e6
+                    )
+                if not tf.math.is_nan(ortho_loss):
+                    total_loss = total_loss + self.ortho_weight * tf.clip_by_value(
+                        ortho_loss, -1e6, 1e6
+                    )
+            
+            gradients = tape.gradient(
+                total_loss, model.trainable_variables,
+                unconnected_gradients=tf.UnconnectedGradients.ZERO
+            )
+            self.ct_accuracy.update_state(micro_labels, classification_output)
+            
+            gradient_sums = [total + g for total, g in zip(gradient_sums, gradients)]
+            loss_sums = [
+                loss_sums[0] + tf.cast(classification_loss, tf.float32),
+                loss_sums[1] + contrastive_loss,
+                loss_sums[2] + ortho_loss
+            ]
+            return i + 1, gradient_sums, loss_sums
+        
+        _, gradients, loss_sums = tf.while_loop(
+            lambda i, *_: i < micro_batches,
+            accumulate,
+            (
+                tf.constant(0),
+                [tf.zeros_like(v) for v in model.trainable_variables],
+                [tf.constant(0.0)] * 3
+            ),
+            parallel_iterations=1  # 依次处理微批次，前一个微批次的激活释放后才开始下一个
+        )
+        classification_loss, contrastive_loss, ortho_loss = loss_sums
+        
+        # 累加后的梯度即整批梯度，裁剪方式与_compute_gradients相同
+        gradients = [tf.clip_by_norm(g, 1.0 / num_replicas) for g in gradients]
+        
+        total_loss = classification_loss
+        if not tf.math.is_nan(contrastive_loss):
+            total_loss = total_loss + self.contrastive_weight * tf.clip_by_value(contrastive_loss, -1e6, 1e6)
+        if not tf.math.is_nan(ortho_loss):
+            total_loss = total_loss + self.ortho_weight * tf.clip_by_value(ortho_loss, -1e6, 1e6)
+        
+        return gradients, {
             'total_loss': total_loss,
             'classification_loss': classification_loss,
             'contrastive_loss': contrastive_loss,
-            'ortho_loss': ortho_loss,
-            'accuracy': self.ct_accuracy.result()
+            'ortho_loss': ortho_loss
         }
     
     def compile_model(self):
         """编译模型，支持混合精度训练和XLA加速"""
-        # 创建优化器，使用更保守的学习率
-        optimizer = optimizers.Adam(
-            learning_rate=0.0001,  # 降低学习率
-            beta_1=0.9,
-            beta_2=0.999,
-            epsilon=1e-07
-        )
+        # 优化器需要和模型变量在同一个分布式策略作用域内创建
+        with self.strategy.scope():
+            # 创建优化器，使用更保守的学习率
+            optimizer = optimizers.Adam(
+                learning_rate=0.0001,  # 降低学习率
+                beta_1=0.9,
+                beta_2=0.999,
+                epsilon=1e-07
+            )
         
-        # 检查是否使用了混合精度
-        if tf.keras.mixed_precision.global_policy().name == 'mixed_float16':
-            print("使用混合精度训练 (mixed_float16)")
-            # 使用损失缩放以避免数值下溢
-            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+            # 检查是否使用了混合精度
+            if self.precision == 'mixed_float16':
+                print("使用混合精度训练 (mixed_float16)")
+                # 使用损失缩放以避免数值下溢
+                optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+            elif self.precision == 'mixed_bfloat16':
+                # bfloat16与float32的指数范围相同，不需要损失缩放
+                print("使用混合精度训练 (mixed_bfloat16)")
             
-        # 启用XLA JIT编译加速
-        tf.config.optimizer.set_jit(True)
-        print("已启用XLA JIT编译加速")
-        
-        # 主模型编译
-        self.dfdn_model.compile(
-            optimizer=optimizer,
-            loss={
-                "stroke_classification": "categorical_crossentropy",
-                "pathology_features": lambda y_true, y_pred: 0.0,  # 占位符
-                "physiology_features": lambda y_true, y_pred: 0.0   # 占位符
-            },
-            loss_weights={
-                "stroke_classification": 1.0,
-                "pathology_features": 0.0,
-                "physiology_features": 0.0
-            },
-            metrics={
-                "stroke_classification": ["accuracy"]
-            },
-            # 提升准确率计算性能
-            run_eagerly=False
-        )
+            # 启用XLA JIT编译加速
+            tf.config.optimizer.set_jit(True)
+            print("已启用XLA JIT编译加速")
+        
+            # 主模型编译
+            self.dfdn_model.compile(
+                optimizer=optimizer,
+                loss={
+                    "stroke_classification": "categorical_crossentropy",
+                    "pathology_features": lambda y_true, y_pred: 0.0,  # 占位符
+                    "physiology_features": lambda y_true, y_pred: 0.0   # 占位符
+                },
+                loss_weights={
+                    "stroke_classification": 1.0,
+                    "pathology_features": 0.0,
+                    "physiology_features": 0.0
+                },
+                metrics={
+                    "stroke_classification": ["accuracy"]
+                },
+                # 提升准确率计算性能
+                run_eagerly=False
+            )
         
         # 预先缓存性能关键函数
         self._cached_ce_loss = tf.keras.losses.CategoricalCrossentropy(
@@ -480,7 +839,13 @@ class DynamicFeatureDecouplingNetwork:
              epochs=50,
              batch_size=128,  # 增大批处理大小以提高GPU利用率
              early_stopping_patience=10,
-             model_save_path=None):
+             validation_freq=1,
+             model_save_path=None,
+             profiler=None,
+             micro_batches=1,
+             checkpointer=None,
+             seed=None,
+             augmentation=None):
         """
         训练模型
         
@@ -490,7 +855,14 @@ class DynamicFeatureDecouplingNetwork:
         epochs: 训练轮数
         batch_size: 批次大小
         early_stopping_patience: 早停耐心值
+        validation_freq: 每隔几个epoch验证一次
         model_save_path: 模型保存路径
+        profiler: 可选的TrainingProfiler，开启性能分析模式（见models/dfdn_profiler.py）
+        micro_batches: 每个批次拆成的微批次数（梯度累加），内存不足时增大
+        checkpointer: 可选的TrainingCheckpointer，周期性保存检查点并支持断点恢复（见models/dfdn_checkpoint.py）
+        seed: 训练集打乱的随机种子，断点恢复后要与不中断时的数据顺序完全一致需要固定种子
+        augmentation: 训练集的批次增强（见models/dfdn_augment.py）：True使用本模态的默认参数，
+            dict覆盖默认参数中的对应项，None不增强
         """
         # 编译模型
         self.compile_model()
@@ -502,7 +874,9 @@ class DynamicFeatureDecouplingNetwork:
             
         # 创建优化的数据集
         print(f"创建优化的数据管道，批处理大小: {batch_size}")
-        train_dataset = self.create_optimized_dataset(x_train, y_train, batch_size, is_training=True)
+        train_dataset = self.create_optimized_dataset(
+            x_train, y_train, batch_size, is_training=True, seed=seed, augmentation=augmentation
+        )
         if validation_data:
             val_dataset = self.create_optimized_dataset(x_val, y_val, batch_size, is_training=False)
             
@@ -525,91 +899,12 @@ class DynamicFeatureDecouplingNetwork:
             steps_per_epoch=steps_per_epoch,
             validation_steps=validation_steps,
             early_stopping_patience=early_stopping_patience,
-            model_save_path=model_save_path
+            validation_freq=validation_freq,
+            model_save_path=model_save_path,
+            profiler=profiler,
+            micro_batches=micro_batches,
+            checkpointer=checkpointer
         )
-        
-        # 训练历史记录
-        history = {
-            "total_loss": [],
-            "classification_loss": [],
-            "contrastive_loss": [],
-            "pathology_contrastive_loss": [],
-            "physiology_contrastive_loss": [],
-            "orthogonality_loss": [],
-            "val_accuracy": [] if validation_data else None
-        }
-        
-        # 早停设置
-        best_val_accuracy = 0
-        patience_counter = 0
-        
-        # 训练循环
-        for epoch in range(epochs):
-            print(f"Epoch {epoch+1}/{epochs}")
-            
-            # 打乱训练数据
-            indices = np.random.permutation(len(x_train))
-            x_train_shuffled = x_train[indices]
-            y_train_shuffled = y_train[indices]
-            sample_weights_shuffled = sample_weights.numpy()[indices] if sample_weights is not None else None
-            
-            # 批次训练
-            epoch_losses = {k: [] for k in history.keys() if k != "val_accuracy"}
-            n_batches = int(np.ceil(len(x_train) / batch_size))
-            
-            for batch in range(n_batches):
-                start_idx = batch * batch_size
-                end_idx = min((batch + 1) * batch_size, len(x_train))
-                
-                x_batch = x_train_shuffled[start_idx:end_idx]
-                y_batch = y_train_shuffled[start_idx:end_idx]
-                sw_batch = sample_weights_shuffled[start_idx:end_idx] if sample_weights_shuffled is not None else None
-                
-                # 执行一步训练
-                batch_losses = self.custom_train_step(x_batch, y_batch, sw_batch)
-                
-                # 记录损失
-                for k, v in batch_losses.items():
-                    if k in epoch_losses:
-                        epoch_losses[k].append(v.numpy())
-                
-                # 打印进度
-                if (batch + 1) % 10 == 0:
-                    print(f"  Batch {batch+1}/{n_batches}, Loss: {batch_losses['total_loss']:.4f}")
-            
-            # 计算并存储本轮的平均损失
-            for k, v in epoch_losses.items():
-                avg_loss = np.mean(v)
-                history[k].append(avg_loss)
-                print(f"  {k}: {avg_loss:.4f}")
-            
-            # 验证评估
-            if validation_data:
-                # 预测验证集
-                val_preds = self.dfdn_model.predict(x_val)[0]
-                val_accuracy = np.mean(np.argmax(val_preds, axis=1) == np.argmax(y_val, axis=1))
-                history["val_accuracy"].append(val_accuracy)
-                print(f"  val_accuracy: {val_accuracy:.4f}")
-                
-                # 早停检查
-                if val_accuracy > best_val_accuracy:
-                    best_val_accuracy = val_accuracy
-                    patience_counter = 0
-                    # 保存最佳模型
-                    if model_save_path:
-                        self.dfdn_model.save_weights(model_save_path)
-                        print(f"  Model saved to {model_save_path}")
-                else:
-                    patience_counter += 1
-                    if patience_counter >= early_stopping_patience:
-                        print(f"Early stopping triggered after {epoch+1} epochs")
-                        break
-        
-        # 如果使用了早停且保存了模型，加载最佳模型
-        if validation_data and model_save_path and os.path.exists(model_save_path):
-            self.dfdn_model.load_weights(model_save_path)
-        
-        return history
     
     def train_with_datasets(self, 
                            train_dataset, 
@@ -618,13 +913,70 @@ class DynamicFeatureDecouplingNetwork:
                            steps_per_epoch=None,
                            validation_steps=None,
                            early_stopping_patience=10,
-                           model_save_path=None):
+                           model_save_path=None,
+                           from_cache=False,
+                           validation_freq=1,
+                           profiler=None,
+                           micro_batches=1,
+                           checkpointer=None):
         """
         使用TensorFlow数据集API训练模型，支持混合精度训练
+        
+        validation_freq控制每隔几个epoch验证一次（最后一个epoch总会验证），
+        validation_steps只取验证集的前若干个批次作为子样本；早停耐心值按验证次数计算
+        
+        from_cache为True时数据集产出的是冻结阶段的缓存激活（见models/dfdn_cache.py），
+        只训练build_cached_model()中的可训练部分
+        
+        分布式训练时（见models/dfdn_distributed.py）train_dataset应为已分片的分布式数据集，
+        每个worker都在完整的验证集上评估，只有chief保存模型
+        
+        profiler为models/dfdn_profiler.TrainingProfiler时开启性能分析模式：逐步记录数据等待、
+        前向+反向、优化器更新的耗时，按需采集trace，训练结束后把汇总写入profiler.log_dir
+        
+        micro_batches大于1时每个批次拆成若干微批次累加梯度，用于内存不足以容纳整个批次的机器，
+        对比损失仍在整个批次上计算
+        
+        checkpointer为models/dfdn_checkpoint.TrainingCheckpointer时周期性地（异步）保存模型、优化器、
+        数据迭代器位置和训练状态，目录中已有检查点时从最近的检查点继续训练
         """
+        if profiler is not None and self.distributed:
+            raise ValueError("性能分析模式只支持单进程训练")
+        
         # 编译模型
         self.compile_model()
         
+        # 选择训练步骤
+        if from_cache:
+            self.build_cached_model()
+            step_fn = lambda batch: self.cached_train_step(batch, micro_batches)
+        else:
+            step_fn = lambda batch: self.train_step(batch, micro_batches)
+        
+        # 有检查点时所有epoch共用一个重复的迭代器，恢复后迭代器（包括打乱顺序）能精确地接着之前的位置；
+        # 每轮步数未知时退回每个epoch新建迭代器
+        if checkpointer is not None and isinstance(train_dataset, tf.data.Dataset):
+            cardinality = int(train_dataset.cardinality())
+            if cardinality >= 0:
+                steps_per_epoch = min(steps_per_epoch or cardinality, cardinality)
+            if steps_per_epoch is not None:
+                train_dataset = train_dataset.repeat()
+        # 分布式数据集由make_distributed_dataset无限重复
+        continuous_iterator = checkpointer is not None and steps_per_epoch is not None
+        
+        if self.distributed:
+            if isinstance(train_dataset, tf.data.Dataset):
+                train_dataset = self.strategy.experimental_distribute_dataset(train_dataset)
+            step_fn = lambda batch: self.distributed_train_step(
+                batch, from_cache=from_cache, micro_batches=micro_batches
+            )
+            if not self.is_chief():
+                model_save_path = None
+        
+        if profiler is not None:
+            forward_backward, apply_gradients = self.build_profiling_steps(from_cache, micro_batches)
+            step_fn = lambda batch: profiler.run_step(forward_backward, apply_gradients, batch)
+        
         # 配置GPU内存增长以最大化性能
         try:
             gpus = tf.config.experimental.list_physical_devices('GPU')
@@ -642,28 +994,65 @@ class DynamicFeatureDecouplingNetwork:
             "total_loss": [],
             "classification_loss": [],
             "contrastive_loss": [],
-            "val_accuracy": [] if validation_dataset else None
+            "val_accuracy": [] if validation_dataset else None,
+            "val_recall": [] if validation_dataset else None,
+            "val_confusion_matrix": None
         }
         
         # 早停设置
         best_val_accuracy = 0
         patience_counter = 0
         
+        # 从检查点恢复训练状态
+        shared_iterator = iter(train_dataset) if continuous_iterator else None
+        start_epoch, resume_step, resume_iterator, resume_epoch_losses = 0, 0, None, None
+        if checkpointer is not None:
+            checkpointer.attach(self)
+            restore_iterator = shared_iterator if continuous_iterator else iter(train_dataset)
+            state = checkpointer.restore(restore_iterator, steps_per_epoch if continuous_iterator else None)
+            if state is not None:
+                history = state["history"]
+                best_val_accuracy = state["best_val_accuracy"]
+                patience_counter = state["patience_counter"]
+                start_epoch = epochs if state["stopped"] else state["epoch"]
+                resume_step, resume_iterator = state["step"], restore_iterator
+                resume_epoch_losses = state["epoch_losses"]
+        
+        def training_state(epoch_losses, stopped=False):
+            return {
+                "history": history,
+                "epoch_losses": epoch_losses,
+                "best_val_accuracy": best_val_accuracy,
+                "patience_counter": patience_counter,
+                "stopped": stopped
+            }
+        
         # 训练循环
-        for epoch in range(epochs):
+        for epoch in range(start_epoch, epochs):
             print(f"Epoch {epoch+1}/{epochs}")
             
-            # 重置度量
-            epoch_losses = {k: [] for k in history.keys() if k != "val_accuracy"}
+            # 重置度量；从epoch中间恢复时接着使用中断位置的迭代器和已记录的损失
+            if resume_step > 0:
+                iterator, first_step, epoch_losses = resume_iterator, resume_step, resume_epoch_losses
+                resume_step = 0
+            else:
+                iterator = shared_iterator if continuous_iterator else iter(train_dataset)
+                first_step = 0
+                epoch_losses = {k: [] for k in history.keys() if k != "val_accuracy"}
+            if checkpointer is not None:
+                checkpointer.track_iterator(iterator)
             
-            # 创建进度条
-            progress_bar = tqdm(total=steps_per_epoch, desc=f"Training")
+            # 创建进度条（未指定步数时按数据集实际长度迭代）
+            progress_bar = tqdm(total=steps_per_epoch, initial=first_step, desc=f"Training")
             
-            # 训练一个epoch
-            for step, batch_data in enumerate(train_dataset):
-                if step >= steps_per_epoch:
-                    break
-                
+            # 训练一个epoch（性能分析模式下同时记录取数据的等待时间）；
+            # 先判断步数再取批次，不会多取走下一轮的数据
+            batches = iterator
+            if steps_per_epoch is not None:
+                batches = itertools.islice(iterator, steps_per_epoch - first_step)
+            if profiler is not None:
+                batches = profiler.iterate(batches)
+            for step, batch_data in enumerate(batches, start=first_step):
                 # 解包批次数据
                 if len(batch_data) == 3:  # 包含样本权重
                     x_batch, y_batch, sample_weights = batch_data
@@ -672,7 +1061,7 @@ class DynamicFeatureDecouplingNetwork:
                     sample_weights = None
                 
                 # 执行一步训练
-                batch_losses = self.train_step((x_batch, y_batch))
+                batch_losses = step_fn((x_batch, y_batch))
                 
                 # 记录损失 - 只记录实际使用的指标
                 for k in epoch_losses.keys():
@@ -682,6 +1071,10 @@ class DynamicFeatureDecouplingNetwork:
                 # 更新进度条
                 progress_bar.update(1)
                 progress_bar.set_postfix({"loss": float(batch_losses['total_loss'])})
+                
+                # 周期性保存检查点
+                if checkpointer is not None:
+                    checkpointer.step_end(epoch, step + 1, lambda: training_state(epoch_losses))
             
             progress_bar.close()
             
@@ -693,50 +1086,19 @@ class DynamicFeatureDecouplingNetwork:
                     print(f"  {k}: {avg_loss:.4f}")
             
             # 验证评估
-            if validation_dataset:
-                # 重置验证指标
-                val_correct = 0
-                val_total = 0
-                
-                # 创建验证进度条
-                val_progress = tqdm(total=validation_steps, desc="Validation")
-                
-                # 验证
-                for step, batch_data in enumerate(validation_dataset):
-                    if step >= validation_steps:
-                        break
-                    
-                    # 解包批次数据
-                    if len(batch_data) == 3:  # 包含样本权重
-                        x_val_batch, y_val_batch, _ = batch_data
-                    else:  # 不包含样本权重
-                        x_val_batch, y_val_batch = batch_data
-                    
-                    # 预测验证batch
-                    val_preds = self.dfdn_model(x_val_batch, training=False)[0]
-                    
-                    # 计算准确率
-                    val_correct_batch = tf.reduce_sum(
-                        tf.cast(
-                            tf.equal(
-                                tf.argmax(val_preds, axis=1),
-                                tf.argmax(y_val_batch, axis=1)
-                            ),
-                            tf.float32
-                        )
-                    )
-                    val_correct += val_correct_batch
-                    val_total += tf.shape(x_val_batch)[0]
-                    
-                    # 更新进度条
-                    val_progress.update(1)
-                
-                val_progress.close()
-                
-                # 计算验证准确率
-                val_accuracy = val_correct / tf.cast(val_total, tf.float32)
-                history["val_accuracy"].append(val_accuracy.numpy())
-                print(f"  val_accuracy: {val_accuracy:.4f}")
+            stop_training = False
+            is_last_epoch = epoch == epochs - 1
+            if validation_dataset and ((epoch + 1) % validation_freq == 0 or is_last_epoch):
+                val_metrics = self.evaluate(validation_dataset, steps=validation_steps, from_cache=from_cache)
+                val_accuracy = val_metrics["accuracy"]
+                history["val_accuracy"].append(val_accuracy)
+                history["val_recall"].append(val_metrics["recall"])
+                history["val_confusion_matrix"] = val_metrics["confusion_matrix"]
+                recall_text = ", ".join(
+                    f"{name} {recall:.4f}" for name, recall in zip(self.CLASS_NAMES, val_metrics["recall"])
+                )
+                print(f"  val_accuracy: {val_accuracy:.4f} ({val_metrics['samples']} 个样本)")
+                print(f"  val_recall: {recall_text}")
                 
                 # 早停检查
                 if val_accuracy > best_val_accuracy:
@@ -750,78 +1112,118 @@ class DynamicFeatureDecouplingNetwork:
                     patience_counter += 1
                     if patience_counter >= early_stopping_patience:
                         print(f"Early stopping triggered after {epoch+1} epochs")
-                        break
+                        stop_training = True
+            
+            # 每个epoch结束时保存检查点，恢复后从下一个epoch开始
+            if checkpointer is not None:
+                checkpointer.save(epoch + 1, 0, training_state({}, stopped=stop_training))
+            if stop_training:
+                break
+        
+        if checkpointer is not None:
+            history["checkpoint"] = checkpointer.close()
         
         # 如果使用了早停且保存了模型，加载最佳模型
         if validation_dataset and model_save_path and os.path.exists(model_save_path):
             self.dfdn_model.load_weights(model_save_path)
         
+        if profiler is not None:
+            history["profile"] = profiler.write_summary(self, from_cache)
+        
         return history
     
-    def visualize_features(self, x_batch, y_batch, save_path=None):
-        """可视化病灶特征和生理特征"""
-        # 获取特征
-        _, pathology_features, physiology_features = self.dfdn_model.predict(x_batch)
+    @tf.function
+    def _accumulate_confusion_matrix(self, dataset, from_cache=False):
+        """在图中遍历验证集，把每个批次的混淆矩阵累加到设备上的变量中"""
+        model = self._cached_model if from_cache else self.dfdn_model
+        for batch_data in dataset:
+            images, labels = batch_data[0], batch_data[1]
+            predictions = model(images, training=False)[0]
+            self.val_confusion_matrix.assign_add(tf.math.confusion_matrix(
+                tf.argmax(labels, axis=1),
+                tf.argmax(predictions, axis=1),
+                num_classes=self.NUM_CLASSES,
+                dtype=tf.int64
+            ))
+    
+    def evaluate(self, dataset, steps=None, from_cache=False):
+        """
+        在验证集上评估模型
         
-        # 使用t-SNE降维
-        from sklearn.manifold import TSNE
-        tsne = TSNE(n_components=2, random_state=42)
+        整个验证循环在一个tf.function中执行，逐批次只在设备上累加混淆矩阵，
+        结束后才读取一次结果
         
-        # 拼接特征以便进行t-SNE
-        combined_features = np.concatenate([
-            pathology_features, 
-            physiology_features
-        ], axis=0)
+        参数:
+        dataset: 产出 (images, labels) 或 (images, labels, sample_weights) 的验证集，labels为one-hot
+        steps: 只评估前steps个批次（子样本），None时评估全部
+        from_cache: 数据集是否为冻结阶段的缓存激活
         
-        # 特征类型标签
-        feature_types = np.array(['Pathology'] * len(pathology_features) + 
-                               ['Physiology'] * len(physiology_features))
-        
-        # 类别标签（重复两次，因为有两种特征）
-        class_labels = np.argmax(y_batch, axis=1)
-        class_names = ['Normal', 'Ischemic', 'Hemorrhagic']
-        class_labels_str = np.array([class_names[i] for i in class_labels])
-        class_labels_str = np.concatenate([class_labels_str, class_labels_str])
-        
-        # 应用t-SNE
-        embedded_features = tsne.fit_transform(combined_features)
-        
-        # 可视化
-        plt.figure(figsize=(12, 10))
-        
-        # 为不同类型和类别创建不同的标记和颜色
-        markers = {'Pathology': 'o', 'Physiology': 'x'}
-        colors = {'Normal': 'green', 'Ischemic': 'blue', 'Hemorrhagic': 'red'}
-        
-        for feature_type in np.unique(feature_types):
-            for class_name in np.unique(class_labels_str):
-                # 选择当前组合的数据点
-                mask = (feature_types == feature_type) & (class_labels_str == class_name)
-                plt.scatter(
-                    embedded_features[mask, 0], 
-                    embedded_features[mask, 1],
-                    marker=markers[feature_type],
-                    c=colors[class_name],
-                    alpha=0.7,
-                    label=f"{feature_type}-{class_name}"
-                )
+        返回:
+        包含accuracy、各类别recall、confusion_matrix和samples的字典
+        """
+        if steps is not None:
+            dataset = dataset.take(steps)
+        if from_cache:
+            self.build_cached_model()
+        
+        self.val_confusion_matrix.assign(tf.zeros_like(self.val_confusion_matrix))
+        self._accumulate_confusion_matrix(dataset, from_cache=from_cache)
+        confusion = self.val_confusion_matrix.numpy()
+        
+        total = int(confusion.sum())
+        class_totals = confusion.sum(axis=1)
+        recall = np.divide(
+            np.diag(confusion), class_totals,
+            out=np.zeros(self.NUM_CLASSES), where=class_totals > 0
+        )
+        return {
+            "accuracy": float(np.trace(confusion) / total) if total else 0.0,
+            "recall": recall.tolist(),
+            "confusion_matrix": confusion.tolist(),
+            "samples": total
+        }
+    
+    def is_chief(self):
+        """当前进程是否为负责保存模型的chief（单进程训练时总是True）"""
+        resolver = getattr(self.strategy, 'cluster_resolver', None)
+        if resolver is None or not resolver.task_type:
+            return True
+        if resolver.task_type == 'chief':
+            return True
+        # 集群中没有单独的chief时，由0号worker承担
+        return (resolver.task_type == 'worker' and resolver.task_id == 0
+                and 'chief' not in resolver.cluster_spec().as_dict())
+    
+    def visualize_features(self, x_batch, y_batch=None, save_path=None, method='pca', batch_size=256, tsne_samples=5000):
+        """
+        可视化病灶特征和生理特征
         
-        plt.legend()
-        plt.title(f'{self.modality} Dynamic Feature Decoupling Visualization')
-        plt.tight_layout()
+        按批次提取特征并用增量PCA投影，内存占用与样本数无关；method='tsne'时只对分层抽样的
+        tsne_samples个点做t-SNE。图像直接渲染到文件（见models/dfdn_visualize.py）。
         
-        if save_path:
-            plt.savefig(save_path)
-            print(f"Visualization saved to {save_path}")
+        参数:
+        x_batch: 图像数组，或产出 (images, labels, ...) 的批次数据集（此时y_batch为None）
+        y_batch: one-hot标签数组
+        save_path: 输出图像路径，默认 dfdn_<模态>_features.png
+        method: 'pca' 或 'tsne'
         
-        plt.show()
+        返回:
+        dict: 样本数、绘制的点数、PCA解释方差比例和输出路径
+        """
+        from models.dfdn_visualize import visualize_feature_space
+        
+        data = x_batch if y_batch is None else (x_batch, y_batch)
+        save_path = save_path or f"dfdn_{self.modality.lower()}_features.png"
+        return visualize_feature_space(
+            self, data, save_path, method=method, batch_size=batch_size, tsne_samples=tsne_samples
+        )
     
     def predict(self, x):
         """模型预测"""
         classification_output, _, _ = self.dfdn_model.predict(x)
         return classification_output
     
-    def create_optimized_dataset(self, x_data, y_data, batch_size, is_training=True):
+    def create_optimized_dataset(self, x_data, y_data, batch_size, is_training=True, seed=None, augmentation=None):
         """创建高效的TensorFlow数据管道以提高GPU利用率
         
         参数:
@@ -829,6 +1231,8 @@ class DynamicFeatureDecouplingNetwork:
         y_data: 标签数据
         batch_size: 批处理大小
         is_training: 是否用于训练
+        seed: 打乱和增强的随机种子
+        augmentation: 训练集的批次增强，见train
         
         返回:
         优化的tf.data.Dataset对象
@@ -836,27 +1240,174 @@ class DynamicFeatureDecouplingNetwork:
         # 计算平衡样本权重（如果是训练集）
         if is_training:
             sample_weights = self.get_balanced_sample_weights(y_data)
-            # 创建包含样本权重的数据集
-            dataset = tf.data.Dataset.from_tensor_slices((x_data, y_data, sample_weights))
-            dataset = dataset.shuffle(buffer_size=len(x_data), reshuffle_each_iteration=True)
+            # 打乱的是样本下标，按批次取出图像：打乱缓冲区（以及检查点保存的迭代器状态）只有下标，
+            # 不会把整个训练集复制进缓冲区
+            x_all, y_all, w_all = (tf.convert_to_tensor(v) for v in (x_data, y_data, sample_weights))
+            dataset = tf.data.Dataset.range(len(x_data))
+            dataset = dataset.shuffle(buffer_size=len(x_data), seed=seed, reshuffle_each_iteration=True)
+            dataset = dataset.batch(batch_size, drop_remainder=True)
+            dataset = dataset.map(
+                lambda i: (tf.gather(x_all, i), tf.gather(y_all, i), tf.gather(w_all, i)),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE
+            )
         else:
             dataset = tf.data.Dataset.from_tensor_slices((x_data, y_data))
+            dataset = dataset.batch(batch_size)
         
-        # 配置数据集性能优化
-        dataset = dataset.batch(batch_size, drop_remainder=is_training)
-        
-        # 使用并行处理器数量进行并行处理
-        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        # 在批次上并行增强，内存中只保留原始数组
+        if is_training and augmentation:
+            from models.dfdn_augment import augment_dataset, get_augmentation_params
+            dataset = augment_dataset(dataset, get_augmentation_params(self.modality, augmentation), seed=seed)
         
         # 启用缓存来减少CPU-GPU数据传输瓶颈
         if not is_training:  # 验证集可以完全缓存
             dataset = dataset.cache()
         
-        # 如果GPU内存充足，可以考虑设置更大的预取值
+        # 预取放在管道末尾，只需要一次
         dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
         
         return dataset
     
+    def train_from_files(self,
+                         train_source,
+                         validation_source=None,
+                         epochs=50,
+                         batch_size=128,
+                         shuffle_buffer=2048,
+                         validation_cache_path=None,
+                         early_stopping_patience=10,
+                         validation_freq=1,
+                         model_save_path=None,
+                         profiler=None,
+                         micro_batches=1,
+                         checkpointer=None,
+                         seed=None,
+                         augmentation=None):
+        """
+        从磁盘流式读取数据训练模型，训练集大小不受内存限制
+        
+        参数:
+        train_source: TFRecord分片目录或按类别分子目录的图像目录（见models/dfdn_data.py）
+        validation_source: 验证集目录或None
+        epochs: 训练轮数
+        batch_size: 批次大小
+        shuffle_buffer: 训练集打乱缓冲区大小
+        validation_cache_path: 验证集本地缓存文件路径，None时缓存在内存中
+        early_stopping_patience: 早停耐心值
+        validation_freq: 每隔几个epoch验证一次
+        model_save_path: 模型保存路径
+        profiler: 可选的TrainingProfiler，开启性能分析模式（见models/dfdn_profiler.py）
+        micro_batches: 每个批次拆成的微批次数（梯度累加），内存不足时增大
+        checkpointer: 可选的TrainingCheckpointer，周期性保存检查点并支持断点恢复（见models/dfdn_checkpoint.py）
+        seed: 训练集打乱的随机种子，断点恢复后要与不中断时的数据顺序完全一致需要固定种子
+        augmentation: 训练集的批次增强（见models/dfdn_augment.py）：True使用本模态的默认参数，
+            dict覆盖默认参数中的对应项，None不增强
+        """
+        from models.dfdn_augment import get_augmentation_params
+        from models.dfdn_data import load_dataset_info, make_dataset
+        
+        image_size = (self.input_shape[1], self.input_shape[0])
+        print(f"创建流式数据管道，批处理大小: {batch_size}")
+        train_dataset = make_dataset(
+            train_source, batch_size, image_size,
+            is_training=True, shuffle_buffer=shuffle_buffer, seed=seed,
+            augmentation=get_augmentation_params(self.modality, augmentation)
+        )
+        val_dataset = None
+        if validation_source:
+            val_dataset = make_dataset(
+                validation_source, batch_size, image_size,
+                is_training=False, cache_path=validation_cache_path
+            )
+        
+        # 每轮完整遍历数据集，不需要预先知道样本数；
+        # 有检查点时按数据集信息确定每轮步数，所有epoch共用一个可以保存位置的迭代器
+        steps_per_epoch = None
+        if checkpointer is not None:
+            steps_per_epoch = load_dataset_info(train_source)["total"] // batch_size
+        
+        return self.train_with_datasets(
+            train_dataset,
+            val_dataset,
+            epochs=epochs,
+            steps_per_epoch=steps_per_epoch,
+            early_stopping_patience=early_stopping_patience,
+            validation_freq=validation_freq,
+            model_save_path=model_save_path,
+            profiler=profiler,
+            micro_batches=micro_batches,
+            checkpointer=checkpointer
+        )
+    
+    def cache_frozen_activations(self, source, cache_dir, batch_size=64, dtype='float16'):
+        """
+        预先计算冻结阶段的激活并写入磁盘缓存（见models/dfdn_cache.py）
+        
+        参数:
+        source: TFRecord分片目录或按类别分子目录的图像目录
+        cache_dir: 缓存目录
+        batch_size: 计算激活的批次大小
+        dtype: 激活的存储精度，'float16' 或 'float32'
+        """
+        from models.dfdn_cache import cache_source
+        
+        print(f"计算冻结阶段激活缓存: {source} -> {cache_dir}")
+        return cache_source(self, source, cache_dir, batch_size, dtype)
+    
+    def train_from_cache(self,
+                         train_cache_dir,
+                         validation_cache_dir=None,
+                         epochs=50,
+                         batch_size=128,
+                         early_stopping_patience=10,
+                         validation_freq=1,
+                         model_save_path=None,
+                         profiler=None,
+                         micro_batches=1,
+                         checkpointer=None,
+                         seed=None):
+        """
+        从冻结阶段激活缓存训练模型，只计算主干尾部、编码器、解码器和分类器
+        
+        参数:
+        train_cache_dir: cache_frozen_activations生成的训练集缓存目录
+        validation_cache_dir: 验证集缓存目录或None
+        epochs: 训练轮数
+        batch_size: 批次大小
+        early_stopping_patience: 早停耐心值
+        validation_freq: 每隔几个epoch验证一次
+        model_save_path: 模型保存路径（保存的是完整dfdn_model的权重）
+        profiler: 可选的TrainingProfiler，开启性能分析模式（见models/dfdn_profiler.py）
+        micro_batches: 每个批次拆成的微批次数（梯度累加），内存不足时增大
+        checkpointer: 可选的TrainingCheckpointer，周期性保存检查点并支持断点恢复（见models/dfdn_checkpoint.py）
+        seed: 训练集打乱的随机种子，断点恢复后要与不中断时的数据顺序完全一致需要固定种子
+        
+        缓存数据集用tf.numpy_function读取激活，迭代器无法保存，checkpointer不保存迭代器位置，
+        恢复时按保存的epoch和步数跳过已训练的批次
+        """
+        from models.dfdn_cache import make_cached_dataset
+        
+        if checkpointer is not None:
+            checkpointer.save_iterator = False
+        
+        train_dataset = make_cached_dataset(self, train_cache_dir, batch_size, is_training=True, seed=seed)
+        val_dataset = None
+        if validation_cache_dir:
+            val_dataset = make_cached_dataset(self, validation_cache_dir, batch_size, is_training=False)
+        
+        return self.train_with_datasets(
+            train_dataset,
+            val_dataset,
+            epochs=epochs,
+            early_stopping_patience=early_stopping_patience,
+            validation_freq=validation_freq,
+            model_save_path=model_save_path,
+            from_cache=True,
+            profiler=profiler,
+            micro_batches=micro_batches,
+            checkpointer=checkpointer
+        )
+    
     def extract_features(self, x):
         """提取特征用于下游任务"""
         _, pathology_features, physiology_features = self.dfdn_model.predict(x)
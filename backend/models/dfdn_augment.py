@@ -0,0 +1,161 @@
+"""
+DFDN训练数据增强 - 在tf.data管道中按批次向量化地随机变换图像
+
+增强放在batch之后，用并行map对整个批次一次性处理，而不是逐张图像调用小算子:
+    - 左右翻转（脑部左右半球对称，不做上下翻转）
+    - 小角度旋转和随机裁剪合成一个投影变换，每张图像只重采样一次，输出保持原尺寸
+    - 亮度、对比度和gamma抖动，可选高斯噪声，结果截断到[0, 1]
+
+随机数由tf.data.Dataset.random按批次产生并使用无状态随机算子，固定seed时增强结果可以复现，
+数据迭代器也可以保存到检查点（见models/dfdn_checkpoint.py）。
+
+用法:
+    params = get_augmentation_params('CT', {'max_rotation': 5})
+    dataset = augment_dataset(dataset, params, seed=7)  # dataset已经batch，元素为(images, labels, ...)
+"""
+import math
+
+import tensorflow as tf
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# 各模态的默认增强参数。CT的灰度值对应固定的窗宽窗位，强度抖动较小；
+# MRI的信号强度在不同设备和序列之间差异大，强度抖动和噪声更强
+AUGMENTATION_PRESETS = {
+    'CT': {
+        'flip_probability': 0.5,
+        'max_rotation': 10.0,          # 最大旋转角度（度）
+        'crop_scale': (0.85, 1.0),     # 裁剪区域边长占原图的比例范围
+        'brightness': 0.05,            # 亮度偏移的最大绝对值
+        'contrast': (0.9, 1.1),        # 对比度缩放范围
+        'gamma': (1.0, 1.0),           # gamma范围，(1, 1)表示不做gamma变换
+        'noise_std': 0.0               # 高斯噪声标准差
+    },
+    'MRI': {
+        'flip_probability': 0.5,
+        'max_rotation': 10.0,
+        'crop_scale': (0.85, 1.0),
+        'brightness': 0.1,
+        'contrast': (0.8, 1.2),
+        'gamma': (0.8, 1.25),
+        'noise_std': 0.01
+    }
+}
+
+
+def get_augmentation_params(modality, augmentation=True):
+    """
+    确定增强参数
+
+    Args:
+        modality (str): 'CT' 或 'MRI'
+        augmentation: None/False表示不增强；True使用模态的默认参数；dict覆盖默认参数中的对应项
+
+    Returns:
+        dict: 增强参数，不增强时返回None
+    """
+    if not augmentation:
+        return None
+    if modality not in AUGMENTATION_PRESETS:
+        raise ValueError(f"没有 {modality} 模态的默认增强参数")
+    params = dict(AUGMENTATION_PRESETS[modality])
+    if isinstance(augmentation, dict):
+        unknown = set(augmentation) - set(params)
+        if unknown:
+            raise ValueError(f"未知的增强参数: {', '.join(sorted(unknown))}")
+        params.update(augmentation)
+    return params
+
+
+def _uniform(shape, seed, bounds):
+    low, high = bounds
+    return tf.random.stateless_uniform(shape, seed, minval=low, maxval=high)
+
+
+def augment_images(images, seed, params):
+    """
+    对一个批次的图像做随机增强
+
+    Args:
+        images: [B, H, W, C] float32，取值范围[0, 1]
+        seed: 形状为[2]的整数张量，无状态随机算子的种子
+        params (dict): get_augmentation_params返回的增强参数
+
+    Returns:
+        增强后的图像，形状和取值范围不变
+    """
+    batch_size = tf.shape(images)[0]
+    height, width = tf.shape(images)[1], tf.shape(images)[2]
+    flip_seed, angle_seed, scale_seed, offset_seed, intensity_seed = tf.unstack(
+        tf.random.experimental.stateless_split(seed, num=5)
+    )
+
+    # 左右翻转
+    flip = tf.random.stateless_uniform([batch_size], flip_seed) < params['flip_probability']
+    images = tf.where(flip[:, None, None, None], tf.reverse(images, axis=[2]), images)
+
+    # 旋转 + 裁剪：输出像素(x, y)从输入的 s * R(angle) * (p - center) + center + offset 处采样，
+    # s < 1时相当于裁剪出边长为s倍的区域再缩放回原尺寸，偏移量保证裁剪区域不超出图像
+    max_angle = params['max_rotation'] * math.pi / 180.0
+    angle = _uniform([batch_size], angle_seed, (-max_angle, max_angle))
+    scale = _uniform([batch_size], scale_seed, params['crop_scale'])
+    center_x = (tf.cast(width, tf.float32) - 1.0) / 2.0
+    center_y = (tf.cast(height, tf.float32) - 1.0) / 2.0
+    offset = _uniform([2, batch_size], offset_seed, (-1.0, 1.0)) * (1.0 - scale)
+    offset_x, offset_y = offset[0] * center_x, offset[1] * center_y
+
+    cos, sin = scale * tf.cos(angle), scale * tf.sin(angle)
+    zeros = tf.zeros_like(angle)
+    transforms = tf.stack([
+        cos, -sin, center_x + offset_x - (cos * center_x - sin * center_y),
+        sin, cos, center_y + offset_y - (sin * center_x + cos * center_y),
+        zeros, zeros
+    ], axis=1)
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=tf.stack([height, width]),
+        fill_value=0.0,
+        interpolation='BILINEAR',
+        fill_mode='CONSTANT'
+    )
+
+    # 强度抖动：对比度围绕每张图像的均值缩放，再加亮度偏移和gamma
+    contrast_seed, brightness_seed, gamma_seed, noise_seed = tf.unstack(
+        tf.random.experimental.stateless_split(intensity_seed, num=4)
+    )
+    contrast = _uniform([batch_size, 1, 1, 1], contrast_seed, params['contrast'])
+    brightness = _uniform([batch_size, 1, 1, 1], brightness_seed, (-params['brightness'], params['brightness']))
+    mean = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+    images = tf.clip_by_value((images - mean) * contrast + mean + brightness, 0.0, 1.0)
+
+    if tuple(params['gamma']) != (1.0, 1.0):
+        images = tf.pow(images, _uniform([batch_size, 1, 1, 1], gamma_seed, params['gamma']))
+    if params['noise_std'] > 0:
+        noise = tf.random.stateless_normal(tf.shape(images), noise_seed, stddev=params['noise_std'])
+        images = tf.clip_by_value(images + noise, 0.0, 1.0)
+    return images
+
+
+def augment_dataset(dataset, params, seed=None):
+    """
+    在已经batch的训练集上增加并行的增强阶段
+
+    Args:
+        dataset: 元素为 (images, labels, ...) 的批次数据集
+        params (dict): get_augmentation_params返回的增强参数，None时原样返回
+        seed (int): 随机种子，None时每次运行的增强不同
+
+    Returns:
+        tf.data.Dataset: 图像经过增强、其余元素不变的数据集
+    """
+    if params is None:
+        return dataset
+
+    # 每个批次配一对随机种子，增强本身使用无状态随机算子
+    seeds = tf.data.Dataset.random(seed=seed).batch(2)
+
+    def augment(batch, batch_seed):
+        return (augment_images(batch[0], batch_seed, params),) + tuple(batch[1:])
+
+    return tf.data.Dataset.zip((dataset, seeds)).map(augment, num_parallel_calls=AUTOTUNE)
@@ -0,0 +1,181 @@
+"""
+DFDN冻结阶段激活缓存 - 微调时不再逐轮重复计算被冻结的ResNet层
+
+ResNet50V2的前100层在训练中不更新，每个epoch对同一张图像算出的激活都相同。这里把
+图像经过冻结阶段（主干网络切分到BACKBONE_SPLIT_LAYER）的激活一次性写入磁盘上的
+内存映射.npy文件（可选float16），之后的训练从缓存读取激活，只对主干尾部、
+Transformer编码器、解码器和分类器做前向和反向传播。
+
+缓存目录结构:
+    cache_dir/activations.npy  [N, H, W, C] 冻结阶段激活
+    cache_dir/labels.npy       [N] 类别索引
+    cache_dir/cache_info.json  输入尺寸、切分层、存储精度和冻结层权重指纹
+
+注意缓存的是确定性的激活，缓存模式下不能再对输入图像做逐轮的随机增强。
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from models.dfdn_data import NUM_CLASSES, balanced_class_weights, load_dataset_info, make_dataset
+
+CACHE_INFO_FILE = 'cache_info.json'
+ACTIVATIONS_FILE = 'activations.npy'
+LABELS_FILE = 'labels.npy'
+SUPPORTED_DTYPES = {'float16', 'float32'}
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def frozen_stage_fingerprint(model):
+    """计算冻结阶段权重的指纹，权重变化后旧缓存不再有效"""
+    digest = hashlib.sha1()
+    for weight in model.build_frozen_stage_model().weights:
+        digest.update(np.ascontiguousarray(weight.numpy()).tobytes())
+    return digest.hexdigest()
+
+
+def build_activation_cache(model, dataset, cache_dir, num_samples, dtype='float16'):
+    """
+    将数据集经过冻结阶段的激活写入缓存目录
+
+    Args:
+        model (DynamicFeatureDecouplingNetwork): DFDN模型
+        dataset (tf.data.Dataset): 产出 (images, labels) 或 (images, labels, sample_weights) 的批次，
+            labels可以是类别索引或one-hot，顺序不要求打乱
+        cache_dir (str): 缓存目录
+        num_samples (int): 数据集样本总数
+        dtype (str): 激活的存储精度，'float16' 或 'float32'
+
+    Returns:
+        dict: 缓存信息
+    """
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"不支持的存储精度: {dtype}")
+
+    frozen_stage = model.build_frozen_stage_model()
+    compute_activations = tf.function(lambda images: frozen_stage(images, training=False))
+    activation_shape = tuple(frozen_stage.output.shape[1:])
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # 先写入临时文件，全部写完后再改名，避免中断的缓存被当作有效缓存读取
+    activations_path = os.path.join(cache_dir, ACTIVATIONS_FILE)
+    partial_path = activations_path + '.partial'
+    activations = np.lib.format.open_memmap(
+        partial_path, mode='w+', dtype=dtype, shape=(num_samples,) + activation_shape
+    )
+    labels = np.empty(num_samples, dtype=np.int64)
+
+    offset = 0
+    for batch in dataset:
+        images, batch_labels = batch[0], batch[1].numpy()
+        if batch_labels.ndim > 1:
+            batch_labels = np.argmax(batch_labels, axis=1)
+        end = offset + len(batch_labels)
+        if end > num_samples:
+            raise ValueError(f"数据集样本数超过了声明的{num_samples}")
+
+        activations[offset:end] = compute_activations(images).numpy().astype(dtype)
+        labels[offset:end] = batch_labels
+        offset = end
+        print(f"  已缓存 {offset}/{num_samples}")
+
+    if offset != num_samples:
+        raise ValueError(f"数据集只有{offset}个样本，少于声明的{num_samples}")
+
+    activations.flush()
+    del activations
+    os.replace(partial_path, activations_path)
+    np.save(os.path.join(cache_dir, LABELS_FILE), labels)
+
+    info = {
+        "numSamples": num_samples,
+        "inputShape": list(model.input_shape),
+        "splitLayer": model.BACKBONE_SPLIT_LAYER,
+        "activationShape": list(activation_shape),
+        "dtype": dtype,
+        "classCounts": np.bincount(labels, minlength=NUM_CLASSES).tolist(),
+        "fingerprint": frozen_stage_fingerprint(model)
+    }
+    with open(os.path.join(cache_dir, CACHE_INFO_FILE), 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    return info
+
+
+def cache_source(model, source, cache_dir, batch_size=64, dtype='float16'):
+    """
+    为磁盘上的数据集（TFRecord分片或图像目录，见dfdn_data.make_dataset）生成激活缓存
+
+    Returns:
+        dict: 缓存信息
+    """
+    image_size = (model.input_shape[1], model.input_shape[0])
+    dataset = make_dataset(source, batch_size, image_size, is_training=False)
+    num_samples = load_dataset_info(source)["total"]
+    return build_activation_cache(model, dataset, cache_dir, num_samples, dtype)
+
+
+def load_activation_cache(model, cache_dir):
+    """
+    以只读内存映射的方式打开激活缓存，并检查缓存是否与当前模型匹配
+
+    Returns:
+        tuple: (激活memmap, 类别索引, 缓存信息)
+    """
+    with open(os.path.join(cache_dir, CACHE_INFO_FILE), 'r', encoding='utf-8') as f:
+        info = json.load(f)
+
+    if info["inputShape"] != list(model.input_shape) or info["splitLayer"] != model.BACKBONE_SPLIT_LAYER:
+        raise ValueError(
+            f"激活缓存的输入尺寸或切分层与当前模型不一致: "
+            f"{info['inputShape']}/{info['splitLayer']} != {list(model.input_shape)}/{model.BACKBONE_SPLIT_LAYER}"
+        )
+    if info["fingerprint"] != frozen_stage_fingerprint(model):
+        raise ValueError("激活缓存与当前模型的冻结层权重不一致，请重新生成缓存")
+
+    activations = np.load(os.path.join(cache_dir, ACTIVATIONS_FILE), mmap_mode='r')
+    labels = np.load(os.path.join(cache_dir, LABELS_FILE))
+    return activations, labels, info
+
+
+def make_cached_dataset(model, cache_dir, batch_size, is_training=True, seed=None):
+    """
+    从激活缓存创建数据集
+
+    只打乱样本索引，每个批次按排好序的索引从内存映射中读取，尽量保持顺序读盘。
+
+    Returns:
+        tf.data.Dataset: 训练集产出 (activations, labels, sample_weights)，验证集产出 (activations, labels)
+    """
+    activations, labels, info = load_activation_cache(model, cache_dir)
+    activation_shape = tuple(info["activationShape"])
+    stored_dtype = tf.as_dtype(info["dtype"])
+
+    def gather(indices):
+        indices = np.sort(indices)
+        return np.asarray(activations[indices]), labels[indices]
+
+    def load(indices):
+        batch, batch_labels = tf.numpy_function(gather, [indices], [stored_dtype, tf.int64])
+        batch = tf.cast(tf.ensure_shape(batch, (None,) + activation_shape), tf.float32)
+        return batch, tf.ensure_shape(batch_labels, (None,))
+
+    dataset = tf.data.Dataset.range(len(labels))
+    if is_training:
+        dataset = dataset.shuffle(len(labels), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, drop_remainder=is_training)
+    dataset = dataset.map(load, num_parallel_calls=AUTOTUNE, deterministic=not is_training)
+
+    if is_training:
+        class_weights = tf.constant(balanced_class_weights(info["classCounts"]))
+        dataset = dataset.map(
+            lambda x, y: (x, tf.one_hot(y, NUM_CLASSES), tf.gather(class_weights, y)),
+            num_parallel_calls=AUTOTUNE
+        )
+    else:
+        dataset = dataset.map(lambda x, y: (x, tf.one_hot(y, NUM_CLASSES)), num_parallel_calls=AUTOTUNE)
+
+    return dataset.prefetch(AUTOTUNE)
@@ -0,0 +1,188 @@
+"""
+DFDN训练检查点 - 长时间训练中断后从最近的检查点精确恢复
+
+检查点用tf.train.Checkpoint保存，内容包括:
+    - 模型权重和优化器状态（Adam的一阶/二阶矩和迭代次数）
+    - 训练准确率指标的状态
+    - 当前epoch训练数据迭代器的位置（包括打乱缓冲区）
+    - epoch、步数、训练历史、早停计数等训练状态（JSON字符串变量）
+
+默认异步写入：save()把变量复制到内存中就返回，权重和优化器状态的写盘在后台线程进行。
+数据迭代器单独同步保存到iterator子目录（异步检查点复制迭代器时会打乱之后各epoch的重新打乱顺序），
+与主检查点使用相同的编号，这部分写盘在训练线程上进行，耗时与迭代器状态的大小成正比——
+打乱缓冲区中的元素都会被序列化。内存数据集（train）打乱的是样本下标，状态只有下标；
+train_from_files的缓冲区是序列化记录或文件名，shuffle_buffer越大每次保存越慢，
+此时可以设置save_iterator=False。每次保存在训练线程上的耗时记录在blocked_seconds中。
+CheckpointManager只保留最近max_to_keep个检查点。
+
+训练循环在有检查点时让所有epoch共用一个重复的迭代器，恢复后从保存的位置继续取批次；
+要让恢复后各epoch的打乱顺序与不中断时完全一致，训练时需要固定seed。
+激活缓存数据集（train_from_cache）的迭代器无法保存，train_from_cache会把save_iterator设为False。
+
+用法:
+    checkpointer = TrainingCheckpointer('checkpoints/ct_run1', save_every_steps=500)
+    model.train_with_datasets(train_dataset, val_dataset, epochs=50, checkpointer=checkpointer)
+    # 中断后用同样的参数再次运行，会从最近的检查点继续训练
+"""
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def _to_json(value):
+    """numpy标量和数组转换为JSON可序列化的值"""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return float(value)
+
+
+class TrainingCheckpointer:
+    """管理DFDN训练循环的周期性检查点和断点恢复"""
+
+    def __init__(self, directory, save_every_steps=None, max_to_keep=3, async_save=True, save_iterator=True):
+        """
+        初始化检查点管理
+
+        Args:
+            directory (str): 检查点目录
+            save_every_steps (int): 每隔多少个训练步保存一次，None时只在每个epoch结束时保存
+            max_to_keep (int): 保留的检查点个数
+            async_save (bool): 是否在后台线程写盘
+            save_iterator (bool): 是否保存数据迭代器的位置。包含tf.numpy_function的数据管道
+                （例如激活缓存数据集）的迭代器无法保存，此时设为False，恢复时跳过本epoch已训练的批次，
+                只有数据顺序确定时才能精确恢复
+        """
+        self.directory = directory
+        self.save_every_steps = save_every_steps
+        self.max_to_keep = max_to_keep
+        self.save_iterator = save_iterator
+        self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=async_save)
+
+        self.saves = 0
+        self.blocked_seconds = []
+        self._optimizer = None
+        self._checkpoint = None
+        self._manager = None
+        self._iterator = None
+        self._iterator_manager = None
+        self._state = None
+        # 优化器的迭代次数在Python中计数，每步读取optimizer.iterations会强制等待设备
+        self._global_step = 0
+
+    def attach(self, model):
+        """绑定模型的权重、优化器和指标（compile_model之后调用）"""
+        self._state = tf.Variable('', dtype=tf.string, trainable=False)
+        self._optimizer = model.dfdn_model.optimizer
+        self._checkpoint = tf.train.Checkpoint(
+            model=model.dfdn_model,
+            optimizer=self._optimizer,
+            # 只保存指标的变量，兼容不同Keras版本的指标对象
+            accuracy=list(model.ct_accuracy.variables),
+            state=self._state
+        )
+
+        # 分布式训练时每个worker都要参与保存；各worker的迭代器位置不同，非chief写入各自的子目录
+        if model.distributed and not model.is_chief():
+            task_id = model.strategy.cluster_resolver.task_id or 0
+            self.directory = os.path.join(self.directory, f"worker{task_id}")
+        os.makedirs(self.directory, exist_ok=True)
+        self._manager = tf.train.CheckpointManager(self._checkpoint, self.directory, max_to_keep=self.max_to_keep)
+        self._global_step = int(self._optimizer.iterations)
+
+    def track_iterator(self, iterator):
+        """设置要保存位置的数据迭代器（每个epoch开始时调用）"""
+        if not self.save_iterator or iterator is self._iterator:
+            return
+        self._iterator = iterator
+        # 主检查点异步写入时最近一个可能还没有完成，多保留一个迭代器检查点与之对应
+        self._iterator_manager = tf.train.CheckpointManager(
+            tf.train.Checkpoint(iterator=iterator),
+            os.path.join(self.directory, 'iterator'),
+            max_to_keep=self.max_to_keep + 1
+        )
+
+    def restore(self, iterator, steps_per_epoch=None):
+        """
+        从最近的检查点恢复
+
+        Args:
+            iterator: 训练数据迭代器，恢复到检查点保存时的位置
+            steps_per_epoch (int): 迭代器跨epoch连续使用时的每轮步数；每个epoch新建迭代器时为None
+
+        Returns:
+            dict: 训练状态（epoch、step、history等），没有检查点时返回None
+        """
+        latest = tf.train.latest_checkpoint(self.directory)
+        if latest is None:
+            return None
+
+        self._checkpoint.restore(latest).expect_partial()
+        state = json.loads(self._state.numpy().decode('utf-8'))
+        self._global_step = int(self._optimizer.iterations)
+
+        iterator_path = os.path.join(self.directory, 'iterator', os.path.basename(latest))
+        if self.save_iterator and tf.io.gfile.exists(iterator_path + '.index'):
+            tf.train.Checkpoint(iterator=iterator).read(iterator_path).expect_partial()
+        else:
+            # 迭代器位置没有保存，跳过已经训练过的批次
+            skip = state["step"] + (state["epoch"] * steps_per_epoch if steps_per_epoch else 0)
+            for _ in range(skip):
+                next(iterator)
+        print(f"从检查点 {latest} 恢复: epoch {state['epoch'] + 1}，第 {state['step']} 步")
+        return state
+
+    def save(self, epoch, step, state):
+        """
+        保存检查点
+
+        Args:
+            epoch (int): 当前epoch（从0开始）
+            step (int): 本epoch已经完成的步数，0表示epoch尚未开始
+            state (dict): 其余训练状态，必须可以序列化为JSON
+        """
+        start = time.perf_counter()
+        self._state.assign(json.dumps(dict(state, epoch=epoch, step=step), default=_to_json))
+        checkpoint_number = self._global_step
+        if self._iterator_manager is not None:
+            self._iterator_manager.save(checkpoint_number=checkpoint_number)
+        try:
+            self._manager.save(checkpoint_number=checkpoint_number, options=self.options)
+        except (ValueError, TypeError, NotImplementedError) as e:
+            if not self.options.experimental_enable_async_checkpoint:
+                raise
+            # 部分TensorFlow/Keras版本的异步检查点不支持某些对象，退回同步写盘
+            print(f"异步检查点失败，改为同步写入: {e}")
+            self.options = tf.train.CheckpointOptions()
+            self._manager.save(checkpoint_number=checkpoint_number, options=self.options)
+        self.blocked_seconds.append(time.perf_counter() - start)
+        self.saves += 1
+
+    def step_end(self, epoch, step, state_fn):
+        """每个训练步之后调用，到达保存间隔时保存；state_fn返回当前训练状态"""
+        self._global_step += 1
+        if self.save_every_steps and self._global_step % self.save_every_steps == 0:
+            self.save(epoch, step, state_fn())
+
+    def _wait_for_pending(self):
+        # 等待后台写盘完成，等待时间计入阻塞时间
+        if self._checkpoint is not None and self.options.experimental_enable_async_checkpoint:
+            start = time.perf_counter()
+            self._checkpoint.sync()
+            self.blocked_seconds.append(time.perf_counter() - start)
+
+    def close(self):
+        """等待最后的写盘完成，返回检查点耗时统计"""
+        self._wait_for_pending()
+        blocked = np.asarray(self.blocked_seconds)
+        stats = {
+            "directory": self.directory,
+            "latest": tf.train.latest_checkpoint(self.directory),
+            "saves": self.saves,
+            "blockedSeconds": round(float(blocked.sum()), 3),
+            "maxBlockedMs": round(float(blocked.max()) * 1000, 2) if len(blocked) else None
+        }
+        print(f"检查点: 阻塞训练循环共 {stats['blockedSeconds']} 秒，最近的检查点 {stats['latest']}")
+        return stats
@@ -0,0 +1,251 @@
+"""
+DFDN训练数据管道 - 从磁盘流式读取带标签的图像或TFRecord分片
+
+create_optimized_dataset把整个训练集以NumPy数组的形式放进from_tensor_slices，数据集大小
+受内存限制。这里的管道只在内存中保留文件名或序列化的记录：并行交错读取多个分片，
+在有界缓冲区内打乱，再并行解码、缩放和归一化（与brain_image_analyzer.preprocess_image
+的处理一致），验证集缓存到本地文件。
+
+数据目录按类别分子目录存放图像，子目录名可以是中文类别名或英文别名：
+    data_dir/正常/*.png  (或 normal/)
+    data_dir/缺血性卒中/*.png  (或 ischemic/)
+    data_dir/出血性卒中/*.png  (或 hemorrhagic/)
+
+转换为TFRecord分片:
+    python -m models.dfdn_data --data-dir /path/to/ct_train --output-dir /path/to/ct_train_shards
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+CLASS_ALIASES = {
+    '正常': 0, 'normal': 0,
+    '缺血性卒中': 1, 'ischemic': 1,
+    '出血性卒中': 2, 'hemorrhagic': 2
+}
+NUM_CLASSES = 3
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+# 分片目录中记录各类别样本数的文件，用于计算平衡样本权重
+DATASET_INFO_FILE = 'dataset_info.json'
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+_FEATURE_SPEC = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.int64)
+}
+
+
+def iter_labeled_images(data_dir):
+    """遍历数据目录，返回 (图像路径, 类别索引)"""
+    for class_dir in sorted(os.listdir(data_dir)):
+        label = CLASS_ALIASES.get(class_dir.lower(), CLASS_ALIASES.get(class_dir))
+        class_path = os.path.join(data_dir, class_dir)
+        if label is None or not os.path.isdir(class_path):
+            continue
+        for filename in sorted(os.listdir(class_path)):
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(class_path, filename), label
+
+
+def _serialize_example(image_bytes, label):
+    """将编码后的图像字节和类别打包为tf.train.Example"""
+    example = tf.train.Example(features=tf.train.Features(feature={
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_bytes])),
+        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label]))
+    }))
+    return example.SerializeToString()
+
+
+def convert_to_shards(data_dir, output_dir, shard_size=1000, seed=42):
+    """
+    将按类别分目录的图像转换为TFRecord分片
+
+    图像以原始编码字节（PNG/JPEG）写入，不在转换时解码，分片体积与原图相当。
+    写入前先打乱文件顺序，使每个分片都包含各类别的样本。
+
+    Args:
+        data_dir (str): 带标签的图像目录
+        output_dir (str): 分片输出目录
+        shard_size (int): 每个分片的样本数
+        seed (int): 打乱文件顺序的随机种子
+
+    Returns:
+        dict: 数据集信息（样本总数、各类别样本数、分片数）
+    """
+    samples = list(iter_labeled_images(data_dir))
+    if not samples:
+        raise ValueError(f"在 {data_dir} 中没有找到带标签的图像")
+    random.Random(seed).shuffle(samples)
+
+    os.makedirs(output_dir, exist_ok=True)
+    num_shards = (len(samples) + shard_size - 1) // shard_size
+    class_counts = [0] * NUM_CLASSES
+
+    for shard in range(num_shards):
+        shard_path = os.path.join(output_dir, f'data-{shard:05d}-of-{num_shards:05d}.tfrecord')
+        with tf.io.TFRecordWriter(shard_path) as writer:
+            for image_path, label in samples[shard * shard_size:(shard + 1) * shard_size]:
+                with open(image_path, 'rb') as f:
+                    writer.write(_serialize_example(f.read(), label))
+                class_counts[label] += 1
+        print(f"  已写入分片 {shard + 1}/{num_shards}")
+
+    info = {"total": len(samples), "classCounts": class_counts, "numShards": num_shards}
+    with open(os.path.join(output_dir, DATASET_INFO_FILE), 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    return info
+
+
+def decode_and_preprocess(image_bytes, image_size=(256, 256)):
+    """
+    解码并预处理单张图像，与preprocess_image一致：转灰度、双线性缩放、min-max归一化
+
+    Args:
+        image_bytes: PNG/JPEG编码的图像字节
+        image_size (tuple): (宽, 高)，与cv2.resize的参数顺序一致
+
+    Returns:
+        tf.Tensor: [高, 宽, 1] 的float32图像
+    """
+    image = tf.io.decode_image(image_bytes, channels=1, expand_animations=False)
+    image = tf.image.resize(image, (image_size[1], image_size[0]), method='bilinear')
+
+    min_value = tf.reduce_min(image)
+    value_range = tf.reduce_max(image) - min_value
+    # 单一灰度图像归一化为全0，避免除零
+    return tf.where(value_range > 0, (image - min_value) / tf.maximum(value_range, 1e-12), tf.zeros_like(image))
+
+
+def load_dataset_info(source):
+    """读取分片目录的数据集信息，图像目录则直接统计各类别样本数"""
+    info_path = os.path.join(source, DATASET_INFO_FILE)
+    if os.path.exists(info_path):
+        with open(info_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    class_counts = [0] * NUM_CLASSES
+    for _, label in iter_labeled_images(source):
+        class_counts[label] += 1
+    return {"total": sum(class_counts), "classCounts": class_counts}
+
+
+def balanced_class_weights(class_counts):
+    """与get_balanced_sample_weights相同的类别权重：total / (类别数 * 类别样本数)"""
+    counts = np.asarray(class_counts, dtype=np.float32)
+    present = counts > 0
+    weights = np.zeros_like(counts)
+    weights[present] = counts.sum() / (present.sum() * counts[present])
+    return weights
+
+
+def make_dataset(source, batch_size, image_size=(256, 256), is_training=True,
+                 shuffle_buffer=2048, cache_path=None, seed=None, num_shards=1, shard_index=0,
+                 augmentation=None):
+    """
+    创建从磁盘流式读取的数据集
+
+    Args:
+        source (str): TFRecord分片目录，或按类别分子目录的图像目录
+        batch_size (int): 批次大小
+        image_size (tuple): 模型输入尺寸 (宽, 高)
+        is_training (bool): 训练集会打乱并附带平衡样本权重，验证集保持顺序
+        shuffle_buffer (int): 打乱缓冲区大小（序列化记录或文件名，不是解码后的图像）
+        cache_path (str): 验证集的本地缓存文件路径，第一轮读完后后续轮次直接读缓存
+        seed (int): 随机种子
+        num_shards (int): 分布式训练时的输入管道数，每个管道只读取自己的分片
+        shard_index (int): 当前输入管道的编号
+        augmentation (dict): 训练集的批次增强参数（models.dfdn_augment.get_augmentation_params），None不增强
+
+    Returns:
+        tf.data.Dataset: 训练集产出 (images, labels, sample_weights)，验证集产出 (images, labels)
+    """
+    shard_files = sorted(glob.glob(os.path.join(source, '*.tfrecord')))
+
+    if shard_files:
+        # 分片级别打乱后并行交错读取，乱序输出以免慢分片阻塞管道
+        dataset = tf.data.Dataset.from_tensor_slices(shard_files)
+        # 分片文件足够时按文件分配给各输入管道，否则在记录级别分配
+        shard_by_file = num_shards > 1 and len(shard_files) >= num_shards
+        if shard_by_file:
+            dataset = dataset.shard(num_shards, shard_index)
+        if is_training:
+            dataset = dataset.shuffle(len(shard_files), seed=seed, reshuffle_each_iteration=True)
+        # 记录级别分配要求各管道看到相同的记录顺序，此时交错读取必须保持确定性
+        dataset = dataset.interleave(
+            tf.data.TFRecordDataset,
+            cycle_length=min(len(shard_files), 16),
+            num_parallel_calls=AUTOTUNE,
+            deterministic=not is_training or (num_shards > 1 and not shard_by_file)
+        )
+        if num_shards > 1 and not shard_by_file:
+            dataset = dataset.shard(num_shards, shard_index)
+        if is_training:
+            dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+
+        def load(record):
+            parsed = tf.io.parse_single_example(record, _FEATURE_SPEC)
+            return decode_and_preprocess(parsed['image'], image_size), parsed['label']
+    else:
+        samples = list(iter_labeled_images(source))
+        if not samples:
+            raise ValueError(f"在 {source} 中没有找到TFRecord分片或带标签的图像")
+        paths, labels = zip(*samples)
+        dataset = tf.data.Dataset.from_tensor_slices((list(paths), list(labels)))
+        if num_shards > 1:
+            dataset = dataset.shard(num_shards, shard_index)
+        if is_training:
+            dataset = dataset.shuffle(min(len(samples), shuffle_buffer), seed=seed, reshuffle_each_iteration=True)
+
+        def load(path, label):
+            return decode_and_preprocess(tf.io.read_file(path), image_size), tf.cast(label, tf.int64)
+
+    dataset = dataset.map(load, num_parallel_calls=AUTOTUNE, deterministic=not is_training)
+
+    if is_training:
+        class_weights = tf.constant(balanced_class_weights(load_dataset_info(source)["classCounts"]))
+
+        def add_weights(image, label):
+            return image, tf.one_hot(label, NUM_CLASSES), tf.gather(class_weights, label)
+
+        dataset = dataset.map(add_weights, num_parallel_calls=AUTOTUNE)
+    else:
+        dataset = dataset.map(lambda image, label: (image, tf.one_hot(label, NUM_CLASSES)),
+                              num_parallel_calls=AUTOTUNE)
+        # 验证集每轮内容相同，缓存解码后的结果；不指定文件时缓存在内存中
+        dataset = dataset.cache(cache_path or '')
+
+    dataset = dataset.batch(batch_size, drop_remainder=is_training)
+    if is_training and augmentation:
+        from models.dfdn_augment import augment_dataset
+        dataset = augment_dataset(dataset, augmentation, seed=seed)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将带标签的图像目录转换为TFRecord分片")
+    parser.add_argument("--data-dir", required=True, help="带标签的图像目录（按类别分子目录）")
+    parser.add_argument("--output-dir", required=True, help="分片输出目录")
+    parser.add_argument("--shard-size", type=int, default=1000, help="每个分片的样本数，默认1000")
+    parser.add_argument("--seed", type=int, default=42, help="打乱文件顺序的随机种子")
+    args = parser.parse_args()
+
+    try:
+        info = convert_to_shards(args.data_dir, args.output_dir, args.shard_size, args.seed)
+    except ValueError as e:
+        print(e)
+        return 1
+
+    print(f"共写入 {info['total']} 个样本，{info['numShards']} 个分片，各类别样本数: {info['classCounts']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""
+DFDN多进程数据并行训练 - 基于MultiWorkerMirroredStrategy
+
+在多路CPU服务器上启动多个本地worker进程，或在多台CPU节点上按TF_CONFIG组成集群，
+每个worker持有一份模型副本，只读取自己的数据分片，梯度通过集合通信求和后同步更新。
+损失按全局批次缩放（见DynamicFeatureDecouplingNetwork._train_step）。
+
+本机启动4个worker进程（全局批次64，每个worker 16）:
+    python -m models.dfdn_distributed --train-source /data/ct_train_shards --workers 4 --batch-size 64
+
+多台主机：每台主机设置各自的TF_CONFIG后运行同样的命令（不带--workers）:
+    TF_CONFIG='{"cluster": {"worker": ["node1:12345", "node2:12345"]}, "task": {"type": "worker", "index": 0}}' \\
+    python -m models.dfdn_distributed --train-source /data/ct_train_shards --batch-size 64
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+
+import tensorflow as tf
+
+from models.dfdn import DynamicFeatureDecouplingNetwork
+from models.dfdn_augment import get_augmentation_params
+from models.dfdn_data import load_dataset_info, make_dataset
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    """设置当前进程的TensorFlow线程数，必须在TensorFlow运行时初始化之前调用"""
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def create_strategy():
+    """根据TF_CONFIG创建多worker策略；CPU集群使用环形all-reduce"""
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING
+    )
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+
+def make_distributed_dataset(strategy, source, global_batch_size, image_size, shuffle_buffer=2048, augmentation=None):
+    """
+    为每个worker创建只读取自己分片的训练集
+
+    Args:
+        strategy: 分布式策略
+        source (str): TFRecord分片目录或按类别分子目录的图像目录
+        global_batch_size (int): 所有副本合计的批次大小
+        image_size (tuple): 模型输入尺寸 (宽, 高)
+        shuffle_buffer (int): 打乱缓冲区大小
+        augmentation (dict): 批次增强参数，None不增强
+
+    Returns:
+        tf.distribute.DistributedDataset: 无限重复的分布式数据集，每轮步数由调用方控制
+    """
+    def dataset_fn(input_context):
+        batch_size = input_context.get_per_replica_batch_size(global_batch_size)
+        dataset = make_dataset(
+            source, batch_size, image_size,
+            is_training=True,
+            shuffle_buffer=shuffle_buffer,
+            num_shards=input_context.num_input_pipelines,
+            shard_index=input_context.input_pipeline_id,
+            augmentation=augmentation
+        )
+        # 各worker的分片大小可能不同，重复数据集并按固定步数训练，保证集合通信的步数一致
+        return dataset.repeat()
+
+    return strategy.distribute_datasets_from_function(dataset_fn)
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def launch_local_workers(num_workers, command, intra_op_threads=None):
+    """
+    在本机启动num_workers个worker进程组成集群，并等待全部结束
+
+    Args:
+        num_workers (int): worker进程数
+        command (list): python解释器之后的参数，例如 ['-m', 'models.dfdn_distributed', ...]
+        intra_op_threads (int): 每个worker的计算线程数，默认平分CPU核数
+
+    Returns:
+        list: 各worker的退出码
+    """
+    workers = [f'localhost:{_free_port()}' for _ in range(num_workers)]
+    intra_op_threads = intra_op_threads or max(1, (os.cpu_count() or 1) // num_workers)
+
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({
+            'cluster': {'worker': workers},
+            'task': {'type': 'worker', 'index': index}
+        })
+        # 避免多个worker进程争抢同一批CPU核
+        env['TF_NUM_INTRAOP_THREADS'] = str(intra_op_threads)
+        env['OMP_NUM_THREADS'] = str(intra_op_threads)
+        processes.append(subprocess.Popen([sys.executable] + command, env=env, cwd=BACKEND_DIR))
+
+    return [process.wait() for process in processes]
+
+
+def train_worker(args):
+    """作为集群中的一个worker运行训练"""
+    configure_threads(args.intra_op_threads)
+    strategy = create_strategy()
+    num_workers = strategy.num_replicas_in_sync
+    print(f"分布式训练: {num_workers} 个副本，全局批次 {args.batch_size}")
+
+    input_shape = (args.input_size, args.input_size, 1)
+    image_size = (args.input_size, args.input_size)
+    model = DynamicFeatureDecouplingNetwork(
+        input_shape=input_shape, modality=args.modality, strategy=strategy, precision=args.precision
+    )
+
+    augmentation = get_augmentation_params(args.modality, args.augment)
+    train_dataset = make_distributed_dataset(strategy, args.train_source, args.batch_size, image_size,
+                                             augmentation=augmentation)
+    steps_per_epoch = load_dataset_info(args.train_source)["total"] // args.batch_size
+    if steps_per_epoch == 0:
+        raise ValueError(f"训练样本数少于全局批次大小 {args.batch_size}")
+
+    val_dataset = None
+    if args.val_source:
+        cache_path = None
+        if args.val_cache:
+            # 同一台主机上的多个worker不能共用一个缓存文件
+            cache_path = f"{args.val_cache}.worker{strategy.cluster_resolver.task_id or 0}"
+        val_dataset = make_dataset(
+            args.val_source, args.batch_size, image_size, is_training=False, cache_path=cache_path
+        )
+
+    checkpointer = None
+    if args.checkpoint_dir:
+        from models.dfdn_checkpoint import TrainingCheckpointer
+        checkpointer = TrainingCheckpointer(args.checkpoint_dir, save_every_steps=args.checkpoint_every)
+
+    return model.train_with_datasets(
+        train_dataset,
+        val_dataset,
+        epochs=args.epochs,
+        steps_per_epoch=steps_per_epoch,
+        early_stopping_patience=args.early_stopping_patience,
+        model_save_path=args.model_save_path,
+        micro_batches=args.micro_batches,
+        checkpointer=checkpointer
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DFDN多进程数据并行训练")
+    parser.add_argument("--train-source", required=True, help="训练集TFRecord分片目录或图像目录")
+    parser.add_argument("--val-source", help="验证集目录")
+    parser.add_argument("--val-cache", help="验证集本地缓存文件前缀")
+    parser.add_argument("--modality", choices=["CT", "MRI"], default="CT")
+    parser.add_argument("--input-size", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=128, help="全局批次大小（所有worker合计）")
+    parser.add_argument("--precision", choices=["float32", "mixed_bfloat16"], default="float32",
+                        help="计算精度，mixed_bfloat16适用于支持AVX512_BF16/AMX的CPU")
+    parser.add_argument("--augment", action="store_true", help="训练集使用本模态默认参数的批次增强")
+    parser.add_argument("--micro-batches", type=int, default=1, help="每个worker的批次拆成的微批次数（梯度累加）")
+    parser.add_argument("--early-stopping-patience", type=int, default=10)
+    parser.add_argument("--model-save-path", help="模型保存路径（只由chief写入）")
+    parser.add_argument("--checkpoint-dir", help="训练检查点目录，重新运行时从最近的检查点恢复")
+    parser.add_argument("--checkpoint-every", type=int, help="每隔多少步保存检查点，默认只在每个epoch结束时保存")
+    parser.add_argument("--workers", type=int, help="在本机启动的worker进程数；不指定时按TF_CONFIG作为单个worker运行")
+    parser.add_argument("--intra-op-threads", type=int, help="每个worker的计算线程数")
+    args = parser.parse_args()
+
+    if args.workers:
+        # 子进程去掉--workers参数，按各自的TF_CONFIG作为worker运行
+        command = ['-m', 'models.dfdn_distributed']
+        skip = False
+        for arg in sys.argv[1:]:
+            if skip:
+                skip = False
+                continue
+            if arg == '--workers':
+                skip = True
+                continue
+            if arg.startswith('--workers='):
+                continue
+            command.append(arg)
+
+        exit_codes = launch_local_workers(args.workers, command, args.intra_op_threads)
+        print(f"worker退出码: {exit_codes}")
+        return 0 if all(code == 0 for code in exit_codes) else 1
+
+    train_worker(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
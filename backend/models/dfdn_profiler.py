@@ -0,0 +1,255 @@
+"""
+DFDN训练性能分析 - 判断训练瓶颈在数据输入、ResNet主干、注意力还是Python循环
+
+性能分析模式是可选的，开启后train_with_datasets会:
+    1. 在指定的步数窗口内采集TensorFlow Profiler trace（用TensorBoard的Profile页查看）
+    2. 把每一步拆成数据等待、前向+反向传播、优化器更新和训练循环中的Python开销
+       （记录损失、更新进度条）分别计时；前向+反向和优化器更新分别编译并在中间同步，
+       比正常训练略慢，只用于分析
+    3. 训练结束后用一个样本批次单独测量各组件的前向耗时占比
+       （主干网络、编码器Transformer、两个解码器、分类器、对比损失和正交损失）
+    4. 把吞吐量、各段耗时、组件占比和内存峰值写入JSON汇总文件
+
+用法:
+    profiler = TrainingProfiler('logs/profile/ct_run1', trace_start_step=10, trace_steps=5)
+    model.train_with_datasets(train_dataset, val_dataset, epochs=1, profiler=profiler)
+"""
+import json
+import os
+import resource
+import time
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+
+def _percentiles(values):
+    """毫秒耗时的均值和分位数"""
+    if not values:
+        return None
+    array = np.asarray(values) * 1000
+    return {
+        "mean": round(float(array.mean()), 3),
+        "p50": round(float(np.percentile(array, 50)), 3),
+        "p95": round(float(np.percentile(array, 95)), 3),
+        "max": round(float(array.max()), 3)
+    }
+
+
+def _wait(value):
+    """读取一个张量以等待设备上的计算完成"""
+    tf.nest.map_structure(lambda tensor: tensor.numpy(), value)
+
+
+def memory_high_water():
+    """进程常驻内存峰值和GPU显存峰值（MB）"""
+    # Linux上ru_maxrss的单位是KB
+    memory = {"maxRssMb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    for gpu in tf.config.list_logical_devices('GPU'):
+        try:
+            info = tf.config.experimental.get_memory_info(gpu.name)
+            memory[f"{gpu.name}PeakMb"] = round(info["peak"] / 1024 ** 2, 1)
+        except (ValueError, tf.errors.InvalidArgumentError):
+            pass
+    return memory
+
+
+class TrainingProfiler:
+    """DFDN训练的逐步计时、trace采集和JSON汇总"""
+
+    def __init__(self, log_dir, trace_start_step=10, trace_steps=5, component_repeats=10):
+        """
+        初始化性能分析器
+
+        Args:
+            log_dir (str): trace和汇总文件的输出目录
+            trace_start_step (int): 从第几步开始采集trace（跳过tf.function追踪和预热）
+            trace_steps (int): 采集trace的步数，0表示不采集
+            component_repeats (int): 测量组件耗时时每个组件重复执行的次数
+        """
+        self.log_dir = log_dir
+        self.trace_start_step = trace_start_step
+        self.trace_steps = trace_steps
+        self.component_repeats = component_repeats
+
+        self.global_step = 0
+        self.data_wait = []
+        self.forward_backward = []
+        self.optimizer = []
+        self.python_loop = []
+        self.batch_sizes = []
+        self._pending_wait = 0.0
+        self._pending_loop = 0.0
+        self._last_step_end = None
+
+        self._tracing = False
+        self._sample_batch = None
+        self._start_time = None
+
+    def iterate(self, dataset):
+        """遍历数据集，记录每次取下一个批次的等待时间和上一步结束后训练循环的开销"""
+        iterator = iter(dataset)
+        # 每个epoch重新开始计算，不把epoch之间的验证时间算作循环开销
+        self._last_step_end = None
+        while True:
+            start = time.perf_counter()
+            self._pending_loop = start - self._last_step_end if self._last_step_end else 0.0
+            try:
+                batch_data = next(iterator)
+            except StopIteration:
+                return
+            self._pending_wait = time.perf_counter() - start
+            yield batch_data
+
+    def run_step(self, forward_backward, apply_gradients, batch_data):
+        """
+        执行并计时一步训练
+
+        Args:
+            forward_backward: DynamicFeatureDecouplingNetwork.build_profiling_steps返回的前向+反向函数
+            apply_gradients: 对应的优化器更新函数
+            batch_data: (images, labels)
+
+        Returns:
+            dict: 本步的损失
+        """
+        if self._start_time is None:
+            self._start_time = time.perf_counter()
+            self._sample_batch = batch_data
+            os.makedirs(self.log_dir, exist_ok=True)
+
+        if self.trace_steps and self.global_step == self.trace_start_step:
+            tf.profiler.experimental.start(self.log_dir)
+            self._tracing = True
+
+        with tf.profiler.experimental.Trace('train', step_num=self.global_step, _r=1):
+            start = time.perf_counter()
+            gradients, losses = forward_backward(batch_data)
+            _wait(losses['total_loss'])
+            backward_end = time.perf_counter()
+
+            _wait(apply_gradients(gradients))
+            end = time.perf_counter()
+
+        self.data_wait.append(self._pending_wait)
+        self.python_loop.append(self._pending_loop)
+        self.forward_backward.append(backward_end - start)
+        self.optimizer.append(end - backward_end)
+        self.batch_sizes.append(int(tf.shape(batch_data[0])[0]))
+        self._pending_wait = self._pending_loop = 0.0
+        self._last_step_end = end
+        self.global_step += 1
+
+        if self._tracing and self.global_step >= self.trace_start_step + self.trace_steps:
+            tf.profiler.experimental.stop()
+            self._tracing = False
+
+        return losses
+
+    def measure_components(self, model, from_cache=False):
+        """
+        用样本批次分别测量各组件的前向耗时
+
+        Returns:
+            dict: 组件名 -> {"ms": 平均耗时, "share": 占比}
+        """
+        if self._sample_batch is None:
+            return {}
+
+        images = self._sample_batch[0]
+        backbone_tail, encoder_tail = model.build_split_models()
+
+        def backbone(inputs):
+            if from_cache:
+                return backbone_tail(inputs, training=False)
+            if model.input_shape[-1] == 1:
+                inputs = tf.repeat(inputs, 3, axis=-1)
+            return model.backbone(inputs, training=False)
+
+        # 逐个组件计算输入，保证每个组件测量的是真实形状
+        backbone_output = backbone(images)
+        encoded = encoder_tail(backbone_output, training=False)
+        pathology = model.pathology_decoder(encoded, training=False)
+        physiology = model.physiology_decoder(encoded, training=False)
+
+        components = {
+            "backbone": (backbone, images),
+            "encoder_transformer": (lambda x: encoder_tail(x, training=False), backbone_output),
+            "pathology_decoder": (lambda x: model.pathology_decoder(x, training=False), encoded),
+            "physiology_decoder": (lambda x: model.physiology_decoder(x, training=False), encoded),
+            "classifier": (lambda x: model.classifier(x, training=False), pathology),
+            "contrastive_loss": (lambda x: model.contrastive_loss(*x), (pathology, physiology)),
+            "orthogonality_loss": (lambda x: model.orthogonality_loss(*x), (pathology, physiology))
+        }
+
+        timings = {}
+        for name, (fn, inputs) in components.items():
+            compiled = tf.function(fn)
+            _wait(compiled(inputs))  # 追踪和预热
+            start = time.perf_counter()
+            for _ in range(self.component_repeats):
+                output = compiled(inputs)
+            _wait(output)
+            timings[name] = (time.perf_counter() - start) / self.component_repeats
+
+        total = sum(timings.values())
+        return {
+            name: {"ms": round(seconds * 1000, 3), "share": round(seconds / total, 4)}
+            for name, seconds in timings.items()
+        }
+
+    def summary(self, model=None, from_cache=False):
+        """汇总本次运行的统计结果"""
+        if self._tracing:
+            tf.profiler.experimental.stop()
+            self._tracing = False
+
+        # 前两步包含tf.function追踪，不计入稳态统计
+        skip = 2 if len(self.forward_backward) > 2 else 0
+        parts = {
+            "dataWait": self.data_wait[skip:],
+            "forwardBackward": self.forward_backward[skip:],
+            "optimizer": self.optimizer[skip:],
+            "pythonLoop": self.python_loop[skip:]
+        }
+        step_total = [sum(values) for values in zip(*parts.values())]
+
+        total_time = sum(step_total)
+        images = sum(self.batch_sizes[skip:])
+        summary = {
+            "createdAt": datetime.now().isoformat(),
+            "steps": self.global_step,
+            "measuredSteps": len(step_total),
+            "imagesPerSecond": round(images / total_time, 2) if total_time else None,
+            "wallSeconds": round(time.perf_counter() - self._start_time, 3) if self._start_time else None,
+            "stepTimeMs": dict(
+                {name: _percentiles(values) for name, values in parts.items()},
+                total=_percentiles(step_total)
+            ),
+            "stepShares": {
+                name: round(sum(values) / total_time, 4) if total_time else None
+                for name, values in parts.items()
+            },
+            "memory": memory_high_water(),
+            "traceDir": self.log_dir if self.trace_steps else None,
+            "traceWindow": [self.trace_start_step, self.trace_start_step + self.trace_steps] if self.trace_steps else None
+        }
+        if model is not None:
+            summary["componentForwardShares"] = self.measure_components(model, from_cache)
+        return summary
+
+    def write_summary(self, model=None, from_cache=False, filename='profile_summary.json'):
+        """写入JSON汇总文件并返回汇总内容"""
+        summary = self.summary(model, from_cache)
+        os.makedirs(self.log_dir, exist_ok=True)
+        path = os.path.join(self.log_dir, filename)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+        print(f"性能分析汇总已写入 {path}")
+        print(f"  吞吐量: {summary['imagesPerSecond']} 图像/秒")
+        for name, share in summary["stepShares"].items():
+            if share is not None:
+                print(f"  {name}: {share:.1%}")
+        return summary
@@ -0,0 +1,224 @@
+"""
+DFDN特征空间可视化 - 流式提取特征，增量PCA投影，无界面渲染到文件
+
+原来的做法是一次性predict整个数组，再对拼接后的全部特征做t-SNE（O(N^2)），几千个样本以上就不可用。
+这里分三步，内存占用与样本数基本无关:
+    1. 按批次前向传播，病灶特征、生理特征和类别写入磁盘上的临时文件（之后用np.memmap读取）
+    2. IncrementalPCA按块拟合两种特征，再按块投影到2维
+    3. 可选：对PCA降到50维后的特征按(特征类型, 类别)分层抽样，只对样本子集做t-SNE
+
+图像用Agg后端渲染到文件，不会打开窗口，可以在服务器和后台任务中运行。
+
+用法:
+    from models.dfdn_visualize import visualize_feature_space
+    visualize_feature_space(model, (x_val, y_val), 'val_features.png', method='tsne')
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+FEATURE_TYPES = ('Pathology', 'Physiology')
+CLASS_NAMES = ('Normal', 'Ischemic', 'Hemorrhagic')
+CLASS_COLORS = ('green', 'blue', 'red')
+MARKERS = {'Pathology': 'o', 'Physiology': 'x'}
+
+
+def _iter_batches(data, batch_size):
+    """统一遍历(images, labels)数组或批次数据集，产出 (images, 类别索引)"""
+    if isinstance(data, tf.data.Dataset):
+        for batch in data:
+            yield batch[0], np.argmax(batch[1], axis=1)
+        return
+    images, labels = data
+    for start in range(0, len(images), batch_size):
+        yield images[start:start + batch_size], np.argmax(labels[start:start + batch_size], axis=1)
+
+
+def spool_features(model, data, spool_dir, batch_size=256):
+    """
+    按批次提取特征并写入spool_dir中的二进制文件
+
+    Args:
+        model: DynamicFeatureDecouplingNetwork
+        data: (images, one-hot labels) 数组，或产出 (images, labels, ...) 的批次数据集
+        spool_dir (str): 临时文件目录
+        batch_size (int): 输入是数组时的批次大小
+
+    Returns:
+        tuple: (pathology, physiology, labels)，前两个是只读的np.memmap
+    """
+    predict = tf.function(lambda x: model.dfdn_model(x, training=False)[1:], reduce_retracing=True)
+    paths = {name: os.path.join(spool_dir, f'{name}.bin') for name in ('pathology', 'physiology')}
+
+    labels = []
+    feature_dim = None
+    with open(paths['pathology'], 'wb') as pathology_file, open(paths['physiology'], 'wb') as physiology_file:
+        for images, batch_labels in _iter_batches(data, batch_size):
+            pathology, physiology = predict(tf.convert_to_tensor(images, tf.float32))
+            pathology_file.write(pathology.numpy().astype(np.float32).tobytes())
+            physiology_file.write(physiology.numpy().astype(np.float32).tobytes())
+            labels.append(np.asarray(batch_labels, dtype=np.int8))
+            feature_dim = pathology.shape[-1]
+
+    if feature_dim is None:
+        raise ValueError("没有可视化的样本")
+    labels = np.concatenate(labels)
+    shape = (len(labels), feature_dim)
+    return (
+        np.memmap(paths['pathology'], dtype=np.float32, mode='r', shape=shape),
+        np.memmap(paths['physiology'], dtype=np.float32, mode='r', shape=shape),
+        labels
+    )
+
+
+def _chunks(features, chunk_size):
+    for start in range(0, len(features), chunk_size):
+        yield np.asarray(features[start:start + chunk_size])
+
+
+def incremental_projection(feature_sets, n_components=2, chunk_size=4096):
+    """
+    用IncrementalPCA在多组特征上按块拟合，再把每组特征按块投影
+
+    Returns:
+        tuple: (投影结果列表, 各主成分的解释方差比例)
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    # 每块至少要有n_components个样本，最后不足的部分并入投影阶段
+    chunk_size = max(chunk_size, n_components)
+    pca = IncrementalPCA(n_components=n_components)
+    for features in feature_sets:
+        for chunk in _chunks(features, chunk_size):
+            if len(chunk) >= n_components:
+                pca.partial_fit(chunk)
+
+    projections = [
+        np.concatenate([pca.transform(chunk) for chunk in _chunks(features, chunk_size)]).astype(np.float32)
+        for features in feature_sets
+    ]
+    return projections, pca.explained_variance_ratio_
+
+
+def stratified_sample(groups, max_samples, seed=42):
+    """
+    按组分层抽样，每组的配额相同，样本不够的组全部保留，剩余配额分给其他组
+
+    Args:
+        groups: 每个样本的组编号
+        max_samples (int): 抽样总数上限
+
+    Returns:
+        np.ndarray: 选中样本的下标（升序）
+    """
+    rng = np.random.default_rng(seed)
+    members = [np.flatnonzero(groups == group) for group in np.unique(groups)]
+    members.sort(key=len)
+
+    selected = []
+    remaining = max_samples
+    for i, indices in enumerate(members):
+        quota = remaining // (len(members) - i)
+        take = min(quota, len(indices))
+        selected.append(rng.choice(indices, take, replace=False) if take < len(indices) else indices)
+        remaining -= take
+    return np.sort(np.concatenate(selected))
+
+
+def render_scatter(points, feature_types, labels, save_path, title):
+    """用Agg画布把二维点渲染到文件"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(12, 10))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(1, 1, 1)
+
+    # 点数多时缩小标记并栅格化，文件大小和渲染时间不随样本数线性增长
+    size = float(np.clip(2e4 / max(len(points), 1), 1, 20))
+    for type_index, feature_type in enumerate(FEATURE_TYPES):
+        for class_index, class_name in enumerate(CLASS_NAMES):
+            mask = (feature_types == type_index) & (labels == class_index)
+            if not mask.any():
+                continue
+            axes.scatter(
+                points[mask, 0], points[mask, 1],
+                s=size,
+                marker=MARKERS[feature_type],
+                c=CLASS_COLORS[class_index],
+                alpha=0.5 if len(points) > 10000 else 0.7,
+                linewidths=0.5 if MARKERS[feature_type] == 'x' else 0,
+                rasterized=True,
+                label=f"{feature_type}-{class_name} ({int(mask.sum())})"
+            )
+
+    # 固定图例位置，loc='best'在点数多时要搜索很久
+    axes.legend(loc='upper right', markerscale=max(1.0, 20 / size))
+    axes.set_title(title)
+    figure.tight_layout()
+
+    directory = os.path.dirname(save_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    figure.savefig(save_path, dpi=150)
+
+
+def visualize_feature_space(model, data, save_path, method='pca', batch_size=256,
+                            tsne_samples=5000, pca_dims=50, spool_dir=None):
+    """
+    可视化病灶特征和生理特征的分布
+
+    Args:
+        model: DynamicFeatureDecouplingNetwork
+        data: (images, one-hot labels) 数组（可以是np.memmap），或产出 (images, labels, ...) 的批次数据集
+        save_path (str): 输出图像路径
+        method (str): 'pca' 只做增量PCA；'tsne' 先用增量PCA降到pca_dims维，再对分层抽样的子集做t-SNE
+        batch_size (int): 输入是数组时的批次大小
+        tsne_samples (int): t-SNE的样本数上限（两种特征合计）
+        pca_dims (int): t-SNE之前PCA降到的维数
+        spool_dir (str): 特征临时文件的目录，默认使用系统临时目录
+
+    Returns:
+        dict: 样本数、绘制的点数、PCA解释方差比例和输出路径
+    """
+    if method not in ('pca', 'tsne'):
+        raise ValueError(f"不支持的可视化方法: {method}")
+
+    work_dir = tempfile.mkdtemp(prefix='dfdn_features_', dir=spool_dir)
+    try:
+        pathology, physiology, labels = spool_features(model, data, work_dir, batch_size)
+        num_samples = len(labels)
+        n_components = 2 if method == 'pca' else min(pca_dims, pathology.shape[1], num_samples)
+        (pathology_projected, physiology_projected), variance = incremental_projection([pathology, physiology], n_components)
+        del pathology, physiology
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    points = np.concatenate([pathology_projected, physiology_projected])
+    feature_types = np.repeat(np.arange(len(FEATURE_TYPES), dtype=np.int8), num_samples)
+    point_labels = np.concatenate([labels, labels])
+
+    if method == 'tsne':
+        from sklearn.manifold import TSNE
+
+        selected = stratified_sample(feature_types * len(CLASS_NAMES) + point_labels, tsne_samples)
+        # perplexity必须小于样本数
+        perplexity = min(30.0, max(1.0, (len(selected) - 1) / 3))
+        points = TSNE(n_components=2, init='pca', perplexity=perplexity, random_state=42).fit_transform(points[selected])
+        feature_types, point_labels = feature_types[selected], point_labels[selected]
+        title = f'{model.modality} Feature Decoupling (PCA-{n_components} + t-SNE, {len(selected)} points)'
+    else:
+        title = f'{model.modality} Feature Decoupling (Incremental PCA, {len(points)} points)'
+
+    render_scatter(points, feature_types, point_labels, save_path, title)
+    print(f"Visualization saved to {save_path}")
+    return {
+        "samples": num_samples,
+        "plottedPoints": len(points),
+        "method": method,
+        "explainedVariance": [round(float(v), 4) for v in variance[:2]],
+        "savePath": save_path
+    }
@@ -0,0 +1,167 @@
+"""
+检测进度发布/订阅模块 - 工作线程发布进度事件，SSE和长轮询接口直接等待事件
+
+原来前端每3秒轮询一次/api/detect/status，每次都要对reports做一次排序查询，
+图像检测的每个阶段也都要把进度写进MongoDB。这里工作线程把进度发布到进程内的ProgressBroker，
+订阅方按任务（job:<jobId>）或用户（user:<userId>，即该用户最近一个任务）等待新事件，
+事件到达后立即返回；MongoDB只在状态变化（提交、完成、失败）时更新。
+
+同步的订阅方（Flask的请求线程）用wait阻塞等待；异步的订阅方（async_app.py）用wait_async，
+每个等待者只占一个Future，不占线程。
+
+事件只在当前进程内传递。任务由其他进程（worker.py、gunicorn的其他工作进程）执行时收不到事件，
+调用方在等待期间每隔PROGRESS_RECHECK_SECONDS回查状态文档（见hello.py中的wait_detection_state）。
+为了让两种来源的进度可以比较，seq是毫秒时间戳：事件的seq取发布时间（进程内严格递增），
+状态文档的seq取updatedAt（seq_at），客户端用上一次收到的seq等待时不会因为状态来自数据库而停在0。
+"""
+import asyncio
+import threading
+import time
+
+TERMINAL_STATUSES = ("finished", "failed")
+
+
+def seq_at(timestamp):
+    """时间（秒）对应的seq"""
+    return int(timestamp * 1000)
+
+
+def is_terminal(event):
+    """任务是否已经结束（临时结果之后还会有模型结果，不算结束）"""
+    return event["status"] in TERMINAL_STATUSES and not event.get("provisional")
+
+
+class ProgressBroker:
+    """进程内的检测进度发布/订阅"""
+
+    def __init__(self, retention_seconds=600):
+        """
+        Args:
+            retention_seconds (float): 事件保留时长，超过后不再作为最新进度返回
+        """
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        self._events = {}
+        self._conditions = {}  # key -> [Condition, 等待者数量]
+        self._async_waiters = {}  # key -> [(事件循环, Future)]
+        self._seq = 0
+        self._last_prune = time.time()
+
+    @staticmethod
+    def job_key(job_id):
+        return f"job:{job_id}"
+
+    @staticmethod
+    def user_key(user_id):
+        return f"user:{user_id}"
+
+    def publish(self, user_id, job_id, status, progress, message="", **extra):
+        """
+        发布进度事件，唤醒等待该任务和该用户的订阅方
+
+        Returns:
+            dict: 事件，seq在进程内单调递增
+        """
+        with self._lock:
+            self._seq = max(self._seq + 1, seq_at(time.time()))
+            event = {
+                "seq": self._seq,
+                "jobId": job_id,
+                "userId": user_id,
+                "status": status,
+                "progress": progress,
+                "message": message,
+                "time": time.time(),
+                **extra
+            }
+            for key in (self.job_key(job_id), self.user_key(user_id)):
+                self._events[key] = event
+                entry = self._conditions.get(key)
+                if entry is not None:
+                    entry[0].notify_all()
+                # publish通常在工作线程中调用，通过call_soon_threadsafe在各自的事件循环中唤醒
+                for loop, future in self._async_waiters.pop(key, ()):
+                    loop.call_soon_threadsafe(_resolve, future, event)
+            self._prune(event["time"])
+        return event
+
+    def _prune(self, now):
+        # 调用方已持有锁，每分钟最多清理一次
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        expired = [key for key, event in self._events.items() if now - event["time"] > self.retention_seconds]
+        for key in expired:
+            del self._events[key]
+
+    def latest(self, key):
+        """某个任务/用户的最新事件，没有时返回None"""
+        with self._lock:
+            return self._events.get(key)
+
+    def wait(self, key, after_seq=0, timeout=None):
+        """
+        等待seq大于after_seq的事件
+
+        Returns:
+            dict: 新事件，超时返回None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            entry = self._conditions.setdefault(key, [threading.Condition(self._lock), 0])
+            entry[1] += 1
+            try:
+                while True:
+                    event = self._events.get(key)
+                    if event is not None and event["seq"] > after_seq:
+                        return event
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    entry[0].wait(remaining)
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._conditions[key]
+
+    async def wait_async(self, key, after_seq=0, timeout=None):
+        """
+        wait的异步版本，在事件循环中等待seq大于after_seq的事件
+
+        Returns:
+            dict: 新事件，超时返回None
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            event = self._events.get(key)
+            if event is not None and event["seq"] > after_seq:
+                return event
+            self._async_waiters.setdefault(key, []).append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._lock:
+                waiters = self._async_waiters.get(key)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._async_waiters[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "events": len(self._events),
+                "waitingKeys": len(self._conditions) + len(self._async_waiters),
+                "waiters": sum(entry[1] for entry in self._conditions.values()),
+                "asyncWaiters": sum(len(waiters) for waiters in self._async_waiters.values())
+            }
+
+
+def _resolve(future, event):
+    # 等待者可能已经超时取消
+    if not future.done():
+        future.set_result(event)
@@ -0,0 +1,195 @@
+"""
+风险评分截止时间模块 - 集成模型超时时先返回简单计算器的临时结果，模型完成后再更新
+
+原来只有集成模型抛出异常或返回空结果时才回退到RiskCalculator，模型变慢（例如负载高时TabNet卡住）
+用户就只能一直等。这里给每次评分一个截止时间:
+    - 截止时间内模型完成：直接写入模型结果
+    - 超过截止时间：立即写入RiskCalculator的结果并标记为临时（provisional）后返回，
+      模型在评分线程池中继续执行，完成后由回调用模型结果更新报告；模型最终失败时临时结果转为正式结果
+score在截止时间后就返回，模型卡住时只占评分线程池的线程，不占risk通道的工作线程，
+排在后面的任务照样在截止时间内拿到临时结果；截止时间从任务提交时算起，已经排队超过截止时间的任务
+立即写入临时结果。进行中的模型预测（包括截止时间后仍在执行的）已经占满评分线程池时不再提交新的预测，
+直接写入简单计算器的正式结果，模型卡住时积压的预测不会无限增长。
+进程内的更新在进程重启后丢失，由调用方另外提交后续任务，对仍是临时结果的报告调用finalize重新评分。
+同时统计首次出报告时间（time-to-first-report）的分布和各种回退的比例。时间从任务提交时算起
+（submitted_at，包括在队列中的等待），没有提交时间时从开始评分算起。
+"""
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import numpy as np
+
+SOURCE_MODEL = "model"
+SOURCE_CALCULATOR = "calculator"
+
+
+class ModelBusyError(Exception):
+    """进行中的模型预测已经占满评分线程池"""
+
+
+class DeadlineRiskScorer:
+    """带截止时间的风险评分"""
+
+    def __init__(self, predict, fallback, deadline=3.0, max_workers=2, window=1000):
+        """
+        Args:
+            predict: predict(user) -> 风险结果dict，失败时返回None或抛出异常
+            fallback: fallback(user) -> 风险结果dict（快速、不会超时的计算）
+            deadline (float): 截止时间（秒，从任务提交时算起），None或0表示一直等待模型结果
+            max_workers (int): 执行模型预测的线程数
+            window (int): 耗时统计的样本数
+        """
+        self.predict = predict
+        self.fallback = fallback
+        self.deadline = deadline
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="risk-model") if deadline else None
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._first_report_ms = deque(maxlen=window)
+        self._final_report_ms = deque(maxlen=window)
+        self._counts = {"model": 0, "timeoutFallback": 0, "errorFallback": 0, "busyFallback": 0,
+                        "upgraded": 0, "upgradeFailed": 0}
+
+    def _acquire(self):
+        """占用一个模型预测名额，进行中的预测已达到max_workers时返回False"""
+        with self._lock:
+            if self._in_flight >= self.max_workers:
+                return False
+            self._in_flight += 1
+            return True
+
+    def _run_model(self, user, release=False):
+        try:
+            return self.predict(user)
+        except Exception as e:
+            print(f"模型预测失败: {str(e)}")
+            traceback.print_exc()
+            return None
+        finally:
+            if release:
+                with self._lock:
+                    self._in_flight -= 1
+
+    def _record(self, start, outcome, first=True, final=True):
+        elapsed_ms = (time.time() - start) * 1000
+        with self._lock:
+            if first:
+                self._first_report_ms.append(elapsed_ms)
+            if final:
+                self._final_report_ms.append(elapsed_ms)
+            self._counts[outcome] += 1
+
+    def score(self, user, publish, submitted_at=None):
+        """
+        计算风险并通过publish写入结果，可能调用两次（临时结果和更新后的结果）
+
+        超过截止时间时写入临时结果后就返回，更新后的结果在模型完成时由评分线程池的线程写入。
+
+        Args:
+            user (dict): 用户数据
+            publish: publish(risk_result, provisional, source)，source为 'model' 或 'calculator'
+            submitted_at (float): 任务的提交时间（time.time()），用于统计首次出报告时间
+        """
+        start = submitted_at or time.time()
+        if self._executor is None:
+            result = self._run_model(user)
+        elif not self._acquire():
+            print(f"进行中的模型预测已达到 {self.max_workers} 个，直接使用简单计算器的结果")
+            publish(self.fallback(user), False, SOURCE_CALCULATOR)
+            self._record(start, "busyFallback")
+            return
+        else:
+            future = self._executor.submit(self._run_model, user, True)
+            # 截止时间从提交时算起，在队列中等待过久的任务不再等满截止时间
+            try:
+                result = future.result(timeout=max(0.0, self.deadline - (time.time() - start)))
+            except TimeoutError:
+                print(f"模型预测超过截止时间 {self.deadline} 秒，先返回简单计算器的临时结果")
+                fallback_result = self.fallback(user)
+                publish(fallback_result, True, SOURCE_CALCULATOR)
+                self._record(start, "timeoutFallback", final=False)
+                future.add_done_callback(lambda done: self._upgrade(done, fallback_result, publish, start))
+                return
+
+        if result is not None:
+            publish(result, False, SOURCE_MODEL)
+            self._record(start, "model")
+        else:
+            print("模型预测失败，回退到简单计算器")
+            publish(self.fallback(user), False, SOURCE_CALCULATOR)
+            self._record(start, "errorFallback")
+
+    def _upgrade(self, future, fallback_result, publish, start):
+        """模型完成后用模型结果更新临时报告（在评分线程池的线程中执行）"""
+        try:
+            result = future.result()
+            if result is not None:
+                print("模型预测完成，用模型结果更新临时报告")
+                publish(result, False, SOURCE_MODEL)
+                self._record(start, "upgraded", first=False)
+            else:
+                publish(fallback_result, False, SOURCE_CALCULATOR)
+                self._record(start, "upgradeFailed", first=False)
+        except Exception as e:
+            print(f"更新临时报告失败: {str(e)}")
+            traceback.print_exc()
+
+    def finalize(self, user, publish):
+        """
+        对仍是临时结果的报告重新评分并写入正式结果（进程内的更新丢失后由后续任务调用）
+
+        在调用线程中执行模型预测；进行中的预测已经占满评分线程池时抛出ModelBusyError，由调用方稍后重试
+
+        Args:
+            user (dict): 用户数据
+            publish: 同score，只调用一次，provisional为False
+        """
+        if self._executor is not None and not self._acquire():
+            raise ModelBusyError(f"进行中的模型预测已达到 {self.max_workers} 个")
+        result = self._run_model(user, release=self._executor is not None)
+        if result is not None:
+            publish(result, False, SOURCE_MODEL)
+            outcome = "upgraded"
+        else:
+            publish(self.fallback(user), False, SOURCE_CALCULATOR)
+            outcome = "upgradeFailed"
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def close(self, wait=True):
+        """停止评分线程池，wait为True时等待进行中的模型预测和报告更新完成"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        """首次/最终出报告时间分布（毫秒）以及模型结果、超时回退、异常回退和满载回退的次数与比例"""
+        with self._lock:
+            first, final = list(self._first_report_ms), list(self._final_report_ms)
+            counts = dict(self._counts)
+
+        def percentiles(values):
+            if not values:
+                return {"p50": None, "p99": None, "max": None}
+            return {
+                "p50": round(float(np.percentile(values, 50)), 1),
+                "p99": round(float(np.percentile(values, 99)), 1),
+                "max": round(float(max(values)), 1)
+            }
+
+        scored = counts["model"] + counts["timeoutFallback"] + counts["errorFallback"] + counts["busyFallback"]
+        return {
+            "deadlineSeconds": self.deadline,
+            "scored": scored,
+            "timeToFirstReportMs": percentiles(first),
+            "timeToFinalReportMs": percentiles(final),
+            "counts": counts,
+            "timeoutRate": counts["timeoutFallback"] / scored if scored else 0.0,
+            "busyRate": counts["busyFallback"] / scored if scored else 0.0,
+            "fallbackRate": (counts["timeoutFallback"] + counts["errorFallback"] + counts["busyFallback"]) / scored
+                            if scored else 0.0
+        }
@@ -0,0 +1,116 @@
+"""
+生产环境部署模块 - gunicorn多进程部署时的模型预加载、工作进程数和线程预算划分
+
+hello.py末尾的app.run是Flask开发服务器（单进程、DEBUG模式下会重新加载代码），不适合生产环境。
+gunicorn.conf.py使用这里的函数:
+    - 主进程中预加载集成模型（XGBoost/LightGBM/TabNet和元学习器），并冻结GC，
+      fork出的工作进程共享这些只读内存页，不用每个进程各加载一份
+    - 工作进程数按CPU线程预算计算，每个工作进程的线程预算是总线程数的一份
+    - 内嵌检测任务工作线程时，在每个工作进程中启动，并预先加载DFDN模型
+
+DFDN（TensorFlow）不能在主进程中预加载：TensorFlow运行时初始化（创建线程池）之后fork出的子进程
+在执行卷积等多线程算子时会卡死，所以只能在各工作进程fork之后加载。
+"""
+import gc
+import os
+import time
+
+import config
+
+_job_workers = []
+
+# 整个服务的计算线程总数，configure_worker把config.THREAD_BUDGET_TOTAL改为每个工作进程的份额
+_TOTAL_THREADS = config.THREAD_BUDGET_TOTAL or os.cpu_count() or 1
+
+
+def worker_count():
+    """
+    工作进程数：配置了SERVING_WORKERS时直接使用，否则按计算线程总数 / 每个进程的线程数
+
+    至少2个，一个工作进程因SERVING_MAX_REQUESTS重启时另一个仍在处理请求。
+    """
+    if config.SERVING_WORKERS:
+        return config.SERVING_WORKERS
+    return max(2, _TOTAL_THREADS // config.SERVING_THREADS_PER_WORKER)
+
+
+def preload_models(workers):
+    """
+    在gunicorn主进程中加载集成模型并冻结GC
+
+    冻结后这些对象不再被GC扫描，GC不会改写它们的对象头，fork后的内存页保持共享。
+    加载模型会导入xgboost、lightgbm和torch，OpenMP线程池的大小在导入时确定，
+    所以先按工作进程的份额配置线程预算（OMP_NUM_THREADS等环境变量）再加载。
+
+    Args:
+        workers (int): 工作进程数
+    """
+    from thread_budget import get_thread_budget
+
+    configure_worker(workers)
+    get_thread_budget().configure_process()
+
+    from stroke_model import load_ensemble
+
+    start = time.perf_counter()
+    ensemble = load_ensemble()
+    if ensemble is None:
+        print("警告: 集成模型预加载失败，工作进程将在首次预测时加载")
+    else:
+        print(f"集成模型已在主进程中预加载（{', '.join(ensemble['l0_models'])} + 元学习器），"
+              f"耗时 {time.perf_counter() - start:.1f} 秒")
+    gc.freeze()
+
+
+def configure_worker(workers):
+    """
+    在fork出的工作进程中、加载hello.py之前调用：把线程预算平分给各工作进程
+
+    Args:
+        workers (int): 工作进程数
+    """
+    from thread_budget import reset_thread_budget
+
+    share = max(1, _TOTAL_THREADS // workers)
+    config.THREAD_BUDGET_TOTAL = share
+    if config.THREAD_BUDGET_TF_INTRA_OP:
+        config.THREAD_BUDGET_TF_INTRA_OP = min(config.THREAD_BUDGET_TF_INTRA_OP, share)
+    # 主进程中按配置的工作进程数创建过线程预算，命令行指定了其他进程数时按实际的份额重新创建
+    reset_thread_budget()
+
+
+def warm_dfdn():
+    """加载图像检测用到的DFDN模型（完整模型和级联的低分辨率模型）"""
+    from brain_image_analyzer import get_model
+    from image_cascade import load_thresholds
+
+    thresholds = load_thresholds() if config.CASCADE_ENABLED else {}
+    start = time.perf_counter()
+    for modality in ("CT", "MRI"):
+        try:
+            get_model(modality)
+            if modality in thresholds:
+                get_model(modality, config.CASCADE_LOW_RES_SIZE)
+        except FileNotFoundError as e:
+            print(f"跳过{modality}模型预加载: {e}")
+    print(f"进程 {os.getpid()} 的DFDN模型已加载，耗时 {time.perf_counter() - start:.1f} 秒")
+
+
+def start_embedded_workers():
+    """JOB_EMBEDDED_WORKERS为True时在当前工作进程中启动检测任务工作线程"""
+    if not config.JOB_EMBEDDED_WORKERS:
+        return
+    from hello import create_job_workers
+
+    _job_workers.extend(create_job_workers())
+    if config.SERVING_WARM_DFDN and "image" in config.JOB_LANES:
+        warm_dfdn()
+    for worker in _job_workers:
+        worker.start()
+
+
+def stop_embedded_workers():
+    """工作进程退出（包括处理SERVING_MAX_REQUESTS个请求后重启）时停止领取任务，等待当前任务结束"""
+    for worker in _job_workers:
+        worker.stop(timeout=config.SERVING_GRACEFUL_TIMEOUT)
+    _job_workers.clear()
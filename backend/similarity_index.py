@@ -0,0 +1,471 @@
+"""
+相似病例检索模块 - 基于DFDN病灶特征的向量索引
+
+每张分析过的图像都会得到一个128维的病灶特征向量。这里按模态维护一个余弦相似度索引：
+数据量较小时用NumPy矩阵乘法精确检索；超过阈值后用球面k-means划分IVF分区，
+查询时只扫描最近的若干个分区。新的分析结果增量加入索引，不需要整体重建；
+训练和重新训练IVF分区在后台线程中进行，期间新病例照常加入、查询照常执行。
+"""
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+
+from embedding_store import unpack_vector
+
+
+def _normalize(vectors):
+    """L2归一化，零向量保持为零"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, k):
+    """返回每行分数最高的k个位置（按分数降序）"""
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    part_scores = np.take_along_axis(scores, part, axis=-1)
+    order = np.argsort(-part_scores, axis=-1)
+    return np.take_along_axis(part, order, axis=-1)
+
+
+def _spherical_kmeans(data, n_clusters, iterations=10, sample_size=None, chunk_size=8192, seed=42):
+    """
+    球面k-means（余弦距离），用于训练IVF的粗量化中心
+
+    Args:
+        data (np.ndarray): 已归一化的向量 [N, D]
+        n_clusters (int): 聚类中心数量
+        iterations (int): 迭代次数
+        sample_size (int): 训练采样数量，默认每个中心64个样本
+        chunk_size (int): 分块计算相似度，控制内存占用
+        seed (int): 随机种子
+
+    Returns:
+        np.ndarray: 归一化的聚类中心 [n_clusters, D]
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = sample_size or n_clusters * 64
+    if len(data) > sample_size:
+        data = data[rng.choice(len(data), sample_size, replace=False)]
+
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(data, centroids, chunk_size)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # 空簇保留原来的中心
+        non_empty = counts > 0
+        centroids[non_empty] = _normalize(sums[non_empty])
+
+    return centroids
+
+
+def _assign(data, centroids, chunk_size=8192):
+    """将每个向量分配到最相似的中心"""
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+class VectorIndex:
+    """
+    余弦相似度向量索引
+
+    向量数量少于ivf_threshold时精确检索；达到阈值后训练IVF分区。之后新增的向量
+    先放在未分区的尾部（精确扫描），尾部积累到merge_size时按已有中心分配进分区；
+    向量总数比上次训练时增长retrain_ratio倍后重新训练中心，保持分区大小均衡。
+
+    auto_build为False时add()不训练分区，由调用方根据needs_rebuild()在锁外调用train_ivf()，
+    再用install_ivf()装入训练结果（见SimilarCaseIndex）。
+    """
+
+    def __init__(self, dim=128, ivf_threshold=50000, n_lists=None, n_probe=16, merge_size=4096, retrain_ratio=2.0,
+                 auto_build=True):
+        """
+        初始化向量索引
+
+        Args:
+            dim (int): 向量维度
+            ivf_threshold (int): 启用IVF分区的向量数量阈值
+            n_lists (int): IVF分区数，默认取sqrt(N)
+            n_probe (int): 每次查询扫描的分区数
+            merge_size (int): 未分区尾部达到该数量时分配进已有分区
+            retrain_ratio (float): 向量总数达到上次训练时的该倍数时重新训练中心
+            auto_build (bool): 是否在add()中同步训练IVF分区
+        """
+        self.dim = dim
+        self.ivf_threshold = ivf_threshold
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.merge_size = merge_size
+        self.retrain_ratio = retrain_ratio
+        self.auto_build = auto_build
+
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._size = 0
+
+        # IVF结构：中心、每个向量所属分区、按分区排列的向量位置（CSR格式）和已分区的向量数量
+        self._centroids = None
+        self._assignments = np.empty(0, dtype=np.int64)
+        self._list_ids = None
+        self._list_offsets = None
+        self._indexed_size = 0
+        self._trained_size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def uses_ivf(self):
+        """当前是否启用IVF分区"""
+        return self._centroids is not None
+
+    def add(self, vectors):
+        """
+        增量添加向量
+
+        Args:
+            vectors (np.ndarray): [N, D] 或 [D]
+
+        Returns:
+            np.ndarray: 新向量在索引中的位置
+        """
+        vectors = _normalize(np.atleast_2d(vectors))
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"向量维度应为{self.dim}，实际为{vectors.shape[1]}")
+
+        # 按倍数扩容，避免每次添加都复制整个数组
+        needed = self._size + len(vectors)
+        if needed > len(self._vectors):
+            capacity = max(needed, 2 * len(self._vectors), 1024)
+            grown = np.empty((capacity, self.dim), dtype=np.float32)
+            grown[:self._size] = self._vectors[:self._size]
+            self._vectors = grown
+
+        self._vectors[self._size:needed] = vectors
+        positions = np.arange(self._size, needed)
+        self._size = needed
+
+        if self.auto_build and self.needs_rebuild():
+            self.build_ivf()
+        elif self.uses_ivf and self._size - self._indexed_size >= self.merge_size:
+            self._merge_tail()
+
+        return positions
+
+    def needs_rebuild(self):
+        """是否需要（重新）训练IVF分区：首次达到ivf_threshold，或向量总数达到上次训练时的retrain_ratio倍"""
+        if not self.uses_ivf:
+            return self._size >= self.ivf_threshold
+        return self._size >= self.retrain_ratio * self._trained_size
+
+    def vectors(self):
+        """
+        当前全部向量（只读视图）
+
+        新向量只写在已有向量之后，扩容时换成新数组，所以视图的内容不会再变，可以在锁外用于训练
+        """
+        return self._vectors[:self._size]
+
+    def train_ivf(self, data):
+        """
+        用给定向量训练IVF中心并分配分区，不修改索引
+
+        Returns:
+            tuple: (中心, data中每个向量所属的分区)，交给install_ivf()
+        """
+        n_lists = self.n_lists or max(16, int(np.sqrt(len(data))))
+        n_lists = min(n_lists, len(data))
+        centroids = _spherical_kmeans(data, n_lists)
+        return centroids, _assign(data, centroids)
+
+    def install_ivf(self, centroids, assignments):
+        """装入train_ivf()的结果；训练期间新增的向量留在未分区的尾部"""
+        self._centroids = centroids
+        self._assignments = assignments
+        self._trained_size = len(assignments)
+        self._rebuild_lists()
+
+    def build_ivf(self):
+        """用当前全部向量训练IVF分区"""
+        self.install_ivf(*self.train_ivf(self.vectors()))
+
+    def _merge_tail(self):
+        """把未分区的尾部按已有中心分配进分区"""
+        tail = self._vectors[self._indexed_size:self._size]
+        self._assignments = np.concatenate([self._assignments, _assign(tail, self._centroids)])
+        self._rebuild_lists()
+
+    def _rebuild_lists(self):
+        """根据分区分配重建CSR格式的分区列表"""
+        n_lists = len(self._centroids)
+        self._list_ids = np.argsort(self._assignments, kind='stable')
+        self._list_offsets = np.concatenate([[0], np.cumsum(np.bincount(self._assignments, minlength=n_lists))])
+        self._indexed_size = len(self._assignments)
+
+    def search(self, queries, k=10, exact=False):
+        """
+        批量查询最相似的k个向量
+
+        Args:
+            queries (np.ndarray): [Q, D] 或 [D]
+            k (int): 返回数量
+            exact (bool): 强制精确检索（用于评估召回率）
+
+        Returns:
+            tuple: (相似度 [Q, k], 位置 [Q, k])，不足k个时只返回实际数量
+        """
+        queries = _normalize(np.atleast_2d(queries))
+        k = min(k, self._size)
+        if k == 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.float32), empty.astype(np.int64)
+
+        if exact or not self.uses_ivf:
+            return self._search_exact(queries, k)
+        return self._search_ivf(queries, k)
+
+    def _search_exact(self, queries, k, chunk_size=65536):
+        """分块精确检索，控制相似度矩阵的内存占用"""
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_ids = np.empty((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, self._size, chunk_size):
+            block = self._vectors[start:min(start + chunk_size, self._size)]
+            scores = queries @ block.T
+            top = _top_k(scores, k)
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            best_ids = np.concatenate([best_ids, top + start], axis=1)
+
+            # 合并当前块和历史结果，只保留前k个
+            keep = _top_k(best_scores, k)
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+            best_ids = np.take_along_axis(best_ids, keep, axis=1)
+
+        return best_scores, best_ids
+
+    def _search_ivf(self, queries, k):
+        """IVF检索：每个查询只扫描最近的n_probe个分区，未分区的尾部对所有查询批量精确扫描"""
+        n_probe = min(self.n_probe, len(self._centroids))
+        probes = _top_k(queries @ self._centroids.T, n_probe)
+
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        all_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            candidates = np.concatenate(
+                [self._list_ids[self._list_offsets[c]:self._list_offsets[c + 1]] for c in probes[i]]
+            )
+            scores = self._vectors[candidates] @ query
+            top = _top_k(scores, k)
+            all_scores[i, :len(top)] = scores[top]
+            all_ids[i, :len(top)] = candidates[top]
+
+        if self._indexed_size < self._size:
+            tail = self._vectors[self._indexed_size:self._size]
+            tail_scores = queries @ tail.T
+            tail_top = _top_k(tail_scores, min(k, len(tail)))
+            all_scores = np.concatenate([all_scores, np.take_along_axis(tail_scores, tail_top, axis=1)], axis=1)
+            all_ids = np.concatenate([all_ids, tail_top + self._indexed_size], axis=1)
+
+            keep = _top_k(all_scores, k)
+            all_scores = np.take_along_axis(all_scores, keep, axis=1)
+            all_ids = np.take_along_axis(all_ids, keep, axis=1)
+
+        return all_scores, all_ids
+
+
+class SimilarCaseIndex:
+    """按模态维护相似病例索引，索引位置映射到病例信息"""
+
+    def __init__(self, embeddings_collection=None, vector_name="pathology", refresh_interval=30,
+                 refresh_overlap=300, **index_kwargs):
+        """
+        初始化相似病例索引
+
+        Args:
+            embeddings_collection: embeddings集合，用于启动时加载和跨进程增量同步
+            vector_name (str): 用于检索的特征名称
+            refresh_interval (int): 查询时与数据库增量同步的最小间隔（秒）
+            refresh_overlap (int): 增量同步时从已见到的最新createdAt往前回看的秒数
+            **index_kwargs: 传给VectorIndex的参数
+        """
+        self.collection = embeddings_collection
+        self.vector_name = vector_name
+        self.refresh_interval = refresh_interval
+        self.refresh_overlap = timedelta(seconds=refresh_overlap)
+        self.index_kwargs = index_kwargs
+
+        self._lock = threading.RLock()
+        self._indexes = {}
+        self._cases = {}
+        self._known_ids = set()
+        self._latest_created_at = None
+        self._last_refresh = 0.0
+        self._rebuilding = set()
+
+    def _index_for(self, modality):
+        if modality not in self._indexes:
+            self._indexes[modality] = VectorIndex(auto_build=False, **self.index_kwargs)
+            self._cases[modality] = []
+        return self._indexes[modality]
+
+    def _schedule_rebuild(self, modality):
+        """需要时在后台线程中训练该模态的IVF分区（调用方持有锁）"""
+        index = self._indexes[modality]
+        if modality in self._rebuilding or not index.needs_rebuild():
+            return
+        self._rebuilding.add(modality)
+        threading.Thread(
+            target=self._rebuild, args=(modality, index, index.vectors()),
+            name=f"similarity-ivf-{modality}", daemon=True
+        ).start()
+
+    def _rebuild(self, modality, index, data):
+        """后台训练IVF分区：k-means在锁外执行，只有装入结果时持有锁"""
+        started = time.perf_counter()
+        try:
+            centroids, assignments = index.train_ivf(data)
+        except Exception as e:
+            print(f"相似病例索引 {modality} 训练IVF分区失败: {str(e)}")
+            with self._lock:
+                self._rebuilding.discard(modality)
+            return
+
+        with self._lock:
+            index.install_ivf(centroids, assignments)
+            self._rebuilding.discard(modality)
+            print(f"相似病例索引 {modality} 已训练IVF分区: {len(data)} 个病例，{len(centroids)} 个分区，"
+                  f"耗时 {time.perf_counter() - started:.1f}s")
+            # 训练期间新增的病例足够多时继续训练
+            self._schedule_rebuild(modality)
+
+    def add_case(self, modality, vector, case):
+        """
+        添加一个病例
+
+        Args:
+            modality (str): 图像模态
+            vector (np.ndarray): 病灶特征向量
+            case (dict): 病例信息，必须包含caseId（即embeddingId）
+        """
+        with self._lock:
+            if case["caseId"] in self._known_ids:
+                return
+            index = self._index_for(modality)
+            index.add(vector)
+            self._cases[modality].append(case)
+            self._known_ids.add(case["caseId"])
+            self._schedule_rebuild(modality)
+
+    def refresh(self, force=False):
+        """
+        从embeddings集合增量加载新的病例（包括其他进程写入的）
+
+        ObjectId和createdAt都在写入方生成，不同进程之间不保证单调：先生成的文档可能后写入，
+        按"大于已见到的最大值"同步会永久漏掉这些病例。这里每次从已见到的最新createdAt往前回看
+        refresh_overlap秒重新读取，已加入的病例按_id去重。
+        """
+        if self.collection is None:
+            return 0
+        with self._lock:
+            if not force and time.monotonic() - self._last_refresh < self.refresh_interval:
+                return 0
+            self._last_refresh = time.monotonic()
+
+            query = {f"vectors.{self.vector_name}": {"$exists": True}}
+            if self._latest_created_at is not None:
+                query["createdAt"] = {"$gte": self._latest_created_at - self.refresh_overlap}
+
+            loaded = 0
+            batches = {}
+            cursor = self.collection.find(
+                query,
+                {f"vectors.{self.vector_name}": 1, "modality": 1, "predictedClass": 1,
+                 "confidence": 1, "createdAt": 1}
+            ).sort("createdAt", 1)
+            for document in cursor:
+                created_at = document.get("createdAt")
+                if created_at is not None and (self._latest_created_at is None or created_at > self._latest_created_at):
+                    self._latest_created_at = created_at
+                case_id = str(document["_id"])
+                if case_id in self._known_ids or not document.get("modality"):
+                    continue
+                vectors, cases = batches.setdefault(document["modality"], ([], []))
+                vectors.append(unpack_vector(document["vectors"][self.vector_name]))
+                cases.append(self._case_from_document(document))
+
+            # 按模态批量加入索引
+            for modality, (vectors, cases) in batches.items():
+                self._index_for(modality).add(np.stack(vectors))
+                self._cases[modality].extend(cases)
+                self._known_ids.update(case["caseId"] for case in cases)
+                loaded += len(cases)
+                self._schedule_rebuild(modality)
+
+            if loaded:
+                print(f"相似病例索引已加载 {loaded} 个新病例")
+            return loaded
+
+    @staticmethod
+    def _case_from_document(document):
+        created_at = document.get("createdAt")
+        return {
+            "caseId": str(document["_id"]),
+            "predictedClass": document.get("predictedClass"),
+            "confidence": document.get("confidence"),
+            "date": created_at.strftime("%Y-%m-%d") if created_at else None
+        }
+
+    def search(self, modality, queries, k=5, exclude_case_ids=None):
+        """
+        批量查询相似病例
+
+        Args:
+            modality (str): 图像模态
+            queries (np.ndarray): 查询向量 [Q, D]
+            k (int): 每个查询返回的病例数量
+            exclude_case_ids (list): 每个查询需要排除的caseId（通常是查询病例本身）
+
+        Returns:
+            list: 每个查询对应的相似病例列表（含similarity字段）
+        """
+        self.refresh()
+        queries = np.atleast_2d(queries)
+        exclude_case_ids = exclude_case_ids or [None] * len(queries)
+
+        with self._lock:
+            index = self._indexes.get(modality)
+            if index is None or len(index) == 0:
+                return [[] for _ in range(len(queries))]
+
+            # 多取一个结果，用于排除查询病例本身
+            scores, positions = index.search(queries, k + 1)
+            cases = self._cases[modality]
+
+            results = []
+            for row_scores, row_positions, exclude_id in zip(scores, positions, exclude_case_ids):
+                matches = []
+                for score, position in zip(row_scores, row_positions):
+                    if position < 0 or cases[position]["caseId"] == exclude_id:
+                        continue
+                    matches.append(dict(cases[position], similarity=round(float(score), 4)))
+                    if len(matches) == k:
+                        break
+                results.append(matches)
+            return results
+
+    def stats(self):
+        """各模态索引的规模和检索方式"""
+        with self._lock:
+            return {
+                modality: {"size": len(index), "ivf": index.uses_ivf}
+                for modality, index in self._indexes.items()
+            }
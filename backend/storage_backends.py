@@ -0,0 +1,276 @@
+"""
+文件存储后端模块 - 上传文件和分析结果文件（可视化分析图、分析报告）的存储
+
+FileHandler按内容的SHA-256把文件存为blob，键是按哈希前缀分层的路径（blob_key），
+同一个目录下的文件数不会随文件总数一起增长。后端只负责按键读写:
+    - LocalStorage  本地文件系统（默认，根目录是UPLOAD_FOLDER），先写临时文件再重命名
+    - S3Storage     S3兼容的对象存储（AWS S3、MinIO等），需要boto3
+InMemoryS3Client是S3客户端的内存替身，实现S3Storage用到的几个接口，用于在没有对象存储服务时测试。
+"""
+import io
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+# 键的哈希前缀分层：ab/cd/abcd...，两层各256个目录
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+
+
+def blob_key(sha256, ext=""):
+    """
+    内容哈希对应的存储键
+
+    Args:
+        sha256 (str): 文件内容的SHA-256十六进制字符串
+        ext (str): 扩展名（含点号，如'.dcm'），保留扩展名便于按类型读取和返回Content-Type
+    """
+    shards = [sha256[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return "/".join(shards + [sha256 + ext.lower()])
+
+
+def is_blob_key(key):
+    """键是否是blob_key格式（迁移前的旧文件是存储目录下的扁平文件名）"""
+    parts = key.split("/")
+    if len(parts) != SHARD_DEPTH + 1:
+        return False
+    name = parts[-1].split(".", 1)[0]
+    return len(name) == 64 and all(c in "0123456789abcdef" for c in name) and \
+        all(part == name[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i, part in enumerate(parts[:-1]))
+
+
+class StorageBackend:
+    """存储后端接口，键是以'/'分隔的相对路径"""
+
+    def put_file(self, key, source_path):
+        """把本地文件source_path存为key（已存在时覆盖），完成后source_path被移走或删除"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def size(self, key):
+        """文件大小（字节），不存在时返回None"""
+        raise NotImplementedError
+
+    def open(self, key):
+        """以二进制只读方式打开，返回有read方法的文件对象，不存在时抛出FileNotFoundError"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """删除文件，不存在时忽略"""
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        """列出以prefix开头的所有键"""
+        raise NotImplementedError
+
+    @contextmanager
+    def local_path(self, key):
+        """
+        得到可以按路径读取的本地文件（图像分析按文件路径读取图像）
+
+        本地存储直接返回文件路径；对象存储下载到临时文件，退出时删除。
+        """
+        with self.open(key) as source, tempfile.NamedTemporaryFile(
+                suffix=os.path.splitext(key)[1], delete=False) as target:
+            shutil.copyfileobj(source, target)
+        try:
+            yield target.name
+        finally:
+            os.remove(target.name)
+
+
+class LocalStorage(StorageBackend):
+    """本地文件系统存储"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        # 键来自数据库和URL，不能指向根目录之外
+        path = os.path.normpath(os.path.join(self.root, key))
+        if os.path.commonpath([os.path.abspath(path), os.path.abspath(self.root)]) != os.path.abspath(self.root):
+            raise ValueError(f"无效的存储键: {key}")
+        return path
+
+    def put_file(self, key, source_path):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 同一文件系统内重命名是原子的，读取方不会看到写了一半的文件；跨文件系统时先复制到同目录的临时文件
+        try:
+            os.replace(source_path, path)
+        except OSError:
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, path)
+            os.remove(source_path)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def size(self, key):
+        try:
+            return os.path.getsize(self.path(key))
+        except OSError:
+            return None
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def delete(self, key):
+        # 哈希前缀目录不删除（最多256*256个），避免与同目录下并发的put_file竞争
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix=""):
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    yield key
+
+    @contextmanager
+    def local_path(self, key):
+        yield self.path(key)
+
+
+class S3Storage(StorageBackend):
+    """S3兼容的对象存储，键前面加上prefix作为对象名"""
+
+    def __init__(self, client, bucket, prefix=""):
+        """
+        Args:
+            client: boto3的S3客户端（或InMemoryS3Client）
+            bucket (str): 存储桶
+            prefix (str): 对象名前缀，如'strokeguard/'
+        """
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _object_key(self, key):
+        return self.prefix + key
+
+    @staticmethod
+    def _is_not_found(error):
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def put_file(self, key, source_path):
+        # upload_file对大文件使用分段上传，内存占用与文件大小无关；对象在上传完成后才可见
+        self.client.upload_file(source_path, self.bucket, self._object_key(key))
+        os.remove(source_path)
+
+    def _head(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except ClientError as e:
+            if self._is_not_found(e):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        head = self._head(key)
+        return head["ContentLength"] if head else None
+
+    def open(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))["Body"]
+        except ClientError as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def list(self, prefix=""):
+        kwargs = {"Bucket": self.bucket, "Prefix": self._object_key(prefix)}
+        while True:
+            page = self.client.list_objects_v2(**kwargs)
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self.prefix):]
+            if not page.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+
+class InMemoryS3Client:
+    """boto3 S3客户端的内存替身（只实现S3Storage用到的接口）"""
+
+    def __init__(self):
+        self.objects = {}  # (bucket, key) -> bytes
+
+    @staticmethod
+    def _not_found(operation, key):
+        from botocore.exceptions import ClientError
+
+        return ClientError({"Error": {"Code": "NoSuchKey", "Message": f"找不到对象: {key}"}}, operation)
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, "rb") as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body.read() if hasattr(Body, "read") else bytes(Body)
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self._not_found("HeadObject", Key)
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self._not_found("GetObject", Key)
+        data = self.objects[(Bucket, Key)]
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, MaxKeys=1000):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + MaxKeys]
+        result = {"Contents": [{"Key": key, "Size": len(self.objects[(Bucket, key)])} for key in page],
+                  "IsTruncated": start + MaxKeys < len(keys)}
+        if result["IsTruncated"]:
+            result["NextContinuationToken"] = str(start + MaxKeys)
+        return result
+
+
+def create_storage_backend(backend="local", root=None, bucket=None, prefix="", endpoint_url=None, region=None):
+    """
+    按配置创建存储后端
+
+    Args:
+        backend (str): 'local'、's3' 或 'memory-s3'（S3Storage + InMemoryS3Client，用于测试）
+        root (str): 本地存储的根目录
+        bucket (str): S3存储桶
+        prefix (str): S3对象名前缀
+        endpoint_url (str): S3兼容服务的地址（MinIO等），None表示AWS S3
+        region (str): S3区域
+    """
+    if backend == "local":
+        return LocalStorage(root)
+    if backend == "s3":
+        import boto3
+
+        client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        return S3Storage(client, bucket, prefix)
+    if backend == "memory-s3":
+        return S3Storage(InMemoryS3Client(), bucket or "test", prefix)
+    raise ValueError(f"不支持的存储后端: {backend}")
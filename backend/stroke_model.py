@@ -5,6 +5,9 @@ import pandas as pd
 import numpy as np
 import joblib
 import os
+import threading
+
+from thread_budget import get_thread_budget
 
 # --- 尝试导入模型库 ---
 try:
@@ -256,12 +259,69 @@ def preprocess_new_data(new_data_df,
     return processed_df
 
 
+# 已加载的集成模型，进程内共享（只读）；serving.py在gunicorn主进程中预加载，工作进程fork后共享内存页
+_ensemble = None
+_ensemble_lock = threading.Lock()
+
+def load_ensemble():
+    """
+    加载预处理组件、Level 0模型和元学习器，成功后缓存，之后直接返回缓存
+
+    Returns:
+        dict: preprocessing、l0_model_names_order、l0_models、meta_model，加载失败时返回None（下次调用重试）
+    """
+    global _ensemble
+    with _ensemble_lock:
+        if _ensemble is not None:
+            return _ensemble
+        
+        print("开始加载模型和预处理对象...")
+        try:
+            # 1. 加载预处理组件
+            preprocessing_info = load_preprocessing_artifacts(MODEL_DIR)
+            if preprocessing_info is None:
+                print("预处理组件加载失败")
+                return None
+            
+            # 2. 加载 Level 0 模型名称顺序
+            l0_order_path = os.path.join(MODEL_DIR, "l0_model_names_order.joblib")
+            if not os.path.exists(l0_order_path):
+                print(f"错误: Level 0 模型顺序文件 'l0_model_names_order.joblib' 在 '{MODEL_DIR}' 未找到！")
+                return None
+            try:
+                l0_model_names_order = joblib.load(l0_order_path)
+                print(f"Level 0 模型顺序已加载: {l0_model_names_order}")
+            except Exception as e:
+                print(f"加载 l0_model_names_order.joblib 时发生错误: {e}")
+                return None
+            
+            # 3. 加载模型
+            loaded_l0_models, meta_model_loaded = load_models(MODEL_DIR, l0_model_names_order)
+            if loaded_l0_models is None or meta_model_loaded is None:
+                print("一个或多个模型未能加载，中止预测。")
+                return None
+            if len(loaded_l0_models) != len(l0_model_names_order):
+                print("警告: 加载的Level 0模型数量与期望的顺序列表数量不符。")
+        
+        except Exception as e:
+            print(f"错误：加载模型或预处理组件时发生未知错误: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+        
+        _ensemble = {
+            "preprocessing": preprocessing_info,
+            "l0_model_names_order": l0_model_names_order,
+            "l0_models": loaded_l0_models,
+            "meta_model": meta_model_loaded
+        }
+        return _ensemble
+
+
 def predict_stroke_risk(new_patient_data_df):
     """
-    加载保存的模型和预处理对象，对新患者数据进行预测。
+    使用已加载的模型和预处理对象（首次调用时加载），对新患者数据进行预测。
     """
-    print("开始加载模型和预处理对象...")
-    
     # 保存原始症状数据，用于日志记录和特征工程
     symptom_cols = [
         'chest_pain', 'shortness_of_breath', 'irregular_heartbeat', 'fatigue_and_weakness', 
@@ -276,41 +336,15 @@ def predict_stroke_risk(new_patient_data_df):
             original_symptom_data[col] = new_patient_data_df[col].copy()
             print(f"原始症状数据: {col} = {new_patient_data_df[col].values}")
     
-    try:
-        # 1. 加载预处理组件
-        preprocessing_info = load_preprocessing_artifacts(MODEL_DIR)
-        if preprocessing_info is None:
-            print("预处理组件加载失败")
-            return None
-            
-        scaler, final_feature_columns, all_categorical_cols_to_encode, \
-        numerical_cols_to_scale, ds1_symptom_cols, filling_values = preprocessing_info
-        
-        # 2. 加载 Level 0 模型名称顺序
-        l0_order_path = os.path.join(MODEL_DIR, "l0_model_names_order.joblib")
-        if not os.path.exists(l0_order_path):
-            print(f"错误: Level 0 模型顺序文件 'l0_model_names_order.joblib' 在 '{MODEL_DIR}' 未找到！")
-            return None
-        try:
-            l0_model_names_order = joblib.load(l0_order_path)
-            print(f"Level 0 模型顺序已加载: {l0_model_names_order}")
-        except Exception as e:
-            print(f"加载 l0_model_names_order.joblib 时发生错误: {e}")
-            return None
-            
-        # 3. 加载模型
-        loaded_l0_models, meta_model_loaded = load_models(MODEL_DIR, l0_model_names_order)
-        if loaded_l0_models is None or meta_model_loaded is None:
-            print("一个或多个模型未能加载，中止预测。")
-            return None
-        if len(loaded_l0_models) != len(l0_model_names_order):
-            print("警告: 加载的Level 0模型数量与期望的顺序列表数量不符。")
-
-    except Exception as e:
-        print(f"错误：加载模型或预处理组件时发生未知错误: {e}")
-        import traceback
-        traceback.print_exc()
+    # 1-3. 预处理组件、Level 0模型顺序和模型（进程内只加载一次）
+    ensemble = load_ensemble()
+    if ensemble is None:
         return None
+    scaler, final_feature_columns, all_categorical_cols_to_encode, \
+    numerical_cols_to_scale, ds1_symptom_cols, filling_values = ensemble["preprocessing"]
+    l0_model_names_order = ensemble["l0_model_names_order"]
+    loaded_l0_models = ensemble["l0_models"]
+    meta_model_loaded = ensemble["meta_model"]
 
     print("\n对新数据进行预处理...")
     try:
@@ -368,17 +402,20 @@ def predict_stroke_risk(new_patient_data_df):
         if model_name in loaded_l0_models:
             model = loaded_l0_models[model_name]
             try:
-                # 为XGBoost模型特殊处理
-                if model_name == "XGBoost":
-                    # 使用NumPy数组而不是DataFrame来避免特征名称检查
-                    print(f"使用NumPy数组格式预测XGBoost模型")
-                    l0_predictions_new_dict[model_name] = model.predict_proba(X_processed_new.values)[:, 1]
-                elif model_name == "TabNet":
-                    # TabNet期望NumPy数组
-                    l0_predictions_new_dict[model_name] = model.predict_proba(X_processed_new.values)[:, 1]
-                else:
-                    # 对所有其他模型使用标准predict_proba
-                    l0_predictions_new_dict[model_name] = model.predict_proba(X_processed_new)[:, 1]
+                # 按当前并发任务数分配推理线程，避免多个任务各自占满全部CPU核；
+                # 模型在并发任务间共享，推理期间持有该模型的线程设置
+                with get_thread_budget().model_threads(model):
+                    # 为XGBoost模型特殊处理
+                    if model_name == "XGBoost":
+                        # 使用NumPy数组而不是DataFrame来避免特征名称检查
+                        print(f"使用NumPy数组格式预测XGBoost模型")
+                        l0_predictions_new_dict[model_name] = model.predict_proba(X_processed_new.values)[:, 1]
+                    elif model_name == "TabNet":
+                        # TabNet期望NumPy数组
+                        l0_predictions_new_dict[model_name] = model.predict_proba(X_processed_new.values)[:, 1]
+                    else:
+                        # 对所有其他模型使用标准predict_proba
+                        l0_predictions_new_dict[model_name] = model.predict_proba(X_processed_new)[:, 1]
                 print(f"  {model_name} 预测完成。预测值: {l0_predictions_new_dict[model_name]}")
             except Exception as e:
                 print(f"  {model_name} 预测失败: {str(e)}")
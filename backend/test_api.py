@@ -141,6 +141,39 @@ def test_upload_file():
     
     return response.status_code == 200
 
+def test_chunked_upload():
+    """测试分块上传（中途查询进度后继续上传）"""
+    import hashlib
+    
+    content = b"%PDF-1.5\n" + b"%Test PDF file for chunked upload\n" * 2000
+    response = requests.post(f"{BASE_URL}/api/upload/init", json={
+        "userId": TEST_USER_ID,
+        "fileName": "test_chunked.pdf",
+        "fileSize": len(content),
+        "kind": "record",
+        "sha256": hashlib.sha256(content).hexdigest()
+    })
+    print_result("初始化分块上传", response)
+    if response.status_code != 200:
+        return False
+    upload_id = response.json()["uploadId"]
+    chunk_size = min(response.json()["chunkSize"], 16 * 1024)
+    
+    # 上传第一个分块后查询进度，从返回的offset继续
+    requests.put(f"{BASE_URL}/api/upload/{upload_id}?offset=0", data=content[:chunk_size])
+    offset = requests.get(f"{BASE_URL}/api/upload/{upload_id}").json()["offset"]
+    while offset < len(content):
+        response = requests.put(f"{BASE_URL}/api/upload/{upload_id}?offset={offset}",
+                                data=content[offset:offset + chunk_size])
+        if response.status_code != 200:
+            print_result("上传分块", response)
+            return False
+        offset = response.json()["offset"]
+    
+    response = requests.post(f"{BASE_URL}/api/upload/{upload_id}/complete")
+    print_result("完成分块上传", response)
+    return response.status_code == 200
+
 def test_get_medical_records():
     """测试获取用户病历记录列表"""
     response = requests.get(f"{BASE_URL}/api/user/medical-records?userId={TEST_USER_ID}")
@@ -171,6 +204,7 @@ def run_all_tests():
         ("检测状态", test_detection_status),
         ("检测报告", test_detection_report),
         ("上传文件", test_upload_file),
+        ("分块上传", test_chunked_upload),
         ("获取用户病历记录", test_get_medical_records),
         ("删除病历记录", test_delete_medical_record)
     ]
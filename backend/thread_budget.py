@@ -0,0 +1,178 @@
+"""
+CPU线程预算模块 - 统一分配TensorFlow、PyTorch、XGBoost和LightGBM的计算线程
+
+后端进程同时加载了DFDN（TensorFlow）、TabNet（PyTorch）和XGBoost/LightGBM，每个库默认都使用
+全部CPU核。风险计算和图像分析在后台线程中并发执行时，几个线程池加起来远超核数，互相抢占反而变慢。
+
+这里按config.py中的总线程数统一分配:
+    - 进程启动时固定TensorFlow的算子内/算子间线程数和PyTorch的线程数（这些线程池创建后不能再改）
+    - TensorFlow的算子内线程池只在image任务中使用，按image通道在image和risk通道工作线程中的占比
+      取得固定份额，图像任务和风险任务同时执行时两者加起来不超过总线程数
+    - 每个后台任务用job()登记，树模型和TabNet用model_threads()在推理期间取得自己的份额
+      （图像任务执行时先扣除TensorFlow的份额，剩下的按其他并发任务数平分）
+    - 线程数是模型对象（n_jobs）或进程级（PyTorch）的设置，并发任务共享同一个模型，
+      所以model_threads()在设置线程数到推理结束期间持有该模型（PyTorch为进程级）的锁，
+      一个任务不会在另一个任务推理过程中改掉它的线程数
+"""
+import os
+import sys
+import threading
+import weakref
+from contextlib import contextmanager
+
+import config
+
+
+class ThreadBudget:
+    """进程内共享的CPU线程预算"""
+
+    def __init__(self, total_threads=None, tf_intra_op_threads=None, tf_inter_op_threads=2, tf_share=0.5):
+        """
+        Args:
+            total_threads (int): 可用的计算线程总数，None时使用CPU核数
+            tf_intra_op_threads (int): TensorFlow算子内线程数，None时为总线程数乘以tf_share
+            tf_inter_op_threads (int): TensorFlow算子间并行数
+            tf_share (float): 未指定tf_intra_op_threads时TensorFlow（image任务）占总线程数的比例
+        """
+        self.total_threads = total_threads or os.cpu_count() or 1
+        self.tf_intra_op_threads = min(tf_intra_op_threads or max(1, int(self.total_threads * tf_share)),
+                                       self.total_threads)
+        self.tf_inter_op_threads = tf_inter_op_threads
+        self._lock = threading.Lock()
+        self._active_jobs = {}
+        # 每个模型对象一把锁；PyTorch的线程数是进程级设置，所有TabNet模型共用一把
+        self._model_locks = weakref.WeakKeyDictionary()
+        self._torch_lock = threading.Lock()
+
+    def configure_process(self):
+        """
+        进程启动时调用，最好在导入tensorflow和torch之前
+
+        未导入的库通过环境变量在初始化时读取线程数；已经导入的库直接设置，
+        TensorFlow运行时已经初始化时无法再修改，只打印提示
+        """
+        os.environ.setdefault('TF_NUM_INTRAOP_THREADS', str(self.tf_intra_op_threads))
+        os.environ.setdefault('TF_NUM_INTEROP_THREADS', str(self.tf_inter_op_threads))
+        # OpenMP线程池（PyTorch、XGBoost、LightGBM）的默认大小
+        os.environ.setdefault('OMP_NUM_THREADS', str(self.total_threads))
+
+        tf = sys.modules.get('tensorflow')
+        if tf is not None:
+            try:
+                tf.config.threading.set_intra_op_parallelism_threads(self.tf_intra_op_threads)
+                tf.config.threading.set_inter_op_parallelism_threads(self.tf_inter_op_threads)
+            except RuntimeError as e:
+                print(f"TensorFlow已初始化，线程数保持不变: {e}")
+
+        torch = sys.modules.get('torch')
+        if torch is not None:
+            torch.set_num_threads(self.total_threads)
+
+        print(f"线程预算: 共 {self.total_threads} 个线程，TensorFlow算子内 {self.tf_intra_op_threads}、"
+              f"算子间 {self.tf_inter_op_threads}")
+
+    @contextmanager
+    def job(self, kind):
+        """
+        登记一个正在执行的后台任务
+
+        Args:
+            kind (str): 任务类型，例如 'risk'、'image'，只用于统计
+        """
+        with self._lock:
+            self._active_jobs[kind] = self._active_jobs.get(kind, 0) + 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._active_jobs[kind] -= 1
+
+    def active_jobs(self):
+        """各类型正在执行的任务数"""
+        with self._lock:
+            return {kind: count for kind, count in self._active_jobs.items() if count}
+
+    def threads_per_job(self):
+        """
+        当前每个非图像任务可用的线程数，至少1个
+
+        有image任务在执行时先扣除TensorFlow算子内线程池的份额（所有image任务共用这个线程池），
+        剩下的按其他并发任务数平分
+        """
+        with self._lock:
+            image_jobs = self._active_jobs.get('image', 0)
+            other_jobs = sum(self._active_jobs.values()) - image_jobs
+        available = self.total_threads - self.tf_intra_op_threads if image_jobs else self.total_threads
+        return max(1, available // max(1, other_jobs))
+
+    def _model_lock(self, model):
+        with self._lock:
+            lock = self._model_locks.get(model)
+            if lock is None:
+                lock = self._model_locks[model] = threading.Lock()
+            return lock
+
+    @contextmanager
+    def model_threads(self, model, threads=None):
+        """
+        在推理期间把模型的线程数设为当前任务的份额
+
+        设置线程数和推理之间持有锁：同一个模型的并发推理依次执行，每次使用各自的份额，
+        不同模型之间互不影响
+
+        Args:
+            model: XGBoost/LightGBM/scikit-learn估计器或TabNet模型
+            threads (int): 线程数，None时使用threads_per_job()
+
+        Yields:
+            int: 设置的线程数
+        """
+        threads = threads or self.threads_per_job()
+        module = type(model).__module__
+
+        if module.startswith('pytorch_tabnet'):
+            # PyTorch的线程数是进程级设置，所有TabNet推理共用一把锁
+            torch = sys.modules.get('torch')
+            with self._torch_lock:
+                if torch is not None:
+                    torch.set_num_threads(threads)
+                yield threads
+        elif hasattr(model, 'get_params') and 'n_jobs' in model.get_params():
+            # XGBClassifier、LGBMClassifier和scikit-learn估计器都通过n_jobs控制线程数
+            with self._model_lock(model):
+                model.set_params(n_jobs=threads)
+                yield threads
+        else:
+            yield threads
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def _image_lane_share():
+    """image通道工作线程数在image和risk通道工作线程中的占比，作为TensorFlow的线程份额"""
+    image = config.JOB_LANES.get('image', {}).get('workers', 0)
+    risk = config.JOB_LANES.get('risk', {}).get('workers', 0)
+    return image / (image + risk) if image + risk else 1.0
+
+
+def reset_thread_budget():
+    """丢弃已创建的线程预算，下次get_thread_budget按config.py重新创建（gunicorn工作进程fork后重新划分预算）"""
+    global _budget
+    with _budget_lock:
+        _budget = None
+
+
+def get_thread_budget():
+    """按config.py创建进程内唯一的线程预算"""
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = ThreadBudget(
+                total_threads=config.THREAD_BUDGET_TOTAL,
+                tf_intra_op_threads=config.THREAD_BUDGET_TF_INTRA_OP,
+                tf_inter_op_threads=config.THREAD_BUDGET_TF_INTER_OP,
+                tf_share=_image_lane_share()
+            )
+        return _budget
@@ -0,0 +1,151 @@
+"""
+分块上传会话模块 - 大文件（DICOM序列等）分块上传、断点续传的会话状态
+
+普通上传接口由Werkzeug解析整个multipart请求体，受MAX_CONTENT_LENGTH（16MB）限制，
+移动网络下连接中断就要从头重传。分块上传分三步:
+    1. init     声明文件名、大小（和可选的SHA-256），得到uploadId
+    2. put      按顺序上传分块，每个分块带上偏移量，服务端按块流式写入磁盘并计算SHA-256
+    3. complete 拼接分块得到最终文件，核对大小和SHA-256后写入病历记录
+连接中断后客户端查询会话得到已提交的偏移量（offset），从该位置继续上传。
+
+会话保存在upload_sessions集合中，多个工作进程共享；分块数据由FileHandler写在存储目录的
+.partial/<uploadId>/下。分块写完后按偏移量条件更新会话（offset必须等于分块的偏移量），
+同一偏移量的并发请求只有一个被采用。会话在UPLOAD_SESSION_TTL_SECONDS内没有新分块时过期，
+由TTL索引删除（见db_schema.py），分块文件由FileHandler.purge_stale_uploads清理。
+"""
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+# 拼接分块的租约：进程在拼接过程中退出时，租约过期后可以重新完成上传
+ASSEMBLE_LEASE_SECONDS = 600
+
+
+class UploadSessionStore:
+    """分块上传会话"""
+
+    def __init__(self, collection, ttl_seconds):
+        """
+        Args:
+            collection: MongoDB集合（upload_sessions）
+            ttl_seconds (int): 会话没有新分块多久后过期
+        """
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+
+    def _expires_at(self, now):
+        return now + timedelta(seconds=self.ttl_seconds)
+
+    def create(self, user_id, kind, file_name, file_size, image_type=None, sha256=None):
+        """
+        创建上传会话
+
+        Args:
+            user_id (str): 用户ID
+            kind (str): 'record'（病历文件）或 'image'（医学图像）
+            file_name (str): 原始文件名
+            file_size (int): 文件大小（字节）
+            image_type (str): 医学图像类型，kind为image时使用
+            sha256 (str): 客户端计算的SHA-256，完成上传时核对
+
+        Returns:
+            dict: 会话文档
+        """
+        now = datetime.now()
+        session = {
+            "_id": uuid.uuid4().hex,
+            "userId": user_id,
+            "kind": kind,
+            "fileName": file_name,
+            "fileSize": file_size,
+            "imageType": image_type,
+            "sha256": sha256.lower() if sha256 else None,
+            "offset": 0,
+            "chunks": [],
+            "status": "uploading",
+            "createdAt": now,
+            "updatedAt": now,
+            "expiresAt": self._expires_at(now)
+        }
+        self.collection.insert_one(session)
+        return session
+
+    def get(self, upload_id):
+        """会话文档，不存在或已过期时返回None"""
+        return self.collection.find_one({"_id": upload_id})
+
+    def commit_chunk(self, upload_id, offset, chunk):
+        """
+        采用一个已写入磁盘的分块：会话仍在上传且已提交的偏移量等于offset时，offset前进分块大小
+
+        Args:
+            upload_id (str): 上传ID
+            offset (int): 分块的偏移量
+            chunk (dict): FileHandler.write_chunk的返回值（name、size、sha256）
+
+        Returns:
+            dict: 更新后的会话，偏移量不匹配（其他请求已提交该位置）或会话不在上传中时返回None
+        """
+        now = datetime.now()
+        return self.collection.find_one_and_update(
+            {"_id": upload_id, "status": "uploading", "offset": offset},
+            {
+                "$set": {"offset": offset + chunk["size"], "updatedAt": now, "expiresAt": self._expires_at(now)},
+                "$push": {"chunks": {"offset": offset, **chunk}}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+
+    def begin_complete(self, upload_id, file_size):
+        """
+        开始拼接：所有分块都已提交（offset等于fileSize）时把会话标记为assembling
+
+        拼接中的会话租约过期后（进程中途退出）可以再次开始。
+
+        Args:
+            upload_id (str): 上传ID
+            file_size (int): 会话声明的文件大小
+
+        Returns:
+            dict: 会话，不满足条件时返回None
+        """
+        now = datetime.now()
+        return self.collection.find_one_and_update(
+            {
+                "_id": upload_id,
+                "offset": file_size,
+                "$or": [
+                    {"status": "uploading"},
+                    {"status": "assembling", "assembleLeaseExpiresAt": {"$lt": now}}
+                ]
+            },
+            {"$set": {
+                "status": "assembling",
+                "assembleLeaseExpiresAt": now + timedelta(seconds=ASSEMBLE_LEASE_SECONDS),
+                "updatedAt": now,
+                "expiresAt": self._expires_at(now)
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def finish(self, upload_id, result):
+        """上传完成，保存返回给客户端的结果（重复的complete请求直接返回该结果）"""
+        now = datetime.now()
+        self.collection.update_one(
+            {"_id": upload_id},
+            {"$set": {"status": "completed", "result": result, "chunks": [], "updatedAt": now,
+                      "expiresAt": self._expires_at(now)}}
+        )
+
+    def fail(self, upload_id, message):
+        """上传失败（大小或SHA-256与声明的不一致），客户端需要重新初始化上传"""
+        now = datetime.now()
+        self.collection.update_one(
+            {"_id": upload_id},
+            {"$set": {"status": "failed", "message": message, "chunks": [], "updatedAt": now,
+                      "expiresAt": self._expires_at(now)}}
+        )
+
+    def delete(self, upload_id):
+        self.collection.delete_one({"_id": upload_id})
@@ -2,6 +2,22 @@
 输入验证模块
 """
 
+# 医学图像（MRI/CT）允许的扩展名
+IMAGE_EXTENSIONS = {"dcm", "jpg", "jpeg", "png"}
+
+# 各扩展名的文件开头特征字节: [(偏移量, 字节)]
+FILE_SIGNATURES = {
+    "pdf": [(0, b"%PDF-")],
+    "jpg": [(0, b"\xff\xd8\xff")],
+    "jpeg": [(0, b"\xff\xd8\xff")],
+    "png": [(0, b"\x89PNG\r\n\x1a\n")],
+    # DICOM文件在128字节的前导区之后是"DICM"标记
+    "dcm": [(128, b"DICM")],
+}
+
+# 检查特征字节需要读取的文件开头字节数
+SIGNATURE_BYTES = max(offset + len(magic) for signatures in FILE_SIGNATURES.values() for offset, magic in signatures)
+
 def validate_basic_info(data):
     """
     验证用户基本信息
@@ -143,7 +159,7 @@ def validate_image_file(file, image_type):
         return False, "文件名不能为空"
     
     # 检查文件扩展名 - 医学图像通常为DICOM格式(.dcm)或常见图像格式
-    allowed_extensions = {"dcm", "jpg", "jpeg", "png"}
+    allowed_extensions = IMAGE_EXTENSIONS
     file_ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
     
     if file_ext not in allowed_extensions:
@@ -152,4 +168,71 @@ def validate_image_file(file, image_type):
     # TODO: 可以在这里添加更多的图像验证逻辑
     # 例如检查图像尺寸、格式等
     
-    return True, "" 
\ No newline at end of file
+    return True, ""
+
+def validate_file_signature(head, filename):
+    """
+    按文件开头的字节检查文件内容与扩展名是否一致（扩展名可以随意修改，内容不行）
+
+    Args:
+        head (bytes): 文件开头的字节（至少SIGNATURE_BYTES个，文件更短时为整个文件）
+        filename (str): 原始文件名
+
+    Returns:
+        tuple: (是否有效, 错误信息)
+    """
+    file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    signatures = FILE_SIGNATURES.get(file_ext)
+    if signatures is None:
+        return False, f"不支持的文件格式: {file_ext}"
+
+    for offset, magic in signatures:
+        if head[offset:offset + len(magic)] == magic:
+            return True, ""
+
+    return False, f"文件内容不是有效的{file_ext.upper()}文件"
+
+def validate_upload_init(data):
+    """
+    验证分块上传的初始化请求
+
+    Args:
+        data (dict): userId、fileName、fileSize、kind（record或image），kind为image时还有imageType，
+            可选的sha256（整个文件的SHA-256，完成上传时核对）
+
+    Returns:
+        tuple: (是否有效, 错误信息)
+    """
+    import config
+
+    if not data.get('userId'):
+        return False, "用户ID不能为空"
+
+    kind = data.get('kind', 'record')
+    if kind not in ['record', 'image']:
+        return False, "上传类型必须是'record'或'image'"
+
+    if kind == 'image' and data.get('imageType') not in ['MRI', 'CT']:
+        return False, "图像类型必须是'MRI'或'CT'"
+
+    filename = data.get('fileName')
+    if not filename or not isinstance(filename, str):
+        return False, "文件名不能为空"
+
+    allowed_extensions = IMAGE_EXTENSIONS if kind == 'image' else config.ALLOWED_EXTENSIONS
+    file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    if file_ext not in allowed_extensions:
+        return False, f"只允许上传以下格式的文件: {', '.join(allowed_extensions)}"
+
+    file_size = data.get('fileSize')
+    if not isinstance(file_size, int) or isinstance(file_size, bool) or file_size <= 0:
+        return False, "文件大小必须是正整数"
+    if file_size > config.UPLOAD_MAX_FILE_SIZE:
+        return False, f"文件不能超过 {config.UPLOAD_MAX_FILE_SIZE // (1024 * 1024)} MB"
+
+    sha256 = data.get('sha256')
+    if sha256 is not None:
+        if not isinstance(sha256, str) or len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256.lower()):
+            return False, "sha256必须是64位十六进制字符串"
+
+    return True, ""
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+检测任务工作进程 - 从任务队列领取风险计算、图像检测和可视化渲染任务并执行
+
+可以在任意数量的进程或节点上运行，任务通过MongoDB中的jobs集合原子地分配。
+每个通道的工作线程数来自config.py中的JOB_LANES；单独部署工作进程时，
+把JOB_EMBEDDED_WORKERS设为False，Web进程只负责提交任务。
+
+用法:
+    python worker.py
+    python worker.py --lanes image render --threads 2
+"""
+import argparse
+import sys
+
+import config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检测任务工作进程")
+    parser.add_argument("--lanes", nargs="+", choices=list(config.JOB_LANES), help="只执行这些通道的任务，默认全部")
+    parser.add_argument("--threads", type=int, help="每个通道的执行线程数，默认使用JOB_LANES中的配置")
+    args = parser.parse_args()
+
+    if config.JOB_QUEUE_BACKEND != "mongo":
+        print(f"错误: 任务队列为 {config.JOB_QUEUE_BACKEND}，独立的工作进程需要使用mongo任务队列")
+        return 1
+
+    # 复用Web应用中的数据库连接、模型和任务处理函数
+    from hello import create_job_workers
+    from job_queue import run_workers
+
+    run_workers(create_job_workers(lanes=args.lanes, threads=args.threads))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
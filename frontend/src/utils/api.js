@@ -155,6 +155,28 @@ const detectApi = {
     return request(`api/detect/status?userId=${userId}`);
   },
 
+  /**
+   * 长轮询检测进度：等待序号大于after的进度事件，超时返回当前进度
+   * @param {String} userId - 用户ID
+   * @param {Number} after - 上一次收到的进度序号，-1表示立即返回当前进度
+   * @param {Number} timeout - 服务端最长等待秒数
+   * @returns {Promise}
+   */
+  waitStatus(userId, after = -1, timeout = 25) {
+    return request(`api/detect/wait?userId=${userId}&after=${after}&timeout=${timeout}`, {
+      timeout: (timeout + 10) * 1000
+    });
+  },
+
+  /**
+   * 检测进度事件流（SSE）地址，用于EventSource
+   * @param {String} userId - 用户ID
+   * @returns {String}
+   */
+  eventsUrl(userId) {
+    return `${BASE_URL}api/detect/events?userId=${encodeURIComponent(userId)}`;
+  },
+
   /**
    * 获取检测报告
    * @param {String} userId - 用户ID